@@ -0,0 +1,261 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from config import AdmissionConfig, ModelConfig, PRIORITY_CLASSES
+from metrics import (ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_WAIT, ADMISSION_REJECTED,
+                     ADMISSION_TENANT_QUEUE_DEPTH, ADMISSION_TENANT_WAIT)
+
+_PRIORITY_NAMES = {value: name for name, value in PRIORITY_CLASSES.items()}
+
+
+class Flow(NamedTuple):
+    """同一优先级内公平分享名额的单位：一个租户，或一个未配置租户的API token"""
+    name: str                 # 租户名，未配置租户时为token的哈希
+    weight: float = 1.0
+    label: str = "other"      # 指标中的租户标签，未配置租户的调用方统一为other，限制标签数量
+
+
+DEFAULT_FLOW = Flow("default")
+
+
+class AdmissionRejected(Exception):
+    """请求未获准入：队列已满(429)或排队超时(503)"""
+
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """准入凭证，请求处理结束（包括流式响应结束）时释放，重复释放无副作用"""
+
+    __slots__ = ("_admission", "_acquired_at", "_released")
+
+    def __init__(self, admission: Optional["ModelAdmission"]):
+        self._admission = admission
+        self._acquired_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._admission is not None:
+            self._admission.release(time.monotonic() - self._acquired_at)
+
+
+class ModelAdmission:
+    """
+    单个模型的准入控制
+
+    同时处理的请求数不超过max_concurrency，超出的请求按优先级排队；队列满时立即拒绝，
+    排队超过queue_timeout拒绝。释放时直接把名额交给队首请求。
+    多worker时每个worker分得 max_concurrency / workers（向上取整）个名额。
+
+    同一优先级内按流（租户）做start-time fair queueing：每个请求的开始标签为
+    max(该优先级的虚拟时间, 该流上一个请求的结束标签)，结束标签为开始标签 + 1/权重，
+    按开始标签出队，出队时虚拟时间推进到该请求的开始标签。积压大量请求的租户只会推后自己的请求，
+    新到达的其他租户的请求排在它积压的请求之前；各租户持续排队时按权重比例获得名额。
+    """
+
+    def __init__(self, model_name: str, config: AdmissionConfig, workers: int = 1):
+        self.model_name = model_name
+        self.config = config
+        self.workers = max(1, workers)
+        self.in_flight = 0
+        # (优先级, 开始标签, 序号, future, 租户标签)；超时或取消的future留在堆中，出队时跳过，
+        # 超过堆的一半时重建堆（见_compact）
+        self._queue: List[Tuple[int, float, int, asyncio.Future, str]] = []
+        self._waiting = 0
+        self._seq = itertools.count()
+        # 各优先级的虚拟时间，(优先级, 流) -> 该流最后一个请求的结束标签
+        self._virtual_time: Dict[int, float] = {}
+        self._finish: Dict[Tuple[int, str], float] = {}
+        # 租户标签 -> 排队数
+        self._tenant_waiting: Dict[str, int] = {}
+        # 请求占用名额时长的指数加权平均，用于估算Retry-After
+        self._avg_hold = 1.0
+
+    @property
+    def limit(self) -> int:
+        """本worker的并发上限，0表示不限制"""
+        if self.config.max_concurrency <= 0:
+            return 0
+        return math.ceil(self.config.max_concurrency / self.workers)
+
+    def _has_capacity(self) -> bool:
+        return self.limit <= 0 or self.in_flight < self.limit
+
+    async def acquire(self, priority: int = PRIORITY_CLASSES["normal"], flow: Flow = DEFAULT_FLOW) -> AdmissionTicket:
+        priority_name = _PRIORITY_NAMES.get(priority, str(priority))
+        if self._has_capacity() and self._waiting == 0:
+            self._admit()
+            ADMISSION_WAIT.observe(0.0, self.model_name, priority_name)
+            ADMISSION_TENANT_WAIT.observe(0.0, self.model_name, flow.label)
+            return AdmissionTicket(self)
+
+        if self._waiting >= self.config.max_queue:
+            ADMISSION_REJECTED.inc(self.model_name, "queue_full")
+            raise AdmissionRejected(429, "Too many queued requests", self._retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, self._start_tag(priority, flow), next(self._seq), future, flow.label))
+        self._waiting += 1
+        self._tenant_queued(flow.label, 1)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.config.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 名额已经交给本请求，但本请求不再需要，转交下一个
+                self.release(None)
+            else:
+                future.cancel()
+                self._waiting -= 1
+                self._tenant_queued(flow.label, -1)
+                self._compact()
+            if isinstance(e, asyncio.TimeoutError):
+                ADMISSION_REJECTED.inc(self.model_name, "queue_timeout")
+                raise AdmissionRejected(503, "Queue timeout", self._retry_after())
+            raise
+        wait = time.monotonic() - start
+        ADMISSION_WAIT.observe(wait, self.model_name, priority_name)
+        ADMISSION_TENANT_WAIT.observe(wait, self.model_name, flow.label)
+        return AdmissionTicket(self)
+
+    def _compact(self):
+        """
+        已超时或取消的条目超过堆的一半时只保留等待中的条目并重建堆
+
+        名额长时间不释放时drain不会运行，超时的条目不重建就会在堆中无限累积；
+        每次重建至少清除一半条目，均摊到每次取消为O(1)。
+        """
+        if len(self._queue) - self._waiting > len(self._queue) // 2:
+            self._queue = [entry for entry in self._queue if not entry[3].done()]
+            heapq.heapify(self._queue)
+
+    def _start_tag(self, priority: int, flow: Flow) -> float:
+        """分配请求的开始标签，并把该流的结束标签推进1/权重"""
+        key = (priority, flow.name)
+        start = max(self._virtual_time.get(priority, 0.0), self._finish.get(key, 0.0))
+        self._finish[key] = start + 1.0 / flow.weight
+        return start
+
+    def _tenant_queued(self, label: str, delta: int):
+        waiting = self._tenant_waiting.get(label, 0) + delta
+        if waiting:
+            self._tenant_waiting[label] = waiting
+        else:
+            self._tenant_waiting.pop(label, None)
+        ADMISSION_QUEUE_DEPTH.set(self._waiting, self.model_name)
+        ADMISSION_TENANT_QUEUE_DEPTH.set(waiting, self.model_name, label)
+
+    def _admit(self):
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight, self.model_name)
+
+    def release(self, hold_time: Optional[float]):
+        """释放名额，hold_time为本次占用时长（秒）"""
+        if hold_time is not None:
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * hold_time
+        self.in_flight -= 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight, self.model_name)
+        self.drain()
+
+    def drain(self):
+        """有空余名额时按优先级、开始标签唤醒排队的请求"""
+        while self._queue and self._has_capacity():
+            priority, start, _, future, label = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            self._virtual_time[priority] = start
+            self._waiting -= 1
+            self._tenant_queued(label, -1)
+            self._admit()
+            future.set_result(None)
+        if not self._queue:
+            # 队列清空后各流重新从0开始，不保留历史
+            self._virtual_time.clear()
+            self._finish.clear()
+        elif len(self._finish) > 2 * self.config.max_queue + 64:
+            # 结束标签不超过虚拟时间的流与没有记录的流等价，删除以限制内存
+            for key in [key for key, finish in self._finish.items()
+                        if finish <= self._virtual_time.get(key[0], 0.0)]:
+                del self._finish[key]
+
+    def _retry_after(self) -> int:
+        """按平均占用时长估算排在队尾的请求需要等待的秒数"""
+        concurrency = max(1, self.limit)
+        return max(1, math.ceil(self._avg_hold * (self._waiting + 1) / concurrency))
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.limit,
+            "in_flight": self.in_flight,
+            "queued": self._waiting,
+            "queued_by_tenant": dict(self._tenant_waiting),
+        }
+
+
+class AdmissionController:
+    """按模型管理准入控制，workers为共同分担并发限制的worker进程数"""
+
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self._models: Dict[str, ModelAdmission] = {}
+
+    def for_model(self, model_config: ModelConfig) -> ModelAdmission:
+        """获取模型的准入控制，不存在时按model_config创建；已有的只由sync()按新配置更新"""
+        admission = self._models.get(model_config.model_name)
+        if admission is None:
+            admission = ModelAdmission(model_config.model_name, model_config.admission, self.workers)
+            self._models[model_config.model_name] = admission
+        return admission
+
+    def sync(self, model_configs: Mapping[str, ModelConfig]):
+        """配置更新后立即应用新的并发限制，移除已删除且空闲的模型"""
+        for model_name, admission in list(self._models.items()):
+            model_config = model_configs.get(model_name)
+            if model_config is not None:
+                if admission.config != model_config.admission:
+                    # 配置变更后按新的限制生效，已占用名额不受影响
+                    admission.config = model_config.admission
+                    admission.drain()
+            elif admission.in_flight == 0 and admission._waiting == 0:
+                del self._models[model_name]
+
+    async def acquire(self, model_config: ModelConfig, priority: int = PRIORITY_CLASSES["normal"],
+                      flow: Flow = DEFAULT_FLOW) -> AdmissionTicket:
+        admission = self._models.get(model_config.model_name)
+        if admission is None:
+            if model_config.admission.max_concurrency <= 0:
+                # 未限制并发的模型不做任何记录
+                return AdmissionTicket(None)
+            admission = self.for_model(model_config)
+        # 已有的准入控制按sync()应用的最新配置判断，不使用请求的旧配置快照
+        return await admission.acquire(priority, flow)
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: admission.stats() for name, admission in self._models.items()}
+
+
+admission_controller: Optional[AdmissionController] = None
+
+
+def init_admission_controller(workers: int = 1) -> AdmissionController:
+    global admission_controller
+    admission_controller = AdmissionController(workers)
+    return admission_controller
+
+
+def get_admission_controller() -> AdmissionController:
+    global admission_controller
+    if admission_controller is None:
+        raise RuntimeError("准入控制未初始化")
+    return admission_controller
@@ -1,13 +1,84 @@
-from argparse import ArgumentParser
+import os
+import tempfile
+from argparse import ArgumentParser, Namespace
+from typing import List, Optional
 
 
-def parse_args():
+def parse_args(argv: Optional[List[str]] = None):
     parser = ArgumentParser()
     parser.add_argument("--auth-url", type=str, required=True)
     parser.add_argument("--base-url", type=str, required=True)
     parser.add_argument("--config-path", type=str, default="config.json")
     parser.add_argument("--port", type=int, default=8000)
     parser.add_argument("--host", type=str, default="0.0.0.0")
-    parser.add_argument("--timeout", type=int, default=300)
+    parser.add_argument("--timeout", type=int, default=300, help="请求总时长上限（秒），模型未配置timeout.total时使用，0表示不限制")
+    parser.add_argument("--auth-cache-ttl", type=float, default=60.0, help="认证通过结果缓存时间（秒）")
+    parser.add_argument("--auth-negative-ttl", type=float, default=5.0, help="认证失败结果缓存时间（秒）")
+    parser.add_argument("--auth-cache-size", type=int, default=10000, help="认证结果缓存的最大token数")
+    parser.add_argument("--auth-max-concurrency", type=int, default=32, help="同时发往认证服务的最大请求数")
+    parser.add_argument("--rate-limit-backend", type=str, default="memory", choices=["memory", "shm", "redis"],
+                        help="限流状态存储：memory（单进程）、shm（同节点多进程共享）、redis（多节点共享）")
+    parser.add_argument("--rate-limit-shm-path", type=str, default="/tmp/maas_gateway_ratelimit.shm",
+                        help="shm限流后端的共享内存文件路径")
+    parser.add_argument("--rate-limit-max-keys", type=int, default=100000, help="限流状态最多保存的key数")
+    parser.add_argument("--redis-url", type=str, default=None, help="redis限流后端地址，如 redis://localhost:6379/0")
+    parser.add_argument("--config-reload-interval", type=float, default=5.0,
+                        help="检查配置文件变化的间隔（秒），0表示只在收到SIGHUP时重新加载")
+    parser.add_argument("--log-file", type=str, default="model_gateway.log", help="日志文件路径")
+    parser.add_argument("--log-level", type=str, default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--log-max-bytes", type=int, default=100 * 1024 * 1024,
+                        help="日志文件轮转大小（字节），0表示不轮转")
+    parser.add_argument("--log-backup-count", type=int, default=5, help="保留的历史日志文件数")
+    parser.add_argument("--log-body-sample-rate", type=float, default=0.0,
+                        help="记录请求体预览的请求比例（0~1）")
+    parser.add_argument("--metrics-dir", type=str, default=None,
+                        help="多worker指标汇总目录，各worker定期写入指标快照，/metrics 输出汇总值")
+    parser.add_argument("--metrics-flush-interval", type=float, default=1.0, help="写入指标快照的间隔（秒）")
+    parser.add_argument("--cache-max-bytes", type=int, default=64 * 1024 * 1024, help="响应缓存内存上限（字节）")
+    parser.add_argument("--cache-max-entry-bytes", type=int, default=1024 * 1024, help="单个响应可缓存的最大字节数")
+    parser.add_argument("--cache-dir", type=str, default=None, help="磁盘缓存目录，不指定则只使用内存缓存")
+    parser.add_argument("--cache-disk-max-bytes", type=int, default=1024 * 1024 * 1024, help="磁盘缓存上限（字节）")
+    parser.add_argument("--compression", type=str, default="zstd,br,gzip",
+                        help="响应压缩可用的编码（按优先顺序，逗号分隔），为空时不压缩；未安装brotli/zstandard时跳过对应编码")
+    parser.add_argument("--compression-min-bytes", type=int, default=1024,
+                        help="非流式响应小于该字节数时不压缩（SSE流式响应总是压缩）")
+    parser.add_argument("--max-decompressed-bytes", type=int, default=32 * 1024 * 1024,
+                        help="压缩的请求体解压后的大小上限（字节），与模型的max_body_bytes取较小值，0表示只按max_body_bytes限制")
+    parser.add_argument("--usage-sink", type=str, default=None,
+                        help="用量记录写入目标：jsonl:<path>、sqlite:<path> 或 http(s)://<收集服务地址>，不指定则只在内存中按分钟汇总")
+    parser.add_argument("--usage-buffer-size", type=int, default=100000,
+                        help="待写入用量记录的缓冲区大小，写入跟不上时丢弃最旧的记录")
+    parser.add_argument("--usage-batch-size", type=int, default=1000, help="每批写入的用量记录数")
+    parser.add_argument("--usage-flush-interval", type=float, default=1.0, help="写入用量记录的间隔（秒）")
+    parser.add_argument("--usage-retention-minutes", type=int, default=1440,
+                        help="/usage 查询的分钟汇总保留时间（分钟）")
+    parser.add_argument("--capture-file", type=str, default=None,
+                        help="流量采集文件（JSONL），指定后按采样比例记录 /v1/ 请求，用 replay.py 重放")
+    parser.add_argument("--capture-sample-rate", type=float, default=1.0, help="流量采集的请求比例（0~1）")
+    parser.add_argument("--capture-max-body-bytes", type=int, default=1024 * 1024,
+                        help="请求体超过该字节数的请求不采集")
+    parser.add_argument("--capture-max-file-bytes", type=int, default=1024 * 1024 * 1024,
+                        help="流量采集文件达到该字节数后停止采集")
+    parser.add_argument("--workers", type=int, default=1, help="worker进程数，大于1时以多进程方式运行")
+    parser.add_argument("--graceful-timeout", type=int, default=30,
+                        help="收到SIGTERM后等待在途请求（包括流式响应）完成的最长时间（秒）")
     
-    return parser.parse_args()
\ No newline at end of file
+    return parser.parse_args(argv)
+
+
+def apply_worker_defaults(args: Namespace) -> Namespace:
+    """
+    多worker时调整只适用于单进程的参数
+
+    - memory限流后端改为shm，限流状态在同节点的worker之间共享
+    - 未指定 --metrics-dir 时使用按端口区分的临时目录，/metrics 输出所有worker的汇总
+    - 多个进程写同一个日志文件时不能各自按大小轮转，改为由外部工具（如logrotate）轮转
+    """
+    if args.workers <= 1:
+        return args
+    if args.rate_limit_backend == "memory":
+        args.rate_limit_backend = "shm"
+    if not args.metrics_dir:
+        args.metrics_dir = os.path.join(tempfile.gettempdir(), f"maas_gateway_metrics_{args.port}")
+    args.log_max_bytes = 0
+    return args
\ No newline at end of file
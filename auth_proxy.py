@@ -1,26 +1,126 @@
-from fastapi import HTTPException, Request, requests
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import aiohttp
+from fastapi import HTTPException, Request
+
+from log import logger
+
+
+class AuthBackendError(Exception):
+    """认证服务不可用（超时、连接失败、5xx），结果不进入缓存"""
+
 
 class AuthProxy:
-    def __init__(self, auth_url: str):
+    """
+    认证代理
+
+    - 使用长连接池异步调用认证服务，不阻塞事件循环
+    - 按token缓存认证结果（TTL + LRU），有效结果与无效结果分别设置缓存时间
+    - 同一token并发到达时只向认证服务发起一次请求（single-flight）
+    - 限制同时发往认证服务的请求数
+    """
+
+    def __init__(self, auth_url: str, cache_ttl: float = 60.0, negative_ttl: float = 5.0,
+                 cache_size: int = 10000, max_concurrency: int = 32, timeout: float = 5.0):
         self.auth_url = auth_url
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.cache_size = cache_size
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._cache: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._session: Optional[aiohttp.ClientSession] = None
 
-    def auth(self, request: Request):
+    async def auth(self, request: Request):
         auth_header = request.headers.get("Authorization")
         if not auth_header:
             raise HTTPException(status_code=401, detail="Unauthorized")
-        
+
         # 获取token 并验证
-        token = auth_header.split(" ")[1]
+        _, _, token = auth_header.partition(" ")
+        token = token.strip()
         if not token:
             raise HTTPException(status_code=401, detail="Unauthorized")
-        
-        response = requests.post(self.auth_url, params={"token": token})
-        if response.status_code != 200:
-            raise HTTPException(status_code=401, detail="Unauthorized")
-        
-        # 验证token是否有效
-        if response.json().get("code") != 0:
+
+        if not await self.verify(token):
             raise HTTPException(status_code=401, detail="Unauthorized")
-        
+
         return True
-    
\ No newline at end of file
+
+    async def verify(self, token: str) -> bool:
+        """验证token，优先使用缓存；同一token的并发请求共享一次认证调用"""
+        cached = self._cache_get(token)
+        if cached is not None:
+            return cached
+
+        task = self._inflight.get(token)
+        if task is None:
+            task = asyncio.ensure_future(self._verify_remote(token))
+            self._inflight[token] = task
+            task.add_done_callback(lambda t, token=token: self._on_verified(token, t))
+        # shield: 某个等待者被取消（客户端断开）不影响其他等待者
+        return await asyncio.shield(task)
+
+    def _on_verified(self, token: str, task: asyncio.Task):
+        self._inflight.pop(token, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            # 认证服务异常不缓存，下次请求重新认证
+            return
+        self._cache_put(token, task.result())
+
+    async def _verify_remote(self, token: str) -> bool:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            try:
+                async with self._get_session().post(self.auth_url, params={"token": token}) as response:
+                    if response.status >= 500:
+                        raise AuthBackendError(f"认证服务返回 {response.status}")
+                    if response.status != 200:
+                        return False
+                    # 验证token是否有效
+                    data = await response.json(content_type=None)
+                    return isinstance(data, dict) and data.get("code") == 0
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise AuthBackendError(f"认证服务请求失败: {e}") from e
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    def _cache_get(self, token: str) -> Optional[bool]:
+        entry = self._cache.get(token)
+        if entry is None:
+            return None
+        valid, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._cache[token]
+            return None
+        self._cache.move_to_end(token)
+        return valid
+
+    def _cache_put(self, token: str, valid: bool):
+        ttl = self.cache_ttl if valid else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._cache[token] = (valid, time.monotonic() + ttl)
+        self._cache.move_to_end(token)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def close(self):
+        """关闭认证服务连接池"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("关闭认证服务连接池")
+        self._session = None
@@ -0,0 +1,338 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import random
+import time
+from typing import Dict, List, Mapping, Optional, Sequence
+
+import aiohttp
+
+from body import RequestBody
+from config import BalancerConfig, ModelConfig
+from log import logger
+from metrics import AFFINITY_ROUTING, BALANCER_EJECTIONS
+
+# 延迟指数加权平均的权重
+EWMA_ALPHA = 0.3
+# ewma策略：失败请求按 max(本次延迟, 副本集合平均延迟) x EWMA_FAILURE_MULTIPLIER 计入延迟，
+# 至少EWMA_FAILURE_LATENCY秒，避免快速失败的副本因延迟低而吸引更多流量
+EWMA_FAILURE_MULTIPLIER = 5
+EWMA_FAILURE_LATENCY = 1.0
+# 剔除时长相对ejection_time的最大倍数
+MAX_EJECTION_MULTIPLIER = 10
+# prefix_affinity：没有messages的请求按prompt开头的多少个字符计算前缀
+AFFINITY_PROMPT_CHARS = 4096
+
+
+def affinity_key(request_body: RequestBody, messages: int) -> Optional[bytes]:
+    """请求前缀（前messages条消息，或prompt的开头）的摘要，没有可用的前缀时返回None"""
+    try:
+        data = request_body.data
+    except ValueError:
+        return None
+    prefix = data.get("messages")
+    if isinstance(prefix, list) and prefix:
+        prefix = prefix[:messages]
+    else:
+        prompt = data.get("prompt")
+        if not isinstance(prompt, str) or not prompt:
+            return None
+        prefix = prompt[:AFFINITY_PROMPT_CHARS]
+    canonical = json.dumps([data.get("model"), prefix], sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).digest()
+
+
+def _rendezvous(key: bytes, url: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key + url.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class Replica:
+    """单个上游副本的运行状态"""
+
+    __slots__ = ("url", "outstanding", "ewma", "failures", "ejections", "ejected_until",
+                 "healthy", "probe_failures")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0            # 正在处理的请求数
+        self.ewma: Optional[float] = None  # 请求延迟（秒，失败按惩罚值计）的指数加权平均
+        self.failures = 0               # 连续请求失败次数
+        self.ejections = 0              # 恢复成功前的连续剔除次数
+        self.ejected_until = 0.0        # 被动剔除截止时间（monotonic）
+        self.healthy = True             # 主动健康检查结果
+        self.probe_failures = 0         # 连续健康检查失败次数
+
+    def available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+    def stats(self, now: float) -> dict:
+        return {
+            "url": self.url,
+            "outstanding": self.outstanding,
+            "ewma_latency": self.ewma,
+            "healthy": self.healthy,
+            "ejected": now < self.ejected_until,
+            "consecutive_failures": self.failures,
+        }
+
+
+class ReplicaPool:
+    """
+    单个模型的副本集合
+
+    choose按策略从可用副本（主动检查健康且未被剔除）中选择一个，
+    全部不可用时退化为在所有副本中选择，避免因误判导致模型完全不可用。
+    """
+
+    def __init__(self, model_name: str, urls: List[str], config: BalancerConfig):
+        self.model_name = model_name
+        self.config = config
+        self.replicas = [Replica(url) for url in urls]
+        self._rr = itertools.count()
+
+    def update(self, urls: List[str], config: BalancerConfig):
+        """更新副本列表和配置，保留仍在列表中的副本的状态"""
+        existing = {replica.url: replica for replica in self.replicas}
+        self.replicas = [existing.get(url) or Replica(url) for url in urls]
+        self.config = config
+
+    def affinity(self, request_body: RequestBody) -> Optional[bytes]:
+        """prefix_affinity策略下请求前缀的摘要，作为choose的key；其他策略返回None"""
+        if self.config.policy != "prefix_affinity" or len(self.replicas) < 2:
+            return None
+        return affinity_key(request_body, self.config.affinity_messages)
+
+    def choose(self, exclude: Sequence[Replica] = (), key: Optional[bytes] = None) -> Replica:
+        """
+        选择一个副本并计入其正在处理的请求数，调用方处理结束后必须调用release
+
+        exclude为本次请求已经尝试过的副本（重试、对冲请求时优先选择其他副本），
+        key为prefix_affinity策略下请求前缀的摘要（见affinity）。
+        """
+        now = time.monotonic()
+        candidates = [replica for replica in self.replicas if replica.available(now)] or self.replicas
+        if exclude:
+            candidates = [replica for replica in candidates if replica not in exclude] or candidates
+        policy = self.config.policy
+        if len(candidates) == 1:
+            replica = candidates[0]
+        elif policy == "least_outstanding":
+            replica = self._least_outstanding(candidates)
+        elif policy == "prefix_affinity":
+            replica = self._by_affinity(candidates, key)
+        elif policy == "power_of_two":
+            a, b = random.sample(candidates, 2)
+            replica = a if a.outstanding <= b.outstanding else b
+        elif policy == "ewma":
+            replica = self._by_ewma(candidates)
+        else:
+            replica = candidates[next(self._rr) % len(candidates)]
+        replica.outstanding += 1
+        return replica
+
+    def _least_outstanding(self, candidates: List[Replica]) -> Replica:
+        # 从轮询位置开始找最小值，空闲时不会总落在第一个副本上
+        start = next(self._rr) % len(candidates)
+        rotated = candidates[start:] + candidates[:start]
+        return min(rotated, key=lambda r: r.outstanding)
+
+    def _by_ewma(self, candidates: List[Replica]) -> Replica:
+        """
+        按 延迟 x (在途请求数+1) 选择
+
+        还没有延迟样本的副本（新加入或刚启动）按副本集合的平均延迟计算，既能分到流量，
+        又不会因为视为零延迟而吸走所有请求；所有副本都没有样本时选择在途请求最少的副本。
+        """
+        seed = self._mean_ewma()
+        if seed is None:
+            return self._least_outstanding(candidates)
+        return min(candidates, key=lambda r: (seed if r.ewma is None else r.ewma) * (r.outstanding + 1))
+
+    def _mean_ewma(self) -> Optional[float]:
+        samples = [replica.ewma for replica in self.replicas if replica.ewma is not None]
+        return sum(samples) / len(samples) if samples else None
+
+    def _observe(self, replica: Replica, latency: float):
+        replica.ewma = latency if replica.ewma is None else (
+            EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * replica.ewma)
+
+    def _by_affinity(self, candidates: List[Replica], key: Optional[bytes]) -> Replica:
+        """
+        rendezvous哈希：相同前缀的请求优先发往同一副本，复用上游的前缀（KV）缓存
+
+        按hash(前缀, 副本地址)从高到低选择第一个未过载的可用副本，过载指在途请求数达到
+        affinity_load_factor x 平均在途请求数（向上取整）。副本增减或被剔除时，
+        只有原本落在该副本上的前缀改变去向。没有前缀的请求选择在途请求最少的副本。
+        """
+        if key is None:
+            AFFINITY_ROUTING.inc(self.model_name, "none")
+            return self._least_outstanding(candidates)
+        ranked = sorted(self.replicas, key=lambda r: _rendezvous(key, r.url), reverse=True)
+        total = sum(replica.outstanding for replica in candidates)
+        limit = math.ceil(self.config.affinity_load_factor * (total + 1) / len(candidates))
+        for replica in ranked:
+            if replica in candidates and replica.outstanding < limit:
+                AFFINITY_ROUTING.inc(self.model_name, "hit" if replica is ranked[0] else "fallback")
+                return replica
+        AFFINITY_ROUTING.inc(self.model_name, "fallback")
+        return self._least_outstanding(candidates)
+
+    def release(self, replica: Replica, latency: Optional[float] = None, failed: bool = False):
+        """
+        请求结束，latency为请求的延迟（秒），失败的请求可以不提供
+
+        failed表示连接错误或上游5xx，按惩罚延迟计入EWMA（见EWMA_FAILURE_MULTIPLIER），
+        连续失败max_failures次后剔除该副本一段时间。
+        """
+        replica.outstanding -= 1
+        if not failed:
+            replica.failures = 0
+            replica.ejections = 0
+            if latency is not None:
+                self._observe(replica, latency)
+            return
+
+        baseline = max(latency or 0.0, self._mean_ewma() or 0.0)
+        self._observe(replica, max(baseline * EWMA_FAILURE_MULTIPLIER, EWMA_FAILURE_LATENCY))
+        replica.failures += 1
+        if self.config.max_failures > 0 and replica.failures >= self.config.max_failures:
+            multiplier = min(2 ** replica.ejections, MAX_EJECTION_MULTIPLIER)
+            replica.ejected_until = time.monotonic() + self.config.ejection_time * multiplier
+            replica.ejections += 1
+            replica.failures = 0
+            BALANCER_EJECTIONS.inc(self.model_name, replica.url)
+            logger.warning(f"剔除上游副本: {self.model_name} {replica.url} "
+                           f"{self.config.ejection_time * multiplier:.0f}s")
+
+    def abandon(self, replica: Replica):
+        """请求被取消（对冲落败、客户端断开或超时），没有结果，只减少在途请求数，不更新副本健康状态"""
+        replica.outstanding -= 1
+
+    async def probe(self, session: aiohttp.ClientSession):
+        """对所有副本做一次主动健康检查"""
+        await asyncio.gather(*(self._probe_replica(session, replica) for replica in self.replicas))
+
+    async def _probe_replica(self, session: aiohttp.ClientSession, replica: Replica):
+        timeout = aiohttp.ClientTimeout(total=self.config.health_check_timeout)
+        try:
+            async with session.get(replica.url + self.config.health_check_path, timeout=timeout) as response:
+                ok = response.status < 400
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+
+        if ok:
+            if not replica.healthy:
+                logger.info(f"上游副本恢复健康: {self.model_name} {replica.url}")
+            replica.healthy = True
+            replica.probe_failures = 0
+            return
+        replica.probe_failures += 1
+        if replica.healthy and replica.probe_failures >= self.config.unhealthy_threshold:
+            replica.healthy = False
+            logger.warning(f"上游副本健康检查失败: {self.model_name} {replica.url}")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "policy": self.config.policy,
+            "replicas": [replica.stats(now) for replica in self.replicas],
+        }
+
+
+class LoadBalancer:
+    """按模型管理副本集合及其健康检查任务"""
+
+    def __init__(self):
+        self._pools: Dict[str, ReplicaPool] = {}
+        self._health_tasks: Dict[str, asyncio.Task] = {}
+        self._probe_session: Optional[aiohttp.ClientSession] = None
+
+    def for_model(self, model_config: ModelConfig) -> ReplicaPool:
+        """
+        获取模型的副本集合，不存在时按model_config创建
+
+        已有的副本集合只由sync()按新配置更新：使用旧配置快照的在途请求（排队、重试、对冲中）
+        不会把副本列表改回旧值。
+        """
+        model_name = model_config.model_name
+        pool = self._pools.get(model_name)
+        if pool is None:
+            pool = ReplicaPool(model_name, model_config.replica_urls(), model_config.balancer)
+            self._pools[model_name] = pool
+        if pool.config.health_check_path and model_name not in self._health_tasks:
+            self._health_tasks[model_name] = asyncio.create_task(self._health_loop(pool))
+        return pool
+
+    def sync(self, model_configs: Mapping[str, ModelConfig]):
+        """
+        按配置创建或更新所有模型的副本集合并启动健康检查，移除已删除模型的副本集合并停止其健康检查
+
+        启动时和配置更新后调用：健康检查不等到模型的第一个请求才开始，
+        首个请求到达前不健康的副本已经被排除。
+        """
+        for model_name, pool in list(self._pools.items()):
+            if model_name not in model_configs:
+                del self._pools[model_name]
+                task = self._health_tasks.pop(model_name, None)
+                if task is not None:
+                    task.cancel()
+        for model_name, model_config in model_configs.items():
+            pool = self._pools.get(model_name)
+            urls = model_config.replica_urls()
+            if pool is not None and (pool.config != model_config.balancer or [r.url for r in pool.replicas] != urls):
+                pool.update(urls, model_config.balancer)
+            self.for_model(model_config)
+
+    async def _health_loop(self, pool: ReplicaPool):
+        try:
+            while pool.config.health_check_path:
+                try:
+                    await pool.probe(self._session())
+                except Exception as e:
+                    logger.error(f"健康检查异常: {pool.model_name} {e}")
+                await asyncio.sleep(pool.config.health_check_interval)
+        finally:
+            if self._health_tasks.get(pool.model_name) is asyncio.current_task():
+                del self._health_tasks[pool.model_name]
+
+    def _session(self) -> aiohttp.ClientSession:
+        # 健康检查使用独立的小连接池，不占用转发请求的连接
+        if self._probe_session is None or self._probe_session.closed:
+            self._probe_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=10))
+        return self._probe_session
+
+    async def close(self):
+        for task in list(self._health_tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._health_tasks.values(), return_exceptions=True)
+        if self._probe_session is not None:
+            await self._probe_session.close()
+            self._probe_session = None
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: pool.stats() for name, pool in self._pools.items()}
+
+
+load_balancer: Optional[LoadBalancer] = None
+
+
+def init_load_balancer() -> LoadBalancer:
+    global load_balancer
+    load_balancer = LoadBalancer()
+    return load_balancer
+
+
+def get_load_balancer() -> LoadBalancer:
+    global load_balancer
+    if load_balancer is None:
+        raise RuntimeError("负载均衡未初始化")
+    return load_balancer
+
+
+async def close_load_balancer():
+    global load_balancer
+    if load_balancer is not None:
+        await load_balancer.close()
+        load_balancer = None
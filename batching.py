@@ -0,0 +1,237 @@
+import asyncio
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from starlette.responses import Response
+
+from body import RequestBody, find_usage, json_dumps, json_loads
+from config import ModelConfig
+from log import logger
+from metrics import BATCH_SIZE, BATCH_WAIT
+
+# 微批返回给每个请求方的结果：(响应体, Content-Type, 该请求方分摊的usage)
+BatchResult = Tuple[bytes, str, Optional[dict]]
+
+
+def split_inputs(value: Any) -> Optional[List[Any]]:
+    """
+    把请求的input拆成独立的输入条目，无法识别时返回None
+
+    字符串和token数组（整数列表）为一条，字符串列表和token数组列表为多条。
+    """
+    if isinstance(value, str):
+        return [value]
+    if not isinstance(value, list) or not value:
+        return None
+    if all(isinstance(item, int) for item in value):
+        return [value]
+    if all(isinstance(item, (str, list)) for item in value):
+        return value
+    return None
+
+
+def split_usage(usage: Optional[dict], weights: List[int]) -> List[Optional[dict]]:
+    """按各请求方输入的长度分摊整批的usage，各项之和与原值相同"""
+    if not isinstance(usage, dict):
+        return [None] * len(weights)
+    total_weight = sum(weights) or len(weights)
+    shares = [dict() for _ in weights]
+    for name, value in usage.items():
+        if not isinstance(value, int):
+            continue
+        remaining = value
+        for i, weight in enumerate(weights):
+            part = value * (weight or 1) // total_weight if i < len(weights) - 1 else remaining
+            shares[i][name] = part
+            remaining -= part
+    return shares
+
+
+class BatchEntry:
+    """一个请求方提交的输入"""
+
+    __slots__ = ("request_body", "inputs", "weight", "future", "arrived_at")
+
+    def __init__(self, request_body: RequestBody, inputs: List[Any]):
+        self.request_body = request_body
+        self.inputs = inputs
+        self.weight = sum(len(item) for item in inputs)
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.arrived_at = time.perf_counter()
+
+
+class PendingBatch:
+    """正在凑批的输入，size为已收集的输入条数"""
+
+    __slots__ = ("key", "model_name", "send", "entries", "size", "timer", "flushed")
+
+    def __init__(self, key: str, model_name: str, send: Callable[[RequestBody], Awaitable[Response]]):
+        self.key = key
+        self.model_name = model_name
+        self.send = send
+        self.entries: List[BatchEntry] = []
+        self.size = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.flushed = False
+
+    def add(self, entry: BatchEntry):
+        self.entries.append(entry)
+        self.size += len(entry.inputs)
+
+    def remove(self, entry: BatchEntry):
+        self.entries.remove(entry)
+        self.size -= len(entry.inputs)
+
+
+class EmbeddingBatcher:
+    """
+    embedding请求微批
+
+    除input外其他字段都相同的请求在max_wait_ms内到达时合并为一次上游请求，
+    凑满max_batch_size条输入时立即发送；上游返回后按顺序把结果拆回各请求方。
+    只有一个请求方的批次原样转发其请求体。
+    """
+
+    def __init__(self):
+        self.pending: Dict[str, PendingBatch] = {}
+        # 发送中的批次，保留引用避免任务被回收
+        self.sending: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def eligible(model_config: ModelConfig, uri: str, request_body: RequestBody) -> bool:
+        """模型开启了微批，且是input可以拆分的非流式embedding请求"""
+        if not model_config.batching.enabled or request_body.stream or not uri.endswith("/embeddings"):
+            return False
+        try:
+            data = request_body.data
+        except ValueError:
+            return False
+        return split_inputs(data.get("input")) is not None
+
+    async def submit(self, uri: str, model_config: ModelConfig, request_body: RequestBody,
+                     send: Callable[[RequestBody], Awaitable[Response]]) -> BatchResult:
+        """
+        提交一个请求并等待其结果
+
+        send用于发送整批请求（由批次中第一个请求方提供），返回上游的200响应，失败时抛出的异常交给批次中所有请求方。
+        """
+        data = request_body.data
+        inputs = split_inputs(data.get("input"))
+        fields = {key: value for key, value in data.items() if key != "input"}
+        key = uri + "\n" + json.dumps(fields, sort_keys=True, ensure_ascii=False)
+        config = model_config.batching
+
+        batch = self.pending.get(key)
+        if batch is not None and batch.size + len(inputs) > config.max_batch_size:
+            self.flush(batch)
+            batch = None
+        if batch is None:
+            batch = PendingBatch(key, model_config.model_name, send)
+            self.pending[key] = batch
+            batch.timer = asyncio.get_running_loop().call_later(config.max_wait_ms / 1000, self.flush, batch)
+        entry = BatchEntry(request_body, inputs)
+        batch.add(entry)
+        if batch.size >= config.max_batch_size:
+            self.flush(batch)
+
+        try:
+            return await entry.future
+        except asyncio.CancelledError:
+            # 还没发送的批次中移除该请求方，已经发送的批次照常完成
+            if not batch.flushed:
+                batch.remove(entry)
+                if not batch.entries:
+                    batch.timer.cancel()
+                    self.discard(batch)
+            raise
+
+    def flush(self, batch: PendingBatch):
+        """停止凑批并发送"""
+        if batch.flushed:
+            return
+        batch.flushed = True
+        batch.timer.cancel()
+        self.discard(batch)
+        if batch.entries:
+            task = asyncio.ensure_future(self._send(batch))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    def discard(self, batch: PendingBatch):
+        if self.pending.get(batch.key) is batch:
+            del self.pending[batch.key]
+
+    async def _send(self, batch: PendingBatch):
+        entries = batch.entries
+        now = time.perf_counter()
+        for entry in entries:
+            BATCH_WAIT.observe(now - entry.arrived_at, batch.model_name)
+        BATCH_SIZE.observe(batch.size, batch.model_name)
+
+        if len(entries) == 1:
+            request_body = entries[0].request_body
+        else:
+            first = entries[0].request_body
+            request_body = RequestBody(first.raw, first.model)
+            request_body.update(input=[item for entry in entries for item in entry.inputs])
+        try:
+            response = await batch.send(request_body)
+            if len(entries) == 1:
+                results = [(response.body, response.media_type, find_usage(response.body))]
+            else:
+                results = self._scatter(response.body, response.media_type, entries)
+        except Exception as e:
+            if len(entries) > 1:
+                logger.warning(f"embedding微批请求失败（{len(entries)}个请求方）: {e}")
+            results = None
+            for entry in entries:
+                if not entry.future.done():
+                    entry.future.set_exception(e)
+        if results is not None:
+            for entry, result in zip(entries, results):
+                if not entry.future.done():
+                    entry.future.set_result(result)
+
+    @staticmethod
+    def _scatter(body: bytes, content_type: str, entries: List[BatchEntry]) -> List[BatchResult]:
+        """把整批响应按输入顺序拆回各请求方，每个请求方的index从0开始"""
+        data = json_loads(body)
+        items = data.get("data") if isinstance(data, dict) else None
+        total = sum(len(entry.inputs) for entry in entries)
+        if not isinstance(items, list) or len(items) != total:
+            raise ValueError(f"upstream returned {len(items) if isinstance(items, list) else 'no'} "
+                             f"embeddings for {total} inputs")
+        if all(isinstance(item, dict) and isinstance(item.get("index"), int) for item in items):
+            items = sorted(items, key=lambda item: item["index"])
+        usages = split_usage(data.get("usage"), [entry.weight for entry in entries])
+        results = []
+        offset = 0
+        for entry, usage in zip(entries, usages):
+            part = [dict(item, index=i) for i, item in enumerate(items[offset:offset + len(entry.inputs)])]
+            offset += len(entry.inputs)
+            result = dict(data, data=part)
+            if usage is not None:
+                result["usage"] = usage
+            results.append((json_dumps(result), content_type, usage))
+        return results
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending_batches": len(self.pending),
+            "pending_inputs": sum(batch.size for batch in self.pending.values()),
+            "sending_batches": len(self.sending),
+        }
+
+
+embedding_batcher: Optional[EmbeddingBatcher] = None
+
+
+def init_embedding_batcher() -> EmbeddingBatcher:
+    global embedding_batcher
+    embedding_batcher = EmbeddingBatcher()
+    return embedding_batcher
+
+
+def get_embedding_batcher() -> Optional[EmbeddingBatcher]:
+    return embedding_batcher
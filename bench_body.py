@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+请求体处理内存分配基准测试
+
+对比旧的模型验证路径（解码 + json.loads + 复制 + 打印 + 转发时重新序列化）
+与快速扫描路径（只提取model/stream，原始bytes原样转发）在不同请求体大小下的
+单请求内存分配峰值和耗时。
+
+用法: python bench_body.py [--sizes 1024,65536,1048576] [--json bench_body.json]
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+from body import parse_request_body
+
+
+def make_body(size: int) -> bytes:
+    """构造约size字节的聊天请求体，内容中英文混合"""
+    unit = "The quick brown fox 跳过了懒狗。"
+    unit_bytes = len(unit.encode("utf-8"))
+    content = unit * max(1, size // unit_bytes)
+    return json.dumps({
+        "model": "deepseek-chat",
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": content},
+        ],
+        "temperature": 0.7,
+        "stream": False,
+    }, ensure_ascii=False).encode("utf-8")
+
+
+def legacy_path(body: bytes) -> bytes:
+    """旧实现：model_validation_middleware + handle_block_request(json=request_data)"""
+    body_str = body.decode("utf-8")
+    preview = f"Request body (first 500 chars): {body_str[:500]}"
+    if body_str.strip() == "" or not body_str.strip().startswith("{"):
+        raise ValueError("invalid body")
+    request_data = json.loads(body_str)
+    printed = f"request_data: {request_data}"
+    state_data = request_data.copy()
+    state_data.get("model")
+    # aiohttp的json=参数使用json.dumps后再编码
+    payload = json.dumps(state_data).encode("utf-8")
+    del preview, printed
+    return payload
+
+
+def fast_path(body: bytes) -> bytes:
+    """新实现：只扫描model/stream，原样转发原始bytes"""
+    preview = f"Request body (first 500 bytes): {body[:500].decode('utf-8', errors='replace')}"
+    request_body = parse_request_body(body)
+    request_body.model
+    del preview
+    return request_body.payload()
+
+
+def measure(func, body: bytes, rounds: int) -> dict:
+    # 预热
+    func(body)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    func(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(body)
+    elapsed = (time.perf_counter() - start) / rounds
+    return {"peak_alloc_bytes": peak - base, "latency_ms": elapsed * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default="1024,65536,1048576,8388608",
+                        help="请求体大小列表（字节），逗号分隔")
+    parser.add_argument("--json", type=str, default=None, help="结果保存路径")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'body size':>12} | {'legacy peak':>12} | {'fast peak':>10} | {'legacy ms':>9} | {'fast ms':>8}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        body = make_body(size)
+        rounds = max(3, min(200, 50_000_000 // max(len(body), 1)))
+        legacy = measure(legacy_path, body, rounds)
+        fast = measure(fast_path, body, rounds)
+        results.append({"body_bytes": len(body), "legacy": legacy, "fast": fast})
+        print(f"{len(body):>12} | {legacy['peak_alloc_bytes']:>12} | {fast['peak_alloc_bytes']:>10} | "
+              f"{legacy['latency_ms']:>9.3f} | {fast['latency_ms']:>8.3f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
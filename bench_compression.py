@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+响应压缩带宽/CPU基准测试
+
+对典型的非流式聊天响应、embedding响应和SSE流式响应（每个分片flush），
+比较各编码（未安装brotli/zstandard时只有gzip）在不同压缩级别下的压缩率和压缩耗时，
+用于选择 --compression 和默认压缩级别。
+
+用法: python bench_compression.py [--completion-tokens 2000] [--embeddings 16] [--dimensions 1536]
+                                  [--json bench_compression.json]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from compression import DEFAULT_LEVELS, available_encodings, create_compressor
+
+# 各编码参与比较的压缩级别
+LEVELS = {"gzip": (1, 5, 9), "br": (1, 4, 8), "zstd": (1, 3, 9)}
+
+
+def completion_body(tokens: int) -> bytes:
+    """非流式聊天响应，内容中英文混合"""
+    words = ["The", "quick", "brown", "fox", "跳过了", "懒狗", "model", "gateway", "请求", "响应"]
+    rng = random.Random(0)
+    text = " ".join(rng.choice(words) for _ in range(tokens))
+    return json.dumps({
+        "id": "chatcmpl-bench", "object": "chat.completion", "created": 1700000000, "model": "deepseek-chat",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 20, "completion_tokens": tokens, "total_tokens": tokens + 20},
+    }, ensure_ascii=False).encode("utf-8")
+
+
+def embedding_body(count: int, dimensions: int) -> bytes:
+    """embedding响应，浮点数向量（压缩率远低于文本）"""
+    rng = random.Random(0)
+    data = [{"object": "embedding", "index": i, "embedding": [round(rng.uniform(-1, 1), 8) for _ in range(dimensions)]}
+            for i in range(count)]
+    return json.dumps({"object": "list", "data": data, "model": "embedding",
+                       "usage": {"prompt_tokens": count * 10, "total_tokens": count * 10}}).encode("utf-8")
+
+
+def sse_chunks(tokens: int) -> list:
+    """流式聊天响应，每个token一个分片"""
+    words = ["The", "quick", "brown", "fox", "跳过了", "懒狗"]
+    chunks = []
+    for i in range(tokens):
+        data = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 1700000000,
+                "model": "deepseek-chat", "choices": [{"index": 0, "delta": {"content": words[i % len(words)] + " "},
+                                                       "finish_reason": None}]}
+        chunks.append(b"data: " + json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n\n")
+    chunks.append(b"data: [DONE]\n\n")
+    return chunks
+
+
+def measure(encoding: str, level: int, chunks: list, flush: bool, rounds: int) -> dict:
+    """压缩chunks（flush为True时每个分片后flush），返回压缩后大小和每次的平均耗时"""
+    def run() -> int:
+        compressor = create_compressor(encoding, level)
+        size = 0
+        for chunk in chunks:
+            size += len(compressor.compress(chunk))
+            if flush:
+                size += len(compressor.flush())
+        return size + len(compressor.finish())
+
+    size = run()
+    start = time.process_time()
+    for _ in range(rounds):
+        run()
+    cpu = (time.process_time() - start) / rounds
+    original = sum(len(chunk) for chunk in chunks)
+    return {"encoding": encoding, "level": level, "original_bytes": original, "compressed_bytes": size,
+            "ratio": original / size, "cpu_ms": cpu * 1000, "mb_per_s": original / cpu / 1e6 if cpu else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--completion-tokens", type=int, default=2000, help="聊天响应的token数")
+    parser.add_argument("--embeddings", type=int, default=16, help="embedding响应中的向量数")
+    parser.add_argument("--dimensions", type=int, default=1536, help="embedding向量维数")
+    parser.add_argument("--json", type=str, default=None, help="结果保存路径")
+    args = parser.parse_args()
+
+    cases = [
+        ("completion", [completion_body(args.completion_tokens)], False),
+        ("embedding", [embedding_body(args.embeddings, args.dimensions)], False),
+        ("sse", sse_chunks(args.completion_tokens), True),
+    ]
+    results = []
+    print(f"{'case':>10} | {'encoding':>8} | {'level':>5} | {'original':>9} | {'compressed':>10} | "
+          f"{'ratio':>6} | {'cpu ms':>7} | {'MB/s':>7}")
+    for name, chunks, flush in cases:
+        rounds = max(3, min(200, 20_000_000 // sum(len(chunk) for chunk in chunks)))
+        for encoding in available_encodings():
+            for level in LEVELS[encoding]:
+                result = measure(encoding, level, chunks, flush, rounds)
+                result.update(case=name, default=level == DEFAULT_LEVELS[encoding])
+                results.append(result)
+                marker = "*" if result["default"] else " "
+                print(f"{name:>10} | {encoding:>8} | {level:>4}{marker} | {result['original_bytes']:>9} | "
+                      f"{result['compressed_bytes']:>10} | {result['ratio']:>6.2f} | {result['cpu_ms']:>7.3f} | "
+                      f"{result['mb_per_s']:>7.1f}")
+    print("\n* 默认压缩级别；sse为每个分片flush后的结果")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+端到端压测
+
+启动模拟上游（fake_upstream.py）和网关（main.py）两个子进程，用异步负载生成器
+按固定并发（闭环）或固定RPS（开环）发送请求，分别测量直连上游和经过网关的
+吞吐量、延迟分位数、首token延迟（TTFT），两者之差即网关增加的开销；
+再保持大量并发流式连接，按网关进程（含所有worker）RSS的增量估算每个连接占用的内存。
+结果可保存为JSON（包含当前commit），用 --compare 与之前的结果对比。
+
+用法: python bench_e2e.py [--requests 2000] [--concurrency 50 | --rps 200] [--stream]
+                          [--upstream-latency-ms 20] [--tokens-per-sec 500] [--completion-tokens 32]
+                          [--error-rate 0.0] [--workers 1] [--hold-connections 200]
+                          [--json bench_e2e.json] [--compare baseline.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import List, Optional, Tuple
+
+import aiohttp
+
+MODEL = "bench-model"
+MB = 1024 * 1024
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """进程及其子进程（多worker）的RSS之和，只支持Linux"""
+    def vm_rss(p: int) -> int:
+        with open(f"/proc/{p}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    try:
+        total = vm_rss(pid)
+    except OSError:
+        return None
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            if ppid == pid:
+                total += vm_rss(int(name))
+        except (OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+    return {
+        "mean": sum(ordered) / len(ordered) * 1000,
+        "p50": pct(0.50),
+        "p95": pct(0.95),
+        "p99": pct(0.99),
+        "max": ordered[-1] * 1000,
+    }
+
+
+def summarize(samples: List[Tuple[int, float, float]], elapsed: float) -> dict:
+    """samples为(状态码, 总耗时, 首字节耗时)，状态码0表示连接错误或超时"""
+    ok = [sample for sample in samples if sample[0] == 200]
+    return {
+        "requests": len(samples),
+        "ok": len(ok),
+        "errors": len(samples) - len(ok),
+        "statuses": dict(Counter(str(sample[0]) for sample in samples)),
+        "duration_s": elapsed,
+        "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+        "latency_ms": percentiles([sample[1] for sample in ok]),
+        "ttft_ms": percentiles([sample[2] for sample in ok]),
+    }
+
+
+async def run_load(url: str, payload: dict, headers: dict, requests: int, concurrency: int,
+                   rps: float = 0.0) -> dict:
+    """rps大于0时按固定速率发送（开环），否则保持concurrency个请求同时进行（闭环）"""
+    samples: List[Tuple[int, float, float]] = []
+    timeout = aiohttp.ClientTimeout(total=300)
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0), timeout=timeout) as session:
+        async def one():
+            start = time.perf_counter()
+            first_byte = None
+            try:
+                async with session.post(url, json=payload, headers=headers) as response:
+                    async for _ in response.content.iter_any():
+                        if first_byte is None:
+                            first_byte = time.perf_counter() - start
+                    status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                status = 0
+            latency = time.perf_counter() - start
+            samples.append((status, latency, first_byte if first_byte is not None else latency))
+
+        start = time.perf_counter()
+        if rps > 0:
+            tasks = []
+            for i in range(requests):
+                delay = start + i / rps - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(one()))
+            await asyncio.gather(*tasks)
+        else:
+            remaining = requests
+
+            async def worker():
+                nonlocal remaining
+                while remaining > 0:
+                    remaining -= 1
+                    await one()
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return summarize(samples, elapsed)
+
+
+async def measure_memory(url: str, payload: dict, headers: dict, pid: int, connections: int) -> dict:
+    """同时保持connections个流式请求（收到首个分片后不再读取），测量网关RSS的增量"""
+    idle = rss_bytes(pid)
+    held_payload = {**payload, "stream": True}
+    # 上游每2秒生成一个token，保证测量期间连接一直处于流式传输中
+    held_headers = {**headers, "X-Fake-Tokens-Per-Sec": "0.5"}
+    responses = []
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        async def hold():
+            response = await session.post(url, json=held_payload, headers=held_headers)
+            await response.content.readany()
+            responses.append(response)
+
+        try:
+            await asyncio.gather(*(hold() for _ in range(connections)))
+            await asyncio.sleep(0.5)
+            held = rss_bytes(pid)
+        finally:
+            for response in responses:
+                response.close()
+    if idle is None or held is None:
+        return {"connections": connections}
+    return {
+        "connections": len(responses),
+        "idle_rss_mb": idle / MB,
+        "held_rss_mb": held / MB,
+        "per_connection_kb": (held - idle) / max(1, len(responses)) / 1024,
+    }
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30.0):
+    import urllib.request
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"进程启动失败: {' '.join(process.args)}")
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"等待服务就绪超时: {url}")
+
+
+def start_processes(args, tmp: str) -> Tuple[subprocess.Popen, subprocess.Popen, int, int]:
+    here = os.path.dirname(os.path.abspath(__file__))
+    upstream_port, gateway_port = free_port(), free_port()
+    upstream = subprocess.Popen(
+        [sys.executable, os.path.join(here, "fake_upstream.py"), "--port", str(upstream_port),
+         "--latency-ms", str(args.upstream_latency_ms), "--tokens-per-sec", str(args.tokens_per_sec),
+         "--completion-tokens", str(args.completion_tokens), "--error-rate", str(args.error_rate)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    config_path = os.path.join(tmp, "config.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump({"model_config": [{
+            "model_name": MODEL, "svc_name": MODEL, "svc_port": upstream_port, "api_key": "bench",
+            "pool": {"limit": 0, "limit_per_host": 0},
+            "replicas": [f"http://127.0.0.1:{upstream_port}"],
+        }]}, f)
+    gateway = subprocess.Popen(
+        [sys.executable, os.path.join(here, "main.py"),
+         "--auth-url", f"http://127.0.0.1:{upstream_port}/auth", "--base-url", "http://unused",
+         "--config-path", config_path, "--port", str(gateway_port), "--host", "127.0.0.1",
+         "--log-file", os.path.join(tmp, "gateway.log"), "--log-level", "WARNING",
+         "--workers", str(args.workers), "--metrics-dir", os.path.join(tmp, "metrics")],
+        cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(f"http://127.0.0.1:{upstream_port}/health", upstream)
+        wait_ready(f"http://127.0.0.1:{gateway_port}/health", gateway)
+    except RuntimeError:
+        stop_processes(upstream, gateway)
+        raise
+    return upstream, gateway, upstream_port, gateway_port
+
+
+def stop_processes(*processes: subprocess.Popen):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def run_benchmark(args, upstream_port: int, gateway_port: int, gateway_pid: int) -> dict:
+    payload = {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": "x" * args.prompt_chars}],
+        "max_tokens": args.completion_tokens,
+        "stream": args.stream,
+    }
+    if args.stream:
+        payload["stream_options"] = {"include_usage": True}
+    headers = {"Authorization": "Bearer bench-token"}
+    path = "/v1/chat/completions"
+    targets = {
+        "direct": f"http://127.0.0.1:{upstream_port}{path}",
+        "gateway": f"http://127.0.0.1:{gateway_port}{path}",
+    }
+
+    results = {}
+    for name, url in targets.items():
+        # 预热：建立连接、填充认证缓存
+        await run_load(url, payload, headers, min(100, args.requests), args.concurrency)
+        results[name] = await run_load(url, payload, headers, args.requests, args.concurrency, args.rps)
+
+    results["overhead_ms"] = {
+        key: results["gateway"]["latency_ms"].get(key, 0.0) - results["direct"]["latency_ms"].get(key, 0.0)
+        for key in ("p50", "p95", "p99")
+    }
+    if args.hold_connections > 0:
+        results["memory"] = await measure_memory(targets["gateway"], payload, headers, gateway_pid,
+                                                 args.hold_connections)
+    return results
+
+
+# (指标路径, 是否越大越好)
+COMPARE_METRICS = [
+    ("gateway.throughput_rps", True),
+    ("gateway.latency_ms.p50", False),
+    ("gateway.latency_ms.p95", False),
+    ("gateway.latency_ms.p99", False),
+    ("gateway.ttft_ms.p50", False),
+    ("gateway.ttft_ms.p99", False),
+    ("overhead_ms.p50", False),
+    ("overhead_ms.p99", False),
+    ("memory.per_connection_kb", False),
+]
+
+
+def lookup(data: dict, path: str) -> Optional[float]:
+    for key in path.split("."):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+def compare(current: dict, baseline: dict):
+    print(f"\n对比 {baseline.get('meta', {}).get('commit')} -> {current.get('meta', {}).get('commit')}")
+    print(f"{'metric':<28} | {'baseline':>10} | {'current':>10} | {'change':>8}")
+    for path, higher_is_better in COMPARE_METRICS:
+        old, new = lookup(baseline, path), lookup(current, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / abs(old) * 100 if old else 0.0
+        worse = change < 0 if higher_is_better else change > 0
+        mark = " !" if worse and abs(change) >= 10 else ""
+        print(f"{path:<28} | {old:>10.2f} | {new:>10.2f} | {change:>+7.1f}%{mark}")
+
+
+def print_results(results: dict):
+    print(f"{'target':>8} | {'ok':>6} | {'err':>5} | {'rps':>8} | {'p50 ms':>8} | {'p95 ms':>8} | "
+          f"{'p99 ms':>8} | {'ttft p50':>8} | {'ttft p99':>8}")
+    for name in ("direct", "gateway"):
+        r = results[name]
+        latency, ttft = r["latency_ms"], r["ttft_ms"]
+        print(f"{name:>8} | {r['ok']:>6} | {r['errors']:>5} | {r['throughput_rps']:>8.1f} | "
+              f"{latency.get('p50', 0):>8.2f} | {latency.get('p95', 0):>8.2f} | {latency.get('p99', 0):>8.2f} | "
+              f"{ttft.get('p50', 0):>8.2f} | {ttft.get('p99', 0):>8.2f}")
+    overhead = results["overhead_ms"]
+    print(f"网关开销: p50 {overhead['p50']:.2f}ms  p95 {overhead['p95']:.2f}ms  p99 {overhead['p99']:.2f}ms")
+    memory = results.get("memory")
+    if memory and "per_connection_kb" in memory:
+        print(f"内存: 空闲 {memory['idle_rss_mb']:.1f}MB，保持{memory['connections']}个流式连接 "
+              f"{memory['held_rss_mb']:.1f}MB，每连接约 {memory['per_connection_kb']:.1f}KB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50, help="闭环模式下同时进行的请求数")
+    parser.add_argument("--rps", type=float, default=0.0, help="开环模式的固定请求速率，0表示使用闭环模式")
+    parser.add_argument("--stream", action="store_true", help="发送流式请求")
+    parser.add_argument("--prompt-chars", type=int, default=2000, help="请求中消息内容的字符数")
+    parser.add_argument("--upstream-latency-ms", type=float, default=20.0, help="模拟上游的首token延迟（毫秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=500.0, help="模拟上游的生成速率")
+    parser.add_argument("--completion-tokens", type=int, default=32, help="每个请求生成的token数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游随机返回503的比例")
+    parser.add_argument("--workers", type=int, default=1, help="网关worker进程数")
+    parser.add_argument("--hold-connections", type=int, default=200, help="测量内存时保持的流式连接数，0表示不测量")
+    parser.add_argument("--json", type=str, default=None, help="结果保存路径")
+    parser.add_argument("--compare", type=str, default=None, help="与之前保存的结果对比")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        upstream, gateway, upstream_port, gateway_port = start_processes(args, tmp)
+        try:
+            results = asyncio.run(run_benchmark(args, upstream_port, gateway_port, gateway.pid))
+        finally:
+            stop_processes(gateway, upstream)
+
+    results["meta"] = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "args": vars(args),
+    }
+    print_results(results)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+日志管道基准测试
+
+在事件循环中模拟请求处理时的日志量（每个请求若干行，含请求头和请求体预览），
+同时用一个1ms周期的探测协程测量事件循环的卡顿时间（实际唤醒时间 - 预期唤醒时间），
+对比旧的同步 FileHandler + StreamHandler 与当前的队列 + 后台写入线程。
+--disk-latency-ms 为每次写文件附加的延迟，模拟磁盘繁忙或网络存储；
+写入跟不上时队列管道会丢弃日志（dropped列）而不是阻塞事件循环。
+
+用法: python bench_logging.py [--requests 3000] [--lines 6] [--concurrency 50] [--disk-latency-ms 0.5] [--json bench_logging.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import log
+from log import dropped_logs, logger, setup_logging, stop_logging
+
+
+class SlowFile:
+    """每次写入前等待固定时间的文件对象"""
+
+    def __init__(self, f, latency: float):
+        self.f = f
+        self.latency = latency
+
+    def write(self, data):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def slow_down(handler: logging.StreamHandler, latency: float):
+    handler.setStream(SlowFile(handler.stream, latency))
+
+
+def setup_legacy(log_file: str, latency: float):
+    """旧配置：在调用logger的线程里同步格式化并写文件和控制台"""
+    stop_logging()
+    logger.handlers.clear()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    file_handler = logging.FileHandler(log_file)
+    slow_down(file_handler, latency)
+    for handler in (file_handler, logging.StreamHandler(sys.stderr)):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def setup_queue(log_file: str, latency: float):
+    setup_logging(log_file=log_file)
+    for handler in log._listener.handlers:
+        if isinstance(handler, logging.FileHandler):
+            slow_down(handler, latency)
+
+
+async def measure_stalls(stop: asyncio.Event, interval: float = 0.001) -> list:
+    stalls = []
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        stalls.append(max(0.0, time.perf_counter() - expected))
+    return stalls
+
+
+async def run_load(requests: int, lines: int, concurrency: int) -> dict:
+    headers = {"authorization": "Bearer sk-secret", "content-type": "application/json", "user-agent": "bench"}
+    preview = '{"model": "deepseek-chat", "messages": [{"role": "user", "content": "' + "x" * 400 + '"}]}'
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            logger.info("收到请求: POST /v1/chat/completions")
+            logger.info(f"request headers: {headers}")
+            for _ in range(max(0, lines - 3)):
+                logger.info(f"Request body (first 500 bytes): {preview}")
+            logger.info("请求完成: POST /v1/chat/completions - 状态码: 200")
+            # 模拟等待上游响应，事件循环空闲时探测协程应能准时唤醒
+            await asyncio.sleep(0.002)
+
+    stop = asyncio.Event()
+    probe = asyncio.create_task(measure_stalls(stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    stalls = sorted(await probe)
+
+    def pct(p):
+        return stalls[min(len(stalls) - 1, int(len(stalls) * p))] * 1000 if stalls else 0.0
+
+    return {
+        "lines_per_sec": requests * lines / elapsed,
+        "dropped": dropped_logs(),
+        "stall_p50_ms": pct(0.50),
+        "stall_p99_ms": pct(0.99),
+        "stall_max_ms": stalls[-1] * 1000 if stalls else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--lines", type=int, default=6, help="每个请求的日志行数")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--disk-latency-ms", type=float, default=0.5, help="每次写文件附加的延迟（毫秒）")
+    parser.add_argument("--json", type=str, default=None, help="结果保存路径")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # 控制台输出重定向到/dev/null，只保留写入开销
+        devnull = open(os.devnull, "w")
+        real_stderr, sys.stderr = sys.stderr, devnull
+        try:
+            latency = args.disk_latency_ms / 1000
+            setup_legacy(os.path.join(tmp, "legacy.log"), latency)
+            results["legacy"] = asyncio.run(run_load(args.requests, args.lines, args.concurrency))
+            for handler in logger.handlers:
+                handler.close()
+
+            setup_queue(os.path.join(tmp, "queue.log"), latency)
+            results["queue"] = asyncio.run(run_load(args.requests, args.lines, args.concurrency))
+            stop_logging()
+        finally:
+            sys.stderr = real_stderr
+            devnull.close()
+
+    print(f"{'pipeline':>8} | {'lines/s':>9} | {'dropped':>7} | {'p50 ms':>7} | {'p99 ms':>7} | {'max ms':>7}")
+    for name, r in results.items():
+        print(f"{name:>8} | {r['lines_per_sec']:>9.0f} | {r['dropped']:>7} | {r['stall_p50_ms']:>7.2f} | "
+              f"{r['stall_p99_ms']:>7.2f} | {r['stall_max_ms']:>7.2f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+中间件栈基准测试
+
+对比旧的 @app.middleware("http")（BaseHTTPMiddleware）中间件链与纯ASGI中间件链
+在普通JSON响应和流式响应下的吞吐量（requests/sec）与延迟分位数。
+两条链执行相同的业务逻辑（日志、认证、模型验证），差别只在中间件实现方式。
+
+用法: python bench_middleware.py [--requests 3000] [--concurrency 50] [--json bench_middleware.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from typing import Callable
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from body import parse_request_body
+from config import get_model_config_by_name, get_server_config, init_config
+from log import logger
+from middleware import setup_middleware
+
+
+class StubAuthProxy:
+    async def auth(self, request):
+        return True
+
+
+def add_routes(app: FastAPI):
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        return {"model": request.state.request_body.model}
+
+    @app.post("/v1/stream")
+    async def stream(request: Request):
+        async def chunks():
+            for i in range(20):
+                yield b'data: {"i": %d}\n\n' % i
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+
+def build_legacy_app() -> FastAPI:
+    """旧实现：三个 @app.middleware("http") 函数"""
+    app = FastAPI()
+    add_routes(app)
+    auth_proxy = StubAuthProxy()
+
+    @app.middleware("http")
+    async def logging_middleware(request: Request, call_next: Callable) -> Response:
+        start_time = time.time()
+        logger.info(f"收到请求: {request.method} {request.url.path}")
+        response = await call_next(request)
+        process_time = time.time() - start_time
+        logger.info(f"请求完成: {request.method} {request.url.path} - 状态码: {response.status_code}")
+        response.headers["X-Process-Time"] = str(process_time)
+        return response
+
+    @app.middleware("http")
+    async def model_validation_middleware(request: Request, call_next: Callable) -> Response:
+        if request.url.path.startswith("/v1/"):
+            body = await request.body()
+            request_body = parse_request_body(body)
+            request.state.request_body = request_body
+            request.state.model_config = get_model_config_by_name(get_server_config(), request_body.model)
+        return await call_next(request)
+
+    @app.middleware("http")
+    async def authentication_middleware(request: Request, call_next: Callable) -> Response:
+        await auth_proxy.auth(request)
+        return await call_next(request)
+
+    return app
+
+
+def build_asgi_app() -> FastAPI:
+    """新实现：纯ASGI中间件"""
+    app = FastAPI()
+    add_routes(app)
+    setup_middleware(app, "http://auth", auth_proxy=StubAuthProxy())
+    return app
+
+
+async def one_request(app, path: str, body: bytes) -> float:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "root_path": "", "headers": [(b"content-type", b"application/json"), (b"authorization", b"Bearer x")],
+        "client": ("127.0.0.1", 1234), "server": ("127.0.0.1", 8000),
+    }
+    request_sent = False
+    response_done = asyncio.Event()
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await response_done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and not message.get("more_body", False):
+            response_done.set()
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    return time.perf_counter() - start
+
+
+async def run_load(app, path: str, body: bytes, total: int, concurrency: int) -> dict:
+    latencies = []
+    remaining = total
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            latencies.append(await one_request(app, path, body))
+
+    # 预热
+    for _ in range(50):
+        await one_request(app, path, body)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {"rps": total / elapsed, "p50_ms": pct(0.50), "p99_ms": pct(0.99)}
+
+
+async def main_async(args):
+    init_config(args.config_path)
+    body = json.dumps({"model": "deepseek-chat", "messages": [{"role": "user", "content": "hi"}]}).encode()
+    results = {}
+    for name, builder in (("legacy", build_legacy_app), ("asgi", build_asgi_app)):
+        app = builder()
+        results[name] = {
+            "json": await run_load(app, "/v1/chat/completions", body, args.requests, args.concurrency),
+            "stream": await run_load(app, "/v1/stream", body, args.requests, args.concurrency),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--config-path", type=str, default="config.json")
+    parser.add_argument("--json", type=str, default=None, help="结果保存路径")
+    args = parser.parse_args()
+
+    # 只测中间件开销，关闭日志输出
+    logger.setLevel(logging.WARNING)
+    results = asyncio.run(main_async(args))
+
+    print(f"{'stack':>8} | {'route':>6} | {'req/s':>9} | {'p50 ms':>7} | {'p99 ms':>7}")
+    for stack, routes in results.items():
+        for route, r in routes.items():
+            print(f"{stack:>8} | {route:>6} | {r['rps']:>9.0f} | {r['p50_ms']:>7.2f} | {r['p99_ms']:>7.2f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import json
+import re
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:  # orjson为可选依赖，未安装时使用标准库json
+    orjson = None
+
+
+class BodyParseError(ValueError):
+    """请求体不是合法的JSON对象"""
+
+    def __init__(self, message: str, pos: Optional[int] = None):
+        super().__init__(message if pos is None else f"{message} (position {pos})")
+        self.message = message
+        self.pos = pos
+
+
+# 扫描嵌套结构时只关心字符串和括号
+_STRUCTURAL = re.compile(rb'["\[\]{}]')
+# 标量值（数字、true/false/null）的结束位置
+_SCALAR_END = re.compile(rb'[\s,\]}]')
+_WHITESPACE = b" \t\r\n"
+# 需要从请求体中提取的顶层字段
+_FIELDS = {b"model": "model", b"stream": "stream", b"max_tokens": "max_tokens",
+           b"max_completion_tokens": "max_tokens"}
+
+
+def _skip_ws(buf: bytes, pos: int) -> int:
+    n = len(buf)
+    while pos < n and buf[pos] in _WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _string_end(buf: bytes, pos: int) -> int:
+    """pos指向字符串开头的双引号，返回结束双引号之后的位置"""
+    i = pos + 1
+    while True:
+        j = buf.find(b'"', i)
+        if j < 0:
+            raise BodyParseError("Unterminated string", pos)
+        # 前面连续反斜杠为奇数个时该双引号是转义字符
+        k = j - 1
+        while k > pos and buf[k] == 0x5C:
+            k -= 1
+        if (j - 1 - k) % 2 == 0:
+            return j + 1
+        i = j + 1
+
+
+def _value_end(buf: bytes, pos: int) -> int:
+    """跳过从pos开始的一个JSON值，返回其结束位置，不构造任何Python对象"""
+    if pos >= len(buf):
+        raise BodyParseError("Expecting value", pos)
+    c = buf[pos]
+    if c == 0x22:  # "
+        return _string_end(buf, pos)
+    if c not in (0x7B, 0x5B):  # 标量
+        m = _SCALAR_END.search(buf, pos)
+        end = m.start() if m else len(buf)
+        if end == pos:
+            raise BodyParseError("Expecting value", pos)
+        return end
+    depth = 0
+    i = pos
+    while True:
+        m = _STRUCTURAL.search(buf, i)
+        if m is None:
+            raise BodyParseError("Unterminated object or array", pos)
+        j = m.start()
+        ch = buf[j]
+        if ch == 0x22:
+            i = _string_end(buf, j)
+            continue
+        if ch in (0x7B, 0x5B):
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return j + 1
+        i = j + 1
+
+
+def json_loads(data: bytes) -> Any:
+    """解析JSON（安装了orjson时使用orjson）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(data: Any) -> bytes:
+    """序列化为紧凑的UTF-8 JSON（安装了orjson时使用orjson）"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class RequestBody:
+    """
+    请求体
+
+    保留客户端发送的原始bytes，只解析出路由需要的 model/stream 字段和上下文长度检查需要的 max_tokens；
+    完整的JSON解析延迟到确实需要读取其他字段时（data属性），
+    只有调用 update() 修改过内容才会重新序列化，否则原样转发给上游。
+    """
+
+    __slots__ = ("raw", "model", "stream", "max_tokens", "_data", "_dirty")
+
+    def __init__(self, raw: bytes, model: Any = None, stream: Any = False, max_tokens: Any = None):
+        self.raw = raw
+        self.model = model
+        self.stream = stream
+        self.max_tokens = max_tokens
+        self._data = None
+        self._dirty = False
+
+    @property
+    def data(self) -> dict:
+        """完整解析后的请求体（首次访问时解析）"""
+        if self._data is None:
+            self._data = json_loads(self.raw)
+        return self._data
+
+    def update(self, **fields):
+        """修改请求体字段，转发时重新序列化"""
+        self.data.update(fields)
+        self._dirty = True
+        if "model" in fields:
+            self.model = fields["model"]
+        if "stream" in fields:
+            self.stream = fields["stream"]
+        for key in ("max_tokens", "max_completion_tokens"):
+            if key in fields:
+                self.max_tokens = fields[key]
+
+    def payload(self) -> bytes:
+        """发往上游的请求体"""
+        if self._dirty:
+            return json_dumps(self._data)
+        return self.raw
+
+    def __len__(self) -> int:
+        return len(self.raw)
+
+
+def find_usage(buf: bytes) -> Optional[dict]:
+    """
+    从上游响应体中找出最后一个 "usage" 对象
+
+    同时适用于普通JSON响应和SSE流（usage位于最后的分片中），从末尾反向查找，
+    只解析usage对象本身。
+    """
+    pos = buf.rfind(b'"usage"')
+    while pos >= 0:
+        colon = _skip_ws(buf, pos + 7)
+        if colon < len(buf) and buf[colon] == 0x3A:
+            start = _skip_ws(buf, colon + 1)
+            if start < len(buf) and buf[start] == 0x7B:
+                try:
+                    return json.loads(buf[start:_value_end(buf, start)])
+                except ValueError:
+                    pass
+        pos = buf.rfind(b'"usage"', 0, pos)
+    return None
+
+
+def parse_request_body(raw: bytes) -> RequestBody:
+    """
+    扫描请求体顶层对象，提取 model、stream 和 max_tokens（或 max_completion_tokens）字段
+
+    只做结构扫描（字符串、括号配对、顶层键值分隔），不解析消息内容，
+    因此大请求体也不会产生完整副本；嵌套值内部的非法标量留给上游校验。
+
+    Raises:
+        BodyParseError: 请求体为空、不是JSON对象或结构不完整
+    """
+    buf = raw
+    n = len(buf)
+    pos = _skip_ws(buf, 0)
+    if pos >= n:
+        raise BodyParseError("Empty request body")
+    if buf[pos] != 0x7B:
+        raise BodyParseError("Request body must be valid JSON object")
+
+    fields = {}
+    pos = _skip_ws(buf, pos + 1)
+    if pos < n and buf[pos] == 0x7D:
+        pos += 1
+    else:
+        while True:
+            if pos >= n or buf[pos] != 0x22:
+                raise BodyParseError("Expecting property name enclosed in double quotes", pos)
+            key_end = _string_end(buf, pos)
+            key = buf[pos + 1:key_end - 1]
+            if b"\\" in key:
+                try:
+                    key = json.loads(buf[pos:key_end]).encode("utf-8")
+                except ValueError as e:
+                    raise BodyParseError(f"Invalid property name: {e}", pos)
+            pos = _skip_ws(buf, key_end)
+            if pos >= n or buf[pos] != 0x3A:  # :
+                raise BodyParseError("Expecting ':' delimiter", pos)
+            value_start = _skip_ws(buf, pos + 1)
+            value_end = _value_end(buf, value_start)
+            name = _FIELDS.get(key)
+            if name is not None:
+                try:
+                    fields[name] = json.loads(buf[value_start:value_end])
+                except ValueError as e:
+                    raise BodyParseError(f"Invalid value for '{name}': {e}", value_start)
+            pos = _skip_ws(buf, value_end)
+            if pos >= n:
+                raise BodyParseError("Expecting ',' delimiter", pos)
+            if buf[pos] == 0x2C:  # ,
+                pos = _skip_ws(buf, pos + 1)
+                continue
+            if buf[pos] == 0x7D:  # }
+                pos += 1
+                break
+            raise BodyParseError("Expecting ',' delimiter", pos)
+
+    if _skip_ws(buf, pos) != n:
+        raise BodyParseError("Extra data", pos)
+    return RequestBody(raw, fields.get("model"), fields.get("stream", False), fields.get("max_tokens"))
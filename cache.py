@@ -0,0 +1,353 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from body import RequestBody
+from config import ModelConfig
+from log import logger
+from metrics import CACHE_BYTES
+
+# 不影响生成结果、不参与缓存key计算的请求字段
+_IGNORED_FIELDS = ("stream",)
+# 重新扫描磁盘缓存目录的间隔（秒），多worker共享目录时据此同步其他进程写入的文件大小
+DISK_RESCAN_INTERVAL = 30.0
+
+
+class CacheEntry:
+    """缓存的上游响应：kind为json（非流式响应体）或sse（完整的流式响应体）"""
+
+    __slots__ = ("body", "content_type", "kind", "created_at", "expires_at")
+
+    def __init__(self, body: bytes, content_type: str, kind: str, created_at: float, expires_at: float):
+        self.body = body
+        self.content_type = content_type
+        self.kind = kind
+        self.created_at = created_at
+        self.expires_at = expires_at
+
+    def expired(self, now: float) -> bool:
+        return now >= self.expires_at
+
+    def sse(self, uri: str = "/v1/chat/completions", include_usage: bool = False) -> bytes:
+        """
+        以SSE格式返回缓存内容，非流式响应转换为单个分片 + usage分片（include_usage时）+ [DONE]
+
+        /v1/completions 的分片为 text_completion 格式，其他为 chat.completion.chunk 格式。
+        """
+        if self.kind == "sse":
+            return self.body
+        data = json.loads(self.body)
+        chunk = {key: value for key, value in data.items() if key not in ("choices", "usage")}
+        if uri.endswith("/chat/completions"):
+            chunk["object"] = "chat.completion.chunk"
+            chunk["choices"] = [
+                {
+                    "index": choice.get("index", i),
+                    "delta": choice.get("message") or {"content": choice.get("text", "")},
+                    "finish_reason": choice.get("finish_reason"),
+                }
+                for i, choice in enumerate(data.get("choices", []))
+            ]
+        else:
+            chunk["object"] = "text_completion"
+            chunk["choices"] = [
+                {
+                    "index": choice.get("index", i),
+                    "text": choice.get("text", ""),
+                    "logprobs": choice.get("logprobs"),
+                    "finish_reason": choice.get("finish_reason"),
+                }
+                for i, choice in enumerate(data.get("choices", []))
+            ]
+        events = [chunk]
+        if include_usage and data.get("usage") is not None:
+            events.append({**chunk, "choices": [], "usage": data["usage"]})
+        return b"".join(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n"
+                        for event in events) + b"data: [DONE]\n\n"
+
+
+def _normalize(value: Any) -> Any:
+    # 0 与 0.0、1 与 1.0 视为同一个值
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def canonical_json(data: dict) -> str:
+    """规范化的请求体：键排序、数值统一、去掉stream字段（stream_options影响流式输出，保留）"""
+    data = {key: value for key, value in data.items() if key not in _IGNORED_FIELDS}
+    return json.dumps(_normalize(data), sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def cache_key(uri: str, request_body: RequestBody) -> str:
+    """请求路径 + 规范化请求体的sha256"""
+    canonical = canonical_json(request_body.data)
+    digest = hashlib.sha256(uri.encode("utf-8"))
+    digest.update(b"\n")
+    digest.update(canonical.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def cache_directives(cache_control: Optional[str]) -> set:
+    """解析请求的Cache-Control头：no-cache 跳过查询但写入缓存，no-store 完全不使用缓存"""
+    if not cache_control:
+        return set()
+    return {directive.strip().lower().split("=", 1)[0] for directive in cache_control.split(",")}
+
+
+class MemoryTier:
+    """按字节数限制大小的LRU"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+
+    def get(self, key: str, now: float) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expired(now):
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+        CACHE_BYTES.set(self.size, "memory")
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self.size -= len(entry.body)
+        CACHE_BYTES.set(self.size, "memory")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class DiskTier:
+    """
+    磁盘缓存，每个条目一个文件：首行为JSON元数据，之后为响应体
+
+    按文件修改时间近似LRU淘汰，读写在线程池中执行，不阻塞事件循环。
+    多个worker可以共享同一目录：索引中没有的key也会尝试读取文件，并定期重新扫描目录，
+    使总大小的限制包含其他进程写入的文件。
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._scanned_at = 0.0
+        os.makedirs(path, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """按修改时间从旧到新重建索引"""
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+        with self._lock:
+            self._index = OrderedDict((name, size) for _, name, size in sorted(files))
+            self.size = sum(self._index.values())
+            self._scanned_at = time.monotonic()
+            CACHE_BYTES.set(self.size, "disk")
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def get(self, key: str, now: float) -> Optional[CacheEntry]:
+        with self._lock:
+            known = key in self._index
+            if known:
+                self._index.move_to_end(key)
+        try:
+            with open(self._file(key), "rb") as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+                size = f.tell()
+        except FileNotFoundError:
+            if known:
+                self._discard(key)
+            return None
+        except (OSError, ValueError):
+            self._discard(key)
+            return None
+        if not known:
+            # 其他worker写入的文件
+            with self._lock:
+                if key not in self._index:
+                    self._index[key] = size
+                    self.size += size
+                    CACHE_BYTES.set(self.size, "disk")
+        entry = CacheEntry(body, meta["content_type"], meta["kind"], meta["created_at"], meta["expires_at"])
+        if entry.expired(now):
+            self._discard(key)
+            return None
+        return entry
+
+    def set(self, key: str, entry: CacheEntry):
+        meta = {"content_type": entry.content_type, "kind": entry.kind,
+                "created_at": entry.created_at, "expires_at": entry.expires_at}
+        data = json.dumps(meta).encode("utf-8") + b"\n" + entry.body
+        tmp = f"{self._file(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._file(key))
+        if time.monotonic() - self._scanned_at > DISK_RESCAN_INTERVAL:
+            self._scan()
+        with self._lock:
+            self.size += len(data) - self._index.pop(key, 0)
+            self._index[key] = len(data)
+            evicted = []
+            while self.size > self.max_bytes and self._index:
+                old_key, old_size = self._index.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_key)
+            CACHE_BYTES.set(self.size, "disk")
+        for old_key in evicted:
+            self._unlink(old_key)
+
+    def _discard(self, key: str):
+        with self._lock:
+            size = self._index.pop(key, None)
+            if size is not None:
+                self.size -= size
+                CACHE_BYTES.set(self.size, "disk")
+        self._unlink(key)
+
+    def _unlink(self, key: str):
+        try:
+            os.unlink(self._file(key))
+        except FileNotFoundError:
+            pass
+
+
+class ResponseCache:
+    """
+    上游响应的精确匹配缓存
+
+    内存LRU为一级缓存，可选磁盘为二级缓存（磁盘命中后提升到内存）；
+    是否缓存、有效期按模型的 cache 配置决定。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_entry_bytes: int = 1024 * 1024,
+                 disk_path: Optional[str] = None, disk_max_bytes: int = 1024 * 1024 * 1024):
+        self.max_entry_bytes = max_entry_bytes
+        self.memory = MemoryTier(max_bytes)
+        self.disk = DiskTier(disk_path, disk_max_bytes) if disk_path else None
+
+    @staticmethod
+    def cacheable(model_config: ModelConfig, request_body: RequestBody) -> bool:
+        """模型开启了缓存，且请求是确定性的（或模型允许缓存非确定性请求）"""
+        if not model_config.cache.enabled:
+            return False
+        try:
+            data = request_body.data
+        except ValueError:
+            return False
+        if not model_config.cache.deterministic_only:
+            return True
+        return data.get("temperature") == 0 and data.get("n", 1) == 1
+
+    async def get(self, key: str, stream: bool) -> Optional[CacheEntry]:
+        """查找缓存，流式请求可以使用两种条目，非流式请求只能使用json条目"""
+        now = time.time()
+        entry = self.memory.get(key, now)
+        if entry is None and self.disk is not None:
+            entry = await asyncio.to_thread(self.disk.get, key, now)
+            if entry is not None:
+                self.memory.set(key, entry)
+        if entry is None or (entry.kind == "sse" and not stream):
+            return None
+        return entry
+
+    async def set(self, key: str, model_config: ModelConfig, body: bytes, content_type: str, kind: str):
+        if len(body) > self.max_entry_bytes:
+            return
+        now = time.time()
+        entry = CacheEntry(body, content_type, kind, now, now + model_config.cache.ttl)
+        self.memory.set(key, entry)
+        if self.disk is not None:
+            try:
+                await asyncio.to_thread(self.disk.set, key, entry)
+            except OSError as e:
+                logger.warning(f"写入磁盘缓存失败: {e}")
+
+    def recorder(self, key: str, model_config: ModelConfig) -> "CacheRecorder":
+        return CacheRecorder(self, key, model_config)
+
+    def stats(self) -> Dict[str, Any]:
+        result = {"memory": {"entries": len(self.memory), "bytes": self.memory.size}}
+        if self.disk is not None:
+            result["disk"] = {"entries": len(self.disk._index), "bytes": self.disk.size}
+        return result
+
+
+class CacheRecorder:
+    """把一次未命中请求的上游响应写入缓存，limit为可缓存的最大响应体字节数"""
+
+    __slots__ = ("cache", "key", "model_config", "limit")
+
+    def __init__(self, cache: ResponseCache, key: str, model_config: ModelConfig):
+        self.cache = cache
+        self.key = key
+        self.model_config = model_config
+        self.limit = cache.max_entry_bytes
+
+    async def __call__(self, body: bytes, content_type: str, stream: bool = False):
+        if not stream and not body.lstrip().startswith(b"{"):
+            # 只缓存JSON对象响应，SSE转换依赖其结构
+            return
+        await self.cache.set(self.key, self.model_config, body, content_type, "sse" if stream else "json")
+
+
+class MultiRecorder:
+    """把同一个上游响应交给多个缓存（精确匹配缓存和语义缓存）的recorder"""
+
+    __slots__ = ("recorders", "limit")
+
+    def __init__(self, *recorders):
+        self.recorders = recorders
+        self.limit = max(recorder.limit for recorder in recorders)
+
+    async def __call__(self, body: bytes, content_type: str, stream: bool = False):
+        for recorder in self.recorders:
+            if len(body) <= recorder.limit:
+                await recorder(body, content_type, stream)
+
+
+response_cache: Optional[ResponseCache] = None
+
+
+def init_response_cache(**kwargs) -> ResponseCache:
+    global response_cache
+    response_cache = ResponseCache(**kwargs)
+    return response_cache
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    return response_cache
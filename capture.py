@@ -0,0 +1,146 @@
+import asyncio
+import os
+import random
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+from body import json_dumps, json_loads
+from log import logger
+from metrics import CAPTURED_REQUESTS
+
+# 记录在环形缓冲区中的请求：(开始时间, 路径, 模型, 租户, 状态码, 耗时毫秒, 请求体)
+CapturedRequest = Tuple[float, str, str, Optional[str], int, float, bytes]
+
+
+def capture_line(request: CapturedRequest) -> bytes:
+    """
+    一条请求的JSONL记录
+
+    模型验证只扫描请求体的顶层结构，字符串中的非法UTF-8等不会被发现，
+    因此请求体解析后重新序列化为单行，不合法时抛出ValueError。调用方的token不写入记录。
+    """
+    timestamp, path, model, tenant, status, latency_ms, body = request
+    meta = json_dumps({"ts": timestamp, "path": path, "model": model, "tenant": tenant,
+                       "status": status, "latency_ms": latency_ms})
+    return meta[:-1] + b',"body":' + json_dumps(json_loads(body)) + b"}\n"
+
+
+class TrafficCapture:
+    """
+    流量采集
+
+    按sample_rate采样 /v1/ 请求，record()只把请求放入环形缓冲区；后台任务每flush_interval秒
+    把缓冲的请求序列化后在线程中追加写入JSONL文件（每批一次write，多worker可写同一文件），
+    供replay.py按原始时间间隔重放。请求体超过max_body_bytes的请求不采集，
+    文件达到max_file_bytes后停止采集；缓冲区满时丢弃最旧的记录。
+    """
+
+    def __init__(self, path: str, sample_rate: float = 1.0, max_body_bytes: int = 1024 * 1024,
+                 max_file_bytes: int = 1024 * 1024 * 1024, capacity: int = 10000, flush_interval: float = 1.0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_body_bytes = max_body_bytes
+        self.max_file_bytes = max_file_bytes
+        self.flush_interval = flush_interval
+        self.buffer: Deque[CapturedRequest] = deque(maxlen=capacity)
+        self.full = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def sampled(self) -> bool:
+        return not self.full and (self.sample_rate >= 1.0 or random.random() < self.sample_rate)
+
+    def record(self, request: CapturedRequest):
+        if len(request[-1]) > self.max_body_bytes:
+            CAPTURED_REQUESTS.inc("too_large")
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            CAPTURED_REQUESTS.inc("dropped")
+        self.buffer.append(request)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        batch = list(self.buffer)
+        self.buffer.clear()
+        try:
+            written, invalid = await asyncio.to_thread(self._append, batch)
+        except OSError as e:
+            CAPTURED_REQUESTS.inc("dropped", amount=len(batch))
+            logger.warning(f"写入流量采集文件失败: {e}")
+            return
+        CAPTURED_REQUESTS.inc("captured", amount=written)
+        if invalid:
+            CAPTURED_REQUESTS.inc("invalid", amount=invalid)
+        if written + invalid < len(batch):
+            CAPTURED_REQUESTS.inc("dropped", amount=len(batch) - written - invalid)
+
+    def _append(self, batch) -> Tuple[int, int]:
+        """追加写入，返回(写入的记录数, 请求体不合法而跳过的记录数)；文件达到大小上限后不再写入"""
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            size = 0
+        lines = []
+        invalid = 0
+        for request in batch:
+            try:
+                line = capture_line(request)
+            except ValueError:
+                invalid += 1
+                continue
+            if size + len(line) > self.max_file_bytes:
+                if not self.full:
+                    self.full = True
+                    logger.warning(f"流量采集文件达到 {self.max_file_bytes} 字节，停止采集: {self.path}")
+                break
+            size += len(line)
+            lines.append(line)
+        if lines:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, b"".join(lines))
+            finally:
+                os.close(fd)
+        return len(lines), invalid
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+traffic_capture: Optional[TrafficCapture] = None
+
+
+def init_traffic_capture(path: Optional[str], **kwargs) -> Optional[TrafficCapture]:
+    """path为空时不采集"""
+    global traffic_capture
+    traffic_capture = TrafficCapture(path, **kwargs) if path else None
+    if traffic_capture is not None:
+        traffic_capture.start()
+    return traffic_capture
+
+
+def get_traffic_capture() -> Optional[TrafficCapture]:
+    return traffic_capture
+
+
+async def close_traffic_capture():
+    global traffic_capture
+    if traffic_capture is not None:
+        await traffic_capture.close()
+        traffic_capture = None
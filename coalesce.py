@@ -0,0 +1,271 @@
+import asyncio
+import json
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from starlette.responses import Response, StreamingResponse
+
+from body import RequestBody
+from config import ModelConfig
+from log import logger
+from metrics import COALESCED_REQUESTS
+
+# 驱动共享响应时使用的ASGI scope：spec_version 2.4 的响应不读取receive
+_SCOPE = {"type": "http", "asgi": {"spec_version": "2.4"}, "method": "POST", "path": "/", "headers": []}
+# 订阅者队列中的结束标记
+_END = object()
+_OVERFLOW = object()
+
+
+async def _receive():
+    # 共享响应没有客户端，请求方断开由各自的CoalescedResponse处理
+    await asyncio.Future()
+
+
+def overflow_event() -> bytes:
+    """请求方读取过慢、待发送数据超限时以SSE error事件结束其响应"""
+    error = {"error": {"message": "Client too slow for shared response", "type": "overflow", "code": 503}}
+    return b"data: " + json.dumps(error).encode("utf-8") + b"\n\n"
+
+
+class Subscriber:
+    """
+    共享同一次上游调用的一个请求方
+
+    上游分片放入各自的队列，pending为已收到但还没有发给客户端的字节数，
+    超过limit时丢弃队列并结束该请求方的响应，不影响其他请求方和上游读取。
+    """
+
+    __slots__ = ("queue", "pending", "limit", "overflowed")
+
+    def __init__(self, limit: int):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.pending = 0
+        self.limit = limit
+        self.overflowed = False
+
+    def push(self, chunk: bytes) -> bool:
+        """放入一个分片，超限时返回False（至少能容纳一个分片，非流式响应总能完整放入）"""
+        if self.overflowed:
+            return True
+        if self.pending and self.pending + len(chunk) > self.limit:
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.pending = 0
+            self.queue.put_nowait(_OVERFLOW)
+            return False
+        self.pending += len(chunk)
+        self.queue.put_nowait(chunk)
+        return True
+
+    def close(self, item=_END):
+        """结束响应：item为_END或上游出错时的异常"""
+        if not self.overflowed:
+            self.queue.put_nowait(item)
+
+    async def chunks(self):
+        while True:
+            item = await self.queue.get()
+            if isinstance(item, bytes):
+                self.pending -= len(item)
+                yield item
+            elif item is _END:
+                return
+            elif item is _OVERFLOW:
+                yield overflow_event()
+                return
+            else:
+                raise item
+
+
+class Flight:
+    """
+    一次进行中的共享上游调用
+
+    上游响应由独立的任务读取并广播给所有订阅者，不随发起请求的客户端断开而取消；
+    最后一个订阅者离开时才取消上游调用。已广播的分片保留在history中供后加入的请求回放，
+    超过limit后不再接受新的订阅者。发起请求在响应结束时以publish公布上游返回的usage，
+    供跟随者各自记录用量。
+    """
+
+    def __init__(self, coalescer: "Coalescer", key: str, model_name: str, limit: int):
+        self.coalescer = coalescer
+        self.key = key
+        self.model_name = model_name
+        self.limit = limit
+        self.subscribers: Set[Subscriber] = set()
+        self.history: List[bytes] = []
+        self.history_bytes = 0
+        self.joinable = True
+        self.usage: Optional[dict] = None
+        # 上游响应开始时为(状态码, 响应头)，开始之前失败时为异常
+        self.started: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.started.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber(self.limit)
+        for chunk in self.history:
+            subscriber.push(chunk)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+        if not self.subscribers and self.task is not None and not self.task.done():
+            # 所有请求方都已离开，取消上游调用
+            self.close()
+            self.task.cancel()
+
+    def publish(self, usage: Optional[dict]):
+        """记录共享上游调用返回的usage，在广播结束之前调用"""
+        self.usage = usage
+
+    def close(self):
+        """不再接受新的订阅者"""
+        self.joinable = False
+        self.history = []
+        self.coalescer.discard(self)
+
+    async def run(self, start: Callable[[Callable[[Optional[dict]], None]], Awaitable[Response]]):
+        try:
+            response = await start(self.publish)
+            await response(_SCOPE, _receive, self._send)
+        except asyncio.CancelledError:
+            # 没有订阅者时才会被取消；进程退出时取消的，以连接中断结束剩余订阅者的响应
+            self._fail(ConnectionAbortedError("Shared upstream call cancelled"))
+            raise
+        except Exception as e:
+            self._fail(e)
+        else:
+            for subscriber in self.subscribers:
+                subscriber.close()
+        finally:
+            self.close()
+
+    def _fail(self, error: BaseException):
+        if not self.started.done():
+            self.started.set_exception(error)
+        else:
+            for subscriber in self.subscribers:
+                subscriber.close(error)
+
+    async def _send(self, message):
+        if message["type"] == "http.response.start":
+            self.started.set_result((message["status"], message.get("headers", [])))
+            return
+        chunk = message.get("body", b"")
+        if not chunk:
+            return
+        if self.joinable:
+            self.history.append(chunk)
+            self.history_bytes += len(chunk)
+            if self.history_bytes > self.limit:
+                # 无法完整回放，之后的相同请求发起新的上游调用
+                self.close()
+        for subscriber in self.subscribers:
+            if not subscriber.push(chunk):
+                COALESCED_REQUESTS.inc(self.model_name, "overflow")
+                logger.warning(f"请求方读取过慢，退出共享响应: {self.model_name}")
+
+
+class CoalescedResponse(StreamingResponse):
+    """
+    把共享上游调用的响应发给一个请求方，结束（包括客户端断开）时退出订阅
+
+    on_usage为跟随者的用量回调，响应发送完后以共享调用的usage（还没有公布时为None）调用。
+    """
+
+    def __init__(self, flight: Flight, subscriber: Subscriber, status_code: int, raw_headers: list,
+                 on_usage: Optional[Callable[[Optional[dict]], Awaitable[None]]] = None):
+        self.flight = flight
+        self.subscriber = subscriber
+        self.on_usage = on_usage
+        super().__init__(subscriber.chunks(), status_code=status_code)
+        self.raw_headers = list(raw_headers)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+            self.flight.unsubscribe(self.subscriber)
+        if self.on_usage is not None:
+            await self.on_usage(self.flight.usage)
+
+
+class Coalescer:
+    """
+    合并并发的相同请求
+
+    key相同（规范化请求体相同且同为流式或非流式）的请求在上游调用进行中到达时加入该调用，
+    共享同一个上游响应，只有发起调用的请求占用准入名额。只在当前进程内合并。
+    """
+
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+
+    @staticmethod
+    def eligible(model_config: ModelConfig, request_body: RequestBody) -> bool:
+        """模型开启了请求合并，且请求是确定性的（或模型允许合并非确定性请求）"""
+        if not model_config.coalesce.enabled:
+            return False
+        if not model_config.coalesce.deterministic_only:
+            return True
+        try:
+            data = request_body.data
+        except ValueError:
+            return False
+        return data.get("temperature") == 0 and data.get("n", 1) == 1
+
+    async def join(self, key: str, model_config: ModelConfig,
+                   start: Callable[[Callable[[Optional[dict]], None]], Awaitable[Response]],
+                   on_usage: Optional[Callable[[Optional[dict]], Awaitable[None]]] = None) -> Response:
+        """
+        加入key对应的上游调用，没有可加入的调用时以start发起一个
+
+        start(publish)发起上游调用，由它自己记录发起请求的用量，并在响应结束时以publish(usage)
+        公布上游返回的usage；加入已有调用的请求在自己的响应发送完后以该usage调用on_usage，
+        使每个请求方都按共享调用的用量记账和计入token限流。
+        """
+        flight = self.flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight(self, key, model_config.model_name, model_config.coalesce.max_buffer_bytes)
+            self.flights[key] = flight
+            flight.task = asyncio.ensure_future(flight.run(start))
+        COALESCED_REQUESTS.inc(model_config.model_name, "leader" if leader else "follower")
+        subscriber = flight.subscribe()
+        try:
+            # 请求方取消等待时不能取消共享的future
+            status_code, raw_headers = await asyncio.shield(flight.started)
+        except BaseException:
+            flight.unsubscribe(subscriber)
+            raise
+        response = CoalescedResponse(flight, subscriber, status_code, raw_headers, None if leader else on_usage)
+        if not leader:
+            response.headers["X-Coalesced"] = "true"
+        return response
+
+    def discard(self, flight: Flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "flights": len(self.flights),
+            "subscribers": sum(len(flight.subscribers) for flight in self.flights.values()),
+        }
+
+
+coalescer: Optional[Coalescer] = None
+
+
+def init_coalescer() -> Coalescer:
+    global coalescer
+    coalescer = Coalescer()
+    return coalescer
+
+
+def get_coalescer() -> Optional[Coalescer]:
+    return coalescer
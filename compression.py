@@ -0,0 +1,249 @@
+import zlib
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Sequence
+
+try:
+    import brotli
+except ImportError:  # brotli为可选依赖，未安装时不支持br编码
+    brotli = None
+# brotli>=1.2 才能限制解压输出的大小；更早的版本只用于压缩响应，不接受br编码的请求体
+BROTLI_BOUNDED = brotli is not None and hasattr(brotli.Decompressor(), "can_accept_more_data")
+
+try:
+    import zstandard
+except ImportError:  # zstandard为可选依赖，未安装时不支持zstd编码
+    zstandard = None
+
+# 按服务端偏好排列的响应压缩编码：客户端对多个编码的q值相同时优先使用靠前的
+PREFERRED_ENCODINGS = ("zstd", "br", "gzip")
+# 各编码的默认压缩级别：网关转发的响应只发送一次，取压缩率和CPU开销的折中
+DEFAULT_LEVELS = {"gzip": 5, "br": 4, "zstd": 3}
+# 超过该字节数的非流式响应在线程中压缩，不阻塞事件循环
+OFFLOAD_BYTES = 256 * 1024
+# 解压后请求体的默认上限：未配置max_body_bytes时同样限制，防止压缩炸弹
+MAX_DECOMPRESSED_BYTES = 32 * 1024 * 1024
+# 超过该字节数的压缩请求体在线程中解压，不阻塞事件循环
+DECOMPRESS_OFFLOAD_BYTES = 16 * 1024
+# zstd每个块解压后最多128KiB、压缩后至少4字节：每字节输入最多解压出约32KiB
+ZSTD_MAX_RATIO = 32 * 1024
+# 值得压缩的响应类型（包括 text/event-stream）
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/x-ndjson", "application/javascript")
+
+
+class UnsupportedEncoding(ValueError):
+    """请求体使用了不支持（或对应依赖未安装）的Content-Encoding"""
+
+
+class DecompressedTooLarge(Exception):
+    """请求体解压后超过大小限制"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"Decompressed request body exceeds {limit} bytes")
+        self.limit = limit
+
+
+class Compressor(ABC):
+    """
+    增量压缩器
+
+    compress() 返回的数据可能为空（仍在压缩器缓冲中）；flush() 输出已输入的全部数据，
+    客户端收到后即可解码，压缩上下文保留给后续分片；finish() 结束压缩流。
+    """
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        """输入数据，返回已产生的压缩输出"""
+
+    @abstractmethod
+    def flush(self) -> bytes:
+        """输出已输入的全部数据，保留压缩上下文"""
+
+    @abstractmethod
+    def finish(self) -> bytes:
+        """结束压缩流"""
+
+
+class GzipCompressor(Compressor):
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor(Compressor):
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class ZstdCompressor(Compressor):
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+_COMPRESSORS: Dict[str, Callable[[int], Compressor]] = {"gzip": GzipCompressor}
+if brotli is not None:
+    _COMPRESSORS["br"] = BrotliCompressor
+if zstandard is not None:
+    _COMPRESSORS["zstd"] = ZstdCompressor
+
+
+def available_encodings(names: Optional[Sequence[str]] = None) -> List[str]:
+    """names中当前环境支持的编码（保持顺序），names为None时为所有支持的编码按偏好排列"""
+    if names is None:
+        names = PREFERRED_ENCODINGS
+    return [name for name in (n.strip().lower() for n in names) if name in _COMPRESSORS]
+
+
+def create_compressor(encoding: str, level: Optional[int] = None) -> Compressor:
+    return _COMPRESSORS[encoding](DEFAULT_LEVELS[encoding] if level is None else level)
+
+
+def compress(data: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    """一次性压缩完整的数据"""
+    compressor = create_compressor(encoding, level)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compressible(content_type: str) -> bool:
+    content_type = content_type.lower()
+    return any(content_type.startswith(prefix) for prefix in COMPRESSIBLE_TYPES)
+
+
+def negotiate(accept_encoding: str, encodings: Sequence[str]) -> Optional[str]:
+    """
+    按Accept-Encoding从encodings（服务端偏好顺序）中选择响应编码，不压缩时返回None
+
+    q值最高的编码优先，q值相同时按服务端偏好；"*" 匹配其他未列出的编码，q=0表示拒绝。
+    """
+    if not accept_encoding or not encodings:
+        return None
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name] = q
+    wildcard = weights.get("*", 0.0)
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = weights.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def _bounded(output: bytes, limit: int) -> bytes:
+    if 0 < limit < len(output):
+        raise DecompressedTooLarge(limit)
+    return output
+
+
+def _inflate(data: bytes, wbits: int, limit: int) -> bytes:
+    decompressor = zlib.decompressobj(wbits)
+    # 最多解压limit+1字节，压缩炸弹不会在内存中完整展开
+    output = decompressor.decompress(data, limit + 1 if limit > 0 else 0)
+    _bounded(output, limit)
+    if not decompressor.eof:
+        raise ValueError("truncated compressed data")
+    return output
+
+
+def _unbrotli(data: bytes, limit: int) -> bytes:
+    decompressor = brotli.Decompressor()
+    # 最多解压limit+1字节，压缩炸弹不会在内存中完整展开
+    output = bytearray(decompressor.process(data, output_buffer_limit=limit + 1))
+    while len(output) <= limit and not decompressor.can_accept_more_data():
+        output += decompressor.process(b"", output_buffer_limit=limit + 1 - len(output))
+    _bounded(output, limit)
+    if not decompressor.is_finished():
+        raise ValueError("truncated compressed data")
+    return bytes(output)
+
+
+def _unzstd(data: bytes, limit: int) -> bytes:
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    if limit <= 0:
+        output = decompressor.decompress(data)
+    else:
+        # decompressobj不能限制单次输出：按剩余额度分段输入，每段最多解压出约剩余额度的输出，
+        # 压缩炸弹不会在内存中完整展开
+        output = bytearray()
+        view = memoryview(data)
+        position = 0
+        while position < len(data) and len(output) <= limit and not decompressor.eof:
+            size = max(64, (limit - len(output)) // ZSTD_MAX_RATIO)
+            output += decompressor.decompress(view[position:position + size])
+            position += size
+        _bounded(output, limit)
+        output = bytes(output)
+    if not decompressor.eof:
+        raise ValueError("truncated compressed data")
+    return output
+
+
+def _decode(data: bytes, encoding: str, limit: int) -> bytes:
+    try:
+        if encoding in ("gzip", "x-gzip"):
+            return _inflate(data, 16 + zlib.MAX_WBITS, limit)
+        if encoding == "deflate":
+            # 规范要求zlib格式，部分客户端发送不带头部的raw deflate
+            try:
+                return _inflate(data, zlib.MAX_WBITS, limit)
+            except zlib.error:
+                return _inflate(data, -zlib.MAX_WBITS, limit)
+        if encoding == "br" and BROTLI_BOUNDED:
+            return _unbrotli(data, limit) if limit > 0 else brotli.decompress(data)
+        if encoding == "zstd" and zstandard is not None:
+            return _unzstd(data, limit)
+    except DecompressedTooLarge:
+        raise
+    except Exception as e:
+        # zlib.error、brotli.error、zstandard.ZstdError
+        raise ValueError(f"invalid {encoding} data: {e}") from e
+    raise UnsupportedEncoding(f"Unsupported Content-Encoding: {encoding}")
+
+
+def decompress(data: bytes, content_encoding: str, limit: int = 0) -> bytes:
+    """
+    按请求头Content-Encoding解压请求体，limit大于0时解压结果超过该字节数抛出DecompressedTooLarge
+
+    多重编码按逆序解码；数据损坏抛出ValueError，不支持的编码抛出UnsupportedEncoding。
+    """
+    encodings = [name.strip().lower() for name in content_encoding.split(",") if name.strip()]
+    for encoding in reversed(encodings):
+        if encoding != "identity":
+            data = _decode(data, encoding, limit)
+    return data
@@ -1,8 +1,243 @@
-from dataclasses import dataclass
-from typing import Dict
+from dataclasses import dataclass, field
+from functools import cached_property
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional
 import json
+import time
 from pathlib import Path
 
+from log import logger
+
+
+@dataclass
+class PoolConfig:
+    """上游连接池配置（对应aiohttp.TCPConnector参数）"""
+    limit: int = 100                  # 连接池总连接数上限，0表示不限制
+    limit_per_host: int = 0           # 单个上游地址的连接数上限，0表示不限制
+    keepalive_timeout: float = 30.0   # 空闲连接保活时间（秒）
+    ttl_dns_cache: int = 300          # DNS缓存时间（秒）
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'PoolConfig':
+        """从字典创建PoolConfig实例，未配置的字段使用默认值"""
+        defaults = cls()
+        return cls(
+            limit=int(data.get('limit', defaults.limit)),
+            limit_per_host=int(data.get('limit_per_host', defaults.limit_per_host)),
+            keepalive_timeout=float(data.get('keepalive_timeout', defaults.keepalive_timeout)),
+            ttl_dns_cache=int(data.get('ttl_dns_cache', defaults.ttl_dns_cache))
+        )
+
+
+@dataclass
+class RateLimitConfig:
+    """按 (API token, 模型) 的限流配置，0表示不限制"""
+    requests_per_minute: float = 0
+    request_burst: float = 0          # 请求突发容量，0表示等于每分钟请求数
+    tokens_per_minute: float = 0      # prompt + completion token速率
+    token_burst: float = 0            # token突发容量，0表示等于每分钟token数
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'RateLimitConfig':
+        """从字典创建RateLimitConfig实例，未配置的字段使用默认值"""
+        return cls(
+            requests_per_minute=float(data.get('requests_per_minute', 0)),
+            request_burst=float(data.get('request_burst', 0)),
+            tokens_per_minute=float(data.get('tokens_per_minute', 0)),
+            token_burst=float(data.get('token_burst', 0))
+        )
+
+    @property
+    def request_burst_size(self) -> float:
+        return self.request_burst or self.requests_per_minute
+
+    @property
+    def token_burst_size(self) -> float:
+        return self.token_burst or self.tokens_per_minute
+
+
+@dataclass
+class AdmissionConfig:
+    """每个模型的并发准入控制，max_concurrency为0表示不限制"""
+    max_concurrency: int = 0          # 同时发往上游的最大请求数
+    max_queue: int = 100              # 等待队列长度上限，超过直接拒绝(429)
+    queue_timeout: float = 30.0       # 排队超时时间（秒），超时拒绝(503)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'AdmissionConfig':
+        """从字典创建AdmissionConfig实例，未配置的字段使用默认值"""
+        defaults = cls()
+        return cls(
+            max_concurrency=int(data.get('max_concurrency', defaults.max_concurrency)),
+            max_queue=int(data.get('max_queue', defaults.max_queue)),
+            queue_timeout=float(data.get('queue_timeout', defaults.queue_timeout))
+        )
+
+
+@dataclass
+class CacheConfig:
+    """非流式响应的精确匹配缓存（需显式开启）"""
+    enabled: bool = False
+    ttl: float = 300.0                # 缓存有效期（秒）
+    deterministic_only: bool = True   # 只缓存 temperature 为0的请求
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'CacheConfig':
+        """从字典创建CacheConfig实例，未配置的字段使用默认值"""
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get('enabled', defaults.enabled)),
+            ttl=float(data.get('ttl', defaults.ttl)),
+            deterministic_only=bool(data.get('deterministic_only', defaults.deterministic_only))
+        )
+
+
+@dataclass
+class SemanticCacheConfig:
+    """按问题相似度匹配的响应缓存（需显式开启）"""
+    enabled: bool = False
+    embedding_model: str = ""         # 计算问题向量的embedding模型（网关中配置的模型名），为空时使用本地替代
+    threshold: float = 0.9            # 余弦相似度不低于该值时返回缓存的响应
+    ttl: float = 3600.0               # 缓存有效期（秒）
+    max_entries: int = 4096           # 每个模型最多缓存的条目数，超过时按LRU淘汰
+    dimensions: int = 256             # 本地替代embedding的维数
+    deterministic_only: bool = True   # 只缓存 temperature 为0的请求
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'SemanticCacheConfig':
+        """从字典创建SemanticCacheConfig实例，未配置的字段使用默认值"""
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get('enabled', defaults.enabled)),
+            embedding_model=str(data.get('embedding_model', defaults.embedding_model)),
+            threshold=float(data.get('threshold', defaults.threshold)),
+            ttl=float(data.get('ttl', defaults.ttl)),
+            max_entries=int(data.get('max_entries', defaults.max_entries)),
+            dimensions=int(data.get('dimensions', defaults.dimensions)),
+            deterministic_only=bool(data.get('deterministic_only', defaults.deterministic_only))
+        )
+
+
+@dataclass
+class CoalesceConfig:
+    """相同请求合并（需显式开启）：并发的相同请求共享一次上游调用"""
+    enabled: bool = False
+    deterministic_only: bool = True   # 只合并 temperature 为0的请求
+    max_buffer_bytes: int = 1048576   # 每个请求方待发送数据的上限，超过时该请求方被断开；也是后加入请求可回放的最大数据量
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'CoalesceConfig':
+        """从字典创建CoalesceConfig实例，未配置的字段使用默认值"""
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get('enabled', defaults.enabled)),
+            deterministic_only=bool(data.get('deterministic_only', defaults.deterministic_only)),
+            max_buffer_bytes=int(data.get('max_buffer_bytes', defaults.max_buffer_bytes))
+        )
+
+
+@dataclass
+class BatchingConfig:
+    """embedding请求微批（需显式开启）：短时间内到达的输入合并为一次上游请求"""
+    enabled: bool = False
+    max_batch_size: int = 32          # 每批最多的输入条数
+    max_wait_ms: float = 5.0          # 第一条输入到达后最多等待的时间（毫秒）
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BatchingConfig':
+        """从字典创建BatchingConfig实例，未配置的字段使用默认值"""
+        defaults = cls()
+        return cls(
+            enabled=bool(data.get('enabled', defaults.enabled)),
+            max_batch_size=int(data.get('max_batch_size', defaults.max_batch_size)),
+            max_wait_ms=float(data.get('max_wait_ms', defaults.max_wait_ms))
+        )
+
+
+# 负载均衡策略
+BALANCER_POLICIES = ("round_robin", "least_outstanding", "power_of_two", "ewma", "prefix_affinity")
+
+
+@dataclass
+class BalancerConfig:
+    """多副本负载均衡、主动健康检查与被动异常剔除配置"""
+    policy: str = "round_robin"
+    health_check_path: str = ""         # 主动健康检查路径（如/health），为空表示不做主动检查
+    health_check_interval: float = 10.0 # 健康检查间隔（秒）
+    health_check_timeout: float = 2.0   # 单次健康检查超时（秒）
+    unhealthy_threshold: int = 2        # 连续多少次检查失败标记为不健康
+    max_failures: int = 5               # 连续多少次请求失败（连接错误或5xx）后剔除副本
+    ejection_time: float = 30.0         # 剔除时长（秒），再次剔除时翻倍，最长10倍
+    affinity_messages: int = 2          # prefix_affinity：按前几条消息（系统提示 + 首轮对话）选择副本
+    affinity_load_factor: float = 1.25  # prefix_affinity：副本在途请求数超过平均值的该倍数时改选下一个副本
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BalancerConfig':
+        """从字典创建BalancerConfig实例，未配置的字段使用默认值"""
+        defaults = cls()
+        policy = data.get('policy', defaults.policy)
+        if policy not in BALANCER_POLICIES:
+            raise ValueError(f"负载均衡策略 '{policy}' 无效，可选: {list(BALANCER_POLICIES)}")
+        return cls(
+            policy=policy,
+            health_check_path=data.get('health_check_path', defaults.health_check_path),
+            health_check_interval=float(data.get('health_check_interval', defaults.health_check_interval)),
+            health_check_timeout=float(data.get('health_check_timeout', defaults.health_check_timeout)),
+            unhealthy_threshold=int(data.get('unhealthy_threshold', defaults.unhealthy_threshold)),
+            max_failures=int(data.get('max_failures', defaults.max_failures)),
+            ejection_time=float(data.get('ejection_time', defaults.ejection_time)),
+            affinity_messages=int(data.get('affinity_messages', defaults.affinity_messages)),
+            affinity_load_factor=float(data.get('affinity_load_factor', defaults.affinity_load_factor))
+        )
+
+
+@dataclass
+class ResilienceConfig:
+    """上游失败重试、对冲请求与熔断配置"""
+    max_retries: int = 0                # 最大重试次数，0表示不重试
+    retry_backoff: float = 0.1          # 重试退避基数（秒），第n次重试在 [0, base * 2^n] 内随机等待
+    retry_backoff_max: float = 2.0      # 单次退避的最长时间（秒）
+    retry_statuses: tuple = (502, 503, 504)  # 需要重试的上游状态码，连接错误和超时总是重试
+    hedge: bool = False                 # 非流式请求超过近期P95延迟仍未返回时，向另一个副本发送对冲请求
+    hedge_min_delay: float = 0.05       # 对冲请求的最短等待时间（秒）
+    breaker_threshold: int = 0          # 连续多少次失败后熔断，0表示不熔断
+    breaker_open_time: float = 30.0     # 熔断持续时间（秒），之后放行一个试探请求
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ResilienceConfig':
+        """从字典创建ResilienceConfig实例，未配置的字段使用默认值"""
+        defaults = cls()
+        return cls(
+            max_retries=int(data.get('max_retries', defaults.max_retries)),
+            retry_backoff=float(data.get('retry_backoff', defaults.retry_backoff)),
+            retry_backoff_max=float(data.get('retry_backoff_max', defaults.retry_backoff_max)),
+            retry_statuses=tuple(int(status) for status in data.get('retry_statuses', defaults.retry_statuses)),
+            hedge=bool(data.get('hedge', defaults.hedge)),
+            hedge_min_delay=float(data.get('hedge_min_delay', defaults.hedge_min_delay)),
+            breaker_threshold=int(data.get('breaker_threshold', defaults.breaker_threshold)),
+            breaker_open_time=float(data.get('breaker_open_time', defaults.breaker_open_time))
+        )
+
+
+@dataclass
+class TimeoutConfig:
+    """上游请求超时（秒），0表示不单独限制"""
+    connect: float = 10.0               # 建立连接（包括等待连接池空闲连接）
+    first_byte: float = 0.0             # 发出请求到收到首个响应字节（流式为首个分片），0表示只受total限制
+    idle: float = 60.0                  # 流式响应相邻两个分片的最长间隔
+    total: float = 0.0                  # 整个请求（包括排队、重试和流式传输）的最长时间，0表示使用 --timeout
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'TimeoutConfig':
+        """从字典创建TimeoutConfig实例，未配置的字段使用默认值"""
+        defaults = cls()
+        return cls(
+            connect=float(data.get('connect', defaults.connect)),
+            first_byte=float(data.get('first_byte', defaults.first_byte)),
+            idle=float(data.get('idle', defaults.idle)),
+            total=float(data.get('total', defaults.total))
+        )
+
 
 @dataclass
 class ModelConfig:
@@ -10,6 +245,23 @@ class ModelConfig:
     svc_name: str
     svc_port: int
     api_key: str
+    pool: PoolConfig = field(default_factory=PoolConfig)
+    rate_limit: RateLimitConfig = field(default_factory=RateLimitConfig)
+    admission: AdmissionConfig = field(default_factory=AdmissionConfig)
+    # 上游副本地址列表（如 http://10.0.0.1:9002），为空时使用 model_svc 对应的单个地址
+    replicas: List[str] = field(default_factory=list)
+    balancer: BalancerConfig = field(default_factory=BalancerConfig)
+    cache: CacheConfig = field(default_factory=CacheConfig)
+    semantic_cache: SemanticCacheConfig = field(default_factory=SemanticCacheConfig)
+    coalesce: CoalesceConfig = field(default_factory=CoalesceConfig)
+    batching: BatchingConfig = field(default_factory=BatchingConfig)
+    resilience: ResilienceConfig = field(default_factory=ResilienceConfig)
+    timeout: TimeoutConfig = field(default_factory=TimeoutConfig)
+    # 请求大小限制，0表示不限制：估算的prompt token数加max_tokens超过上下文长度返回400，请求体过大返回413
+    max_context_tokens: int = 0
+    max_body_bytes: int = 0
+    # 估算prompt token数使用的分词器（tiktoken编码名或register_tokenizer注册的名称），为空时按字节估算
+    tokenizer: str = ""
     
     @classmethod
     def from_dict(cls, data: dict) -> 'ModelConfig':
@@ -18,7 +270,21 @@ class ModelConfig:
             model_name=data['model_name'],  
             svc_name=data['svc_name'],
             svc_port=data['svc_port'],
-            api_key=data['api_key']
+            api_key=data['api_key'],
+            pool=PoolConfig.from_dict(data.get('pool', {})),
+            rate_limit=RateLimitConfig.from_dict(data.get('rate_limit', {})),
+            admission=AdmissionConfig.from_dict(data.get('admission', {})),
+            replicas=[url.rstrip('/') for url in data.get('replicas', [])],
+            balancer=BalancerConfig.from_dict(data.get('balancer', {})),
+            cache=CacheConfig.from_dict(data.get('cache', {})),
+            semantic_cache=SemanticCacheConfig.from_dict(data.get('semantic_cache', {})),
+            coalesce=CoalesceConfig.from_dict(data.get('coalesce', {})),
+            batching=BatchingConfig.from_dict(data.get('batching', {})),
+            resilience=ResilienceConfig.from_dict(data.get('resilience', {})),
+            timeout=TimeoutConfig.from_dict(data.get('timeout', {})),
+            max_context_tokens=int(data.get('max_context_tokens', 0)),
+            max_body_bytes=int(data.get('max_body_bytes', 0)),
+            tokenizer=str(data.get('tokenizer', ''))
         )
     @classmethod
     def from_model_name(cls, model_name: str) -> 'ModelConfig':
@@ -34,25 +300,132 @@ class ModelConfig:
         svc_addr = f"{self.svc_name}-svc.maas.svc.cluster.local:{self.svc_port}"
         
         return svc_addr
+
+    def replica_urls(self) -> List[str]:
+        """上游副本地址列表，未配置replicas时为集群内服务地址"""
+        return self.replicas or [f"http://{self.model_svc(self.model_name)}"]
         
         
         
     
+# 优先级类别，数值越小越优先
+PRIORITY_CLASSES = {"high": 0, "normal": 1, "low": 2}
+
+
 @dataclass
+class TenantConfig:
+    """调用方（租户）配置：持有的API token、优先级及同优先级内公平调度的权重"""
+    name: str
+    api_keys: List[str]
+    priority: str = "normal"
+    weight: float = 1.0               # 排队时与同优先级的其他租户按权重比例分享名额
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'TenantConfig':
+        """从字典创建TenantConfig实例"""
+        priority = data.get('priority', 'normal')
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"租户 '{data['name']}' 的优先级 '{priority}' 无效，可选: {list(PRIORITY_CLASSES)}")
+        weight = float(data.get('weight', 1.0))
+        if weight <= 0:
+            raise ValueError(f"租户 '{data['name']}' 的权重必须大于0")
+        return cls(
+            name=data['name'],
+            api_keys=list(data['api_keys']),
+            priority=priority,
+            weight=weight
+        )
+
+    @property
+    def priority_value(self) -> int:
+        return PRIORITY_CLASSES[self.priority]
+
+
+@dataclass(frozen=True)
 class ServerConfig:
-    model_config: Dict[str, ModelConfig]
+    """
+    配置快照
+
+    加载后不再修改，热更新时整体替换为新的快照；
+    请求在进入时取得快照，处理过程中始终使用同一份配置。
+    """
+    model_config: Mapping[str, ModelConfig]
+    # API token -> 租户配置
+    tenants: Mapping[str, TenantConfig] = field(default_factory=dict)
+    version: int = 0
+    loaded_at: float = 0.0
     
     @classmethod
-    def from_dict(cls, data: dict) -> 'ServerConfig':
+    def from_dict(cls, data: dict, version: int = 0) -> 'ServerConfig':
         """从字典创建ServerConfig实例"""
         model_configs = {}
         for config in data['model_config']:
             model_config = ModelConfig.from_dict(config)
             model_configs[model_config.model_name] = model_config
-        return cls(model_config=model_configs)
+        tenants = {}
+        for config in data.get('tenants', []):
+            tenant = TenantConfig.from_dict(config)
+            for api_key in tenant.api_keys:
+                tenants[api_key] = tenant
+        return cls(
+            model_config=MappingProxyType(model_configs),
+            tenants=MappingProxyType(tenants),
+            version=version,
+            loaded_at=time.time()
+        )
+
+    def validate(self):
+        """
+        检查配置是否可用，热更新时校验失败则保留旧配置
+
+        Raises:
+            ValueError: 配置不可用
+        """
+        if not self.model_config:
+            raise ValueError("至少需要配置一个模型")
+        for name, model_config in self.model_config.items():
+            if not model_config.api_key:
+                raise ValueError(f"模型 '{name}' 缺少 api_key")
+            if not 0 < int(model_config.svc_port) < 65536:
+                raise ValueError(f"模型 '{name}' 的端口 {model_config.svc_port} 无效")
+            for url in model_config.replicas:
+                if not url.startswith(("http://", "https://")):
+                    raise ValueError(f"模型 '{name}' 的副本地址 '{url}' 必须以 http:// 或 https:// 开头")
+            if model_config.admission.max_concurrency < 0 or model_config.admission.max_queue < 0:
+                raise ValueError(f"模型 '{name}' 的准入控制配置不能为负数")
+            if model_config.balancer.affinity_messages < 1 or model_config.balancer.affinity_load_factor < 1:
+                raise ValueError(f"模型 '{name}' 的前缀亲和配置无效：affinity_messages 至少为1，"
+                                 f"affinity_load_factor 不能小于1")
+            if model_config.resilience.max_retries < 0 or model_config.resilience.breaker_threshold < 0:
+                raise ValueError(f"模型 '{name}' 的重试/熔断配置不能为负数")
+            timeout = model_config.timeout
+            if min(timeout.connect, timeout.first_byte, timeout.idle, timeout.total) < 0:
+                raise ValueError(f"模型 '{name}' 的超时配置不能为负数")
+            if model_config.coalesce.max_buffer_bytes <= 0:
+                raise ValueError(f"模型 '{name}' 的 coalesce.max_buffer_bytes 必须大于0")
+            semantic_cache = model_config.semantic_cache
+            if (not 0 < semantic_cache.threshold <= 1 or semantic_cache.max_entries < 1
+                    or semantic_cache.dimensions < 1):
+                raise ValueError(f"模型 '{name}' 的语义缓存配置无效：threshold 须在(0, 1]之间，"
+                                 f"max_entries 和 dimensions 至少为1")
+            if semantic_cache.embedding_model and semantic_cache.embedding_model not in self.model_config:
+                raise ValueError(f"模型 '{name}' 的语义缓存使用的embedding模型 "
+                                 f"'{semantic_cache.embedding_model}' 未配置")
+            if model_config.batching.max_batch_size < 1 or model_config.batching.max_wait_ms < 0:
+                raise ValueError(f"模型 '{name}' 的微批配置无效：max_batch_size 至少为1，max_wait_ms 不能为负数")
+            if model_config.max_context_tokens < 0 or model_config.max_body_bytes < 0:
+                raise ValueError(f"模型 '{name}' 的请求大小限制不能为负数")
+
+    @cached_property
+    def max_body_bytes(self) -> int:
+        """所有模型中最大的请求体限制，读取请求体时（还不知道模型）超过该值即可拒绝；0表示不限制"""
+        limits = [model_config.max_body_bytes for model_config in self.model_config.values()]
+        if not limits or 0 in limits:
+            return 0
+        return max(limits)
     
     
-def load_config(config_path: str) -> ServerConfig:
+def load_config(config_path: str, version: int = 0) -> ServerConfig:
     """
     从JSON文件加载配置并解析为ServerConfig对象
     
@@ -66,6 +439,7 @@ def load_config(config_path: str) -> ServerConfig:
         FileNotFoundError: 配置文件不存在
         json.JSONDecodeError: JSON格式错误
         KeyError: 缺少必需的配置字段
+        ValueError: 配置校验失败
     """
     config_file = Path(config_path)
     if not config_file.exists():
@@ -78,11 +452,13 @@ def load_config(config_path: str) -> ServerConfig:
         raise json.JSONDecodeError(f"JSON格式错误: {e}", e.doc, e.pos)
     
     try:
-        return ServerConfig.from_dict(config_data)
+        server_config = ServerConfig.from_dict(config_data, version)
     except KeyError as e:
         raise KeyError(f"配置文件缺少必需字段: {e}")
     except Exception as e:
         raise Exception(f"解析配置文件时出错: {e}")
+    server_config.validate()
+    return server_config
 
 
 def get_model_config_by_name(server_config: ServerConfig, model_name: str) -> ModelConfig:
@@ -105,12 +481,32 @@ def get_model_config_by_name(server_config: ServerConfig, model_name: str) -> Mo
     available_models = list(server_config.model_config.keys())
     raise ValueError(f"未找到模型 '{model_name}'，可用模型: {available_models}")
 
+def get_tenant_by_api_key(server_config: ServerConfig, api_key: Optional[str]) -> Optional[TenantConfig]:
+    """根据调用方的API token获取租户配置，未配置时返回None"""
+    if not api_key:
+        return None
+    return server_config.tenants.get(api_key)
+
+
 server_config = None
 
 def init_config(config_path: str):
     global server_config
     server_config = load_config(config_path)
-    print(f"server_config: {server_config}")
+    logger.info(f"server_config: {server_config}")
+
+
+def reload_config(config_path: str) -> ServerConfig:
+    """
+    重新加载配置并原子替换当前快照
+
+    解析或校验失败时抛出异常，当前配置保持不变；正在处理的请求继续使用旧快照。
+    """
+    global server_config
+    version = server_config.version + 1 if server_config is not None else 0
+    new_config = load_config(config_path, version)
+    server_config = new_config
+    return new_config
     
     
 def get_server_config() -> ServerConfig:
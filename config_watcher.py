@@ -0,0 +1,80 @@
+import asyncio
+import os
+import signal
+from typing import Awaitable, Callable, Optional, Tuple
+
+from config import ServerConfig, reload_config
+from log import logger
+
+
+class ConfigWatcher:
+    """
+    配置文件热更新
+
+    定期检查配置文件的修改时间和大小（interval为0时不轮询），收到SIGHUP时立即重新加载；
+    新配置校验通过后原子替换当前快照并调用on_reload，校验失败时保留当前配置。
+    """
+
+    def __init__(self, config_path: str, interval: float = 5.0,
+                 on_reload: Optional[Callable[[ServerConfig], Awaitable[None]]] = None):
+        self.config_path = config_path
+        self.interval = interval
+        self.on_reload = on_reload
+        self._stamp = self._file_stamp()
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._sighup = False
+
+    def _file_stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload()))
+            self._sighup = True
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+            # 非主线程或不支持信号的平台只能依赖轮询
+            logger.warning("无法注册SIGHUP，配置热更新仅依赖文件轮询")
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._poll())
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            stamp = self._file_stamp()
+            if stamp is not None and stamp != self._stamp:
+                await self.reload()
+
+    async def reload(self) -> bool:
+        """重新加载配置，返回是否替换成功"""
+        async with self._lock:
+            self._stamp = self._file_stamp()
+            try:
+                new_config = reload_config(self.config_path)
+            except Exception as e:
+                logger.error(f"配置热更新失败，继续使用当前配置: {e}")
+                return False
+            logger.info(f"配置已更新: version={new_config.version} 模型={list(new_config.model_config)}")
+            if self.on_reload is not None:
+                try:
+                    await self.on_reload(new_config)
+                except Exception as e:
+                    logger.error(f"配置更新回调失败: {e}", exc_info=True)
+            return True
+
+    async def stop(self):
+        if self._sighup:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            self._sighup = False
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
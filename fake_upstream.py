@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+模拟的OpenAI兼容上游模型服务，用于压测和端到端测试
+
+- POST /v1/chat/completions、/v1/completions：支持非流式和SSE流式响应，按首token延迟和token速率模拟生成
+- POST /v1/embeddings：每条输入返回一个由其内容确定的小向量，index与输入顺序一致
+- GET /health：健康检查
+- POST /auth：模拟认证服务，总是返回 {"code": 0}
+
+延迟、token速率和错误注入可以通过命令行参数设置全局默认值，也可以用请求头按请求覆盖：
+X-Fake-Latency-Ms（首token延迟）、X-Fake-Tokens-Per-Sec（生成速率）、X-Fake-Status（直接返回该状态码）。
+请求体中的 max_tokens 决定生成的token数（不超过 --completion-tokens）。
+
+用法: python fake_upstream.py [--port 9100] [--latency-ms 50] [--tokens-per-sec 100] [--completion-tokens 64]
+                              [--error-rate 0.0] [--error-status 503]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Optional
+
+from aiohttp import web
+
+
+class FakeModel:
+    """模拟生成行为：latency为首token延迟（秒），tokens_per_sec为0时所有token同时生成"""
+
+    def __init__(self, latency: float = 0.05, tokens_per_sec: float = 100.0, completion_tokens: int = 64,
+                 error_rate: float = 0.0, error_status: int = 503):
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.aborted = 0  # 调用方中途关闭连接的流式请求数
+
+    def plan(self, request: web.Request, body: dict) -> dict:
+        """按全局设置和请求头覆盖计算本次请求的行为"""
+        headers = request.headers
+        status = int(headers.get("x-fake-status", 0))
+        if not status and self.error_rate > 0 and random.random() < self.error_rate:
+            status = self.error_status
+        tokens = self.completion_tokens
+        if body.get("max_tokens"):
+            tokens = max(1, min(tokens, int(body["max_tokens"])))
+        return {
+            "status": status,
+            "latency": float(headers.get("x-fake-latency-ms", self.latency * 1000)) / 1000,
+            "tokens_per_sec": float(headers.get("x-fake-tokens-per-sec", self.tokens_per_sec)),
+            "tokens": tokens,
+        }
+
+
+FAKE_MODEL = web.AppKey("fake_model", FakeModel)
+
+
+def prompt_tokens(body: dict) -> int:
+    """粗略估算prompt token数：每4个字符一个token"""
+    text = json.dumps(body.get("messages") or body.get("prompt") or "", ensure_ascii=False)
+    return max(1, len(text) // 4)
+
+
+def chunk_event(completion_id: str, model: str, created: int, chat: bool, text: Optional[str],
+                finish_reason: Optional[str] = None, usage: Optional[dict] = None) -> bytes:
+    if chat:
+        choices = [] if usage else [{"index": 0, "delta": {"content": text} if text is not None else {},
+                                     "finish_reason": finish_reason}]
+        data = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": choices}
+    else:
+        choices = [] if usage else [{"index": 0, "text": text or "", "finish_reason": finish_reason}]
+        data = {"id": completion_id, "object": "text_completion", "created": created, "model": model,
+                "choices": choices}
+    if usage:
+        data["usage"] = usage
+    return b"data: " + json.dumps(data).encode("utf-8") + b"\n\n"
+
+
+async def completions(request: web.Request) -> web.StreamResponse:
+    fake = request.app[FAKE_MODEL]
+    fake.requests += 1
+    try:
+        body = await request.json()
+    except ValueError:
+        return web.json_response({"error": {"message": "invalid json"}}, status=400)
+    plan = fake.plan(request, body)
+    if plan["status"]:
+        return web.json_response({"error": {"message": "injected error"}}, status=plan["status"])
+
+    chat = request.path.endswith("/chat/completions")
+    model = body.get("model", "fake-model")
+    completion_id = f"cmpl-{uuid.uuid4().hex[:16]}"
+    created = int(time.time())
+    tokens = plan["tokens"]
+    interval = 1.0 / plan["tokens_per_sec"] if plan["tokens_per_sec"] > 0 else 0.0
+    usage = {"prompt_tokens": prompt_tokens(body), "completion_tokens": tokens,
+             "total_tokens": prompt_tokens(body) + tokens}
+
+    await asyncio.sleep(plan["latency"])
+    if not body.get("stream"):
+        await asyncio.sleep(interval * (tokens - 1))
+        text = " ".join(["tok"] * tokens)
+        if chat:
+            choice = {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "length"}
+            obj = "chat.completion"
+        else:
+            choice = {"index": 0, "text": text, "finish_reason": "length"}
+            obj = "text_completion"
+        return web.json_response({"id": completion_id, "object": obj, "created": created, "model": model,
+                                  "choices": [choice], "usage": usage})
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    try:
+        await response.prepare(request)
+        for i in range(tokens):
+            if i:
+                await asyncio.sleep(interval)
+            finish_reason = "length" if i == tokens - 1 else None
+            await response.write(chunk_event(completion_id, model, created, chat, "tok ", finish_reason))
+        await response.write(chunk_event(completion_id, model, created, chat, None, usage=usage))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+    except ConnectionResetError:
+        # 调用方（网关超时或客户端断开）已关闭连接，停止生成
+        fake.aborted += 1
+    return response
+
+
+async def embeddings(request: web.Request) -> web.Response:
+    fake = request.app[FAKE_MODEL]
+    fake.requests += 1
+    try:
+        body = await request.json()
+    except ValueError:
+        return web.json_response({"error": {"message": "invalid json"}}, status=400)
+    plan = fake.plan(request, body)
+    if plan["status"]:
+        return web.json_response({"error": {"message": "injected error"}}, status=plan["status"])
+
+    inputs = body.get("input")
+    if isinstance(inputs, str) or (isinstance(inputs, list) and inputs and isinstance(inputs[0], int)):
+        inputs = [inputs]
+    await asyncio.sleep(plan["latency"])
+    data = []
+    tokens = 0
+    for i, item in enumerate(inputs or []):
+        text = item if isinstance(item, str) else json.dumps(item)
+        tokens += max(1, len(text) // 4)
+        seed = sum(text.encode("utf-8")) % 1000
+        data.append({"object": "embedding", "index": i, "embedding": [seed / 1000, len(text) / 1000, i / 1000]})
+    return web.json_response({"object": "list", "data": data, "model": body.get("model", "fake-model"),
+                              "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "healthy"})
+
+
+async def auth(request: web.Request) -> web.Response:
+    return web.json_response({"code": 0})
+
+
+def create_fake_upstream(fake_model: Optional[FakeModel] = None) -> web.Application:
+    app = web.Application()
+    app[FAKE_MODEL] = fake_model or FakeModel()
+    app.router.add_post("/v1/chat/completions", completions)
+    app.router.add_post("/v1/completions", completions)
+    app.router.add_post("/v1/embeddings", embeddings)
+    app.router.add_get("/health", health)
+    app.router.add_post("/auth", auth)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="首token延迟（毫秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=100.0, help="生成速率，0表示瞬间生成")
+    parser.add_argument("--completion-tokens", type=int, default=64, help="每个请求生成的token数上限")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机返回错误的请求比例（0~1）")
+    parser.add_argument("--error-status", type=int, default=503, help="注入错误的状态码")
+    args = parser.parse_args()
+
+    fake_model = FakeModel(args.latency_ms / 1000, args.tokens_per_sec, args.completion_tokens,
+                           args.error_rate, args.error_status)
+    web.run_app(create_fake_upstream(fake_model), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
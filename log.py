@@ -1,9 +1,160 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import queue
+import random
+import re
+import time
+from contextvars import ContextVar
+from typing import Any, Optional
 
+# 当前请求的ID，由LoggingMiddleware在请求开始时设置
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("model_gateway.log"), logging.StreamHandler()],
+# 需要脱敏的字段名（小写）
+REDACT_KEYS = {"authorization", "proxy-authorization", "api_key", "api-key", "x-api-key", "apikey"}
+# 消息文本中 authorization/api_key 后面的值，如 "'authorization': 'Bearer xxx'"、"api_key='xxx'"
+_REDACT_PATTERN = re.compile(
+    r"(?i)((?:proxy-)?authorization|x-api-key|api[_-]?key)(['\"]?\s*[:=]\s*['\"]?)(bearer\s+)?([^'\"\s,})]+)"
 )
-logger = logging.getLogger("maas_gateway")
\ No newline at end of file
+REDACTED = "***"
+
+# 记录完整请求体等详细日志的采样比例
+body_log_sample_rate = 0.0
+
+
+def redact(value: Any) -> Any:
+    """脱敏：字典中敏感字段的值替换为***，字符串中 authorization/api_key 后面的值替换为***"""
+    if isinstance(value, str):
+        return _REDACT_PATTERN.sub(lambda m: f"{m.group(1)}{m.group(2)}{m.group(3) or ''}{REDACTED}", value)
+    if isinstance(value, dict):
+        return {k: REDACTED if str(k).lower() in REDACT_KEYS else redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
+
+
+def sample_body_log() -> bool:
+    """本次请求是否记录详细的请求体日志"""
+    return body_log_sample_rate > 0 and random.random() < body_log_sample_rate
+
+
+class RequestIdFilter(logging.Filter):
+    """在产生日志的线程/协程中取出请求ID，日志写入线程中无法再读取上下文变量"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出为一行紧凑的JSON
+
+    通过 extra={"fields": {...}} 传入的结构化字段合并到顶层，输出前统一脱敏。
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(redact(fields))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃日志而不是阻塞事件循环，dropped为丢弃的条数"""
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 只合并消息参数，JSON格式化在写入线程中进行；异常栈在这里转成文本以便跨线程传递
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+logger = logging.getLogger("maas_gateway")
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(log_file: Optional[str] = "model_gateway.log", level: str = "INFO",
+                  max_bytes: int = 100 * 1024 * 1024, backup_count: int = 5,
+                  body_sample_rate: float = 0.0, queue_size: int = 10000, console: bool = True):
+    """
+    配置异步日志：业务代码只把日志放入内存队列，由后台线程格式化并写入文件/控制台
+
+    文件按大小轮转（max_bytes为0时不轮转，由外部工具轮转），可重复调用以替换之前的配置。
+    """
+    global _listener, body_log_sample_rate
+    stop_logging()
+    body_log_sample_rate = body_sample_rate
+
+    formatter = JsonFormatter()
+    handlers = []
+    if log_file and max_bytes > 0:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"))
+    elif log_file:
+        # 不自行轮转：文件被外部工具移走后重新打开，多个进程可以追加写同一个文件
+        handlers.append(logging.handlers.WatchedFileHandler(log_file, encoding="utf-8"))
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: queue.Queue = queue.Queue(queue_size)
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    logger.handlers.clear()
+    logger.addHandler(queue_handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def dropped_logs() -> int:
+    """日志队列满时丢弃的日志条数"""
+    return sum(getattr(handler, "dropped", 0) for handler in logger.handlers)
+
+
+def stop_logging():
+    """写完队列中剩余的日志并停止后台线程"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+setup_logging()
+atexit.register(stop_logging)
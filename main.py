@@ -1,28 +1,212 @@
-from typing import Dict
+from contextlib import asynccontextmanager
+import asyncio
+import importlib.util
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 import aiohttp
-from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, logger
+from fastapi import APIRouter, FastAPI, HTTPException, Request, Response, BackgroundTasks, logger
 import uvicorn
 import ssl
 import json
+import time
 
-from args import parse_args
-from config import ModelConfig, init_config
+from args import apply_worker_defaults, parse_args
+from config import (ModelConfig, ResilienceConfig, ServerConfig, init_config, get_server_config, get_model_config_by_name,
+                    get_tenant_by_api_key, PRIORITY_CLASSES)
+from config_watcher import ConfigWatcher
 from middleware import setup_middleware
-from log import logger
+from log import logger, setup_logging
+from auth_proxy import AuthProxy
+from body import RequestBody, find_usage, json_dumps, json_loads
+from admission import DEFAULT_FLOW, AdmissionRejected, Flow, init_admission_controller, get_admission_controller
+from ratelimit import create_backend, init_rate_limiter, get_rate_limiter, close_rate_limiter
+from cache import (CacheEntry, CacheRecorder, MultiRecorder, cache_directives, cache_key, init_response_cache,
+                   get_response_cache)
+from semantic import init_semantic_cache, get_semantic_cache
+from coalesce import init_coalescer, get_coalescer
+from batching import init_embedding_batcher, get_embedding_batcher
+from usage import create_sink, init_usage_pipeline, get_usage_pipeline, close_usage_pipeline, key_id
+from capture import init_traffic_capture, close_traffic_capture
+from metrics import (CACHE_REQUESTS, REQUESTS_ABORTED, TOKENS_TOTAL, UPSTREAM_CONNECTIONS, UPSTREAM_DURATION, UPSTREAM_RETRIES,
+                     clear_metrics_dir, init_metrics_exporter, get_metrics_exporter, close_metrics_exporter)
+from balancer import Replica, ReplicaPool, init_load_balancer, get_load_balancer, close_load_balancer
+from resilience import CircuitOpen, ModelResilience, backoff_delay, hedged, init_resilience, get_resilience
+from timeouts import (REQUEST_TIMEOUT_HEADER, StreamDeadlines, UpstreamTimeout, client_timeout, request_deadline,
+                      wait_until)
+from upstream import init_upstream_client, get_upstream_client, close_upstream_client
+from streaming import UpstreamStreamingResponse
 
-args = parse_args()
-init_config(args.config_path)
-app = FastAPI(title="Maas Gateway")
-# 设置中间件
-setup_middleware(app, args.auth_url)
+# 由create_app在每个worker进程中设置
+args = None
+auth_proxy: Optional[AuthProxy] = None
 
-@app.get("/health")
+
+def configure_logging(args):
+    setup_logging(
+        log_file=args.log_file,
+        level=args.log_level,
+        max_bytes=args.log_max_bytes,
+        backup_count=args.log_backup_count,
+        body_sample_rate=args.log_body_sample_rate,
+    )
+
+
+def create_app(argv: Optional[List[str]] = None) -> FastAPI:
+    """
+    应用工厂：解析命令行参数，初始化日志、配置和认证代理并创建应用
+
+    多worker时由uvicorn在每个worker进程中调用一次（worker进程的命令行参数与主进程相同）。
+    """
+    global args, auth_proxy
+    args = apply_worker_defaults(parse_args(argv))
+    configure_logging(args)
+    init_config(args.config_path)
+    auth_proxy = AuthProxy(
+        args.auth_url,
+        cache_ttl=args.auth_cache_ttl,
+        negative_ttl=args.auth_negative_ttl,
+        cache_size=args.auth_cache_size,
+        max_concurrency=args.auth_max_concurrency,
+    )
+    app = FastAPI(title="Maas Gateway", lifespan=lifespan)
+    app.include_router(router)
+    # 设置中间件
+    setup_middleware(app, args.auth_url, auth_proxy=auth_proxy, compression_min_bytes=args.compression_min_bytes,
+                     compression_encodings=args.compression.split(","), capture=bool(args.capture_file),
+                     max_decompressed_bytes=args.max_decompressed_bytes)
+    return app
+
+
+def __getattr__(name: str):
+    # 兼容 `uvicorn main:app` 及直接引用 main.app：首次访问时才创建应用
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时创建上游连接池，关闭时释放"""
+    init_upstream_client()
+    init_admission_controller(args.workers)
+    # 启动时即开始所有模型的副本健康检查
+    init_load_balancer().sync(get_server_config().model_config)
+    init_resilience()
+    init_coalescer()
+    init_embedding_batcher()
+    init_semantic_cache(embed=embed_text, max_entry_bytes=args.cache_max_entry_bytes)
+    init_response_cache(
+        max_bytes=args.cache_max_bytes,
+        max_entry_bytes=args.cache_max_entry_bytes,
+        disk_path=args.cache_dir,
+        disk_max_bytes=args.cache_disk_max_bytes,
+    )
+    init_rate_limiter(create_backend(
+        args.rate_limit_backend,
+        shm_path=args.rate_limit_shm_path,
+        redis_url=args.redis_url,
+        max_keys=args.rate_limit_max_keys,
+    ))
+    init_metrics_exporter(args.metrics_dir, args.metrics_flush_interval)
+    init_usage_pipeline(
+        sink=create_sink(args.usage_sink),
+        capacity=args.usage_buffer_size,
+        batch_size=args.usage_batch_size,
+        flush_interval=args.usage_flush_interval,
+        retention_minutes=args.usage_retention_minutes,
+        snapshot_dir=args.metrics_dir,
+    )
+    init_traffic_capture(
+        args.capture_file,
+        sample_rate=args.capture_sample_rate,
+        max_body_bytes=args.capture_max_body_bytes,
+        max_file_bytes=args.capture_max_file_bytes,
+    )
+    config_watcher = ConfigWatcher(args.config_path, args.config_reload_interval, on_reload=on_config_reload)
+    config_watcher.start()
+    try:
+        yield
+    finally:
+        # uvicorn已停止接收新连接并等待在途请求结束（最长 --graceful-timeout 秒）
+        logger.info("worker退出，释放资源")
+        await config_watcher.stop()
+        await close_usage_pipeline()
+        await close_traffic_capture()
+        await close_metrics_exporter()
+        await close_load_balancer()
+        await close_upstream_client()
+        await close_rate_limiter()
+        await auth_proxy.close()
+
+
+async def on_config_reload(new_config: ServerConfig):
+    """配置热更新后同步各组件：保留未变化模型的连接池，立即应用新的并发限制"""
+    get_upstream_client().sync(new_config.model_config, grace=args.timeout)
+    get_load_balancer().sync(new_config.model_config)
+    get_resilience().sync(new_config.model_config)
+    get_admission_controller().sync(new_config.model_config)
+
+
+router = APIRouter()
+
+# 不转发给上游的请求头：逐跳头，以及由aiohttp根据实际请求重新生成的头
+# （请求体已由中间件解压；上游响应的压缩由aiohttp协商并自动解压，再按客户端的Accept-Encoding重新压缩）
+HOP_BY_HOP_HEADERS = {
+    "host", "content-length", "transfer-encoding", "connection", "keep-alive",
+    "proxy-authorization", "proxy-connection", "te", "trailer", "upgrade",
+    "content-encoding", "accept-encoding",
+}
+
+@router.get("/health")
 async def health_check():
     """健康检查端点"""
     return {"status": "healthy", "service": "maas-gateway"}
 
 
-@app.post("/debug/json")
+@router.get("/upstream/stats")
+async def upstream_stats():
+    """上游连接池状态（使用中/空闲/等待数）、各模型准入队列状态、副本状态、熔断状态、响应缓存占用、语义缓存条目数、
+    合并中的请求数、凑批中的embedding输入数及待写入的用量记录数"""
+    return {
+        "pools": get_upstream_client().stats(),
+        "admission": get_admission_controller().stats(),
+        "replicas": get_load_balancer().stats(),
+        "resilience": get_resilience().stats(),
+        "cache": get_response_cache().stats(),
+        "semantic_cache": get_semantic_cache().stats(),
+        "coalesce": get_coalescer().stats(),
+        "batching": get_embedding_batcher().stats(),
+        "usage": get_usage_pipeline().stats(),
+    }
+
+
+@router.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus指标（多worker时为所有worker的汇总）"""
+    for model_name, pool in get_upstream_client().stats().items():
+        for state in ("in_use", "idle", "waiters"):
+            UPSTREAM_CONNECTIONS.set(pool[state], model_name, state)
+    content = await get_metrics_exporter().collect()
+    return Response(content=content, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@router.get("/usage")
+async def usage_endpoint(request: Request, since: Optional[float] = None, until: Optional[float] = None,
+                         model: Optional[str] = None, step: int = 60):
+    """
+    调用方（按Authorization中的token）在 [since, until) 内的用量，按step秒（60的整数倍）和模型分组
+
+    since/until为unix时间戳，默认为最近一小时；数据来自每分钟的预汇总，保留 --usage-retention-minutes 分钟。
+    """
+    if step < 60 or step % 60:
+        raise HTTPException(status_code=400, detail="step must be a positive multiple of 60 seconds")
+    now = time.time()
+    until = now + 60 if until is None else until
+    since = until - 3600 if since is None else since
+    return await get_usage_pipeline().query(key_id(bearer_token(request)), since, until, model, step // 60)
+
+
+@router.post("/debug/json")
 async def debug_json_endpoint(request: Request):
     """调试JSON解析问题的端点"""
     try:
@@ -30,7 +214,7 @@ async def debug_json_endpoint(request: Request):
         if body:
             body_str = body.decode('utf-8')
             logger.info(f"Debug - Request body length: {len(body_str)}")
-            logger.info(f"Debug - Request body: {body_str}")
+            logger.debug(f"Debug - Request body: {body_str}")
             
             try:
                 parsed = json.loads(body_str)
@@ -55,7 +239,7 @@ async def debug_json_endpoint(request: Request):
         return {"status": "error", "message": f"Unexpected error: {str(e)}"}
 
 
-@app.post("/{path:path}")
+@router.post("/{path:path}")
 async def dispatch(path: str, request: Request, background_tasks: BackgroundTasks):
     """
     处理API请求
@@ -83,9 +267,9 @@ async def handle_request(request: Request):
     uri = request.url.path
     logger.info(f"handle request: {uri}")
     
-    # 获取请求header并创建可变副本
-    headers = dict(request.headers)
-    logger.info(f"request headers: {headers}")
+    # 获取请求header并创建可变副本（去掉逐跳头和由aiohttp重新计算的头）
+    headers = {k: v for k, v in request.headers.items() if k not in HOP_BY_HOP_HEADERS}
+    logger.debug(f"request headers: {headers}")
     
     # 检查是否有模型配置（对于/v1/路径的请求）
     model_config = getattr(request.state, 'model_config', None)
@@ -95,63 +279,443 @@ async def handle_request(request: Request):
     
     api_key = model_config.api_key
     headers["authorization"] = f"Bearer {api_key}"
+    # 请求体以原始bytes转发，需保证上游按JSON解析
+    headers.setdefault("content-type", "application/json")
     
-    # 使用中间件已经解析的请求数据
-    request_data = getattr(request.state, 'request_data', {})
-    if not request_data:
-        # 如果没有中间件解析的数据，尝试直接解析（用于非/v1/路径的请求）
-        try:
-            # 注意：如果中间件已经消费了body，这里可能会失败
-            # 我们应该依赖中间件解析的数据
-            logger.warning("No request data from middleware, using empty dict")
-            request_data = {}
-        except Exception as e:
-            logger.error(f"Failed to parse request JSON: {e}")
-            request_data = {}
-    
-    is_stream = request_data.get("stream", False) # 流式请求
-    
-    if is_stream:
-        return await handle_stream_request(uri, headers, request_data, model_config)
+    # 使用中间件已经扫描的请求体（原始bytes + model/stream字段）
+    request_body = getattr(request.state, 'request_body', None)
+    if request_body is None:
+        logger.warning("No request body from middleware, using empty object")
+        request_body = RequestBody(b"{}")
+    
+    is_stream = request_body.stream # 流式请求
+    
+    # 命中响应缓存时直接返回，不占用上游并发名额
+    recorder = None
+    key = None
+    directives = cache_directives(request.headers.get("cache-control"))
+    cache = get_response_cache()
+    if cache is not None and cache.cacheable(model_config, request_body):
+        if "no-store" in directives:
+            CACHE_REQUESTS.inc(model_config.model_name, "bypass")
+        else:
+            key = cache_key(uri, request_body)
+            entry = None if "no-cache" in directives else await cache.get(key, is_stream)
+            if entry is not None:
+                CACHE_REQUESTS.inc(model_config.model_name, "hit")
+                return cached_response(entry, uri, request_body)
+            CACHE_REQUESTS.inc(model_config.model_name, "bypass" if "no-cache" in directives else "miss")
+            recorder = cache.recorder(key, model_config)
+    
+    # 精确匹配未命中时按问题的相似度查找语义缓存，只缓存非流式响应
+    semantic = get_semantic_cache()
+    if (semantic is not None and "no-store" not in directives
+            and semantic.eligible(model_config, uri, request_body)):
+        query = await semantic.query(uri, model_config, request_body)
+        if query is not None:
+            found = None if "no-cache" in directives else semantic.lookup(model_config, query)
+            if found is not None:
+                entry, similarity = found
+                response = cached_response(entry, uri, request_body)
+                response.headers["X-Semantic-Similarity"] = f"{similarity:.4f}"
+                return response
+            if not is_stream:
+                semantic_recorder = semantic.recorder(model_config, query)
+                recorder = semantic_recorder if recorder is None else MultiRecorder(recorder, semantic_recorder)
+    
+    # 整个请求（排队、重试、等待上游响应头）受截止时间限制，客户端断开时立即取消并关闭上游连接
+    model_name = model_config.model_name
+    deadline = request_deadline(model_config.timeout, request.headers.get(REQUEST_TIMEOUT_HEADER), args.timeout,
+                                asyncio.get_running_loop().time())
+    # 开启请求合并时，相同请求共享进行中的上游调用（客户端要求不使用缓存时不合并）
+    coalescer = get_coalescer()
+    batcher = get_embedding_batcher()
+    if (coalescer is not None and coalescer.eligible(model_config, request_body)
+            and not directives & {"no-cache", "no-store"}):
+        key = key or cache_key(uri, request_body)
+        
+        async def start(publish: Callable[[Optional[dict]], None]) -> Response:
+            async with asyncio.timeout_at(deadline):
+                return await forward_request(request, uri, headers, request_body, model_config, recorder, deadline,
+                                             publish)
+        
+        async def on_usage(usage: Optional[dict]):
+            # 跟随者没有自己的上游调用，按共享调用的用量记账并补扣token限流
+            await record_usage(request.state, model_config, usage, coalesced=True)
+        
+        forward = coalescer.join(f"{key}:{'stream' if is_stream else 'block'}", model_config, start, on_usage)
+    elif batcher is not None and batcher.eligible(model_config, uri, request_body):
+        # 开启微批时，并发的embedding请求合并为一次上游调用
+        forward = forward_batched(request, uri, headers, request_body, model_config, recorder, deadline)
     else:
-        return await handle_block_request(uri, headers, request_data, model_config)
-    
-
-async def handle_block_request(uri: str, headers: Dict[str, str], request_data: dict, model_config: ModelConfig):
-    #svc_addr = model_config.model_svc(model_config.model_name)
-    svc_addr = f"https://chat.cq.uban360.com:21008/{uri}"
-    print(f"handle block request to {svc_addr}")
-    
-    # 创建SSL上下文，跳过证书验证
-    '''
-    ssl_context = ssl.create_default_context()
-    ssl_context.check_hostname = False
-    ssl_context.verify_mode = ssl.CERT_NONE
-    
-    connector = aiohttp.TCPConnector(ssl=ssl_context)
-    '''
-    async with aiohttp.ClientSession() as session:
-        print(f"request_data: {request_data}")
-        print(f"headers: {headers}")
-        async with session.post(svc_addr, json=request_data, headers=headers) as response:
-            print(f"response: {response}")
+        forward = forward_request(request, uri, headers, request_body, model_config, recorder, deadline)
+    try:
+        async with asyncio.timeout_at(deadline):
+            response = await cancel_on_disconnect(request, forward)
+    except ClientDisconnected:
+        REQUESTS_ABORTED.inc(model_name, "client_disconnect")
+        logger.info(f"客户端在响应前断开，已取消上游请求: {uri}")
+        raise HTTPException(status_code=499, detail="Client closed request")
+    except UpstreamTimeout as e:
+        REQUESTS_ABORTED.inc(model_name, e.phase)
+        raise HTTPException(status_code=504, detail=str(e))
+    except aiohttp.ConnectionTimeoutError:
+        REQUESTS_ABORTED.inc(model_name, "connect")
+        raise HTTPException(status_code=504, detail="Upstream connect timeout")
+    except asyncio.TimeoutError:
+        REQUESTS_ABORTED.inc(model_name, "deadline")
+        raise HTTPException(status_code=504, detail="Request deadline exceeded")
+    except aiohttp.ClientError as e:
+        raise HTTPException(status_code=502, detail=f"Upstream error: {e}")
+    if recorder is not None:
+        response.headers["X-Cache"] = "MISS"
+    return response
+
+
+class ClientDisconnected(Exception):
+    """客户端在收到响应之前断开了连接"""
+
+
+async def wait_for_disconnect(request: Request):
+    # 请求体已由中间件读完，之后的receive只会在客户端断开（或响应结束）时返回
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable[Response]) -> Response:
+    """等待awaitable完成，期间客户端断开则取消它并抛出ClientDisconnected"""
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            return task.result()
+        raise ClientDisconnected()
+    finally:
+        watcher.cancel()
+        task.cancel()
+
+
+async def forward_request(request: Request, uri: str, headers: Dict[str, str], request_body: RequestBody,
+                          model_config: ModelConfig, recorder: Optional[CacheRecorder],
+                          deadline: Optional[float],
+                          publish_usage: Optional[Callable[[Optional[dict]], None]] = None) -> Response:
+    """经过准入控制后把请求转发给上游，publish_usage为请求合并时公布上游usage的回调"""
+    ticket = await admit(model_config, *request_scheduling(request))
+    
+    async def on_complete(usage: Optional[dict]):
+        # 非流式请求在读完响应后、流式请求在流结束后释放名额
+        ticket.release()
+        if publish_usage is not None:
+            publish_usage(usage)
+        await record_usage(request.state, model_config, usage)
+    
+    try:
+        if request_body.stream:
+            return await handle_stream_request(uri, headers, request_body, model_config, on_complete, recorder,
+                                               deadline)
+        response = await handle_block_request(uri, headers, request_body, model_config, on_complete)
+        if recorder is not None:
+            await recorder(response.body, response.media_type)
+        return response
+    except BaseException:
+        ticket.release()
+        raise
+
+
+async def forward_batched(request: Request, uri: str, headers: Dict[str, str], request_body: RequestBody,
+                          model_config: ModelConfig, recorder: Optional[CacheRecorder],
+                          deadline: Optional[float]) -> Response:
+    """把embedding请求加入微批，整批只占用一个准入名额，返回该请求对应的部分"""
+    priority, flow = request_scheduling(request)
+    
+    async def send(batch_body: RequestBody) -> Response:
+        # 由批次中第一个请求方的截止时间限制整批请求，名额也计入该请求方
+        ticket = await admit(model_config, priority, flow)
+        try:
+            async with asyncio.timeout_at(deadline):
+                return await handle_block_request(uri, headers, batch_body, model_config)
+        finally:
+            ticket.release()
+    
+    response_body, content_type, usage = await get_embedding_batcher().submit(uri, model_config, request_body, send)
+    await record_usage(request.state, model_config, usage)
+    if recorder is not None:
+        await recorder(response_body, content_type)
+    return Response(content=response_body, media_type=content_type)
+
+
+# 网关自身发起的上游请求（语义缓存的embedding）在准入队列中的流
+GATEWAY_FLOW = Flow("gateway", label="gateway")
+
+
+async def embed_text(model_name: str, text: str) -> List[float]:
+    """调用网关中配置的embedding模型计算文本的向量（语义缓存使用）"""
+    model_config = get_model_config_by_name(get_server_config(), model_name)
+    headers = {"authorization": f"Bearer {model_config.api_key}", "content-type": "application/json"}
+    request_body = RequestBody(json_dumps({"model": model_name, "input": text}), model_name)
+    deadline = request_deadline(model_config.timeout, None, args.timeout, asyncio.get_running_loop().time())
+    ticket = await admit(model_config, PRIORITY_CLASSES["normal"], GATEWAY_FLOW)
+    try:
+        async with asyncio.timeout_at(deadline):
+            response = await handle_block_request("/v1/embeddings", headers, request_body, model_config)
+    finally:
+        ticket.release()
+    return json_loads(response.body)["data"][0]["embedding"]
+
+
+def request_scheduling(request: Request) -> Tuple[int, Flow]:
+    """
+    调用方排队时的优先级和公平调度的流：配置了租户时为租户的优先级、租户名和权重，
+    否则为normal优先级、按token区分的流（权重1），未配置租户的调用方之间同样公平分享名额
+    """
+    server_config = getattr(request.state, 'server_config', None) or get_server_config()
+    token = bearer_token(request)
+    tenant = get_tenant_by_api_key(server_config, token)
+    if tenant is not None:
+        return tenant.priority_value, Flow(tenant.name, tenant.weight, tenant.name)
+    return PRIORITY_CLASSES["normal"], Flow("key:" + key_id(token))
+
+
+async def admit(model_config: ModelConfig, priority: int, flow: Flow = DEFAULT_FLOW):
+    """按模型限制并发，超出的请求按调用方优先级排队、同优先级内按租户权重公平调度，返回准入名额"""
+    try:
+        return await get_admission_controller().acquire(model_config, priority, flow)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.reason,
+                            headers={"Retry-After": str(e.retry_after)})
+
+
+def cached_response(entry: CacheEntry, uri: str, request_body: RequestBody) -> Response:
+    """由缓存条目构造响应，流式请求以SSE格式一次性返回，按stream_options.include_usage决定是否返回usage分片"""
+    headers = {"X-Cache": "HIT", "Age": str(int(max(0.0, time.time() - entry.created_at)))}
+    if request_body.stream:
+        headers["Cache-Control"] = "no-cache"
+        stream_options = request_body.data.get("stream_options")
+        include_usage = isinstance(stream_options, dict) and bool(stream_options.get("include_usage"))
+        return Response(content=entry.sse(uri, include_usage), media_type="text/event-stream", headers=headers)
+    return Response(content=entry.body, media_type=entry.content_type, headers=headers)
+
+
+def bearer_token(request: Request) -> Optional[str]:
+    """调用方在Authorization头中携带的token"""
+    _, _, token = request.headers.get("authorization", "").partition(" ")
+    return token.strip() or None
+
+
+async def record_usage(state, model_config: ModelConfig, usage: Optional[dict], coalesced: bool = False):
+    """
+    响应结束后处理上游返回的token用量，并留给用量记录中间件
+
+    coalesced表示请求合并的跟随者：用量来自共享的上游调用，同样计入调用方的用量记录和token限流，
+    但已由发起请求计入上游token指标，不重复统计。
+    """
+    state.usage = usage
+    state.coalesced = coalesced
+    if not usage:
+        return
+    if not coalesced:
+        TOKENS_TOTAL.inc(model_config.model_name, "prompt", amount=usage.get("prompt_tokens") or 0)
+        TOKENS_TOTAL.inc(model_config.model_name, "completion", amount=usage.get("completion_tokens") or 0)
+    rate_limiter = get_rate_limiter()
+    rate_limit_key = getattr(state, 'rate_limit_key', None)
+    if rate_limiter is not None and rate_limit_key is not None:
+        # 进入时已按预估扣减prompt token，这里补扣completion token及prompt token少估的部分
+        estimated = getattr(state, 'prompt_tokens', 0) or 0
+        tokens = (usage.get("completion_tokens") or 0) + max(0, (usage.get("prompt_tokens") or 0) - estimated)
+        await rate_limiter.charge_tokens(rate_limit_key, model_config, tokens)
+    
+
+def upstream_url(replica: Replica, uri: str) -> str:
+    """拼接上游副本地址，uri为以/开头的请求路径"""
+    return f"{replica.url}{uri}"
+
+
+def check_circuit(resilience: ModelResilience, policy: ResilienceConfig):
+    """模型熔断时直接返回503，不再请求上游"""
+    try:
+        resilience.breaker.allow(policy)
+    except CircuitOpen as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+async def send_block_request(pool: ReplicaPool, replica: Replica, uri: str, headers: Dict[str, str],
+                             request_body: RequestBody, model_config: ModelConfig,
+                             resilience: ModelResilience) -> Tuple[int, bytes, str]:
+    """向一个副本发送非流式请求并读完响应，返回(状态码, 响应体, Content-Type)"""
+    svc_addr = upstream_url(replica, uri)
+    logger.info(f"handle block request to {svc_addr}")
+    
+    # 复用模型对应的长连接池
+    session = get_upstream_client().session(model_config)
+    logger.debug(f"headers: {headers}")
+    start_time = time.perf_counter()
+    latency = None
+    failed = False
+    cancelled = False
+    timeout = model_config.timeout
+    first_byte_at = asyncio.get_running_loop().time() + timeout.first_byte if timeout.first_byte > 0 else None
+    try:
+        # 非流式响应在生成结束后才返回响应头，first_byte即等待响应头的时间
+        response = await wait_until(
+            session.post(svc_addr, data=request_body.payload(), headers=headers, timeout=client_timeout(timeout)),
+            first_byte_at, "first_byte")
+        async with response:
+            logger.debug(f"response: {response.status} {response.headers.get('Content-Type')}")
+            failed = response.status >= 500
+            UPSTREAM_DURATION.observe(time.perf_counter() - start_time, model_config.model_name)
+            # 原样返回上游响应体，不再解析和重新序列化
+            response_body = await response.read()
+            content_type = response.headers.get("Content-Type", "application/json")
+        latency = time.perf_counter() - start_time
+        if not failed:
+            resilience.latency.observe(latency)
+        return response.status, response_body, content_type
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        failed = True
+        raise
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        if cancelled:
+            # 被取消的请求（对冲落败、客户端断开、超过总超时）没有结果，不更新副本健康状态和延迟
+            pool.abandon(replica)
+        else:
+            pool.release(replica, None if failed else latency, failed)
+
+
+async def handle_block_request(uri: str, headers: Dict[str, str], request_body: RequestBody, model_config: ModelConfig,
+                               on_usage: Optional[Callable[[Optional[dict]], Awaitable[None]]] = None):
+    pool = get_load_balancer().for_model(model_config)
+    resilience = get_resilience().for_model(model_config)
+    policy = model_config.resilience
+    tried: List[Replica] = []
+    affinity = pool.affinity(request_body)
+    
+    def attempt() -> Awaitable[Tuple[int, bytes, str]]:
+        # 重试和对冲请求优先发往还没有尝试过的副本
+        replica = pool.choose(tried, affinity)
+        tried.append(replica)
+        return send_block_request(pool, replica, uri, headers, request_body, model_config, resilience)
+    
+    for retry in range(policy.max_retries + 1):
+        check_circuit(resilience, policy)
+        delay = resilience.hedge_delay(policy, len(pool.replicas))
+        try:
+            status, response_body, content_type = await hedged(
+                model_config.model_name, attempt, attempt, delay, lambda result: result[0] < 500)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            resilience.breaker.record(False, policy)
+            if retry >= policy.max_retries:
+                raise
+            reason = "error"
+        else:
+            resilience.breaker.record(status < 500, policy)
+            if status not in policy.retry_statuses or retry >= policy.max_retries:
+                break
+            reason = str(status)
+        UPSTREAM_RETRIES.inc(model_config.model_name, reason)
+        await asyncio.sleep(backoff_delay(policy, retry))
+    
+    if status != 200:
+        raise HTTPException(status_code=status, detail=response_body.decode("utf-8", errors="replace"))
+    if on_usage is not None:
+        await on_usage(find_usage(response_body))
+    return Response(content=response_body, status_code=status, media_type=content_type)
+            
+
+async def handle_stream_request(uri: str, headers: Dict[str, str], request_body: RequestBody, model_config: ModelConfig,
+                                on_usage: Optional[Callable[[Optional[dict]], Awaitable[None]]] = None,
+                                recorder: Optional[CacheRecorder] = None, deadline: Optional[float] = None):
+    start_time = time.perf_counter()
+    pool = get_load_balancer().for_model(model_config)
+    resilience = get_resilience().for_model(model_config)
+    policy = model_config.resilience
+    session = get_upstream_client().session(model_config)
+    timeout = model_config.timeout
+    loop = asyncio.get_running_loop()
+    tried: List[Replica] = []
+    affinity = pool.affinity(request_body)
+    
+    # 收到上游200响应头之前还没有向客户端发送任何数据，失败时可以换一个副本重试
+    for retry in range(policy.max_retries + 1):
+        check_circuit(resilience, policy)
+        replica = pool.choose(tried, affinity)
+        tried.append(replica)
+        svc_addr = upstream_url(replica, uri)
+        logger.info(f"handle stream request to {svc_addr}")
+        attempt_start = time.perf_counter()
+        attempt_started_at = loop.time()
+        first_byte_at = attempt_started_at + timeout.first_byte if timeout.first_byte > 0 else None
+        try:
+            response = await wait_until(
+                session.post(svc_addr, data=request_body.payload(), headers=headers, timeout=client_timeout(timeout)),
+                first_byte_at, "first_byte")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pool.release(replica, failed=True)
+            resilience.breaker.record(False, policy)
+            if retry >= policy.max_retries:
+                raise
+            reason = "error"
+        except asyncio.CancelledError:
+            pool.abandon(replica)
+            raise
+        except BaseException:
+            pool.release(replica)
+            raise
+        else:
             if response.status == 200:
-                response_data = await response.text()
-                print(f"response_data: {response_data}")
-                # 尝试解析为JSON，如果失败则返回原始文本
-                try:
-                    return json.loads(response_data)
-                except json.JSONDecodeError:
-                    return {"response": response_data}
-            else:
+                break
+            failed = response.status >= 500
+            pool.release(replica, failed=failed)
+            resilience.breaker.record(not failed, policy)
+            try:
                 error_text = await response.text()
+            finally:
+                response.release()
+            if response.status not in policy.retry_statuses or retry >= policy.max_retries:
                 raise HTTPException(status_code=response.status, detail=error_text)
-            
+            reason = str(response.status)
+        UPSTREAM_RETRIES.inc(model_config.model_name, reason)
+        await asyncio.sleep(backoff_delay(policy, retry))
+    
+    resilience.breaker.record(True, policy)
+    # 流式请求以收到响应头的时间作为副本延迟
+    latency = time.perf_counter() - attempt_start
+    UPSTREAM_DURATION.observe(latency, model_config.model_name)
+    
+    async def on_complete(usage: Optional[dict]):
+        pool.release(replica, latency)
+        if on_usage is not None:
+            await on_usage(usage)
+    
+    # 上游分片到达即转发给客户端，客户端断开时关闭上游连接
+    # 首个分片、分片间隔和整个流的超时在转发过程中检查
+    return UpstreamStreamingResponse(response, model_config.model_name, start_time, on_complete=on_complete,
+                                     recorder=recorder,
+                                     deadlines=StreamDeadlines(timeout, attempt_started_at, deadline))
 
-async def handle_stream_request(uri: str, headers: Dict[str, str], request_data: dict, model_config: ModelConfig):
-    pass
+
+def main():
+    run_args = apply_worker_defaults(parse_args())
+    configure_logging(run_args)
+    # uvicorn自动使用已安装的uvloop/httptools，未安装时使用asyncio/h11
+    loop_impl = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http_impl = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    logger.info(f"启动网关: workers={run_args.workers} loop={loop_impl} http={http_impl} "
+                f"rate_limit_backend={run_args.rate_limit_backend} metrics_dir={run_args.metrics_dir}")
+    options = dict(host=run_args.host, port=run_args.port, loop="auto", http="auto",
+                   timeout_graceful_shutdown=run_args.graceful_timeout)
+    if run_args.workers > 1:
+        # 各worker的计数器从0开始，清除上一次运行的快照以免重复计入
+        clear_metrics_dir(run_args.metrics_dir)
+        uvicorn.run("main:create_app", factory=True, workers=run_args.workers, **options)
+    else:
+        uvicorn.run(create_app(), **options)
 
 
 if __name__ == "__main__":
-    
-    uvicorn.run(app, host=args.host, port=args.port)
\ No newline at end of file
+    main()
@@ -0,0 +1,539 @@
+import asyncio
+import bisect
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from log import logger
+
+# 默认延迟分桶（秒），覆盖从毫秒级的token间隔到分钟级的长推理
+DEFAULT_LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0
+)
+# 请求体/响应体大小分桶（字节）
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+# token数分桶
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 131072, 262144)
+
+# 所有已创建的指标，/metrics 按创建顺序输出
+REGISTRY: List["_Metric"] = []
+
+
+class _Metric:
+    """
+    指标基类
+
+    每个worker进程只在事件循环线程中更新自己的指标，不需要加锁；
+    多worker时各自把dump()的结果写入共享目录，由 /metrics 合并。
+    """
+
+    type = ""
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        REGISTRY.append(self)
+
+    def dump(self) -> dict:
+        return {
+            "type": self.type,
+            "help": self.description,
+            "labels": list(self.label_names),
+            "values": [[list(labels), value] for labels, value in self.snapshot().items()],
+        }
+
+
+class Counter(_Metric):
+    """按标签值分别累加的计数器"""
+
+    type = "counter"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        super().__init__(name, description, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0)
+
+    def snapshot(self) -> Dict[Tuple[str, ...], float]:
+        return dict(self._values)
+
+
+class Gauge(_Metric):
+    """按标签值分别记录的当前值"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        super().__init__(name, description, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, *label_values: str):
+        self._values[label_values] = value
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) - amount
+
+    def value(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0)
+
+    def snapshot(self) -> Dict[Tuple[str, ...], float]:
+        return dict(self._values)
+
+
+class Histogram(_Metric):
+    """
+    分桶直方图
+
+    按标签值分别统计，每个标签组合只保存各桶计数、总和与样本数，
+    observe为O(log 桶数)，适合在请求热路径上调用。
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各桶计数..., +Inf桶计数], 总和
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *label_values: str):
+        counts = self._counts.get(label_values)
+        if counts is None:
+            counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+            self._sums[label_values] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[label_values] += value
+
+    def count(self, *label_values: str) -> int:
+        return sum(self._counts.get(label_values, ()))
+
+    def sum(self, *label_values: str) -> float:
+        return self._sums.get(label_values, 0.0)
+
+    def snapshot(self) -> Dict[Tuple[str, ...], dict]:
+        """返回各标签组合的分桶计数、总和与样本数"""
+        return {
+            labels: {"buckets": list(counts), "sum": self._sums[labels], "count": sum(counts)}
+            for labels, counts in self._counts.items()
+        }
+
+    def dump(self) -> dict:
+        data = super().dump()
+        data["buckets"] = list(self.buckets)
+        return data
+
+
+# 请求：按模型和状态码统计
+REQUESTS_TOTAL = Counter(
+    "maas_gateway_requests_total",
+    "API请求数",
+    ("model", "status"),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "maas_gateway_requests_in_flight",
+    "正在处理的API请求数",
+)
+REQUEST_DURATION = Histogram(
+    "maas_gateway_request_duration_seconds",
+    "API请求从进入网关到响应（包括流式响应）结束的时间",
+    ("model",),
+)
+UPSTREAM_DURATION = Histogram(
+    "maas_gateway_upstream_response_seconds",
+    "从发出上游请求到收到上游响应头的时间",
+    ("model",),
+)
+REQUEST_BODY_BYTES = Histogram(
+    "maas_gateway_request_body_bytes",
+    "请求体大小",
+    ("model",),
+    buckets=SIZE_BUCKETS,
+)
+RESPONSE_BODY_BYTES = Histogram(
+    "maas_gateway_response_body_bytes",
+    "响应体大小",
+    ("model",),
+    buckets=SIZE_BUCKETS,
+)
+RESPONSE_COMPRESSION_BYTES = Counter(
+    "maas_gateway_response_compression_bytes_total",
+    "压缩响应的字节数（stage为original压缩前、compressed压缩后）",
+    ("encoding", "stage"),
+)
+TOKENS_TOTAL = Counter(
+    "maas_gateway_tokens_total",
+    "上游返回的usage中的token数，type为prompt/completion",
+    ("model", "type"),
+)
+PROMPT_TOKENS_ESTIMATED = Histogram(
+    "maas_gateway_prompt_tokens_estimated",
+    "转发前估算的prompt token数",
+    ("model",),
+    buckets=TOKEN_BUCKETS,
+)
+REQUESTS_OVERSIZED = Counter(
+    "maas_gateway_requests_oversized_total",
+    "因请求过大而在转发前拒绝的请求数，reason为body_bytes/context_tokens",
+    ("model", "reason"),
+)
+UPSTREAM_CONNECTIONS = Gauge(
+    "maas_gateway_upstream_connections",
+    "上游连接池连接数，state为in_use/idle/waiters",
+    ("model", "state"),
+)
+REQUESTS_ABORTED = Counter(
+    "maas_gateway_requests_aborted_total",
+    "因超时或客户端断开而中止的请求数，reason为connect/first_byte/idle/deadline/client_disconnect",
+    ("model", "reason"),
+)
+
+# 流式请求：首token延迟与token间隔
+STREAM_TTFT = Histogram(
+    "maas_gateway_stream_time_to_first_token_seconds",
+    "流式请求从网关收到请求到向客户端发出首个分片的时间",
+    ("model",),
+)
+STREAM_INTER_TOKEN = Histogram(
+    "maas_gateway_stream_inter_token_seconds",
+    "流式请求相邻两个分片之间的间隔",
+    ("model",),
+)
+
+# 准入控制：每个模型的排队情况
+ADMISSION_IN_FLIGHT = Gauge(
+    "maas_gateway_admission_in_flight",
+    "已获得准入、正在处理的请求数",
+    ("model",),
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "maas_gateway_admission_queue_depth",
+    "等待准入的请求数",
+    ("model",),
+)
+ADMISSION_WAIT = Histogram(
+    "maas_gateway_admission_wait_seconds",
+    "请求在准入队列中的等待时间",
+    ("model", "priority"),
+)
+ADMISSION_TENANT_QUEUE_DEPTH = Gauge(
+    "maas_gateway_admission_tenant_queue_depth",
+    "各租户等待准入的请求数，未配置租户的调用方合计为other",
+    ("model", "tenant"),
+)
+ADMISSION_TENANT_WAIT = Histogram(
+    "maas_gateway_admission_tenant_wait_seconds",
+    "各租户的请求在准入队列中的等待时间，未配置租户的调用方合计为other",
+    ("model", "tenant"),
+)
+ADMISSION_REJECTED = Counter(
+    "maas_gateway_admission_rejected_total",
+    "准入控制拒绝的请求数",
+    ("model", "reason"),
+)
+
+# 负载均衡：被动剔除
+BALANCER_EJECTIONS = Counter(
+    "maas_gateway_upstream_ejections_total",
+    "连续失败被剔除的上游副本次数",
+    ("model", "replica"),
+)
+AFFINITY_ROUTING = Counter(
+    "maas_gateway_affinity_routing_total",
+    "prefix_affinity策略的选择结果，result为hit（前缀对应的首选副本）/fallback（首选副本过载或不可用）/none（请求没有可用的前缀）",
+    ("model", "result"),
+)
+
+# 响应缓存
+CACHE_REQUESTS = Counter(
+    "maas_gateway_cache_requests_total",
+    "响应缓存查询次数，result为hit/miss/bypass",
+    ("model", "result"),
+)
+CACHE_BYTES = Gauge(
+    "maas_gateway_cache_bytes",
+    "响应缓存占用的字节数",
+    ("tier",),
+)
+
+# 语义缓存
+SEMANTIC_CACHE_REQUESTS = Counter(
+    "maas_gateway_semantic_cache_requests_total",
+    "语义缓存查询次数，result为hit/miss/error（计算embedding失败）",
+    ("model", "result"),
+)
+SEMANTIC_CACHE_LOOKUP = Histogram(
+    "maas_gateway_semantic_cache_lookup_seconds",
+    "语义缓存查询耗时，stage为embed（计算embedding）或search（向量查找）",
+    ("model", "stage"),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5),
+)
+SEMANTIC_CACHE_SIMILARITY = Histogram(
+    "maas_gateway_semantic_cache_similarity",
+    "语义缓存中最相似条目的余弦相似度，用于调整threshold",
+    ("model",),
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.93, 0.95, 0.97, 0.99, 1.0),
+)
+
+# 相同请求合并
+COALESCED_REQUESTS = Counter(
+    "maas_gateway_coalesced_requests_total",
+    "参与请求合并的请求数，result为leader（发起上游请求）/follower（共享进行中的请求）/overflow（待发送数据超限被断开）",
+    ("model", "result"),
+)
+
+# embedding请求微批
+BATCH_SIZE = Histogram(
+    "maas_gateway_batch_size",
+    "每次发往上游的embedding微批包含的输入条数",
+    ("model",),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+BATCH_WAIT = Histogram(
+    "maas_gateway_batch_wait_seconds",
+    "embedding请求为凑批额外等待的时间",
+    ("model",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+
+# 用量记录
+USAGE_EVENTS = Counter(
+    "maas_gateway_usage_events_total",
+    "用量记录数，result为recorded（进入缓冲区）/written（已写入sink）/failed（写入失败待重试）/dropped（缓冲区满被丢弃）",
+    ("result",),
+)
+USAGE_FLUSH_DURATION = Histogram(
+    "maas_gateway_usage_flush_seconds",
+    "每批用量记录写入sink的耗时",
+)
+
+# 流量采集
+CAPTURED_REQUESTS = Counter(
+    "maas_gateway_capture_requests_total",
+    "流量采集的请求数，result为captured（已写入文件）/too_large（请求体超过上限）/invalid（请求体不是合法的JSON或UTF-8）/dropped（缓冲区满、文件达到上限或写入失败）",
+    ("result",),
+)
+
+# 上游重试、对冲请求与熔断
+UPSTREAM_RETRIES = Counter(
+    "maas_gateway_upstream_retries_total",
+    "上游请求重试次数，reason为上游状态码或error（连接错误/超时）",
+    ("model", "reason"),
+)
+UPSTREAM_HEDGES = Counter(
+    "maas_gateway_upstream_hedges_total",
+    "对冲请求数，result为sent（已发送）/won（先于原请求返回可用结果）",
+    ("model", "result"),
+)
+BREAKER_STATE = Gauge(
+    "maas_gateway_circuit_breaker_state",
+    "模型熔断状态：0关闭，1熔断，2半开",
+    ("model",),
+)
+BREAKER_REJECTED = Counter(
+    "maas_gateway_circuit_breaker_rejected_total",
+    "熔断期间直接拒绝的请求数",
+    ("model",),
+)
+
+
+def dump_all() -> Dict[str, dict]:
+    """当前进程所有指标的快照"""
+    return {metric.name: metric.dump() for metric in REGISTRY}
+
+
+def merge(snapshots: Sequence[Tuple[Dict[str, dict], bool]]) -> Dict[str, dict]:
+    """
+    合并多个worker的指标快照，snapshots为 (快照, 进程是否存活)
+
+    计数器和直方图累加；Gauge表示当前状态，只累加存活进程的值。
+    """
+    merged: Dict[str, dict] = {}
+    for snapshot, alive in snapshots:
+        for name, family in snapshot.items():
+            target = merged.setdefault(name, {**family, "values": {}})
+            if family["type"] == "gauge" and not alive:
+                continue
+            values = target["values"]
+            for labels, value in family["values"]:
+                key = tuple(labels)
+                if family["type"] == "histogram":
+                    current = values.get(key)
+                    if current is None:
+                        values[key] = {"buckets": list(value["buckets"]), "sum": value["sum"],
+                                       "count": value["count"]}
+                    elif len(current["buckets"]) == len(value["buckets"]):
+                        current["buckets"] = [a + b for a, b in zip(current["buckets"], value["buckets"])]
+                        current["sum"] += value["sum"]
+                        current["count"] += value["count"]
+                else:
+                    values[key] = values.get(key, 0) + value
+    return merged
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def render(families: Dict[str, dict]) -> str:
+    """按Prometheus文本格式输出合并后的指标"""
+    lines = []
+    for name, family in families.items():
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        label_names = family["labels"]
+        for labels, value in family["values"].items():
+            if family["type"] != "histogram":
+                lines.append(f"{name}{_labels(label_names, labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(family["buckets"]) + [float("inf")], value["buckets"]):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{name}_bucket{_labels(label_names, labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(label_names, labels)} {_number(value['sum'])}")
+            lines.append(f"{name}_count{_labels(label_names, labels)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MetricsExporter:
+    """
+    多worker指标汇总
+
+    每个worker定期把自己的指标快照写入共享目录（文件名为进程号），
+    任一worker收到 /metrics 请求时读取所有快照合并输出，自身使用实时值。
+    directory为None时只输出当前进程的指标。
+    """
+
+    def __init__(self, directory: Optional[str] = None, interval: float = 1.0):
+        self.directory = directory
+        self.interval = interval
+        self.pid = os.getpid()
+        self._task: Optional[asyncio.Task] = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        if self.directory and self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self._write, dump_all())
+            except OSError as e:
+                logger.warning(f"写入指标快照失败: {e}")
+
+    def _write(self, snapshot: Dict[str, dict]):
+        path = os.path.join(self.directory, f"{self.pid}.json")
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, path)
+
+    def _read_others(self) -> List[Tuple[Dict[str, dict], bool]]:
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                pid = int(name[:-5])
+            except ValueError:
+                continue
+            if pid == self.pid:
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                    snapshots.append((json.load(f), _pid_alive(pid)))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    async def collect(self) -> str:
+        snapshots = [(dump_all(), True)]
+        if self.directory:
+            snapshots += await asyncio.to_thread(self._read_others)
+        return render(merge(snapshots))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.directory:
+            # 退出前写入最终值，计数器在进程退出后仍计入汇总
+            try:
+                self._write(dump_all())
+            except OSError:
+                pass
+
+
+def clear_metrics_dir(directory: str):
+    """删除上一次运行留下的指标快照，在启动worker之前由主进程调用"""
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith(".json") or name.endswith(".tmp"):
+            try:
+                os.unlink(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+metrics_exporter: Optional[MetricsExporter] = None
+
+
+def init_metrics_exporter(directory: Optional[str] = None, interval: float = 1.0) -> MetricsExporter:
+    global metrics_exporter
+    metrics_exporter = MetricsExporter(directory, interval)
+    metrics_exporter.start()
+    return metrics_exporter
+
+
+def get_metrics_exporter() -> MetricsExporter:
+    global metrics_exporter
+    if metrics_exporter is None:
+        raise RuntimeError("指标汇总未初始化")
+    return metrics_exporter
+
+
+async def close_metrics_exporter():
+    global metrics_exporter
+    if metrics_exporter is not None:
+        await metrics_exporter.close()
+        metrics_exporter = None
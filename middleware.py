@@ -1,239 +1,723 @@
+import asyncio
+import math
 import time
+import uuid
 import logging
-from typing import Callable, Dict, Any
-from fastapi import Request, Response, HTTPException
+from typing import Dict, Any, Optional
+from fastapi import Request, HTTPException
 from fastapi.responses import JSONResponse
-import json
-from config import get_server_config, get_model_config_by_name
-from log import logger
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from auth_proxy import AuthBackendError, AuthProxy
+from body import BodyParseError, parse_request_body
+from compression import (DECOMPRESS_OFFLOAD_BYTES, MAX_DECOMPRESSED_BYTES, OFFLOAD_BYTES, DecompressedTooLarge,
+                         UnsupportedEncoding, available_encodings, compress, compressible, create_compressor,
+                         decompress, negotiate)
+from config import get_server_config, get_model_config_by_name, get_tenant_by_api_key
+from log import logger, request_id_var, sample_body_log
+from metrics import (REQUESTS_TOTAL, REQUESTS_IN_FLIGHT, REQUEST_DURATION, REQUEST_BODY_BYTES, RESPONSE_BODY_BYTES,
+                     PROMPT_TOKENS_ESTIMATED, REQUESTS_OVERSIZED, RESPONSE_COMPRESSION_BYTES)
+from ratelimit import get_rate_limiter
+from tokens import estimate_prompt_tokens
+from usage import UsageEvent, get_usage_pipeline, key_id
+from capture import get_traffic_capture
 
-# 配置日志
+# 认证服务不可用时建议客户端重试的等待秒数
+AUTH_RETRY_AFTER = 5
+
+# 所有中间件均为纯ASGI实现：直接透传receive/send，不包装响应流，
+# 流式响应的每个分片都能立即发给客户端并保持背压。
+
+
+def _path(scope: Scope) -> str:
+    return scope.get("path", "")
+
+
+def _state(scope: Scope) -> Dict[str, Any]:
+    """与 request.state 共享的请求状态字典"""
+    return scope.setdefault("state", {})
 
 
 class AuthMiddleware:
-    """认证中间件"""
-    
-    def __init__(self, auth_url: str):
+    """
+    认证中间件
+
+    token缺失或无效返回401；认证服务不可用（超时、连接失败、5xx）返回503和Retry-After，
+    客户端可以重试，不会误认为token无效。
+    """
+
+    def __init__(self, app: ASGIApp, auth_url: str, auth_proxy=None):
+        self.app = app
         self.auth_url = auth_url
-        from auth_proxy import AuthProxy
-        self.auth_proxy = AuthProxy(auth_url)
-    
-    async def __call__(self, request: Request, call_next: Callable) -> Response:
+        self.auth_proxy = auth_proxy or AuthProxy(auth_url)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         """处理认证"""
+        # 跳过健康检查、监控等不需要认证的路径
+        if scope["type"] != "http" or _path(scope) in ["/health", "/docs", "/upstream/stats", "/metrics"]:
+            await self.app(scope, receive, send)
+            return
+
         try:
-            # 跳过健康检查等不需要认证的路径
-            if request.url.path in ["/health", "/docs"]:
-                return await call_next(request)
-            
-            # 执行认证
-            self.auth_proxy.auth(request)
-            return await call_next(request)
-            
+            # 执行认证（异步，结果有缓存）
+            await self.auth_proxy.auth(Request(scope))
+        except AuthBackendError as e:
+            logger.error(f"认证服务不可用: {e}")
+            response = JSONResponse(
+                status_code=503,
+                content={"error": "Authentication service unavailable", "detail": str(e)},
+                headers={"Retry-After": str(AUTH_RETRY_AFTER)}
+            )
+            await response(scope, receive, send)
+            return
+        except HTTPException as e:
+            logger.error(f"认证失败: {e.detail}")
+            response = JSONResponse(
+                status_code=e.status_code,
+                content={"error": "Authentication failed", "detail": str(e.detail)}
+            )
+            await response(scope, receive, send)
+            return
         except Exception as e:
-            logger.error(f"认证失败: {e}")
-            return JSONResponse(
-                status_code=401,
-                content={"error": "Authentication failed", "detail": str(e)}
+            logger.error(f"认证异常: {e}")
+            response = JSONResponse(
+                status_code=500,
+                content={"error": "Internal server error during authentication", "detail": str(e)}
             )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
 
 
 class LoggingMiddleware:
-    """日志记录中间件"""
-    
-    async def __call__(self, request: Request, call_next: Callable) -> Response:
+    """
+    日志记录中间件
+
+    为每个请求分配请求ID（沿用客户端传入的X-Request-ID），写入日志上下文和响应头，
+    请求结束时输出一条结构化的访问日志。
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
         start_time = time.time()
-        
+        method, path = scope["method"], _path(scope)
+        status_code = 500
+        request_id = _request_id(scope)
+        token = request_id_var.set(request_id)
+        _state(scope)["request_id"] = request_id
+
         # 记录请求信息
-        logger.info(f"收到请求: {request.method} {request.url.path}")
-        
-        # 处理请求
-        response = await call_next(request)
-        
-        # 记录响应信息
-        process_time = time.time() - start_time
-        logger.info(f"请求完成: {request.method} {request.url.path} - 状态码: {response.status_code} - 耗时: {process_time:.3f}s")
-        
-        # 添加处理时间到响应头
-        response.headers["X-Process-Time"] = str(process_time)
-        
-        return response
+        logger.info(f"收到请求: {method} {path}")
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                # 添加处理时间（到响应头发出为止）到响应头
+                headers = MutableHeaders(scope=message)
+                headers["X-Process-Time"] = str(time.time() - start_time)
+                headers["X-Request-ID"] = request_id
+            await send(message)
+
+        try:
+            # 处理请求
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # 记录响应信息（流式响应在最后一个分片发出后记录）
+            process_time = time.time() - start_time
+            logger.info(f"请求完成: {method} {path} - 状态码: {status_code} - 耗时: {process_time:.3f}s",
+                        extra={"fields": {"method": method, "path": path, "status": status_code,
+                                          "duration_ms": round(process_time * 1000, 1)}})
+            request_id_var.reset(token)
+
+
+class MetricsMiddleware:
+    """
+    请求指标中间件
+
+    统计 /v1/ 请求的数量（按模型、状态码）、总耗时（流式响应到最后一个分片）、
+    请求体/响应体大小和正在处理的请求数。模型在请求结束后从请求状态中读取，
+    未通过模型验证的请求记为 unknown。
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not _path(scope).startswith("/v1/"):
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = 500
+        response_bytes = 0
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code, response_bytes
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            state = _state(scope)
+            model_config = state.get("model_config")
+            model = model_config.model_name if model_config is not None else "unknown"
+            REQUESTS_TOTAL.inc(model, str(status_code))
+            REQUEST_DURATION.observe(time.perf_counter() - start_time, model)
+            RESPONSE_BODY_BYTES.observe(response_bytes, model)
+            request_body = state.get("request_body")
+            if request_body is not None:
+                REQUEST_BODY_BYTES.observe(len(request_body), model)
+
+
+class UsageMiddleware:
+    """
+    用量记录中间件
+
+    /v1/ 请求结束时（流式响应在最后一个分片发出后）把调用方、模型、上游返回的token用量、
+    耗时和状态码交给用量记录管道，只在内存中记录，不做I/O。未通过模型验证的请求不记录。
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        pipeline = get_usage_pipeline()
+        if scope["type"] != "http" or pipeline is None or not _path(scope).startswith("/v1/"):
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            state = _state(scope)
+            model_config = state.get("model_config")
+            if model_config is not None:
+                # 上游返回的用量由main.record_usage写入请求状态，缓存命中等没有上游调用的请求为0
+                usage = state.get("usage") or {}
+                token = _bearer_token(scope)
+                tenant = get_tenant_by_api_key(state.get("server_config") or get_server_config(), token)
+                pipeline.record(UsageEvent(
+                    time.time(), key_id(token), model_config.model_name, status_code,
+                    round((time.perf_counter() - start_time) * 1000, 1),
+                    prompt_tokens=usage.get("prompt_tokens") or 0,
+                    completion_tokens=usage.get("completion_tokens") or 0,
+                    path=_path(scope), request_id=state.get("request_id"),
+                    tenant=tenant.name if tenant is not None else None,
+                    coalesced=bool(state.get("coalesced")),
+                ))
+
+
+class CaptureMiddleware:
+    """
+    流量采集中间件（--capture-file 开启时才加入中间件栈）
+
+    按采样比例把通过模型验证的 /v1/ 请求（解压后的原始请求体、开始时间、状态码和耗时）
+    交给流量采集，由后台任务写入JSONL文件，用于 replay.py 重放。
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        capture = get_traffic_capture()
+        if scope["type"] != "http" or capture is None or not _path(scope).startswith("/v1/") or not capture.sampled():
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.time()
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            state = _state(scope)
+            model_config = state.get("model_config")
+            request_body = state.get("request_body")
+            if model_config is not None and request_body is not None:
+                tenant = get_tenant_by_api_key(state.get("server_config") or get_server_config(), _bearer_token(scope))
+                capture.record((started_at, _path(scope), model_config.model_name,
+                                tenant.name if tenant is not None else None, status_code,
+                                round((time.perf_counter() - start_time) * 1000, 1), request_body.raw))
+
+
+def _request_id(scope: Scope) -> str:
+    """沿用客户端或上层代理传入的请求ID，否则生成新的"""
+    for name, value in scope.get("headers", ()):
+        if name == b"x-request-id" and 0 < len(value) <= 128:
+            return value.decode("latin-1")
+    return uuid.uuid4().hex
+
+
+class BodyTooLarge(Exception):
+    """请求体超过所有模型的请求体大小限制"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"Request body exceeds {limit} bytes")
+        self.limit = limit
+
+
+def _body_too_large(model: str, limit: int) -> JSONResponse:
+    REQUESTS_OVERSIZED.inc(model, "body_bytes")
+    return JSONResponse(
+        status_code=413,
+        content={"error": "Request body too large", "detail": f"Request body exceeds {limit} bytes"}
+    )
+
+
+class ModelValidationMiddleware:
+    """
+    模型验证中间件
+
+    带Content-Encoding的请求体先解压（不支持的编码返回415），解压结果不超过max_decompressed_bytes，
+    较大的请求体在线程中解压。
+    同时在转发前检查请求大小：请求体超过限制返回413（还不知道模型时按所有模型中最大的限制，
+    Content-Length超限或读到超限时立即拒绝，不再读取剩余部分）；估算的prompt token数
+    加上max_tokens超过模型上下文长度返回400。估算结果写入请求状态供限流使用。
+    """
+
+    def __init__(self, app: ASGIApp, max_decompressed_bytes: int = MAX_DECOMPRESSED_BYTES):
+        self.app = app
+        self.max_decompressed_bytes = max_decompressed_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        # 只对API请求进行模型验证
+        if scope["type"] != "http" or not _path(scope).startswith("/v1/"):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            # 请求处理过程中始终使用进入时的配置快照，不受热更新影响
+            server_config = get_server_config()
+            # 获取请求体，读完后通过replay_receive交给后续处理
+            body = await self._read_body(scope, receive, server_config.max_body_bytes)
+            if body:
+                limits = [limit for limit in (server_config.max_body_bytes, self.max_decompressed_bytes) if limit > 0]
+                body = await self._decode_body(scope, body, min(limits, default=0))
+                if isinstance(body, JSONResponse):
+                    await body(scope, receive, send)
+                    return
+                error_response = self._validate(scope, body, server_config)
+                if error_response is not None:
+                    await error_response(scope, receive, send)
+                    return
+        except BodyTooLarge as e:
+            await _body_too_large("unknown", e.limit)(scope, receive, send)
+            return
+        except ConnectionError as e:
+            # 客户端已断开，无需响应
+            logger.info(f"{e}: {_path(scope)}")
+            return
+        except Exception as e:
+            logger.error(f"模型验证失败: {e}")
+            response = JSONResponse(
+                status_code=500,
+                content={"error": "Internal server error during model validation", "detail": str(e)}
+            )
+            await response(scope, receive, send)
+            return
+
+        body_replayed = False
+
+        async def replay_receive() -> Message:
+            nonlocal body_replayed
+            if not body_replayed:
+                body_replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # 之后的receive用于感知客户端断开
+            return await receive()
+
+        await self.app(scope, replay_receive, send)
+
+    @staticmethod
+    async def _read_body(scope: Scope, receive: Receive, limit: int = 0) -> bytes:
+        """读取完整请求体，limit大于0时超过该字节数抛出BodyTooLarge"""
+        if limit > 0:
+            for name, value in scope.get("headers", ()):
+                if name == b"content-length" and value.isdigit() and int(value) > limit:
+                    raise BodyTooLarge(limit)
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionError("客户端在请求体发送完成前断开")
+            chunk = message.get("body", b"")
+            if chunk:
+                chunks.append(chunk)
+                size += len(chunk)
+                if 0 < limit < size:
+                    raise BodyTooLarge(limit)
+            if not message.get("more_body", False):
+                break
+        # 单个分片时直接使用，避免额外拷贝
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+    @staticmethod
+    async def _decode_body(scope: Scope, body: bytes, limit: int = 0):
+        """
+        按Content-Encoding解压请求体，返回解压后的请求体或错误响应
+
+        解压后去掉Content-Encoding和Content-Length请求头，后续处理和转发都按未压缩的请求体进行；
+        解压结果同样受请求体大小限制，超过时抛出BodyTooLarge。
+        """
+        content_encoding = None
+        for name, value in scope.get("headers", ()):
+            if name == b"content-encoding":
+                content_encoding = value.decode("latin-1")
+        if content_encoding is None:
+            return body
+        try:
+            if len(body) > DECOMPRESS_OFFLOAD_BYTES:
+                body = await asyncio.to_thread(decompress, body, content_encoding, limit)
+            else:
+                body = decompress(body, content_encoding, limit)
+        except DecompressedTooLarge as e:
+            raise BodyTooLarge(e.limit)
+        except UnsupportedEncoding as e:
+            return JSONResponse(status_code=415, content={"error": "Unsupported Content-Encoding", "detail": str(e)})
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": "Invalid compressed request body",
+                                                          "detail": str(e)})
+        scope["headers"] = [(name, value) for name, value in scope["headers"]
+                            if name not in (b"content-encoding", b"content-length")]
+        return body
+
+    @staticmethod
+    def _validate(scope: Scope, body: bytes, server_config):
+        """校验请求体、模型和请求大小，通过时写入请求状态并返回None，否则返回错误响应"""
+        if sample_body_log():
+            # 请求体日志量大，只按比例采样记录
+            logger.info("request body", extra={"fields": {
+                "body_length": len(body),
+                "body_preview": body[:500].decode('utf-8', errors='replace'),
+            }})
+
+        # 只扫描出 model/stream 字段，原始bytes保留并原样转发给上游
+        try:
+            request_body = parse_request_body(body)
+        except BodyParseError as e:
+            logger.error(f"JSON decode error: {e}")
+            # 空请求体或不是JSON对象
+            if e.pos is None:
+                return JSONResponse(
+                    status_code=400,
+                    content={"error": e.message}
+                )
+            logger.error(f"Body around error: {body[max(0, e.pos-50):e.pos+50]!r}")
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "error": "Invalid JSON in request body",
+                    "detail": f"JSON decode error: {str(e)}",
+                    "position": e.pos
+                }
+            )
+        # 存储请求体到请求状态中
+        state = _state(scope)
+        state["request_body"] = request_body
+
+        model_name = request_body.model
+
+        if not model_name or not isinstance(model_name, str):
+            return JSONResponse(
+                status_code=400,
+                content={"error": "Model name is required"}
+            )
+
+        # 验证模型是否存在
+        try:
+            state["server_config"] = server_config
+            model_config = get_model_config_by_name(server_config, model_name)
+            # 将模型配置添加到请求状态中
+            state["model_config"] = model_config
+        except ValueError as e:
+            return JSONResponse(
+                status_code=400,
+                content={"error": f"Invalid model: {str(e)}"}
+            )
+
+        if 0 < model_config.max_body_bytes < len(body):
+            return _body_too_large(model_name, model_config.max_body_bytes)
+        # 需要按估算值拒绝请求（或扣减token限额）时解析请求体，只计入文本部分
+        parse = model_config.max_context_tokens > 0 or model_config.rate_limit.tokens_per_minute > 0
+        prompt_tokens = estimate_prompt_tokens(request_body, model_config.tokenizer, parse)
+        state["prompt_tokens"] = prompt_tokens
+        PROMPT_TOKENS_ESTIMATED.observe(prompt_tokens, model_name)
+        max_tokens = request_body.max_tokens
+        if not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens < 0:
+            max_tokens = 0
+        if 0 < model_config.max_context_tokens < prompt_tokens + max_tokens:
+            REQUESTS_OVERSIZED.inc(model_name, "context_tokens")
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "error": "Context length exceeded",
+                    "detail": f"Estimated prompt tokens ({prompt_tokens}) plus max_tokens ({max_tokens}) "
+                              f"exceed the model's context length ({model_config.max_context_tokens})",
+                    "prompt_tokens": prompt_tokens,
+                    "max_context_tokens": model_config.max_context_tokens
+                }
+            )
+        return None
+
+
+class CompressionMiddleware:
+    """
+    响应压缩中间件
+
+    按Accept-Encoding在encodings（服务端偏好顺序，默认zstd、br、gzip中已安装的）中协商编码。
+    非流式响应小于min_bytes时不压缩，大响应在线程中压缩；SSE流式响应的每个分片压缩后立即flush，
+    客户端收到即可解码，不会因压缩而延迟。已经编码过或类型不适合压缩的响应原样透传。
+    """
+
+    def __init__(self, app: ASGIApp, min_bytes: int = 1024, encodings=None):
+        self.app = app
+        self.min_bytes = min_bytes
+        self.encodings = available_encodings(encodings)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self.encodings:
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = ""
+        for name, value in scope.get("headers", ()):
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        encoding = negotiate(accept_encoding, self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor = None
+        stream = False
+
+        async def send_wrapper(message: Message):
+            nonlocal start_message, compressor, stream
+            if message["type"] == "http.response.start":
+                # 看到第一个响应体分片后才能决定是否压缩
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                start, start_message = start_message, None
+                headers = MutableHeaders(raw=start["headers"])
+                stream = headers.get("content-type", "").startswith("text/event-stream")
+                if ("content-encoding" in headers or not compressible(headers.get("content-type", ""))
+                        or (not stream and not more_body and len(body) < self.min_bytes)):
+                    await send(start)
+                    await send(message)
+                    return
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if not more_body:
+                    # 完整的非流式响应一次性压缩，保留Content-Length
+                    if len(body) >= OFFLOAD_BYTES:
+                        data = await asyncio.to_thread(compress, body, encoding)
+                    else:
+                        data = compress(body, encoding)
+                    RESPONSE_COMPRESSION_BYTES.inc(encoding, "original", amount=len(body))
+                    RESPONSE_COMPRESSION_BYTES.inc(encoding, "compressed", amount=len(data))
+                    headers["Content-Length"] = str(len(data))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": data, "more_body": False})
+                    return
+                if "content-length" in headers:
+                    del headers["Content-Length"]
+                compressor = create_compressor(encoding)
+                await send(start)
+            if compressor is None:
+                await send(message)
+                return
+            data = compressor.compress(body)
+            if not more_body:
+                data += compressor.finish()
+            elif stream:
+                data += compressor.flush()
+            RESPONSE_COMPRESSION_BYTES.inc(encoding, "original", amount=len(body))
+            RESPONSE_COMPRESSION_BYTES.inc(encoding, "compressed", amount=len(data))
+            if data or not more_body:
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
+        if start_message is not None:
+            # 没有响应体分片的响应
+            await send(start_message)
 
 
 class ErrorHandlingMiddleware:
     """错误处理中间件"""
-    
-    async def __call__(self, request: Request, call_next: Callable) -> Response:
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        response_started = False
+
+        async def send_wrapper(message: Message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
         try:
-            return await call_next(request)
+            await self.app(scope, receive, send_wrapper)
         except HTTPException:
             # 重新抛出HTTP异常
             raise
         except Exception as e:
             logger.error(f"未处理的异常: {e}", exc_info=True)
-            return JSONResponse(
+            if response_started:
+                # 响应已经开始发送，无法再改为错误响应
+                raise
+            response = JSONResponse(
                 status_code=500,
                 content={"error": "Internal server error", "detail": str(e)}
             )
+            await response(scope, receive, send)
 
 
 class RateLimitingMiddleware:
-    """速率限制中间件"""
-    
-    def __init__(self):
-        self.request_counts: Dict[str, int] = {}
-        self.last_reset = time.time()
-        self.max_requests = 100  # 每分钟最大请求数
-        self.reset_interval = 60  # 重置间隔（秒）
-    
-    async def __call__(self, request: Request, call_next: Callable) -> Response:
-        # 获取客户端IP
-        client_ip = request.client.host if request.client else "unknown"
-        
-        # 检查是否需要重置计数器
-        current_time = time.time()
-        if current_time - self.last_reset > self.reset_interval:
-            self.request_counts.clear()
-            self.last_reset = current_time
-        
+    """
+    速率限制中间件
+
+    按 API token（没有token时按客户端IP）+ 模型 做令牌桶限流，限额来自模型的 rate_limit 配置。
+    需要在模型验证之后执行。
+    """
+
+    def __init__(self, app: ASGIApp, rate_limiter=None):
+        self.app = app
+        self.rate_limiter = rate_limiter
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        rate_limiter = self.rate_limiter or get_rate_limiter()
+        state = scope.get("state", {})
+        model_config = state.get("model_config")
+        if scope["type"] != "http" or rate_limiter is None or model_config is None:
+            await self.app(scope, receive, send)
+            return
+
+        client_key = _client_key(scope)
+        state["rate_limit_key"] = client_key
+        # 模型验证时已估算prompt token数
+        prompt_tokens = state.get("prompt_tokens")
+        if prompt_tokens is None:
+            request_body = state.get("request_body")
+            prompt_tokens = estimate_prompt_tokens(request_body) if request_body is not None else 0
+
         # 检查速率限制
-        if client_ip in self.request_counts:
-            if self.request_counts[client_ip] >= self.max_requests:
-                return JSONResponse(
-                    status_code=429,
-                    content={"error": "Rate limit exceeded", "detail": "Too many requests"}
-                )
-            self.request_counts[client_ip] += 1
-        else:
-            self.request_counts[client_ip] = 1
-        
-        return await call_next(request)
+        retry_after = await rate_limiter.acquire(client_key, model_config, prompt_tokens)
+        if retry_after > 0:
+            response = JSONResponse(
+                status_code=429,
+                content={"error": "Rate limit exceeded", "detail": "Too many requests"},
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+            await response(scope, receive, send)
+            return
+
+        await self.app(scope, receive, send)
+
+
+def _bearer_token(scope: Scope) -> Optional[str]:
+    """调用方在Authorization头中携带的token"""
+    for name, value in scope.get("headers", ()):
+        if name == b"authorization":
+            _, _, token = value.decode("latin-1").partition(" ")
+            return token.strip() or None
+    return None
+
+
+def _client_key(scope: Scope) -> str:
+    """限流key：优先使用Authorization中的token，没有时使用客户端IP"""
+    token = _bearer_token(scope)
+    if token:
+        return "token:" + token
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
 
 
 class CORSMiddleware:
     """CORS中间件"""
-    
-    async def __call__(self, request: Request, call_next: Callable) -> Response:
-        response = await call_next(request)
-        
-        # 添加CORS头
-        response.headers["Access-Control-Allow-Origin"] = "*"
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-        response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-        
-        return response
-
-
-def setup_middleware(app, auth_url: str):
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                # 添加CORS头
+                headers = MutableHeaders(scope=message)
+                headers["Access-Control-Allow-Origin"] = "*"
+                headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
+                headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def setup_middleware(app, auth_url: str, auth_proxy=None, compression_min_bytes: int = 1024,
+                     compression_encodings=None, capture: bool = False,
+                     max_decompressed_bytes: int = MAX_DECOMPRESSED_BYTES):
     """设置所有中间件"""
-    
-    # 添加中间件（注意顺序很重要）
-    #app.add_middleware(ErrorHandlingMiddleware)
-    
-    @app.middleware("http")
-    async def logging_middleware(request: Request, call_next: Callable) -> Response:
-        start_time = time.time()
-        
-        # 记录请求信息
-        logger.info(f"收到请求: {request.method} {request.url.path}")
-        
-        # 处理请求
-        response = await call_next(request)
-        
-        # 记录响应信息
-        process_time = time.time() - start_time
-        logger.info(f"请求完成: {request.method} {request.url.path} - 状态码: {response.status_code} - 耗时: {process_time:.3f}s")
-        
-        # 添加处理时间到响应头
-        response.headers["X-Process-Time"] = str(process_time)
-        
-        return response
-    
-    @app.middleware("http")
-    async def model_validation_middleware(request: Request, call_next: Callable) -> Response:
-        # 只对API请求进行模型验证
-        if request.url.path.startswith("/v1/"):
-            try:
-                # 获取请求体
-                body = await request.body()
-                if body:
-                    try:
-                        # 尝试解码为字符串，然后解析JSON
-                        body_str = body.decode('utf-8')
-                        logger.info(f"Request body length: {len(body_str)}")
-                        logger.info(f"Request body (first 500 chars): {body_str[:500]}")
-                        
-                        # 检查是否有明显的JSON格式问题
-                        if body_str.strip() == "":
-                            logger.error("Empty request body")
-                            return JSONResponse(
-                                status_code=400,
-                                content={"error": "Empty request body"}
-                            )
-                        
-                        # 检查是否以 { 开头
-                        if not body_str.strip().startswith('{'):
-                            logger.error(f"Request body does not start with '{{': {body_str[:100]}")
-                            return JSONResponse(
-                                status_code=400,
-                                content={"error": "Request body must be valid JSON object"}
-                            )
-                        
-                        request_data = json.loads(body_str)
-                        print(f"request_data: {request_data}")
-                        # 存储解析后的请求数据到request.state中
-                        request.state.request_data = request_data.copy()
-                        # 存储原始body字符串以便调试
-                        request.state.request_body_str = body_str
-                        
-                        model_name = request_data.get("model")
-                        
-                        if not model_name:
-                            return JSONResponse(
-                                status_code=400,
-                                content={"error": "Model name is required"}
-                            )
-                        
-                        # 验证模型是否存在
-                        try:
-                            server_config = get_server_config()
-                            print(f"model_name: {model_name}, server_config: {server_config}")
-                            model_config = get_model_config_by_name(server_config, model_name)
-                            # 将模型配置添加到请求状态中
-                            request.state.model_config = model_config
-                        except ValueError as e:
-                            return JSONResponse(
-                                status_code=400,
-                                content={"error": f"Invalid model: {str(e)}"}
-                            )
-                    except UnicodeDecodeError as e:
-                        logger.error(f"Failed to decode request body as UTF-8: {e}")
-                        logger.error(f"Body bytes: {body[:100]}")
-                        return JSONResponse(
-                            status_code=400,
-                            content={"error": "Invalid request encoding", "detail": "Request body must be valid UTF-8"}
-                        )
-                    except json.JSONDecodeError as e:
-                        logger.error(f"JSON decode error: {e}")
-                        logger.error(f"Error position: {e.pos}")
-                        logger.error(f"Body around error: {body_str[max(0, e.pos-50):e.pos+50]}")
-                        return JSONResponse(
-                            status_code=400,
-                            content={
-                                "error": "Invalid JSON in request body",
-                                "detail": f"JSON decode error: {str(e)}",
-                                "position": e.pos if hasattr(e, 'pos') else None
-                            }
-                        )
-                
-            except Exception as e:
-                logger.error(f"模型验证失败: {e}")
-                return JSONResponse(
-                    status_code=500,
-                    content={"error": "Internal server error during model validation", "detail": str(e)}
-                )
-        
-        return await call_next(request)
-    
-    #app.add_middleware(RateLimitingMiddleware)
-    # app.add_middleware(AuthMiddleware, auth_url=auth_url)
-    #app.add_middleware(CORSMiddleware)
\ No newline at end of file
+
+    # 添加中间件（注意顺序很重要）：后添加的在外层、先执行
+    # 实际执行顺序：错误处理 -> 日志 -> 指标 -> 流量采集（开启时） -> 用量 -> 压缩 -> 认证 -> 模型验证 -> 限流 -> 路由
+    # 限流依赖模型验证解析出的模型配置
+    app.add_middleware(RateLimitingMiddleware)
+    app.add_middleware(ModelValidationMiddleware, max_decompressed_bytes=max_decompressed_bytes)
+    # 认证在模型验证之前执行，未通过认证的请求不再读取请求体
+    app.add_middleware(AuthMiddleware, auth_url=auth_url, auth_proxy=auth_proxy)
+    # 压缩在指标之内，响应体大小指标统计实际发送的字节数
+    app.add_middleware(CompressionMiddleware, min_bytes=compression_min_bytes, encodings=compression_encodings)
+    # 用量记录的耗时与指标一致（流式响应到最后一个分片）
+    app.add_middleware(UsageMiddleware)
+    # 流量采集只在开启时加入，不采集时不增加开销
+    if capture:
+        app.add_middleware(CaptureMiddleware)
+    # 指标在认证之外，认证失败的请求也计入
+    app.add_middleware(MetricsMiddleware)
+    #app.add_middleware(CORSMiddleware)
+    app.add_middleware(LoggingMiddleware)
+    app.add_middleware(ErrorHandlingMiddleware)
@@ -0,0 +1,317 @@
+import asyncio
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+from config import ModelConfig, RateLimitConfig
+from log import logger
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # redis为可选依赖，仅在使用redis后端时需要
+    aioredis = None
+
+
+# GCRA（通用信元速率算法，等价于令牌桶）：
+# 每个key只保存一个"理论到达时间"TAT。消耗cost个令牌会把TAT推后 cost * interval，
+# 只要推后的TAT不超过 当前时间 + burst * interval 就允许通过。
+# TAT早于当前时间的key等价于满桶，可以随时丢弃而不影响限流结果。
+
+# 一次判定涉及的令牌桶：(key, 消耗的令牌数, 每个令牌的间隔秒数, 突发容量)
+Bucket = Tuple[str, float, float, float]
+
+
+def gcra(tat: float, now: float, cost: float, interval: float, burst: float) -> Tuple[float, float]:
+    """
+    计算一次GCRA判定
+
+    Returns:
+        (新的TAT, 需要等待的秒数)；等待秒数为0表示允许通过，此时应保存新的TAT
+    """
+    tat = max(tat, now)
+    new_tat = tat + cost * interval
+    # 单次消耗超过桶容量时，只要桶是满的就放行（之后按欠额限流）
+    allow_at = new_tat - burst * interval if cost <= burst else tat
+    if allow_at > now:
+        return tat, allow_at - now
+    return new_tat, 0.0
+
+
+class MemoryBackend:
+    """
+    进程内后端
+
+    OrderedDict按最近使用排序，超过max_keys时淘汰最久未使用的key；
+    每次访问顺带清理队首已空闲（TAT已过期）的key，内存占用有上界且为O(1)操作。
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._tats: "OrderedDict[str, float]" = OrderedDict()
+
+    async def acquire(self, key: str, cost: float, interval: float, burst: float) -> float:
+        return await self.acquire_all([(key, cost, interval, burst)])
+
+    async def acquire_all(self, buckets: Sequence[Bucket]) -> float:
+        """所有桶都允许时才一起扣减，否则都不扣减，返回最长的等待秒数"""
+        now = time.monotonic()
+        results = [gcra(self._tats.get(key, 0.0), now, cost, interval, burst)
+                   for key, cost, interval, burst in buckets]
+        retry_after = max((wait for _, wait in results), default=0.0)
+        if retry_after == 0.0:
+            for (key, _, _, _), (new_tat, _) in zip(buckets, results):
+                self._store(key, new_tat, now)
+        return retry_after
+
+    async def charge(self, key: str, cost: float, interval: float, burst: float):
+        now = time.monotonic()
+        self._store(key, max(self._tats.get(key, 0.0), now) + cost * interval, now)
+
+    def _store(self, key: str, tat: float, now: float):
+        self._tats[key] = tat
+        self._tats.move_to_end(key)
+        # 清理空闲key
+        for _ in range(2):
+            oldest_key, oldest_tat = next(iter(self._tats.items()))
+            if oldest_tat > now or oldest_key == key:
+                break
+            del self._tats[oldest_key]
+        while len(self._tats) > self.max_keys:
+            self._tats.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._tats)
+
+    async def close(self):
+        pass
+
+
+class SharedMemoryBackend:
+    """
+    同一节点多进程共享的后端
+
+    状态保存在mmap映射的文件中：固定数量的槽位，每个槽位为(key哈希, TAT)，
+    按哈希线性探测；找不到时复用空闲槽位，没有空闲槽位则覆盖TAT最早的槽位。
+    读改写在fcntl文件锁内完成，临界区只有几次内存访问；锁被其他worker持有时在事件循环中等待重试。
+    文件在重启后仍然保留，TAT使用墙上时间：单调时钟在重启后从头计时，旧的TAT会长时间限流。
+    """
+
+    SLOT = struct.Struct("<Qd")
+    PROBES = 8
+    LOCK_RETRY_INTERVAL = 0.0005
+
+    def __init__(self, path: str, slots: int = 65536):
+        self.path = path
+        self.slots = slots
+        size = self.SLOT.size * slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._mmap = mmap.mmap(self._fd, size)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        # 0 表示空槽位
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") | 1
+
+    def _locate(self, key_hash: int, now: float) -> Tuple[int, float]:
+        """返回(槽位偏移, 当前TAT)，key不存在时返回可复用的槽位且TAT为0"""
+        start = key_hash % self.slots
+        victim, victim_tat = None, None
+        for i in range(self.PROBES):
+            offset = ((start + i) % self.slots) * self.SLOT.size
+            slot_hash, tat = self.SLOT.unpack_from(self._mmap, offset)
+            if slot_hash == key_hash:
+                return offset, tat
+            if slot_hash == 0 or tat <= now:
+                if victim is None or victim_tat > 0.0:
+                    victim, victim_tat = offset, 0.0
+            elif victim is None or tat < victim_tat:
+                victim, victim_tat = offset, tat
+        return victim, 0.0
+
+    async def _update(self, buckets: Sequence[Bucket], force: bool) -> float:
+        key_hashes = [self._hash(key) for key, _, _, _ in buckets]
+        # 非阻塞加锁，其他worker持有锁时让出事件循环稍后重试，不阻塞本worker的其他请求
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(self.LOCK_RETRY_INTERVAL)
+        # 加锁后的读改写中没有await，同一进程内的协程之间也不会交错
+        try:
+            now = time.time()
+            new_tats: List[float] = []
+            retry_after = 0.0
+            for key_hash, (_, cost, interval, burst) in zip(key_hashes, buckets):
+                _, tat = self._locate(key_hash, now)
+                if force:
+                    new_tat, wait = max(tat, now) + cost * interval, 0.0
+                else:
+                    new_tat, wait = gcra(tat, now, cost, interval, burst)
+                new_tats.append(new_tat)
+                retry_after = max(retry_after, wait)
+            if retry_after == 0.0:
+                # 逐个重新定位后写入，多个key不会占用同一个空闲槽位
+                for key_hash, new_tat in zip(key_hashes, new_tats):
+                    offset, _ = self._locate(key_hash, now)
+                    self.SLOT.pack_into(self._mmap, offset, key_hash, new_tat)
+            return retry_after
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    async def acquire(self, key: str, cost: float, interval: float, burst: float) -> float:
+        return await self._update([(key, cost, interval, burst)], force=False)
+
+    async def acquire_all(self, buckets: Sequence[Bucket]) -> float:
+        return await self._update(buckets, force=False)
+
+    async def charge(self, key: str, cost: float, interval: float, burst: float):
+        await self._update([(key, cost, interval, burst)], force=True)
+
+    async def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+
+class RedisBackend:
+    """多节点共享的后端：GCRA在Lua脚本中原子执行，空闲key由过期时间自动清理"""
+
+    # KEYS为各个桶，ARGV[1]为是否强制扣减，之后每个桶依次为 cost, interval, burst；
+    # 所有桶都允许时才一起写入，返回最长的等待秒数
+    SCRIPT = """
+    local now_parts = redis.call('TIME')
+    local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+    local force = ARGV[1] == '1'
+    local new_tats = {}
+    local wait = 0
+    for i, key in ipairs(KEYS) do
+        local cost = tonumber(ARGV[i * 3 - 1])
+        local interval = tonumber(ARGV[i * 3])
+        local burst = tonumber(ARGV[i * 3 + 1])
+        local tat = tonumber(redis.call('GET', key) or '0')
+        if tat < now then tat = now end
+        local new_tat = tat + cost * interval
+        if not force then
+            local allow_at = tat
+            if cost <= burst then allow_at = new_tat - burst * interval end
+            if allow_at - now > wait then wait = allow_at - now end
+        end
+        new_tats[i] = new_tat
+    end
+    if wait > 0 then return tostring(wait) end
+    for i, key in ipairs(KEYS) do
+        redis.call('SET', key, tostring(new_tats[i]), 'PX', math.ceil((new_tats[i] - now) * 1000) + 1000)
+    end
+    return '0'
+    """
+
+    def __init__(self, url: str, prefix: str = "maas_gateway:ratelimit:"):
+        if aioredis is None:
+            raise RuntimeError("使用redis限流后端需要安装redis: pip install redis")
+        self.prefix = prefix
+        self._client = aioredis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def _key(self, key: str) -> str:
+        return self.prefix + hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+    async def acquire(self, key: str, cost: float, interval: float, burst: float) -> float:
+        return await self.acquire_all([(key, cost, interval, burst)])
+
+    async def acquire_all(self, buckets: Sequence[Bucket]) -> float:
+        args = [0]
+        for _, cost, interval, burst in buckets:
+            args += [cost, interval, burst]
+        result = await self._script(keys=[self._key(key) for key, _, _, _ in buckets], args=args)
+        return float(result)
+
+    async def charge(self, key: str, cost: float, interval: float, burst: float):
+        await self._script(keys=[self._key(key)], args=[1, cost, interval, burst])
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class RateLimiter:
+    """
+    按 (API token, 模型) 限流
+
+    每个模型可配置请求速率和token速率两种限制（RateLimitConfig），两者都允许时才扣减；
+    token限制在请求进入时按预估的prompt token数扣减，响应结束后再按实际completion token数补扣。
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def acquire(self, client_key: str, model_config: ModelConfig, prompt_tokens: int = 0) -> float:
+        """
+        判断请求是否允许通过
+
+        Returns:
+            0 表示允许，否则为建议客户端等待的秒数
+        """
+        limits = model_config.rate_limit
+        key = f"{client_key}:{model_config.model_name}"
+        buckets: List[Bucket] = []
+        if limits.requests_per_minute > 0:
+            buckets.append((key + ":req", 1, 60.0 / limits.requests_per_minute, limits.request_burst_size))
+        if limits.tokens_per_minute > 0 and prompt_tokens > 0:
+            buckets.append((key + ":tok", prompt_tokens, 60.0 / limits.tokens_per_minute, limits.token_burst_size))
+        if not buckets:
+            return 0.0
+        # 两个桶一起判定：被token限制拒绝的请求不占用请求速率的额度
+        return await self.backend.acquire_all(buckets)
+
+    async def charge_tokens(self, client_key: str, model_config: ModelConfig, tokens: int):
+        """扣减响应实际产生的token数（不拒绝，超额部分让后续请求等待）"""
+        limits = model_config.rate_limit
+        if limits.tokens_per_minute <= 0 or tokens <= 0:
+            return
+        key = f"{client_key}:{model_config.model_name}:tok"
+        await self.backend.charge(key, tokens, 60.0 / limits.tokens_per_minute, limits.token_burst_size)
+
+    async def close(self):
+        await self.backend.close()
+
+
+def create_backend(name: str, shm_path: Optional[str] = None, redis_url: Optional[str] = None,
+                   max_keys: int = 100000):
+    """根据名称创建限流后端：memory / shm / redis"""
+    if name == "memory":
+        return MemoryBackend(max_keys=max_keys)
+    if name == "shm":
+        return SharedMemoryBackend(shm_path or "/tmp/maas_gateway_ratelimit.shm", slots=max_keys)
+    if name == "redis":
+        if not redis_url:
+            raise ValueError("redis限流后端需要指定 --redis-url")
+        return RedisBackend(redis_url)
+    raise ValueError(f"未知的限流后端: {name}")
+
+
+rate_limiter: Optional[RateLimiter] = None
+
+
+def init_rate_limiter(backend) -> RateLimiter:
+    global rate_limiter
+    rate_limiter = RateLimiter(backend)
+    logger.info(f"限流后端: {type(backend).__name__}")
+    return rate_limiter
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    global rate_limiter
+    return rate_limiter
+
+
+async def close_rate_limiter():
+    global rate_limiter
+    if rate_limiter is not None:
+        await rate_limiter.close()
+        rate_limiter = None
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+流量重放
+
+读取网关以 --capture-file 采集的JSONL文件，按请求的原始时间间隔（可用 --speed 压缩或拉长）
+向网关重新发送，--concurrency 限制同时进行的请求数（达到上限时请求推迟发送，推迟的时间记为send_lag）。
+按模型输出状态码分布、延迟和首字节延迟（TTFT）分位数，并与采集时的延迟对比，
+用于在本地（如对接 fake_upstream.py）复现生产环境的负载形态。
+
+用法: python replay.py capture.jsonl [--url http://127.0.0.1:8000] [--speed 1.0] [--concurrency 0]
+                       [--api-key sk-xxx] [--tenant-key internal=sk-xxx] [--model deepseek-chat]
+                       [--limit 1000] [--json replay.json]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from bench_e2e import percentiles, summarize
+from body import json_dumps
+
+# 每个请求的结果：(记录下标, 状态码, 总耗时, 首字节耗时, 推迟发送的时间)，状态码0表示连接错误或超时
+Sample = Tuple[int, int, float, float, float]
+
+
+def load_capture(path: str, models: Optional[List[str]] = None, limit: int = 0) -> List[dict]:
+    """读取采集文件，按请求开始时间排序；跳过无法解码或解析的行（如写入中途被截断的最后一行）"""
+    records = []
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record, dict) or not isinstance(record.get("ts"), (int, float)):
+                continue
+            if models and record.get("model") not in models:
+                continue
+            records.append(record)
+    records.sort(key=lambda record: record["ts"])
+    return records[:limit] if limit > 0 else records
+
+
+def schedule(records: List[dict], speed: float) -> List[float]:
+    """各请求相对第一个请求的发送时间（秒），speed为时间压缩倍数，0表示不等待、尽快发送"""
+    if not records or speed <= 0:
+        return [0.0] * len(records)
+    first = records[0]["ts"]
+    return [(record["ts"] - first) / speed for record in records]
+
+
+async def replay(records: List[dict], url: str, speed: float = 1.0, concurrency: int = 0,
+                 api_key: Optional[str] = None, tenant_keys: Optional[Dict[str, str]] = None,
+                 timeout: float = 300.0) -> Tuple[List[Sample], float]:
+    """按计划时间发送所有请求，返回各请求的结果和总耗时"""
+    offsets = schedule(records, speed)
+    semaphore = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+    samples: List[Sample] = []
+    tenant_keys = tenant_keys or {}
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0),
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async def one(index: int, record: dict, due: float):
+            headers = {"Content-Type": "application/json"}
+            token = tenant_keys.get(record.get("tenant")) or api_key
+            if token:
+                headers["Authorization"] = f"Bearer {token}"
+            if semaphore is not None:
+                await semaphore.acquire()
+            try:
+                start = time.perf_counter()
+                lag = max(0.0, start - due)
+                first_byte = None
+                try:
+                    async with session.post(url.rstrip("/") + record["path"], data=json_dumps(record["body"]),
+                                            headers=headers) as response:
+                        async for _ in response.content.iter_any():
+                            if first_byte is None:
+                                first_byte = time.perf_counter() - start
+                        status = response.status
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    status = 0
+                latency = time.perf_counter() - start
+                samples.append((index, status, latency, first_byte if first_byte is not None else latency, lag))
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+
+        start = time.perf_counter()
+        tasks = []
+        for index, (record, offset) in enumerate(zip(records, offsets)):
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one(index, record, start + offset)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return samples, elapsed
+
+
+def report(records: List[dict], samples: List[Sample], elapsed: float) -> Dict[str, dict]:
+    """按模型（及all合计）汇总重放结果，captured_latency_ms为采集时网关记录的延迟"""
+    groups: Dict[str, List[Sample]] = defaultdict(list)
+    for sample in samples:
+        groups[records[sample[0]]["model"]].append(sample)
+        groups["all"].append(sample)
+    results = {}
+    for model, group in sorted(groups.items()):
+        result = summarize([(status, latency, first_byte) for _, status, latency, first_byte, _ in group], elapsed)
+        result["send_lag_ms"] = percentiles([sample[4] for sample in group])
+        captured = [records[sample[0]] for sample in group]
+        result["captured_latency_ms"] = percentiles([record["latency_ms"] / 1000 for record in captured
+                                                     if record.get("status") == 200])
+        results[model] = result
+    return results
+
+
+def print_results(results: Dict[str, dict]):
+    print(f"{'model':>20} | {'requests':>8} | {'errors':>6} | {'rps':>7} | {'p50 ms':>8} | {'p95 ms':>8} | "
+          f"{'p99 ms':>8} | {'ttft p50':>8} | {'captured p95':>12} | {'lag p95':>8}")
+    for model, result in results.items():
+        latency, ttft = result["latency_ms"], result["ttft_ms"]
+        captured, lag = result["captured_latency_ms"], result["send_lag_ms"]
+        print(f"{model:>20} | {result['requests']:>8} | {result['errors']:>6} | {result['throughput_rps']:>7.1f} | "
+              f"{latency.get('p50', 0):>8.1f} | {latency.get('p95', 0):>8.1f} | {latency.get('p99', 0):>8.1f} | "
+              f"{ttft.get('p50', 0):>8.1f} | {captured.get('p95', 0):>12.1f} | {lag.get('p95', 0):>8.1f}")
+    statuses = results.get("all", {}).get("statuses", {})
+    print(f"\n状态码: {statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture", type=str, help="网关 --capture-file 采集的JSONL文件")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000", help="重放目标网关地址")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="时间压缩倍数：2表示以两倍速率发送，0表示不等待、尽快发送")
+    parser.add_argument("--concurrency", type=int, default=0, help="同时进行的最大请求数，0表示不限制")
+    parser.add_argument("--api-key", type=str, default=None, help="重放请求使用的API token")
+    parser.add_argument("--tenant-key", action="append", default=[], metavar="TENANT=TOKEN",
+                        help="采集时属于该租户的请求使用的token（可重复指定），其余请求使用 --api-key")
+    parser.add_argument("--model", action="append", default=None, help="只重放这些模型的请求（可重复指定）")
+    parser.add_argument("--limit", type=int, default=0, help="最多重放的请求数，0表示全部")
+    parser.add_argument("--timeout", type=float, default=300.0, help="单个请求的超时时间（秒）")
+    parser.add_argument("--json", type=str, default=None, help="结果保存路径")
+    args = parser.parse_args()
+
+    tenant_keys = dict(item.split("=", 1) for item in args.tenant_key)
+    records = load_capture(args.capture, args.model, args.limit)
+    if not records:
+        parser.error(f"采集文件中没有可重放的请求: {args.capture}")
+    span = records[-1]["ts"] - records[0]["ts"]
+    print(f"重放 {len(records)} 个请求，采集时长 {span:.1f}s，speed={args.speed}，concurrency={args.concurrency}\n")
+
+    samples, elapsed = asyncio.run(replay(records, args.url, args.speed, args.concurrency, args.api_key,
+                                          tenant_keys, args.timeout))
+    results = report(records, samples, elapsed)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"capture": args.capture, "speed": args.speed, "concurrency": args.concurrency,
+                       "results": results}, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Mapping, Optional, TypeVar
+
+from config import ModelConfig, ResilienceConfig
+from log import logger
+from metrics import BREAKER_REJECTED, BREAKER_STATE, UPSTREAM_HEDGES
+
+T = TypeVar("T")
+
+# 计算对冲延迟使用的最近上游延迟样本数
+LATENCY_WINDOW = 200
+# 样本数达到此值后才发送对冲请求，样本太少时P95没有意义
+HEDGE_MIN_SAMPLES = 20
+
+_BREAKER_STATES = {"closed": 0, "open": 1, "half_open": 2}
+
+
+class CircuitOpen(Exception):
+    """模型处于熔断状态，请求不再发往上游"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Upstream circuit open")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    单个模型的熔断器
+
+    连续失败（连接错误、超时或5xx）达到breaker_threshold次后熔断breaker_open_time秒，
+    期间直接拒绝请求；之后进入半开状态放行一个试探请求，成功则恢复，失败则再次熔断。
+    试探请求没有结果（如客户端断开）时，breaker_open_time秒后再放行下一个。
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.state = "closed"
+        self.failures = 0
+        self._retry_at = 0.0
+
+    def _set_state(self, state: str):
+        self.state = state
+        BREAKER_STATE.set(_BREAKER_STATES[state], self.model_name)
+
+    def allow(self, config: ResilienceConfig):
+        """
+        检查是否可以向上游发送请求
+
+        Raises:
+            CircuitOpen: 处于熔断状态，或半开状态下已有试探请求
+        """
+        if config.breaker_threshold <= 0 or self.state == "closed":
+            return
+        now = time.monotonic()
+        if now < self._retry_at:
+            BREAKER_REJECTED.inc(self.model_name)
+            raise CircuitOpen(max(1, math.ceil(self._retry_at - now)))
+        self._set_state("half_open")
+        self._retry_at = now + config.breaker_open_time
+
+    def record(self, success: bool, config: ResilienceConfig):
+        if success:
+            self.failures = 0
+            if self.state != "closed":
+                self._set_state("closed")
+                logger.info(f"上游熔断恢复: {self.model_name}")
+            return
+        self.failures += 1
+        if config.breaker_threshold <= 0:
+            return
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= config.breaker_threshold):
+            self._retry_at = time.monotonic() + config.breaker_open_time
+            self._set_state("open")
+            logger.warning(f"上游熔断: {self.model_name} 连续失败{self.failures}次，"
+                           f"{config.breaker_open_time:.0f}s内直接拒绝请求")
+
+
+class LatencyWindow:
+    """最近LATENCY_WINDOW个成功请求的上游延迟，P95每积累一定样本后重新计算"""
+
+    def __init__(self):
+        self._samples: deque = deque(maxlen=LATENCY_WINDOW)
+        self._p95: Optional[float] = None
+        self._stale = 0
+
+    def observe(self, latency: float):
+        self._samples.append(latency)
+        self._stale += 1
+
+    def p95(self) -> Optional[float]:
+        if len(self._samples) < HEDGE_MIN_SAMPLES:
+            return None
+        if self._p95 is None or self._stale >= HEDGE_MIN_SAMPLES:
+            ordered = sorted(self._samples)
+            self._p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            self._stale = 0
+        return self._p95
+
+
+class ModelResilience:
+    """单个模型的熔断器和延迟统计"""
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.breaker = CircuitBreaker(model_name)
+        self.latency = LatencyWindow()
+
+    def hedge_delay(self, config: ResilienceConfig, replicas: int) -> Optional[float]:
+        """
+        发送对冲请求前的等待时间，None表示不对冲（未开启、只有一个副本或延迟样本不足）
+
+        熔断器不处于关闭状态时不对冲，半开状态下只发送一个试探请求。
+        """
+        if not config.hedge or replicas < 2 or self.breaker.state != "closed":
+            return None
+        p95 = self.latency.p95()
+        if p95 is None:
+            return None
+        return max(config.hedge_min_delay, p95)
+
+    def stats(self) -> dict:
+        return {
+            "breaker": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "latency_p95": self.latency.p95(),
+        }
+
+
+def backoff_delay(config: ResilienceConfig, attempt: int) -> float:
+    """第attempt次重试（从0开始）前的等待时间：full jitter指数退避"""
+    return random.uniform(0, min(config.retry_backoff_max, config.retry_backoff * (2 ** attempt)))
+
+
+async def hedged(model_name: str, primary: Callable[[], Awaitable[T]], backup: Callable[[], Awaitable[T]],
+                 delay: Optional[float], acceptable: Callable[[T], bool]) -> T:
+    """
+    发送primary，delay秒内未完成时再发送backup，返回先得到的可接受结果并取消另一个
+
+    两个都不可接受（异常或acceptable返回False）时，返回/抛出后完成的那个的结果。
+    """
+    if delay is None:
+        return await primary()
+    first = asyncio.ensure_future(primary())
+    pending = {first}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            pending.add(asyncio.ensure_future(backup()))
+            UPSTREAM_HEDGES.inc(model_name, "sent")
+        last = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                last = task
+                if task.exception() is None and acceptable(task.result()):
+                    if task is not first:
+                        UPSTREAM_HEDGES.inc(model_name, "won")
+                    return task.result()
+        return last.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class ResilienceManager:
+    """按模型管理熔断器和延迟统计"""
+
+    def __init__(self):
+        self._models: Dict[str, ModelResilience] = {}
+
+    def for_model(self, model_config: ModelConfig) -> ModelResilience:
+        resilience = self._models.get(model_config.model_name)
+        if resilience is None:
+            resilience = ModelResilience(model_config.model_name)
+            self._models[model_config.model_name] = resilience
+        return resilience
+
+    def sync(self, model_configs: Mapping[str, ModelConfig]):
+        """配置更新后移除已删除模型的状态"""
+        for model_name in list(self._models):
+            if model_name not in model_configs:
+                del self._models[model_name]
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: resilience.stats() for name, resilience in self._models.items()}
+
+
+resilience_manager: Optional[ResilienceManager] = None
+
+
+def init_resilience() -> ResilienceManager:
+    global resilience_manager
+    resilience_manager = ResilienceManager()
+    return resilience_manager
+
+
+def get_resilience() -> ResilienceManager:
+    global resilience_manager
+    if resilience_manager is None:
+        raise RuntimeError("重试与熔断未初始化")
+    return resilience_manager
@@ -0,0 +1,281 @@
+import hashlib
+import math
+import re
+import time
+import zlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from body import RequestBody
+from cache import CacheEntry, canonical_json
+from config import ModelConfig
+from log import logger
+from metrics import SEMANTIC_CACHE_LOOKUP, SEMANTIC_CACHE_REQUESTS, SEMANTIC_CACHE_SIMILARITY
+
+try:
+    import numpy
+except ImportError:  # numpy为可选依赖，未安装时逐条计算相似度
+    numpy = None
+
+# 向量矩阵的初始行数，写满后按倍数扩容直到max_entries
+_INITIAL_ROWS = 64
+_WORD = re.compile(r"\w+")
+
+# 由embedding模型名称和文本计算向量，由main注入（调用网关中配置的embedding模型）
+Embed = Callable[[str, str], Awaitable[Sequence[float]]]
+
+
+def _normalized(vector: Sequence[float]) -> Optional[List[float]]:
+    """L2归一化后的向量（余弦相似度即为点积），零向量返回None"""
+    norm = math.sqrt(sum(x * x for x in vector))
+    if norm == 0:
+        return None
+    return [x / norm for x in vector]
+
+
+def local_embedding(text: str, dimensions: int) -> List[float]:
+    """
+    本地替代的embedding：词和字符三元组哈希到固定维数（带符号），不调用模型
+
+    只能识别字面上相近的问题（大小写、空白、标点、少量词语不同），不理解同义改写。
+    """
+    text = " ".join(text.lower().split())
+    vector = [0.0] * dimensions
+    features = [(word, 1.0) for word in _WORD.findall(text)]
+    padded = f" {text} "
+    features.extend((padded[i:i + 3], 0.5) for i in range(len(padded) - 2))
+    for feature, weight in features:
+        h = zlib.crc32(feature.encode("utf-8"))
+        vector[h % dimensions] += weight if h & 0x80000000 else -weight
+    return vector
+
+
+def query_text(data: dict) -> Optional[str]:
+    """请求中最后一条消息（须为user消息）的文本"""
+    messages = data.get("messages")
+    if not isinstance(messages, list) or not messages or not isinstance(messages[-1], dict):
+        return None
+    message = messages[-1]
+    if message.get("role") != "user":
+        return None
+    content = message.get("content")
+    if isinstance(content, list):
+        content = "\n".join(part["text"] for part in content
+                            if isinstance(part, dict) and isinstance(part.get("text"), str))
+    return content if isinstance(content, str) and content.strip() else None
+
+
+def query_scope(uri: str, data: dict) -> str:
+    """
+    除最后一条消息的内容外请求完全相同（系统提示、历史消息、参数）的请求属于同一范围，
+    只在同一范围内按相似度查找
+    """
+    messages = list(data["messages"])
+    messages[-1] = {key: value for key, value in messages[-1].items() if key != "content"}
+    canonical = canonical_json({**data, "messages": messages})
+    return hashlib.sha256(f"{uri}\n{canonical}".encode("utf-8")).hexdigest()
+
+
+class VectorIndex:
+    """
+    有容量上限的向量索引
+
+    归一化向量按行存放（安装了numpy时为float32矩阵，以矩阵乘法批量计算相似度），
+    按范围分组后只与同一范围的向量比较；条目按LRU淘汰，过期条目在查到时删除。
+    """
+
+    def __init__(self, dimensions: int, capacity: int):
+        self.dimensions = dimensions
+        self.capacity = capacity
+        if numpy is not None:
+            self.rows = numpy.zeros((min(_INITIAL_ROWS, capacity), dimensions), dtype=numpy.float32)
+        else:
+            self.rows: List[Optional[List[float]]] = []
+        # 行号 -> (范围, 缓存条目)，按最近使用排序
+        self.entries: "OrderedDict[int, Tuple[str, CacheEntry]]" = OrderedDict()
+        self.by_scope: Dict[str, Set[int]] = {}
+        self.free: List[int] = []
+        self.used = 0
+
+    def search(self, vector: List[float], scope: str) -> Optional[Tuple[int, float]]:
+        """同一范围中与vector最相似的条目，返回(行号, 余弦相似度)"""
+        slots = self.by_scope.get(scope)
+        if not slots:
+            return None
+        if numpy is not None:
+            index = numpy.fromiter(slots, dtype=numpy.intp, count=len(slots))
+            similarities = self.rows[index] @ numpy.asarray(vector, dtype=numpy.float32)
+            best = int(similarities.argmax())
+            return int(index[best]), float(similarities[best])
+        return max(((slot, sum(a * b for a, b in zip(self.rows[slot], vector))) for slot in slots),
+                   key=lambda item: item[1])
+
+    def get(self, slot: int, now: float) -> Optional[CacheEntry]:
+        _, entry = self.entries[slot]
+        if entry.expired(now):
+            self.remove(slot)
+            return None
+        self.entries.move_to_end(slot)
+        return entry
+
+    def add(self, vector: List[float], scope: str, entry: CacheEntry):
+        if len(self.entries) >= self.capacity:
+            self.remove(next(iter(self.entries)))
+        slot = self._allocate()
+        self.rows[slot] = vector
+        self.entries[slot] = (scope, entry)
+        self.by_scope.setdefault(scope, set()).add(slot)
+
+    def remove(self, slot: int):
+        scope, _ = self.entries.pop(slot)
+        slots = self.by_scope[scope]
+        slots.discard(slot)
+        if not slots:
+            del self.by_scope[scope]
+        if numpy is None:
+            self.rows[slot] = None
+        self.free.append(slot)
+
+    def _allocate(self) -> int:
+        if self.free:
+            return self.free.pop()
+        slot = self.used
+        self.used += 1
+        if numpy is None:
+            self.rows.append(None)
+        elif slot >= len(self.rows):
+            grown = numpy.zeros((min(len(self.rows) * 2, self.capacity), self.dimensions), dtype=numpy.float32)
+            grown[:len(self.rows)] = self.rows
+            self.rows = grown
+        return slot
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SemanticQuery:
+    """一个请求的语义缓存查询：范围和归一化的向量"""
+
+    __slots__ = ("scope", "vector")
+
+    def __init__(self, scope: str, vector: List[float]):
+        self.scope = scope
+        self.vector = vector
+
+
+class SemanticCache:
+    """
+    按问题相似度匹配的响应缓存
+
+    对聊天请求最后一条user消息计算embedding（模型配置的embedding_model，未配置时使用本地替代），
+    在该模型的向量索引中查找同一范围内最相似的已缓存问题，相似度不低于threshold时直接返回其响应。
+    只缓存非流式响应，命中时流式请求以SSE格式返回。
+    """
+
+    def __init__(self, embed: Optional[Embed] = None, max_entry_bytes: int = 1024 * 1024):
+        self.embed = embed
+        self.max_entry_bytes = max_entry_bytes
+        self.indexes: Dict[str, VectorIndex] = {}
+
+    @staticmethod
+    def eligible(model_config: ModelConfig, uri: str, request_body: RequestBody) -> bool:
+        """模型开启了语义缓存，是最后一条为user消息的聊天请求，且请求是确定性的（或模型允许非确定性请求）"""
+        config = model_config.semantic_cache
+        if not config.enabled or not uri.endswith("/chat/completions"):
+            return False
+        try:
+            data = request_body.data
+        except ValueError:
+            return False
+        if data.get("n", 1) != 1 or (config.deterministic_only and data.get("temperature") != 0):
+            return False
+        return query_text(data) is not None
+
+    async def query(self, uri: str, model_config: ModelConfig, request_body: RequestBody) -> Optional[SemanticQuery]:
+        """计算请求的范围和向量，embedding模型调用失败时返回None（不使用语义缓存）"""
+        config = model_config.semantic_cache
+        data = request_body.data
+        text = query_text(data)
+        start = time.perf_counter()
+        try:
+            if config.embedding_model and self.embed is not None:
+                vector = await self.embed(config.embedding_model, text)
+            else:
+                vector = local_embedding(text, config.dimensions)
+        except Exception as e:
+            SEMANTIC_CACHE_REQUESTS.inc(model_config.model_name, "error")
+            logger.warning(f"语义缓存计算embedding失败（{config.embedding_model}）: {e}")
+            return None
+        SEMANTIC_CACHE_LOOKUP.observe(time.perf_counter() - start, model_config.model_name, "embed")
+        vector = _normalized(vector)
+        if vector is None:
+            return None
+        return SemanticQuery(query_scope(uri, data), vector)
+
+    def lookup(self, model_config: ModelConfig, query: SemanticQuery) -> Optional[Tuple[CacheEntry, float]]:
+        """查找相似度不低于阈值的缓存响应，返回(缓存条目, 相似度)"""
+        index = self._index(model_config, len(query.vector))
+        start = time.perf_counter()
+        found = index.search(query.vector, query.scope)
+        SEMANTIC_CACHE_LOOKUP.observe(time.perf_counter() - start, model_config.model_name, "search")
+        if found is not None:
+            slot, similarity = found
+            SEMANTIC_CACHE_SIMILARITY.observe(similarity, model_config.model_name)
+            if similarity >= model_config.semantic_cache.threshold:
+                entry = index.get(slot, time.time())
+                if entry is not None:
+                    SEMANTIC_CACHE_REQUESTS.inc(model_config.model_name, "hit")
+                    return entry, similarity
+        SEMANTIC_CACHE_REQUESTS.inc(model_config.model_name, "miss")
+        return None
+
+    def store(self, model_config: ModelConfig, query: SemanticQuery, body: bytes, content_type: str):
+        if len(body) > self.max_entry_bytes:
+            return
+        now = time.time()
+        entry = CacheEntry(body, content_type, "json", now, now + model_config.semantic_cache.ttl)
+        self._index(model_config, len(query.vector)).add(query.vector, query.scope, entry)
+
+    def _index(self, model_config: ModelConfig, dimensions: int) -> VectorIndex:
+        """模型的向量索引，容量或向量维数（更换了embedding模型）变化时重建"""
+        index = self.indexes.get(model_config.model_name)
+        capacity = model_config.semantic_cache.max_entries
+        if index is None or index.dimensions != dimensions or index.capacity != capacity:
+            index = self.indexes[model_config.model_name] = VectorIndex(dimensions, capacity)
+        return index
+
+    def recorder(self, model_config: ModelConfig, query: SemanticQuery) -> "SemanticRecorder":
+        return SemanticRecorder(self, model_config, query)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: {"entries": len(index), "capacity": index.capacity} for name, index in self.indexes.items()}
+
+
+class SemanticRecorder:
+    """把一次未命中请求的非流式上游响应写入语义缓存，接口与CacheRecorder相同"""
+
+    __slots__ = ("cache", "model_config", "query", "limit")
+
+    def __init__(self, cache: SemanticCache, model_config: ModelConfig, query: SemanticQuery):
+        self.cache = cache
+        self.model_config = model_config
+        self.query = query
+        self.limit = cache.max_entry_bytes
+
+    async def __call__(self, body: bytes, content_type: str, stream: bool = False):
+        if stream or not body.lstrip().startswith(b"{"):
+            return
+        self.cache.store(self.model_config, self.query, body, content_type)
+
+
+semantic_cache: Optional[SemanticCache] = None
+
+
+def init_semantic_cache(**kwargs) -> SemanticCache:
+    global semantic_cache
+    semantic_cache = SemanticCache(**kwargs)
+    return semantic_cache
+
+
+def get_semantic_cache() -> Optional[SemanticCache]:
+    return semantic_cache
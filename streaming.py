@@ -0,0 +1,117 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+import aiohttp
+from fastapi.responses import StreamingResponse
+from starlette.requests import ClientDisconnect
+
+from body import find_usage
+from log import logger
+from metrics import REQUESTS_ABORTED, STREAM_TTFT, STREAM_INTER_TOKEN
+from timeouts import StreamDeadlines, UpstreamTimeout, wait_until
+
+# 保留流末尾的字节数，用于在流结束后找出最后分片中的usage
+TAIL_SIZE = 8192
+
+
+async def relay_stream(response: aiohttp.ClientResponse, model_name: str, start_time: float,
+                       tail: bytearray, capture: Optional[bytearray] = None,
+                       capture_limit: int = 0, deadlines: Optional[StreamDeadlines] = None) -> AsyncIterator[bytes]:
+    """
+    逐块转发上游响应体
+
+    收到多少转发多少，不做缓冲和重新序列化；同时记录首个分片延迟和分片间隔，
+    并在tail中保留流末尾的少量字节。capture不为None时同时保存完整响应体，
+    超过capture_limit后停止保存。指定deadlines时首个分片、分片间隔和整个流超时后
+    向客户端发送一个error事件并结束（此时上游没有读完，连接会被关闭）。
+    """
+    loop = asyncio.get_running_loop()
+    last_chunk_time = None
+    while True:
+        if deadlines is None:
+            chunk = await response.content.readany()
+        else:
+            when, phase = deadlines.next_chunk(last_chunk_time is None, loop.time())
+            try:
+                chunk = await wait_until(response.content.readany(), when, phase)
+            except UpstreamTimeout as e:
+                deadlines.timed_out = e.phase
+                REQUESTS_ABORTED.inc(model_name, e.phase)
+                logger.warning(f"流式响应超时({e.phase})，取消上游请求: {response.url}")
+                yield timeout_event(e.phase)
+                return
+        if not chunk:
+            break
+        now = time.perf_counter()
+        if last_chunk_time is None:
+            STREAM_TTFT.observe(now - start_time, model_name)
+        else:
+            STREAM_INTER_TOKEN.observe(now - last_chunk_time, model_name)
+        last_chunk_time = now
+        tail += chunk[-TAIL_SIZE:]
+        if len(tail) > TAIL_SIZE:
+            del tail[:-TAIL_SIZE]
+        if capture is not None and len(capture) <= capture_limit:
+            capture += chunk
+        yield chunk
+
+
+def timeout_event(phase: str) -> bytes:
+    """流式响应已经开始后无法再修改状态码，以SSE error事件通知客户端"""
+    error = {"error": {"message": f"Upstream {phase} timeout", "type": "timeout", "code": 504}}
+    return b"data: " + json.dumps(error).encode("utf-8") + b"\n\n"
+
+
+class UpstreamStreamingResponse(StreamingResponse):
+    """
+    透传上游流式响应
+
+    无论是正常结束、客户端断开还是出现异常，都会在响应结束时处理上游连接：
+    上游数据已读完则归还连接池，否则直接关闭连接以取消上游推理。
+    结束后以流中最后的usage（没有则为None）调用on_complete；
+    指定了recorder（缓存写入）时，完整读完且不超过recorder.limit的响应体交给recorder。
+    deadlines为流式传输阶段的超时设置，见relay_stream。
+    """
+
+    def __init__(self, upstream: aiohttp.ClientResponse, model_name: str, start_time: float,
+                 on_complete: Optional[Callable[[Optional[dict]], Awaitable[None]]] = None,
+                 recorder=None, deadlines: Optional[StreamDeadlines] = None):
+        self.upstream = upstream
+        self.model_name = model_name
+        self.on_complete = on_complete
+        self.recorder = recorder
+        self.deadlines = deadlines
+        self.tail = bytearray()
+        self.captured = bytearray() if recorder is not None else None
+        super().__init__(
+            relay_stream(upstream, model_name, start_time, self.tail, self.captured,
+                         recorder.limit if recorder is not None else 0, deadlines),
+            status_code=upstream.status,
+            media_type=upstream.headers.get("Content-Type", "text/event-stream"),
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    async def __call__(self, scope, receive, send):
+        failed = False
+        try:
+            await super().__call__(scope, receive, send)
+        except ClientDisconnect:
+            raise
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            await self.body_iterator.aclose()
+            completed = self.upstream.content.at_eof()
+            if completed:
+                self.upstream.release()
+            else:
+                if not failed and (self.deadlines is None or self.deadlines.timed_out is None):
+                    REQUESTS_ABORTED.inc(self.model_name, "client_disconnect")
+                    logger.info(f"客户端提前断开，取消上游请求: {self.upstream.url}")
+                self.upstream.close()
+            if self.on_complete is not None:
+                await self.on_complete(find_usage(bytes(self.tail)))
+            if completed and self.recorder is not None and len(self.captured) <= self.recorder.limit:
+                await self.recorder(bytes(self.captured), self.media_type, stream=True)
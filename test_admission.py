@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+测试按模型的并发准入控制
+"""
+
+import asyncio
+
+from admission import AdmissionController, AdmissionRejected, Flow
+from config import AdmissionConfig, ModelConfig, PRIORITY_CLASSES
+from metrics import ADMISSION_REJECTED, ADMISSION_TENANT_QUEUE_DEPTH, ADMISSION_TENANT_WAIT
+
+
+def limited_model(name="m", **admission) -> ModelConfig:
+    model_config = ModelConfig.from_model_name(name)
+    model_config.admission = AdmissionConfig(**admission)
+    return model_config
+
+
+def test_concurrency_bounded():
+    """同时处理的请求数不超过max_concurrency"""
+    async def run():
+        controller = AdmissionController()
+        model_config = limited_model(max_concurrency=2)
+        state = {"current": 0, "max": 0}
+
+        async def request():
+            ticket = await controller.acquire(model_config)
+            state["current"] += 1
+            state["max"] = max(state["max"], state["current"])
+            await asyncio.sleep(0.01)
+            state["current"] -= 1
+            ticket.release()
+
+        await asyncio.gather(*(request() for _ in range(10)))
+        assert state["max"] == 2
+        assert controller.stats()["m"] == {"max_concurrency": 2, "in_flight": 0, "queued": 0,
+                                          "queued_by_tenant": {}}
+
+    asyncio.run(run())
+
+
+def test_priority_order():
+    """释放名额时高优先级请求先获得准入，同优先级按到达顺序"""
+    async def run():
+        controller = AdmissionController()
+        model_config = limited_model(max_concurrency=1)
+        first = await controller.acquire(model_config)
+        order = []
+
+        async def request(name, priority):
+            ticket = await controller.acquire(model_config, PRIORITY_CLASSES[priority])
+            order.append(name)
+            ticket.release()
+
+        tasks = [asyncio.ensure_future(request("low", "low")),
+                 asyncio.ensure_future(request("normal-1", "normal")),
+                 asyncio.ensure_future(request("high", "high")),
+                 asyncio.ensure_future(request("normal-2", "normal"))]
+        await asyncio.sleep(0.01)
+        first.release()
+        await asyncio.gather(*tasks)
+        assert order == ["high", "normal-1", "normal-2", "low"]
+
+    asyncio.run(run())
+
+
+def test_fair_share_across_tenants():
+    """同优先级内积压大量请求的租户不阻塞其他租户，持续排队时按权重比例获得名额"""
+    async def run():
+        controller = AdmissionController()
+        model_config = limited_model("fair-model", max_concurrency=1)
+        order = []
+
+        async def request(flow, priority="normal"):
+            ticket = await controller.acquire(model_config, PRIORITY_CLASSES[priority], flow)
+            order.append(flow.name)
+            await asyncio.sleep(0)
+            ticket.release()
+
+        noisy, quiet = Flow("noisy", label="noisy"), Flow("quiet", label="quiet")
+        first = await controller.acquire(model_config)
+        tasks = [asyncio.ensure_future(request(noisy)) for _ in range(10)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.ensure_future(request(quiet)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert controller.stats()["fair-model"]["queued_by_tenant"] == {"noisy": 10, "quiet": 2}
+        assert ADMISSION_TENANT_QUEUE_DEPTH.value("fair-model", "noisy") == 10
+        first.release()
+        await asyncio.gather(*tasks)
+        # 先到的noisy积压10个请求，后到的quiet仍与之轮流获得名额
+        assert order[:4] == ["noisy", "quiet", "noisy", "quiet"]
+        assert ADMISSION_TENANT_WAIT.count("fair-model", "quiet") == 2
+        assert ADMISSION_TENANT_QUEUE_DEPTH.value("fair-model", "noisy") == 0
+
+        # 权重3:1时，前8个名额中heavy得到6个；高优先级仍然优先于任何权重
+        order.clear()
+        heavy, light = Flow("heavy", weight=3.0), Flow("light", weight=1.0)
+        first = await controller.acquire(model_config)
+        tasks = [asyncio.ensure_future(request(flow)) for _ in range(8) for flow in (heavy, light)]
+        tasks.append(asyncio.ensure_future(request(Flow("vip"), "high")))
+        await asyncio.sleep(0)
+        first.release()
+        await asyncio.gather(*tasks)
+        assert order[0] == "vip"
+        assert order[1:9].count("heavy") == 6
+        assert controller.stats()["fair-model"]["queued"] == 0
+
+    asyncio.run(run())
+
+
+def test_queue_full_and_timeout():
+    """队列满返回429，排队超时返回503，均带Retry-After"""
+    async def run():
+        controller = AdmissionController()
+        model_config = limited_model("reject-model", max_concurrency=1, max_queue=1, queue_timeout=0.05)
+        ticket = await controller.acquire(model_config)
+        waiter = asyncio.ensure_future(controller.acquire(model_config))
+        await asyncio.sleep(0)
+
+        try:
+            await controller.acquire(model_config)
+            assert False, "queue overflow accepted"
+        except AdmissionRejected as e:
+            assert e.status_code == 429 and e.retry_after >= 1
+
+        try:
+            await waiter
+            assert False, "queue timeout not raised"
+        except AdmissionRejected as e:
+            assert e.status_code == 503 and e.retry_after >= 1
+
+        assert ADMISSION_REJECTED.value("reject-model", "queue_full") == 1
+        assert ADMISSION_REJECTED.value("reject-model", "queue_timeout") == 1
+        # 超时的请求不占用名额
+        ticket.release()
+        ticket.release()
+        assert controller.stats()["reject-model"]["in_flight"] == 0
+        assert controller.stats()["reject-model"]["queued"] == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_passes_slot():
+    """排队中的请求被取消后，名额交给下一个请求"""
+    async def run():
+        controller = AdmissionController()
+        model_config = limited_model(max_concurrency=1)
+        ticket = await controller.acquire(model_config)
+        cancelled = asyncio.ensure_future(controller.acquire(model_config))
+        waiting = asyncio.ensure_future(controller.acquire(model_config))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        ticket.release()
+        second = await asyncio.wait_for(waiting, 1)
+        assert controller.stats()["m"]["in_flight"] == 1
+        second.release()
+
+    asyncio.run(run())
+
+
+def test_stale_entries_compacted():
+    """名额一直不释放时，超时和取消的排队条目不会在堆中无限累积"""
+    async def run():
+        controller = AdmissionController()
+        model_config = limited_model("stale-model", max_concurrency=1, max_queue=4, queue_timeout=0.01)
+        ticket = await controller.acquire(model_config)
+        admission = controller.for_model(model_config)
+        for _ in range(50):
+            waiters = [asyncio.ensure_future(controller.acquire(model_config)) for _ in range(4)]
+            await asyncio.sleep(0)
+            waiters[0].cancel()
+            await asyncio.gather(*waiters, return_exceptions=True)
+            assert len(admission._queue) <= 4
+        assert admission.stats()["queued"] == 0
+
+        # 重建后的堆仍按顺序唤醒等待中的请求
+        timed_out = asyncio.ensure_future(controller.acquire(model_config))
+        await asyncio.sleep(0)
+        await asyncio.gather(timed_out, return_exceptions=True)
+        model_config.admission.queue_timeout = 10
+        waiting = asyncio.ensure_future(controller.acquire(model_config))
+        await asyncio.sleep(0)
+        ticket.release()
+        (await asyncio.wait_for(waiting, 1)).release()
+
+    asyncio.run(run())
+
+
+def test_unlimited_model_passthrough():
+    """未配置并发限制的模型直接放行"""
+    async def run():
+        controller = AdmissionController()
+        tickets = [await controller.acquire(ModelConfig.from_model_name("free")) for _ in range(100)]
+        for ticket in tickets:
+            ticket.release()
+        assert controller.stats() == {}
+
+    asyncio.run(run())
+
+
+def test_limit_split_across_workers():
+    """多worker时每个worker分得 max_concurrency / workers（向上取整）个名额"""
+    async def run():
+        controller = AdmissionController(workers=4)
+        model_config = limited_model(max_concurrency=10)
+        tickets = [await controller.acquire(model_config) for _ in range(3)]
+        assert controller.stats()["m"]["max_concurrency"] == 3
+        try:
+            await asyncio.wait_for(controller.acquire(model_config), 0.05)
+            assert False, "第4个请求应排队"
+        except asyncio.TimeoutError:
+            pass
+        for ticket in tickets:
+            ticket.release()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试准入控制...\n")
+    for test in (test_concurrency_bounded, test_priority_order, test_fair_share_across_tenants,
+                 test_queue_full_and_timeout, test_cancelled_waiter_passes_slot, test_stale_entries_compacted,
+                 test_unlimited_model_passthrough,
+                 test_limit_split_across_workers):
+        test()
+        print(f"✅ {test.__doc__}")
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+测试认证代理（使用本地认证桩服务）
+"""
+
+import asyncio
+from aiohttp import web
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from auth_proxy import AuthProxy, AuthBackendError
+
+
+async def start_auth_server(state: dict, delay: float = 0.05):
+    """
+    启动本地认证桩服务
+
+    token以 "valid" 开头视为有效，"error" 开头返回500，其余返回 code=1
+    """
+    state.setdefault("calls", 0)
+    state.setdefault("concurrent", 0)
+    state.setdefault("max_concurrent", 0)
+
+    async def handler(request):
+        state["calls"] += 1
+        state["concurrent"] += 1
+        state["max_concurrent"] = max(state["max_concurrent"], state["concurrent"])
+        try:
+            await asyncio.sleep(delay)
+            token = request.query.get("token", "")
+            if token.startswith("error"):
+                return web.Response(status=500, text="boom")
+            return web.json_response({"code": 0 if token.startswith("valid") else 1})
+        finally:
+            state["concurrent"] -= 1
+
+    app = web.Application()
+    app.router.add_post("/auth", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/auth"
+
+
+def make_request(authorization: str = None) -> Request:
+    headers = []
+    if authorization is not None:
+        headers.append((b"authorization", authorization.encode()))
+    return Request({"type": "http", "method": "POST", "path": "/v1/chat/completions", "headers": headers})
+
+
+def run_with_auth_server(coro_factory, **server_kwargs):
+    async def run():
+        state = {}
+        runner, auth_url = await start_auth_server(state, **server_kwargs)
+        try:
+            await coro_factory(auth_url, state)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_auth_caches_verdicts():
+    """有效和无效token的结果都被缓存"""
+    async def scenario(auth_url, state):
+        proxy = AuthProxy(auth_url)
+        try:
+            assert await proxy.auth(make_request("Bearer valid-1"))
+            assert await proxy.auth(make_request("Bearer valid-1"))
+            assert state["calls"] == 1
+
+            for _ in range(2):
+                try:
+                    await proxy.auth(make_request("Bearer bad-1"))
+                    assert False, "invalid token accepted"
+                except HTTPException as e:
+                    assert e.status_code == 401
+            assert state["calls"] == 2
+        finally:
+            await proxy.close()
+
+    run_with_auth_server(scenario)
+
+
+def test_negative_ttl_expires():
+    """无效结果过期后重新认证"""
+    async def scenario(auth_url, state):
+        proxy = AuthProxy(auth_url, negative_ttl=0.05)
+        try:
+            assert not await proxy.verify("bad-1")
+            await asyncio.sleep(0.1)
+            assert not await proxy.verify("bad-1")
+            assert state["calls"] == 2
+        finally:
+            await proxy.close()
+
+    run_with_auth_server(scenario, delay=0)
+
+
+def test_single_flight():
+    """同一token的并发请求只触发一次认证调用"""
+    async def scenario(auth_url, state):
+        proxy = AuthProxy(auth_url)
+        try:
+            results = await asyncio.gather(*(proxy.verify("valid-burst") for _ in range(50)))
+            assert all(results)
+            assert state["calls"] == 1
+        finally:
+            await proxy.close()
+
+    run_with_auth_server(scenario)
+
+
+def test_max_concurrency():
+    """发往认证服务的并发数受限"""
+    async def scenario(auth_url, state):
+        proxy = AuthProxy(auth_url, max_concurrency=2)
+        try:
+            await asyncio.gather(*(proxy.verify(f"valid-{i}") for i in range(8)))
+            assert state["calls"] == 8
+            assert state["max_concurrent"] <= 2
+        finally:
+            await proxy.close()
+
+    run_with_auth_server(scenario)
+
+
+def test_backend_error_not_cached():
+    """认证服务异常时拒绝请求且不缓存结果"""
+    async def scenario(auth_url, state):
+        proxy = AuthProxy(auth_url)
+        try:
+            for _ in range(2):
+                try:
+                    await proxy.verify("error-1")
+                    assert False, "backend error swallowed"
+                except AuthBackendError:
+                    pass
+            assert state["calls"] == 2
+        finally:
+            await proxy.close()
+
+    run_with_auth_server(scenario, delay=0)
+
+
+def test_missing_header():
+    """缺少Authorization头直接拒绝，不调用认证服务"""
+    async def scenario(auth_url, state):
+        proxy = AuthProxy(auth_url)
+        for header in (None, "Bearer", "Bearer   "):
+            try:
+                await proxy.auth(make_request(header))
+                assert False, "missing token accepted"
+            except HTTPException as e:
+                assert e.status_code == 401
+        assert state["calls"] == 0
+        await proxy.close()
+
+    run_with_auth_server(scenario)
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试认证代理...\n")
+    for test in (test_auth_caches_verdicts, test_negative_ttl_expires, test_single_flight,
+                 test_max_concurrency, test_backend_error_not_cached, test_missing_header):
+        test()
+        print(f"✅ {test.__doc__}")
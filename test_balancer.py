@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+测试多副本负载均衡
+"""
+
+import asyncio
+import json
+from collections import Counter
+from aiohttp import web
+
+from balancer import LoadBalancer, ReplicaPool
+from body import RequestBody
+from config import BalancerConfig, ModelConfig
+from metrics import AFFINITY_ROUTING
+
+
+URLS = ["http://replica-a:9002", "http://replica-b:9002", "http://replica-c:9002"]
+
+
+def test_replica_urls_from_config():
+    """配置replicas时使用副本列表，否则使用集群内服务地址"""
+    model_config = ModelConfig.from_dict({
+        "model_name": "m", "svc_name": "m", "svc_port": 9002, "api_key": "k",
+        "replicas": ["http://10.0.0.1:9002/", "http://10.0.0.2:9002"],
+        "balancer": {"policy": "ewma", "health_check_path": "/health"},
+    })
+    assert model_config.replica_urls() == ["http://10.0.0.1:9002", "http://10.0.0.2:9002"]
+    assert model_config.balancer.policy == "ewma"
+    assert ModelConfig.from_model_name("m").replica_urls() == ["http://m-svc.maas.svc.cluster.local:9002"]
+    try:
+        BalancerConfig.from_dict({"policy": "random"})
+        assert False, "invalid policy accepted"
+    except ValueError:
+        pass
+
+
+def test_round_robin():
+    """轮询均匀分配到各副本"""
+    pool = ReplicaPool("m", URLS, BalancerConfig())
+    counts = Counter()
+    for _ in range(30):
+        replica = pool.choose()
+        counts[replica.url] += 1
+        pool.release(replica, 0.1)
+    assert set(counts.values()) == {10}
+
+
+def test_least_outstanding_and_power_of_two():
+    """优先选择在途请求少的副本"""
+    for policy in ("least_outstanding", "power_of_two"):
+        pool = ReplicaPool("m", URLS, BalancerConfig(policy=policy))
+        held = [pool.choose() for _ in range(30)]
+        outstanding = [replica.outstanding for replica in pool.replicas]
+        # 只选在途更少的副本，各副本的在途请求数不会相差太多
+        assert max(outstanding) - min(outstanding) <= (1 if policy == "least_outstanding" else 5), outstanding
+        for replica in held:
+            pool.release(replica)
+        assert all(replica.outstanding == 0 for replica in pool.replicas)
+
+
+def test_ewma_prefers_fast_replica():
+    """EWMA策略把流量导向延迟低的副本"""
+    pool = ReplicaPool("m", URLS, BalancerConfig(policy="ewma"))
+    latencies = {URLS[0]: 0.05, URLS[1]: 1.0, URLS[2]: 1.0}
+    counts = Counter()
+    for _ in range(100):
+        replica = pool.choose()
+        counts[replica.url] += 1
+        pool.release(replica, latencies[replica.url])
+    assert counts[URLS[0]] > 90
+
+
+def test_ewma_unsampled_and_failures():
+    """没有延迟样本的副本按平均延迟参与选择，失败按惩罚延迟计入EWMA"""
+    pool = ReplicaPool("m", URLS[:2], BalancerConfig(policy="ewma"))
+    fast, slow = pool.replicas
+    fast.ewma = 0.1
+    # 新副本按平均延迟0.1计算，与fast各分到一半流量，而不是视为零延迟吸走所有请求
+    held = [pool.choose() for _ in range(10)]
+    assert sum(replica is slow for replica in held) == 5
+    for replica in held:
+        pool.abandon(replica)
+
+    # 快速失败的副本EWMA升高，流量转向另一个副本
+    slow.ewma = 0.5
+    for _ in range(2):
+        fast.outstanding += 1
+        pool.release(fast, 0.001, failed=True)
+    assert fast.ewma > slow.ewma
+    assert pool.choose() is slow
+
+
+def test_outlier_ejection():
+    """连续失败的副本被剔除，被取消的请求不重置失败计数，全部不可用时退化为在所有副本中选择"""
+    pool = ReplicaPool("m", URLS[:2], BalancerConfig(max_failures=3, ejection_time=60))
+    bad = pool.replicas[0]
+    for _ in range(2):
+        bad.outstanding += 1
+        pool.release(bad, failed=True)
+    # 对冲落败或超时被取消的请求没有结果，不视为成功
+    bad.outstanding += 1
+    pool.abandon(bad)
+    assert bad.failures == 2 and bad.outstanding == 0
+    bad.outstanding += 1
+    pool.release(bad, failed=True)
+    assert all(pool.choose() is pool.replicas[1] for _ in range(10))
+    assert pool.stats()["replicas"][0]["ejected"] is True
+
+    # 另一个副本也被剔除后，仍然能选出副本
+    other = pool.replicas[1]
+    for _ in range(3):
+        other.outstanding += 1
+        pool.release(other, failed=True)
+    assert pool.choose() in pool.replicas
+
+
+def test_prefix_affinity():
+    """相同前缀的请求发往同一副本，首选副本过载或被剔除时改选其他副本，副本减少时其他前缀不改变去向"""
+    def chat(system: str, *turns: str) -> RequestBody:
+        messages = [{"role": "system", "content": system}] + [{"role": "user", "content": turn} for turn in turns]
+        return RequestBody(json.dumps({"model": "m", "messages": messages}).encode(), "m")
+
+    pool = ReplicaPool("affinity-model", URLS, BalancerConfig(policy="prefix_affinity", affinity_messages=2))
+
+    def route(request_body: RequestBody):
+        replica = pool.choose(key=pool.affinity(request_body))
+        pool.release(replica)
+        return replica
+
+    # 只有前两条消息参与计算，之后的轮次不影响选择
+    first = route(chat("You are a support bot.", "hello"))
+    assert all(route(chat("You are a support bot.", "hello", f"turn {i}")) is first for i in range(10))
+    targets = {prompt: route(chat(f"system prompt {prompt}", "hi")).url for prompt in range(60)}
+    assert set(targets.values()) == set(URLS)
+
+    # 首选副本在途请求达到平均值的affinity_load_factor倍时改选下一个副本
+    key = pool.affinity(chat("You are a support bot.", "hello"))
+    fallbacks = AFFINITY_ROUTING.value("affinity-model", "fallback")
+    held = [pool.choose(key=key) for _ in range(6)]
+    assert held[0] is first
+    assert any(replica is not first for replica in held)
+    assert AFFINITY_ROUTING.value("affinity-model", "fallback") > fallbacks
+    for replica in held:
+        pool.release(replica)
+
+    # 去掉一个副本后，原本不在该副本上的前缀不改变去向
+    removed = URLS[2]
+    pool.update(URLS[:2], pool.config)
+    for prompt, url in targets.items():
+        if url != removed:
+            assert route(chat(f"system prompt {prompt}", "hi")).url == url
+
+    # 没有前缀的请求按在途请求数选择；其他策略不计算前缀
+    none_before = AFFINITY_ROUTING.value("affinity-model", "none")
+    pool.choose(key=pool.affinity(RequestBody(b'{"model": "m", "input": "x"}', "m")))
+    assert AFFINITY_ROUTING.value("affinity-model", "none") == none_before + 1
+    assert ReplicaPool("m", URLS, BalancerConfig()).affinity(chat("s", "hi")) is None
+
+
+def test_health_check():
+    """主动健康检查失败的副本不再接收流量，恢复后重新加入"""
+    async def run():
+        status = {"code": 200}
+
+        async def health(request):
+            return web.Response(status=status["code"])
+
+        app = web.Application()
+        app.router.add_get("/health", health)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+
+        balancer = LoadBalancer()
+        model_config = ModelConfig.from_model_name("m")
+        model_config.replicas = [f"http://127.0.0.1:{port}", "http://127.0.0.1:1"]
+        model_config.balancer = BalancerConfig(health_check_path="/health", health_check_interval=0.05,
+                                               health_check_timeout=1, unhealthy_threshold=1)
+        try:
+            # 健康检查由sync（启动时及配置更新后）启动，不等待模型的第一个请求
+            balancer.sync({"m": model_config})
+            await asyncio.sleep(0.3)
+            pool = balancer.for_model(model_config)
+            healthy = [replica.healthy for replica in pool.replicas]
+            assert healthy == [True, False]
+            status["code"] = 503
+            await asyncio.sleep(0.3)
+            assert not any(replica.healthy for replica in pool.replicas)
+            status["code"] = 200
+            await asyncio.sleep(0.3)
+            assert pool.replicas[0].healthy
+        finally:
+            await balancer.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试负载均衡...\n")
+    for test in (test_replica_urls_from_config, test_round_robin, test_least_outstanding_and_power_of_two,
+                 test_ewma_prefers_fast_replica, test_ewma_unsampled_and_failures, test_outlier_ejection, test_prefix_affinity, test_health_check):
+        test()
+        print(f"✅ {test.__doc__}")
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+测试embedding请求微批
+"""
+
+import asyncio
+import json
+
+from starlette.responses import Response
+
+from batching import EmbeddingBatcher, split_inputs, split_usage
+from body import RequestBody, parse_request_body
+from config import BatchingConfig, ModelConfig
+
+URI = "/v1/embeddings"
+
+
+def model_config(**batching) -> ModelConfig:
+    config = ModelConfig.from_model_name("embedding-model")
+    config.batching = BatchingConfig(enabled=True, **batching)
+    return config
+
+
+def embedding_body(inputs, **fields) -> RequestBody:
+    return parse_request_body(json.dumps({"model": "embedding-model", "input": inputs, **fields}).encode())
+
+
+class FakeSend:
+    """记录每次发往上游的输入，按输入返回逆序排列的embedding（检验按index还原顺序）"""
+
+    def __init__(self, delay: float = 0.0, error: Exception = None):
+        self.delay = delay
+        self.error = error
+        self.batches = []
+
+    async def __call__(self, request_body: RequestBody) -> Response:
+        inputs = json.loads(request_body.payload())["input"]
+        self.batches.append(inputs)
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        data = [{"object": "embedding", "index": i, "embedding": [len(text)]} for i, text in enumerate(inputs)]
+        usage = {"prompt_tokens": len(inputs) * 10, "total_tokens": len(inputs) * 10}
+        body = json.dumps({"object": "list", "data": data[::-1], "usage": usage}).encode()
+        return Response(body, media_type="application/json")
+
+
+def test_split_inputs_and_usage():
+    """input按条拆分，usage按输入长度分摊且总数不变"""
+    assert split_inputs("a") == ["a"]
+    assert split_inputs(["a", "b"]) == ["a", "b"]
+    assert split_inputs([1, 2, 3]) == [[1, 2, 3]]
+    assert split_inputs([[1, 2], [3]]) == [[1, 2], [3]]
+    assert split_inputs([]) is None
+    assert split_inputs({"text": "a"}) is None
+
+    shares = split_usage({"prompt_tokens": 10, "total_tokens": 10}, [1, 2])
+    assert shares == [{"prompt_tokens": 3, "total_tokens": 3}, {"prompt_tokens": 7, "total_tokens": 7}]
+    assert split_usage(None, [1, 2]) == [None, None]
+
+    config = model_config()
+    assert EmbeddingBatcher.eligible(config, URI, embedding_body("a"))
+    assert not EmbeddingBatcher.eligible(config, "/v1/chat/completions", embedding_body("a"))
+    assert not EmbeddingBatcher.eligible(ModelConfig.from_model_name("m"), URI, embedding_body("a"))
+    assert not EmbeddingBatcher.eligible(config, URI, embedding_body([{"text": "a"}]))
+
+
+def test_concurrent_requests_share_one_call():
+    """并发请求合并为一次上游调用，结果按顺序拆回，每个请求方的index从0开始"""
+    async def run():
+        batcher = EmbeddingBatcher()
+        send = FakeSend()
+        config = model_config(max_wait_ms=20)
+        bodies = [embedding_body("a"), embedding_body(["bb", "ccc"]), embedding_body("dddd")]
+        results = await asyncio.gather(*[batcher.submit(URI, config, body, send) for body in bodies])
+
+        assert send.batches == [["a", "bb", "ccc", "dddd"]]
+        parts = [json.loads(body) for body, _, _ in results]
+        assert [[item["embedding"][0] for item in part["data"]] for part in parts] == [[1], [2, 3], [4]]
+        assert [[item["index"] for item in part["data"]] for part in parts] == [[0], [0, 1], [0]]
+        # usage按输入长度（1:5:4）分摊
+        assert [usage["prompt_tokens"] for _, _, usage in results] == [4, 20, 16]
+        assert parts[1]["usage"]["prompt_tokens"] == 20
+        assert all(content_type == "application/json" for _, content_type, _ in results)
+        assert batcher.stats()["pending_batches"] == 0
+
+        # 其他参数不同的请求不合并
+        send = FakeSend()
+        await asyncio.gather(batcher.submit(URI, config, embedding_body("a"), send),
+                             batcher.submit(URI, config, embedding_body("a", dimensions=8), send))
+        assert len(send.batches) == 2
+
+    asyncio.run(run())
+
+
+def test_flush_on_size_and_wait():
+    """凑满max_batch_size立即发送，超出的输入进入下一批；单独的请求原样转发"""
+    async def run():
+        batcher = EmbeddingBatcher()
+        send = FakeSend()
+        config = model_config(max_batch_size=2, max_wait_ms=1000)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.gather(*[batcher.submit(URI, config, embedding_body(text), send) for text in ("a", "b")])
+        assert loop.time() - started < 0.5
+        assert send.batches == [["a", "b"]]
+
+        send = FakeSend()
+        config = model_config(max_batch_size=2, max_wait_ms=10)
+        await asyncio.gather(batcher.submit(URI, config, embedding_body("a"), send),
+                             batcher.submit(URI, config, embedding_body(["b", "c"]), send))
+        assert send.batches == ["a", ["b", "c"]]
+
+        send = FakeSend()
+        body, _, usage = await batcher.submit(URI, config, embedding_body("single"), send)
+        assert send.batches == ["single"]
+        assert usage == {"prompt_tokens": 10, "total_tokens": 10}
+
+    asyncio.run(run())
+
+
+def test_cancellation_and_errors():
+    """发送前取消的请求方退出批次；上游失败时批次中所有请求方收到同一个异常"""
+    async def run():
+        batcher = EmbeddingBatcher()
+        send = FakeSend()
+        config = model_config(max_wait_ms=30)
+        cancelled = asyncio.ensure_future(batcher.submit(URI, config, embedding_body("gone"), send))
+        kept = asyncio.ensure_future(batcher.submit(URI, config, embedding_body("kept"), send))
+        await asyncio.sleep(0.005)
+        cancelled.cancel()
+        await kept
+        assert send.batches == ["kept"]
+
+        alone = asyncio.ensure_future(batcher.submit(URI, config, embedding_body("alone"), send))
+        await asyncio.sleep(0.005)
+        alone.cancel()
+        await asyncio.sleep(0.05)
+        assert batcher.stats() == {"pending_batches": 0, "pending_inputs": 0, "sending_batches": 0}
+        assert len(send.batches) == 1
+
+        failing = FakeSend(error=ValueError("upstream failed"))
+        results = await asyncio.gather(*[batcher.submit(URI, config, embedding_body(text), failing)
+                                         for text in ("a", "b")], return_exceptions=True)
+        assert len(failing.batches) == 1
+        assert all(isinstance(result, ValueError) for result in results)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试embedding微批...\n")
+    for test in (test_split_inputs_and_usage, test_concurrent_requests_share_one_call, test_flush_on_size_and_wait,
+                 test_cancellation_and_errors):
+        test()
+        print(f"✅ {test.__doc__}")
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+测试请求体快速扫描
+"""
+
+import json
+
+from body import BodyParseError, RequestBody, find_usage, parse_request_body
+
+
+def expect_error(raw: bytes) -> BodyParseError:
+    try:
+        parse_request_body(raw)
+    except BodyParseError as e:
+        return e
+    assert False, f"expected BodyParseError for {raw!r}"
+
+
+def test_extract_model_and_stream():
+    """提取顶层 model/stream，忽略嵌套对象中的同名字段"""
+    raw = json.dumps({
+        "messages": [{"role": "user", "content": 'say "model": "x" {[}]', "model": "nested"}],
+        "model": "deepseek-chat",
+        "options": {"stream": False},
+        "stream": True,
+        "temperature": 0.7,
+    }).encode()
+    body = parse_request_body(raw)
+    assert body.model == "deepseek-chat"
+    assert body.stream is True
+    # 原始bytes原样保留并转发
+    assert body.raw is raw
+    assert body.payload() is raw
+
+
+def test_defaults_and_whitespace():
+    """缺省stream为False，允许任意空白"""
+    body = parse_request_body(b' \n{ "model" : "m1" ,\n "n" : 1 } \n')
+    assert body.model == "m1"
+    assert body.stream is False
+    assert parse_request_body(b"{}").model is None
+
+
+def test_escaped_strings():
+    """字符串中的转义双引号和反斜杠"""
+    raw = b'{"messages": [{"content": "a \\\\\\" b \\\\"}], "model": "m\\u0031"}'
+    assert json.loads(raw)["model"] == "m1"
+    assert parse_request_body(raw).model == "m1"
+
+
+def test_invalid_bodies():
+    """各种非法请求体返回错误及位置"""
+    assert expect_error(b"").pos is None
+    assert expect_error(b"   ").message == "Empty request body"
+    assert expect_error(b"[1, 2]").message == "Request body must be valid JSON object"
+    assert expect_error(b'{"model": "m", "messages": [{"content": "Hello}]}').pos is not None
+    assert expect_error(b'{"model": "m", "messages": [{"content": "Hello"}]').pos is not None
+    assert expect_error(b'{"model": "m",}').pos is not None
+    assert expect_error(b'{"model": "m"} extra').message == "Extra data"
+    assert expect_error(b'{"model" "m"}').message == "Expecting ':' delimiter"
+    assert expect_error(b'{"model": "m", "stream": tru}').message.startswith("Invalid value")
+    assert expect_error(b'{"\\x": 1, "model": "m"}').message.startswith("Invalid property name")
+
+
+def test_lazy_parse_and_rewrite():
+    """只有修改过的请求体才重新序列化"""
+    raw = b'{"model": "m1", "messages": [], "stream": false}'
+    body = parse_request_body(raw)
+    assert body.data["messages"] == []
+    assert body.payload() is raw
+
+    body.update(model="m2", stream=True)
+    assert body.model == "m2" and body.stream is True
+    rewritten = json.loads(body.payload())
+    assert rewritten == {"model": "m2", "messages": [], "stream": True}
+
+    assert RequestBody(b"{}").payload() == b"{}"
+
+
+def test_find_usage():
+    """从JSON响应和SSE流末尾找出usage"""
+    block = b'{"choices": [{"message": {"content": "\\"usage\\": 1"}}], "usage": {"prompt_tokens": 3, "completion_tokens": 5}}'
+    assert find_usage(block) == {"prompt_tokens": 3, "completion_tokens": 5}
+    sse = (b'data: {"choices": [], "usage": null}\n\n'
+           b'data: {"choices": [], "usage": {"prompt_tokens": 1, "completion_tokens": 2}}\n\n'
+           b'data: [DONE]\n\n')
+    assert find_usage(sse) == {"prompt_tokens": 1, "completion_tokens": 2}
+    assert find_usage(b'data: {"choices": [], "usage": null}\n\n') is None
+    # 被截断的usage
+    assert find_usage(b'"usage": {"prompt_tokens": 1') is None
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试请求体扫描...\n")
+    for test in (test_extract_model_and_stream, test_defaults_and_whitespace, test_escaped_strings,
+                 test_invalid_bodies, test_lazy_parse_and_rewrite, test_find_usage):
+        test()
+        print(f"✅ {test.__doc__}")
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+测试响应缓存
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+
+from body import RequestBody, find_usage
+from cache import ResponseCache, cache_directives, cache_key
+from config import CacheConfig, ModelConfig
+
+COMPLETION = json.dumps({
+    "id": "chatcmpl-1", "object": "chat.completion", "model": "m",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "你好"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 3, "completion_tokens": 2},
+}).encode()
+TEXT_COMPLETION = json.dumps({
+    "id": "cmpl-1", "object": "text_completion", "model": "m",
+    "choices": [{"index": 0, "text": "你好", "logprobs": None, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 3, "completion_tokens": 2},
+}).encode()
+
+
+def cached_model(**cache) -> ModelConfig:
+    model_config = ModelConfig.from_model_name("m")
+    model_config.cache = CacheConfig(enabled=True, **cache)
+    return model_config
+
+
+def test_cache_key_canonical():
+    """字段顺序、数值写法和stream字段不影响缓存key，stream_options影响"""
+    a = RequestBody(b'{"model": "m", "temperature": 0, "messages": [{"role": "user", "content": "hi"}]}')
+    b = RequestBody(b'{"messages":[{"content":"hi","role":"user"}],"stream":true,"temperature":0.0,"model":"m"}')
+    c = RequestBody(b'{"model": "m", "temperature": 0, "messages": [{"role": "user", "content": "hello"}]}')
+    assert cache_key("/v1/chat/completions", a) == cache_key("/v1/chat/completions", b)
+    assert cache_key("/v1/chat/completions", a) != cache_key("/v1/chat/completions", c)
+    assert cache_key("/v1/chat/completions", a) != cache_key("/v1/completions", a)
+    # stream_options.include_usage 改变流式输出，不能共用缓存
+    d = RequestBody(b'{"model": "m", "temperature": 0, "messages": [{"role": "user", "content": "hi"}], '
+                    b'"stream": true, "stream_options": {"include_usage": true}}')
+    assert cache_key("/v1/chat/completions", b) != cache_key("/v1/chat/completions", d)
+
+
+def test_cacheable_and_directives():
+    """只缓存开启缓存的模型上的确定性请求，Cache-Control可以绕过缓存"""
+    deterministic = RequestBody(b'{"model": "m", "temperature": 0}')
+    sampled = RequestBody(b'{"model": "m", "temperature": 0.7}')
+    assert ResponseCache.cacheable(cached_model(), deterministic)
+    assert not ResponseCache.cacheable(cached_model(), sampled)
+    assert ResponseCache.cacheable(cached_model(deterministic_only=False), sampled)
+    assert not ResponseCache.cacheable(ModelConfig.from_model_name("m"), deterministic)
+    assert cache_directives("No-Cache, max-age=0") == {"no-cache", "max-age"}
+    assert cache_directives(None) == set()
+
+
+def test_memory_lru_and_ttl():
+    """内存缓存按字节数淘汰最久未使用的条目，过期条目不返回"""
+    async def run():
+        cache = ResponseCache(max_bytes=3 * len(COMPLETION), max_entry_bytes=len(COMPLETION))
+        model_config = cached_model()
+        for key in ("a", "b", "c"):
+            await cache.set(key, model_config, COMPLETION, "application/json", "json")
+        assert await cache.get("a", False) is not None
+        await cache.set("d", model_config, COMPLETION, "application/json", "json")
+        assert await cache.get("b", False) is None
+        assert await cache.get("a", False) is not None
+        assert cache.memory.size <= cache.memory.max_bytes
+        # 超过单条上限的响应不缓存
+        await cache.set("big", model_config, COMPLETION + b" ", "application/json", "json")
+        assert await cache.get("big", False) is None
+
+        await cache.set("short", cached_model(ttl=0), COMPLETION, "application/json", "json")
+        assert await cache.get("short", False) is None
+
+    asyncio.run(run())
+
+
+def test_disk_tier():
+    """磁盘缓存在重启后仍然可用，命中后提升到内存"""
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ResponseCache(disk_path=tmp)
+            await cache.set("k", cached_model(), COMPLETION, "application/json", "json")
+
+            restarted = ResponseCache(disk_path=tmp)
+            entry = await restarted.get("k", False)
+            assert entry is not None and entry.body == COMPLETION
+            assert len(restarted.memory) == 1
+
+            small = ResponseCache(disk_path=tmp, disk_max_bytes=len(COMPLETION) + 200)
+            await small.set("k2", cached_model(), COMPLETION, "application/json", "json")
+            assert small.stats()["disk"]["entries"] == 1
+
+    asyncio.run(run())
+
+
+def test_disk_shared_between_workers():
+    """多个worker共享磁盘缓存目录：读取其他进程写入的条目，淘汰时计入其他进程写入的文件"""
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            worker_a = ResponseCache(disk_path=tmp, disk_max_bytes=(len(COMPLETION) + 200) * 2)
+            worker_b = ResponseCache(disk_path=tmp, disk_max_bytes=(len(COMPLETION) + 200) * 2)
+            await worker_a.set("k", cached_model(), COMPLETION, "application/json", "json")
+            entry = await worker_b.get("k", False)
+            assert entry is not None and entry.body == COMPLETION
+            assert worker_b.stats()["disk"]["entries"] == 1
+
+            await worker_a.set("k2", cached_model(), COMPLETION, "application/json", "json")
+            worker_b.disk._scanned_at = 0.0
+            await worker_b.set("k3", cached_model(), COMPLETION, "application/json", "json")
+            assert len(os.listdir(tmp)) == 2
+
+    asyncio.run(run())
+
+
+def test_sse_replay():
+    """非流式缓存条目按端点和include_usage回放为SSE格式，流式条目原样回放"""
+    async def run():
+        cache = ResponseCache()
+        await cache.set("json", cached_model(), COMPLETION, "application/json", "json")
+        sse = (await cache.get("json", True)).sse(include_usage=True)
+        events = [line[6:] for line in sse.decode().split("\n\n") if line]
+        assert events[-1] == "[DONE]"
+        first = json.loads(events[0])
+        assert first["object"] == "chat.completion.chunk"
+        assert first["choices"][0]["delta"]["content"] == "你好"
+        assert find_usage(sse) == {"prompt_tokens": 3, "completion_tokens": 2}
+        # 请求没有要求 include_usage 时不返回usage分片
+        assert find_usage((await cache.get("json", True)).sse()) is None
+
+        # /v1/completions 回放为 text_completion 分片
+        await cache.set("text", cached_model(), TEXT_COMPLETION, "application/json", "json")
+        sse = (await cache.get("text", True)).sse("/v1/completions")
+        first = json.loads(sse.decode().split("\n\n")[0][6:])
+        assert first["object"] == "text_completion" and first["choices"][0]["text"] == "你好"
+
+        stream_body = b'data: {"choices": []}\n\ndata: [DONE]\n\n'
+        await cache.set("sse", cached_model(), stream_body, "text/event-stream", "sse")
+        assert (await cache.get("sse", True)).sse() == stream_body
+        # 流式条目不能用于非流式请求
+        assert await cache.get("sse", False) is None
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试响应缓存...\n")
+    for test in (test_cache_key_canonical, test_cacheable_and_directives, test_memory_lru_and_ttl,
+                 test_disk_tier, test_disk_shared_between_workers, test_sse_replay):
+        test()
+        print(f"✅ {test.__doc__}")
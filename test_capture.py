@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+测试流量采集与重放
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from aiohttp import web
+from starlette.responses import Response
+
+from body import RequestBody
+from capture import TrafficCapture, capture_line, close_traffic_capture, init_traffic_capture
+from config import ModelConfig, init_config
+from fake_upstream import FakeModel, create_fake_upstream
+from metrics import CAPTURED_REQUESTS
+from middleware import CaptureMiddleware
+from replay import load_capture, replay, report, schedule
+
+BODY = b'{"model": "m", "messages": [{"role": "user", "content": "hi"}]}'
+
+
+def captured(ts: float = 1000.0, model: str = "m", body: bytes = BODY, latency_ms: float = 50.0):
+    return (ts, "/v1/chat/completions", model, None, 200, latency_ms, body)
+
+
+async def serve(fake_model: FakeModel):
+    runner = web.AppRunner(create_fake_upstream(fake_model))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+
+def test_capture_line():
+    """请求体重新序列化为单行JSONL记录，不合法的请求体抛出ValueError"""
+    line = capture_line((1000.5, "/v1/chat/completions", "m", "internal", 200, 12.5, BODY))
+    assert line.endswith(b"}\n") and line.count(b"\n") == 1
+    record = json.loads(line)
+    assert record["body"] == json.loads(BODY) and record["tenant"] == "internal"
+    assert record["ts"] == 1000.5 and record["status"] == 200 and record["latency_ms"] == 12.5
+
+    pretty = json.dumps(json.loads(BODY), indent=2).encode()
+    line = capture_line(captured(body=pretty))
+    assert line.count(b"\n") == 1 and json.loads(line)["body"] == json.loads(BODY)
+
+    try:
+        capture_line(captured(body=b'{"model": "m", "messages": [{"content": "hi \xff"}]}'))
+        assert False, "应当拒绝非法UTF-8"
+    except ValueError:
+        pass
+
+
+def test_capture_limits():
+    """请求体超过上限的请求不采集，文件达到上限后停止采集，采样比例为0时不采集"""
+    async def run():
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "capture.jsonl")
+            capture = TrafficCapture(path, max_body_bytes=200, max_file_bytes=len(capture_line(captured())) * 3)
+            too_large = CAPTURED_REQUESTS.value("too_large")
+            capture.record(captured(body=b'{"input": "' + b"x" * 300 + b'"}'))
+            assert CAPTURED_REQUESTS.value("too_large") == too_large + 1 and not capture.buffer
+
+            for i in range(5):
+                capture.record(captured(ts=1000.0 + i))
+            assert capture.sampled()
+            await capture.flush()
+            assert len(load_capture(path)) == 3
+            assert capture.full and not capture.sampled()
+
+        assert not TrafficCapture("unused", sample_rate=0.0).sampled()
+
+    asyncio.run(run())
+
+
+def test_invalid_body_not_captured():
+    """请求体含非法UTF-8的请求不写入采集文件，文件中损坏的行在读取时跳过"""
+    async def run():
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "capture.jsonl")
+            capture = TrafficCapture(path)
+            invalid = CAPTURED_REQUESTS.value("invalid")
+            capture.record(captured(ts=1000.0))
+            capture.record(captured(ts=1001.0, body=b'{"model": "m", "messages": [{"content": "hi \xff"}]}'))
+            capture.record(captured(ts=1002.0))
+            await capture.flush()
+            assert CAPTURED_REQUESTS.value("invalid") == invalid + 1
+            assert [record["ts"] for record in load_capture(path)] == [1000.0, 1002.0]
+
+            # 其他工具写入的损坏行（非法UTF-8、不是对象）同样跳过
+            with open(path, "ab") as f:
+                f.write(b'{"ts": 1003.0, "body": "\xff"}\n[1, 2]\n')
+                f.write(capture_line(captured(ts=1004.0)))
+            assert [record["ts"] for record in load_capture(path)] == [1000.0, 1002.0, 1004.0]
+
+    asyncio.run(run())
+
+
+def test_middleware_captures_validated_requests():
+    """采集通过模型验证的请求的原始请求体、状态码和耗时，未通过验证的请求不采集"""
+    async def run():
+        init_config("config.json")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "capture.jsonl")
+            init_traffic_capture(path, flush_interval=60)
+
+            async def validated(scope, receive, send):
+                state = scope.setdefault("state", {})
+                state["model_config"] = ModelConfig.from_model_name("m")
+                state["request_body"] = RequestBody(BODY, "m")
+                await Response(b"{}", media_type="application/json")(scope, receive, send)
+
+            async def rejected(scope, receive, send):
+                await Response(b"", status_code=401)(scope, receive, send)
+
+            for app in (validated, rejected):
+                scope = {"type": "http", "method": "POST", "path": "/v1/chat/completions",
+                         "headers": [(b"authorization", b"Bearer sk-internal-example")]}
+
+                async def receive():
+                    return {"type": "http.request", "body": b"", "more_body": False}
+
+                async def send(message):
+                    pass
+
+                await CaptureMiddleware(app)(scope, receive, send)
+
+            await close_traffic_capture()
+            with open(path, "rb") as f:
+                content = f.read()
+            assert b"sk-internal-example" not in content
+            records = load_capture(path)
+            assert len(records) == 1
+            assert records[0]["model"] == "m" and records[0]["tenant"] == "internal" and records[0]["status"] == 200
+            assert abs(records[0]["ts"] - time.time()) < 5
+
+    asyncio.run(run())
+
+
+def test_replay_schedule_and_report():
+    """按压缩后的原始时间间隔发送，并发上限使请求推迟发送，按模型汇总延迟"""
+    async def run():
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "capture.jsonl")
+            with open(path, "wb") as f:
+                for i, model in enumerate(["a", "b", "a", "a"]):
+                    f.write(capture_line(captured(ts=1000.0 + i, model=model)))
+                f.write(b'{"ts": 1003.5, "trunc')
+            records = load_capture(path)
+            assert [r["model"] for r in records] == ["a", "b", "a", "a"]
+            assert schedule(records, 10.0) == [0.0, 0.1, 0.2, 0.3]
+            assert schedule(records, 0) == [0.0] * 4
+            assert len(load_capture(path, models=["b"])) == 1 and len(load_capture(path, limit=2)) == 2
+
+            fake = FakeModel(latency=0.05, tokens_per_sec=0, completion_tokens=4)
+            runner, base = await serve(fake)
+            try:
+                samples, elapsed = await replay(records, base, speed=10.0)
+                assert 0.3 <= elapsed < 1.0 and fake.requests == 4
+                results = report(records, samples, elapsed)
+                assert set(results) == {"a", "b", "all"}
+                assert results["a"]["requests"] == 3 and results["all"]["ok"] == 4
+                assert results["a"]["captured_latency_ms"]["p50"] == 50.0
+
+                # 并发上限为1、尽快发送时后面的请求需要等待前面的完成
+                samples, _ = await replay(records, base, speed=0, concurrency=1)
+                assert max(sample[4] for sample in samples) >= 0.1
+            finally:
+                await runner.cleanup()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试流量采集与重放...\n")
+    for test in (test_capture_line, test_capture_limits, test_invalid_body_not_captured,
+                 test_middleware_captures_validated_requests,
+                 test_replay_schedule_and_report):
+        test()
+        print(f"✅ {test.__doc__}")
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+测试相同请求合并
+"""
+
+import asyncio
+
+from starlette.responses import Response, StreamingResponse
+
+from body import RequestBody
+from coalesce import Coalescer
+from config import CoalesceConfig, ModelConfig
+
+
+def model_config(**coalesce) -> ModelConfig:
+    config = ModelConfig.from_model_name("coalesce-model")
+    config.coalesce = CoalesceConfig(enabled=True, **coalesce)
+    return config
+
+
+async def collect(response: Response, slow: float = 0.0):
+    """以ASGI方式发送响应，返回(状态码, 响应头, 响应体)；slow模拟读取缓慢的客户端"""
+    messages = []
+
+    async def receive():
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        messages.append(message)
+        if slow:
+            await asyncio.sleep(slow)
+
+    scope = {"type": "http", "asgi": {"spec_version": "2.4"}, "method": "POST", "path": "/", "headers": []}
+    await response(scope, receive, send)
+    start = messages[0]
+    headers = {key.decode(): value.decode() for key, value in start["headers"]}
+    return start["status"], headers, b"".join(m.get("body", b"") for m in messages[1:])
+
+
+def test_eligible():
+    """只有开启合并的模型的确定性请求才合并"""
+    deterministic = RequestBody(b'{"model": "m", "temperature": 0}')
+    sampled = RequestBody(b'{"model": "m", "temperature": 0.7}')
+    assert Coalescer.eligible(model_config(), deterministic)
+    assert not Coalescer.eligible(model_config(), sampled)
+    assert Coalescer.eligible(model_config(deterministic_only=False), sampled)
+    assert not Coalescer.eligible(ModelConfig.from_model_name("m"), deterministic)
+
+
+def test_block_requests_share_one_call():
+    """并发的相同非流式请求只发起一次上游调用，跟随者的响应带X-Coalesced头"""
+    async def run():
+        coalescer = Coalescer()
+        calls = []
+
+        async def start(publish):
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return Response(b'{"id": 1}', media_type="application/json")
+
+        responses = await asyncio.gather(*[coalescer.join("k", model_config(), start) for _ in range(5)])
+        results = await asyncio.gather(*[collect(response) for response in responses])
+        assert len(calls) == 1
+        assert all(body == b'{"id": 1}' and status == 200 for status, _, body in results)
+        assert [headers.get("x-coalesced") for _, headers, _ in results] == [None] + ["true"] * 4
+        assert results[0][1]["content-length"] == "9"
+        assert coalescer.stats() == {"flights": 0, "subscribers": 0}
+
+        # 上游调用结束后到达的请求发起新的调用
+        await collect(await coalescer.join("k", model_config(), start))
+        assert len(calls) == 2
+
+    asyncio.run(run())
+
+
+def test_stream_broadcast_and_slow_subscriber():
+    """流式分片广播给所有请求方（后加入的请求回放已发送的分片），读取过慢的请求方超限后被单独断开"""
+    async def run():
+        coalescer = Coalescer()
+        chunks = [b"data: %d\n\n" % i for i in range(20)]
+
+        async def stream():
+            for chunk in chunks:
+                yield chunk
+                await asyncio.sleep(0.005)
+
+        async def start(publish):
+            return StreamingResponse(stream(), media_type="text/event-stream")
+
+        config = model_config(max_buffer_bytes=40)
+        first = await coalescer.join("s", config, start)
+        await asyncio.sleep(0.012)
+        late = await coalescer.join("s", config, start)
+        slow = await coalescer.join("s", config, start)
+        results = await asyncio.gather(collect(first), collect(late), collect(slow, slow=0.05))
+
+        assert results[0][2] == b"".join(chunks)
+        assert results[1][2] == b"".join(chunks)
+        assert b'"type": "overflow"' in results[2][2]
+        assert len(results[2][2]) < len(b"".join(chunks))
+        # 已发送的数据超过max_buffer_bytes后不再接受新的请求方
+        assert coalescer.stats()["flights"] == 0
+
+    asyncio.run(run())
+
+
+def test_upstream_error_and_cancellation():
+    """上游调用失败时所有请求方收到同一个异常；所有请求方离开后取消上游调用"""
+    async def run():
+        coalescer = Coalescer()
+
+        async def failing(publish):
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream failed")
+
+        results = await asyncio.gather(*[coalescer.join("e", model_config(), failing) for _ in range(3)],
+                                       return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+
+        cancelled = []
+
+        async def hanging(publish):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        waiters = [asyncio.ensure_future(coalescer.join("c", model_config(), hanging)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        waiters[0].cancel()
+        await asyncio.sleep(0.01)
+        # 还有请求方在等待时不取消
+        assert not cancelled and coalescer.stats() == {"flights": 1, "subscribers": 1}
+        waiters[1].cancel()
+        await asyncio.sleep(0.01)
+        assert cancelled == [True]
+        assert coalescer.stats() == {"flights": 0, "subscribers": 0}
+
+    asyncio.run(run())
+
+
+def test_followers_record_usage():
+    """发起请求公布的usage交给每个跟随者的on_usage，跟随者各自记账；发起请求自己记账，不调用on_usage"""
+    async def run():
+        coalescer = Coalescer()
+        usage = {"prompt_tokens": 10, "completion_tokens": 20}
+
+        async def stream(publish):
+            for i in range(3):
+                yield b"data: %d\n\n" % i
+                await asyncio.sleep(0.005)
+            # 与StreamingResponse相同，在流结束时（广播结束之前）公布usage
+            publish(usage)
+
+        async def start(publish):
+            return StreamingResponse(stream(publish), media_type="text/event-stream")
+
+        recorded = {}
+
+        def on_usage(name):
+            async def record(value):
+                recorded[name] = value
+            return record
+
+        responses = [await coalescer.join("u", model_config(), start, on_usage(name))
+                     for name in ("leader", "a", "b")]
+        await asyncio.gather(*[collect(response) for response in responses])
+        assert recorded == {"a": usage, "b": usage}
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试请求合并...\n")
+    for test in (test_eligible, test_block_requests_share_one_call, test_stream_broadcast_and_slow_subscriber,
+                 test_upstream_error_and_cancellation, test_followers_record_usage):
+        test()
+        print(f"✅ {test.__doc__}")
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+测试响应压缩与请求体解压
+"""
+
+import asyncio
+import gzip
+import json
+import zlib
+
+from starlette.responses import Response, StreamingResponse
+
+from compression import (BROTLI_BOUNDED, DECOMPRESS_OFFLOAD_BYTES, DecompressedTooLarge, UnsupportedEncoding,
+                         available_encodings, compress, decompress, negotiate)
+from config import init_config
+from middleware import CompressionMiddleware, ModelValidationMiddleware
+
+
+async def call_asgi(app, body=b"", headers=None):
+    """以ASGI方式调用app，返回 (状态码, 响应头dict, 响应体分片列表, scope)"""
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/v1/chat/completions",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    start = {}
+    chunks = []
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            start.update(status=message["status"],
+                         headers={k.decode().lower(): v.decode() for k, v in message["headers"]})
+        elif message.get("body"):
+            chunks.append(message["body"])
+
+    await app(scope, receive, send)
+    return start["status"], start["headers"], chunks, scope
+
+
+def echo_app():
+    """读取请求体并记录到scope的下游app"""
+    async def app(scope, receive, send):
+        message = await receive()
+        scope["received_body"] = message.get("body", b"")
+        await Response(b'{"status": "success"}', media_type="application/json")(scope, receive, send)
+    return app
+
+
+def response_app(body: bytes, media_type: str = "application/json", **headers):
+    async def app(scope, receive, send):
+        await Response(body, media_type=media_type, headers=headers)(scope, receive, send)
+    return app
+
+
+def test_negotiate():
+    """按q值选择编码，q值相同时按服务端偏好，q=0表示拒绝"""
+    encodings = ["zstd", "br", "gzip"]
+    assert negotiate("gzip, deflate, br", encodings) == "br"
+    assert negotiate("gzip", encodings) == "gzip"
+    assert negotiate("br;q=0.5, gzip", encodings) == "gzip"
+    assert negotiate("*", encodings) == "zstd"
+    assert negotiate("*, zstd;q=0", encodings) == "br"
+    assert negotiate("identity", encodings) is None
+    assert negotiate("gzip;q=0", encodings) is None
+    assert negotiate("", encodings) is None
+
+
+def test_decompress():
+    """请求体按Content-Encoding解压，超过限制、数据损坏和不支持的编码分别报错"""
+    body = b'{"model": "deepseek-chat", "input": "' + b"x" * 1000 + b'"}'
+    assert decompress(gzip.compress(body), "gzip") == body
+    assert decompress(zlib.compress(body), "deflate") == body
+    assert decompress(compress(body, "gzip"), "GZIP ") == body
+    assert decompress(body, "identity") == body
+    try:
+        decompress(gzip.compress(body), "gzip", limit=100)
+        assert False, "应当超过大小限制"
+    except DecompressedTooLarge as e:
+        assert e.limit == 100
+    try:
+        decompress(gzip.compress(body)[:-20], "gzip")
+        assert False, "应当报告数据损坏"
+    except ValueError as e:
+        assert not isinstance(e, UnsupportedEncoding)
+    try:
+        decompress(body, "compress")
+        assert False, "应当不支持该编码"
+    except UnsupportedEncoding:
+        pass
+
+
+def test_decompress_bomb():
+    """压缩炸弹解压到超过限制即停止，不在内存中完整展开"""
+    bomb = b"\0" * (64 * 1024 * 1024)
+    for encoding in available_encodings():
+        if encoding == "br" and not BROTLI_BOUNDED:
+            continue
+        data = compress(bomb, encoding)
+        try:
+            decompress(data, encoding, limit=1024 * 1024)
+            assert False, f"{encoding} 应当超过大小限制"
+        except DecompressedTooLarge as e:
+            assert e.limit == 1024 * 1024
+        body = b'{"input": "' + b"x" * 1000 + b'"}'
+        assert decompress(compress(body, encoding), encoding, limit=len(body)) == body
+
+
+def test_decompress_truncated():
+    """被截断的请求体（包括zstd）报告数据损坏，不返回不完整的解压结果"""
+    async def run():
+        init_config("config.json")
+        middleware = ModelValidationMiddleware(echo_app())
+        body = json.dumps({"model": "deepseek-chat", "input": "x" * 1000 + bytes(range(256)).hex()}).encode()
+        for encoding in available_encodings():
+            if encoding == "br" and not BROTLI_BOUNDED:
+                continue
+            truncated = compress(body, encoding)[:-8]
+            for limit in (0, len(body), 1024 * 1024):
+                try:
+                    decompress(truncated, encoding, limit=limit)
+                    assert False, f"{encoding} 应当报告数据损坏"
+                except ValueError as e:
+                    assert not isinstance(e, UnsupportedEncoding)
+            status, _, _, _ = await call_asgi(middleware, body=truncated, headers={"Content-Encoding": encoding})
+            assert status == 400, encoding
+
+    asyncio.run(run())
+
+
+def test_compress_block_response():
+    """大的非流式响应压缩并更新Content-Length，小响应、已编码响应和不接受压缩的客户端原样返回"""
+    async def run():
+        body = json.dumps({"choices": [{"text": "hello world " * 200}]}).encode()
+        middleware = CompressionMiddleware(response_app(body), min_bytes=1024, encodings=["gzip"])
+        status, headers, chunks, _ = await call_asgi(middleware, headers={"Accept-Encoding": "gzip, br"})
+        data = b"".join(chunks)
+        assert status == 200 and headers["content-encoding"] == "gzip"
+        assert headers["vary"] == "Accept-Encoding"
+        assert int(headers["content-length"]) == len(data) < len(body)
+        assert gzip.decompress(data) == body
+
+        _, headers, chunks, _ = await call_asgi(middleware)
+        assert "content-encoding" not in headers and b"".join(chunks) == body
+
+        small = CompressionMiddleware(response_app(b'{"ok": true}'), encodings=["gzip"])
+        _, headers, chunks, _ = await call_asgi(small, headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in headers and b"".join(chunks) == b'{"ok": true}'
+
+        encoded = CompressionMiddleware(response_app(gzip.compress(body), **{"Content-Encoding": "gzip"}),
+                                        encodings=["gzip"])
+        _, headers, chunks, _ = await call_asgi(encoded, headers={"Accept-Encoding": "gzip"})
+        assert gzip.decompress(b"".join(chunks)) == body
+
+        image = CompressionMiddleware(response_app(b"\x89PNG" * 1000, media_type="image/png"), encodings=["gzip"])
+        _, headers, _, _ = await call_asgi(image, headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in headers
+
+    asyncio.run(run())
+
+
+def test_compress_stream_flushes_each_chunk():
+    """SSE流式响应每个分片压缩后立即flush，客户端收到的每个分片都能解码出完整事件"""
+    async def run():
+        events = [b'data: {"choices": [{"delta": {"content": "tok %d"}}]}\n\n' % i for i in range(5)]
+
+        async def app(scope, receive, send):
+            async def stream():
+                for event in events:
+                    yield event
+            await StreamingResponse(stream(), media_type="text/event-stream")(scope, receive, send)
+
+        middleware = CompressionMiddleware(app, min_bytes=1024, encodings=["gzip"])
+        _, headers, chunks, _ = await call_asgi(middleware, headers={"Accept-Encoding": "gzip"})
+        assert headers["content-encoding"] == "gzip" and "content-length" not in headers
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decoded = [decompressor.decompress(chunk) for chunk in chunks]
+        assert decoded[:len(events)] == events
+        assert b"".join(decoded) + decompressor.flush() == b"".join(events)
+        assert decompressor.eof
+
+    asyncio.run(run())
+
+
+def test_decompress_request_body():
+    """压缩的请求体解压后交给后续处理并去掉Content-Encoding头，损坏的返回400，不支持的编码返回415"""
+    async def run():
+        init_config("config.json")
+        middleware = ModelValidationMiddleware(echo_app())
+        body = json.dumps({"model": "deepseek-chat", "messages": [{"role": "user", "content": "Hello"}]}).encode()
+        status, _, _, scope = await call_asgi(middleware, body=gzip.compress(body),
+                                              headers={"Content-Encoding": "gzip"})
+        assert status == 200
+        assert scope["received_body"] == body
+        assert scope["state"]["request_body"].model == "deepseek-chat"
+        assert all(name != b"content-encoding" for name, _ in scope["headers"])
+
+        status, _, chunks, _ = await call_asgi(middleware, body=b"not gzip", headers={"Content-Encoding": "gzip"})
+        assert status == 400
+        assert json.loads(b"".join(chunks))["error"] == "Invalid compressed request body"
+        status, _, _, _ = await call_asgi(middleware, body=body, headers={"Content-Encoding": "compress"})
+        assert status == 415
+
+        # 未配置max_body_bytes时解压结果同样有上限，较大的请求体在线程中解压
+        middleware = ModelValidationMiddleware(echo_app(), max_decompressed_bytes=1024 * 1024)
+        bomb = gzip.compress(b"\0" * (64 * 1024 * 1024))
+        assert len(bomb) > DECOMPRESS_OFFLOAD_BYTES
+        status, _, _, _ = await call_asgi(middleware, body=bomb, headers={"Content-Encoding": "gzip"})
+        assert status == 413
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试响应压缩...\n")
+    for test in (test_negotiate, test_decompress, test_decompress_bomb, test_decompress_truncated,
+                 test_compress_block_response, test_compress_stream_flushes_each_chunk,
+                 test_decompress_request_body):
+        test()
+        print(f"✅ {test.__doc__}")
@@ -3,7 +3,7 @@
 测试配置文件解析功能
 """
 
-from config import load_config, get_model_config_by_name, ServerConfig, ModelConfig
+from config import load_config, get_model_config_by_name, ServerConfig, ModelConfig, PoolConfig
 
 
 def test_config_parsing():
@@ -20,7 +20,7 @@ def test_config_parsing():
         for i, (model_name, model_config) in enumerate(server_config.model_config.items(), 1):
             print(f"\n📝 模型配置 {i}:")
             print(f"   模型名称: {model_name}")
-            print(f"   应用名称: {model_config.app_name}")
+            print(f"   服务地址: {model_config.model_svc(model_name)}")
             print(f"   API密钥: {model_config.api_key[:8]}...")
         
         # 测试根据模型名称查找配置
@@ -28,10 +28,10 @@ def test_config_parsing():
         
         # 查找存在的模型
         deepseek_chat = get_model_config_by_name(server_config, "deepseek-chat")
-        print(f"✅ 找到模型 'deepseek-chat': {deepseek_chat.app_name}")
+        print(f"✅ 找到模型 'deepseek-chat': {deepseek_chat.svc_name}")
         
         deepseek_reasoner = get_model_config_by_name(server_config, "deepseek-reasoner")
-        print(f"✅ 找到模型 'deepseek-reasoner': {deepseek_reasoner.app_name}")
+        print(f"✅ 找到模型 'deepseek-reasoner': {deepseek_reasoner.svc_name}")
         
         # 测试查找不存在的模型
         try:
@@ -54,12 +54,14 @@ def test_config_structure():
     test_model_configs = {
         "test-model-1": ModelConfig(
             model_name="test-model-1",
-            app_name="test-app-1", 
+            svc_name="test-app-1",
+            svc_port=9002,
             api_key="test-key-1"
         ),
         "test-model-2": ModelConfig(
             model_name="test-model-2",
-            app_name="test-app-2",
+            svc_name="test-app-2",
+            svc_port=9002,
             api_key="test-key-2"
         )
     }
@@ -74,8 +76,10 @@ def test_config_structure():
         "model_config": [
             {
                 "model_name": "dict-model-1",
-                "app_name": "dict-app-1",
-                "api_key": "dict-key-1"
+                "svc_name": "dict-app-1",
+                "svc_port": 9002,
+                "api_key": "dict-key-1",
+                "pool": {"limit": 10, "keepalive_timeout": 5}
             }
         ]
     }
@@ -84,6 +88,29 @@ def test_config_structure():
     print(f"✅ 从字典创建配置成功: {list(dict_server_config.model_config.keys())[0]}")
 
 
+def test_pool_config():
+    """测试连接池配置解析"""
+    print("\n🔌 测试连接池配置:")
+    
+    model_config = ModelConfig.from_dict({
+        "model_name": "pool-model",
+        "svc_name": "pool-app",
+        "svc_port": 9002,
+        "api_key": "pool-key",
+        "pool": {"limit": 10, "keepalive_timeout": 5}
+    })
+    assert model_config.pool.limit == 10
+    assert model_config.pool.keepalive_timeout == 5.0
+    # 未配置的字段使用默认值
+    assert model_config.pool.limit_per_host == PoolConfig().limit_per_host
+    assert model_config.pool.ttl_dns_cache == PoolConfig().ttl_dns_cache
+    
+    # 未配置pool时使用默认连接池配置
+    default_config = ModelConfig.from_model_name("default-model")
+    assert default_config.pool == PoolConfig()
+    print("✅ 连接池配置解析成功")
+
+
 if __name__ == "__main__":
     print("🚀 开始测试配置文件解析功能...\n")
     
@@ -93,6 +120,9 @@ if __name__ == "__main__":
     # 测试配置结构
     test_config_structure()
     
+    # 测试连接池配置
+    test_pool_config()
+    
     if success:
         print("\n🎉 所有测试通过!")
     else:
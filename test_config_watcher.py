@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+测试配置热更新
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+
+import config
+from admission import AdmissionController
+from balancer import LoadBalancer
+from config import ModelConfig, PoolConfig, get_server_config, init_config, reload_config
+from config_watcher import ConfigWatcher
+from upstream import UpstreamClientManager
+
+
+def model_entry(name: str, api_key: str = "key", **extra) -> dict:
+    return {"model_name": name, "svc_name": name, "svc_port": 9002, "api_key": api_key, **extra}
+
+
+def write_config(path: str, *models: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"model_config": list(models)}, f)
+
+
+def test_reload_swaps_snapshot():
+    """重新加载后替换为新快照，旧快照保持不变；校验失败时保留当前配置"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "config.json")
+        write_config(path, model_entry("m1", api_key="old"))
+        init_config(path)
+        old = get_server_config()
+
+        write_config(path, model_entry("m1", api_key="new"), model_entry("m2"))
+        new = reload_config(path)
+        assert get_server_config() is new and new.version == old.version + 1
+        assert new.model_config["m1"].api_key == "new"
+        # 正在处理的请求持有的旧快照不受影响
+        assert old.model_config["m1"].api_key == "old" and "m2" not in old.model_config
+
+        for broken in ('{"model_config": [', json.dumps({"model_config": []}),
+                       json.dumps({"model_config": [model_entry("m1", replicas=["10.0.0.1:9002"])]})):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(broken)
+            try:
+                reload_config(path)
+                assert False, f"invalid config accepted: {broken}"
+            except Exception:
+                pass
+            assert get_server_config() is new
+
+        try:
+            new.model_config["m3"] = ModelConfig.from_model_name("m3")
+            assert False, "snapshot is mutable"
+        except TypeError:
+            pass
+    config.server_config = None
+
+
+def test_watcher_polls_file():
+    """配置文件修改后自动重新加载并调用回调"""
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "config.json")
+            write_config(path, model_entry("m1"))
+            init_config(path)
+            reloaded = []
+
+            async def on_reload(new_config):
+                reloaded.append(new_config)
+
+            watcher = ConfigWatcher(path, interval=0.02, on_reload=on_reload)
+            watcher.start()
+            try:
+                await asyncio.sleep(0.05)
+                assert reloaded == []
+                write_config(path, model_entry("m1"), model_entry("m2", api_key="another-key"))
+                for _ in range(50):
+                    if reloaded:
+                        break
+                    await asyncio.sleep(0.02)
+                assert list(reloaded[0].model_config) == ["m1", "m2"]
+                assert await watcher.reload() is True
+            finally:
+                await watcher.stop()
+        config.server_config = None
+
+    asyncio.run(run())
+
+
+def test_upstream_sync_keeps_unchanged_pools():
+    """配置未变的模型保留连接池，删除或连接池配置变化的模型换用新连接池"""
+    async def run():
+        manager = UpstreamClientManager()
+        unchanged, changed, removed = (ModelConfig.from_model_name(name) for name in ("a", "b", "c"))
+        sessions = {m.model_name: manager.session(m) for m in (unchanged, changed, removed)}
+
+        new_changed = ModelConfig.from_model_name("b")
+        new_changed.pool = PoolConfig(limit=7)
+        manager.sync({"a": ModelConfig.from_model_name("a"), "b": new_changed})
+        assert manager.session(unchanged) is sessions["a"]
+        assert manager.session(new_changed) is not sessions["b"]
+        assert manager.session(new_changed).connector.limit == 7
+        await asyncio.sleep(0.01)
+        # 没有在途请求的旧连接池立即关闭
+        assert sessions["b"].closed and sessions["c"].closed
+        assert not sessions["a"].closed
+        await manager.close()
+
+    asyncio.run(run())
+
+
+def test_stale_snapshot_does_not_revert_sync():
+    """配置更新后，使用旧配置快照的在途请求不会把副本列表、并发限制和连接池改回旧值"""
+    async def run():
+        old = ModelConfig.from_dict(model_entry("m", replicas=["http://a", "http://b"],
+                                                admission={"max_concurrency": 4}))
+        new = ModelConfig.from_dict(model_entry("m", replicas=["http://c"], admission={"max_concurrency": 1},
+                                                pool={"limit": 7}))
+        balancer, controller, manager = LoadBalancer(), AdmissionController(), UpstreamClientManager()
+        balancer.for_model(old)
+        (await controller.acquire(old)).release()
+        manager.session(old)
+
+        balancer.sync({"m": new})
+        controller.sync({"m": new})
+        manager.sync({"m": new})
+        # 旧快照的请求（排队、重试、对冲中）继续调用
+        pool = balancer.for_model(old)
+        ticket = await controller.acquire(old)
+        assert [replica.url for replica in pool.replicas] == ["http://c"]
+        assert controller.stats()["m"]["max_concurrency"] == 1
+        assert manager.session(old).connector.limit == 7
+        waiter = asyncio.ensure_future(controller.acquire(old))
+        await asyncio.sleep(0)
+        assert controller.stats()["m"]["queued"] == 1
+        ticket.release()
+        (await waiter).release()
+        await balancer.close()
+        await manager.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试配置热更新...\n")
+    for test in (test_reload_swaps_snapshot, test_watcher_polls_file, test_upstream_sync_keeps_unchanged_pools,
+                 test_stale_snapshot_does_not_revert_sync):
+        test()
+        print(f"✅ {test.__doc__}")
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+测试模拟上游模型服务
+"""
+
+import asyncio
+import json
+
+import aiohttp
+from aiohttp import web
+
+from bench_e2e import summarize
+from body import find_usage
+from fake_upstream import FakeModel, create_fake_upstream
+
+
+async def serve(fake_model: FakeModel):
+    runner = web.AppRunner(create_fake_upstream(fake_model))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+
+def test_block_and_stream_responses():
+    """非流式返回带usage的chat.completion，流式返回按token的SSE分片、usage分片和[DONE]"""
+    async def run():
+        runner, base = await serve(FakeModel(latency=0.0, tokens_per_sec=0, completion_tokens=8))
+        try:
+            async with aiohttp.ClientSession() as session:
+                body = {"model": "m", "messages": [{"role": "user", "content": "hello"}], "max_tokens": 4}
+                async with session.post(f"{base}/v1/chat/completions", json=body) as response:
+                    data = await response.json()
+                assert data["object"] == "chat.completion"
+                assert data["usage"]["completion_tokens"] == 4
+
+                async with session.post(f"{base}/v1/chat/completions", json={**body, "stream": True}) as response:
+                    assert response.headers["Content-Type"] == "text/event-stream"
+                    raw = await response.read()
+                events = [line[6:] for line in raw.decode().split("\n\n") if line]
+                assert events[-1] == "[DONE]"
+                assert sum(1 for event in events[:-1] if json.loads(event)["choices"]) == 4
+                assert find_usage(raw)["completion_tokens"] == 4
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_error_injection_and_overrides():
+    """按错误比例或X-Fake-Status返回错误，X-Fake-Latency-Ms覆盖首token延迟"""
+    async def run():
+        fake_model = FakeModel(latency=0.0, tokens_per_sec=0, error_rate=1.0, error_status=503)
+        runner, base = await serve(fake_model)
+        try:
+            async with aiohttp.ClientSession() as session:
+                body = {"model": "m", "messages": []}
+                async with session.post(f"{base}/v1/chat/completions", json=body) as response:
+                    assert response.status == 503
+                fake_model.error_rate = 0.0
+                async with session.post(f"{base}/v1/completions", json=body,
+                                        headers={"X-Fake-Status": "429"}) as response:
+                    assert response.status == 429
+                loop = asyncio.get_running_loop()
+                start = loop.time()
+                async with session.post(f"{base}/v1/completions", json=body,
+                                        headers={"X-Fake-Latency-Ms": "100"}) as response:
+                    assert (await response.json())["object"] == "text_completion"
+                assert loop.time() - start >= 0.1
+                assert fake_model.requests == 3
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_summarize():
+    """压测结果按成功请求统计延迟分位数，失败请求按状态码计数"""
+    samples = [(200, i / 1000, i / 2000) for i in range(1, 101)] + [(503, 0.001, 0.001), (0, 1.0, 1.0)]
+    result = summarize(samples, elapsed=2.0)
+    assert result["ok"] == 100 and result["errors"] == 2
+    assert result["statuses"] == {"200": 100, "503": 1, "0": 1}
+    assert result["throughput_rps"] == 50.0
+    assert abs(result["latency_ms"]["p50"] - 51.0) < 1e-9
+    assert abs(result["ttft_ms"]["max"] - 50.0) < 1e-9
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试模拟上游...\n")
+    for test in (test_block_and_stream_responses, test_error_injection_and_overrides, test_summarize):
+        test()
+        print(f"✅ {test.__doc__}")
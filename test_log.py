@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+测试异步结构化日志
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+import log
+from log import JsonFormatter, logger, redact, request_id_var, setup_logging, stop_logging
+
+
+def read_lines(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_redact():
+    """脱敏authorization和api_key的值"""
+    assert redact("{'authorization': 'Bearer sk-123', 'accept': '*/*'}") == \
+        "{'authorization': 'Bearer ***', 'accept': '*/*'}"
+    assert redact("ModelConfig(model_name='m', api_key='abc123', pool=1)") == \
+        "ModelConfig(model_name='m', api_key='***', pool=1)"
+    assert redact({"Authorization": "Bearer x", "nested": {"api_key": "y", "n": 1}}) == \
+        {"Authorization": "***", "nested": {"api_key": "***", "n": 1}}
+
+
+def test_json_lines_with_request_id():
+    """日志经队列写入文件，每行一个JSON，带请求ID和结构化字段"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "gateway.log")
+        setup_logging(log_file=path, console=False)
+        token = request_id_var.set("req-1")
+        try:
+            logger.info("请求完成", extra={"fields": {"status": 200, "headers": {"authorization": "Bearer s"}}})
+        finally:
+            request_id_var.reset(token)
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.error("失败", exc_info=True)
+        stop_logging()
+
+        first, second = read_lines(path)
+        assert first["msg"] == "请求完成" and first["request_id"] == "req-1"
+        assert first["status"] == 200 and first["headers"] == {"authorization": "***"}
+        assert "request_id" not in second and "ValueError: boom" in second["exc"]
+    setup_logging(console=False)
+
+
+def test_rotation_and_sampling():
+    """日志文件按大小轮转；采样比例为0时不记录请求体"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "gateway.log")
+        setup_logging(log_file=path, console=False, max_bytes=2000, backup_count=2, body_sample_rate=0.0)
+        for i in range(100):
+            logger.info(f"line {i}")
+        assert not log.sample_body_log()
+        stop_logging()
+        assert sorted(os.listdir(tmp)) == ["gateway.log", "gateway.log.1", "gateway.log.2"]
+        assert read_lines(path)[-1]["msg"] == "line 99"
+
+        setup_logging(log_file=None, console=False, body_sample_rate=1.0)
+        assert log.sample_body_log()
+        stop_logging()
+    setup_logging(console=False)
+
+
+def test_formatter_standalone():
+    """格式化器也可直接用于同步handler"""
+    record = logging.LogRecord("maas_gateway", logging.WARNING, __file__, 1, "api_key=%s", ("k1",), None)
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["level"] == "WARNING" and entry["msg"] == "api_key=***"
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试日志...\n")
+    for test in (test_redact, test_json_lines_with_request_id, test_rotation_and_sampling, test_formatter_standalone):
+        test()
+        print(f"✅ {test.__doc__}")
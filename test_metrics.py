@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+测试Prometheus指标
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+
+from metrics import Counter, Gauge, Histogram, MetricsExporter, dump_all, merge, render
+
+
+def test_render_text_format():
+    """按Prometheus文本格式输出计数器、Gauge和累计分桶的直方图"""
+    counter = Counter("test_render_requests_total", "请求数", ("model", "status"))
+    counter.inc("m", "200")
+    counter.inc("m", "200")
+    gauge = Gauge("test_render_in_flight", "在途请求")
+    gauge.inc()
+    histogram = Histogram("test_render_seconds", "耗时", ("model",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value, 'a"b')
+
+    text = render(merge([(dump_all(), True)]))
+    assert '# TYPE test_render_requests_total counter' in text
+    assert 'test_render_requests_total{model="m",status="200"} 2' in text
+    assert 'test_render_in_flight 1' in text
+    assert 'test_render_seconds_bucket{model="a\\"b",le="0.1"} 1' in text
+    assert 'test_render_seconds_bucket{model="a\\"b",le="1"} 2' in text
+    assert 'test_render_seconds_bucket{model="a\\"b",le="+Inf"} 3' in text
+    assert 'test_render_seconds_count{model="a\\"b"} 3' in text
+
+
+def test_merge_workers():
+    """多个worker的计数器和直方图累加，已退出进程的Gauge不计入"""
+    counter = Counter("test_merge_total", "计数", ("model",))
+    gauge = Gauge("test_merge_gauge", "当前值")
+    histogram = Histogram("test_merge_seconds", "耗时", buckets=(1.0,))
+    counter.inc("m", amount=3)
+    gauge.set(2)
+    histogram.observe(0.5)
+    snapshot = dump_all()
+
+    merged = merge([(snapshot, True), (snapshot, True), (snapshot, False)])
+    assert merged["test_merge_total"]["values"][("m",)] == 9
+    assert merged["test_merge_gauge"]["values"][()] == 4
+    assert merged["test_merge_seconds"]["values"][()] == {"buckets": [3, 0], "sum": 1.5, "count": 3}
+
+
+def test_exporter_reads_other_workers():
+    """汇总目录中其他worker的快照与本进程的实时值合并输出"""
+    async def run():
+        counter = Counter("test_exporter_total", "计数")
+        counter.inc(amount=2)
+        with tempfile.TemporaryDirectory() as tmp:
+            # 模拟另一个已退出的worker留下的快照
+            other = {"test_exporter_total": {"type": "counter", "help": "计数", "labels": [], "values": [[[], 5]]}}
+            with open(os.path.join(tmp, "999999999.json"), "w", encoding="utf-8") as f:
+                json.dump(other, f)
+            exporter = MetricsExporter(tmp, interval=0.01)
+            exporter.start()
+            await asyncio.sleep(0.05)
+            assert os.path.exists(os.path.join(tmp, f"{os.getpid()}.json"))
+            assert "test_exporter_total 7" in await exporter.collect()
+            await exporter.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试指标...\n")
+    for test in (test_render_text_format, test_merge_workers, test_exporter_reads_other_workers):
+        test()
+        print(f"✅ {test.__doc__}")
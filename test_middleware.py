@@ -5,203 +5,312 @@
 
 import asyncio
 import json
-from unittest.mock import Mock, AsyncMock
-from fastapi import Request
+import os
+import tempfile
+from fastapi import HTTPException
 from fastapi.responses import JSONResponse
 
 from middleware import (
-    AuthMiddleware, 
-    LoggingMiddleware, 
+    AuthMiddleware,
+    LoggingMiddleware,
     ModelValidationMiddleware,
     ErrorHandlingMiddleware,
     RateLimitingMiddleware,
-    CORSMiddleware
+    CORSMiddleware,
+    MetricsMiddleware
 )
-from config import init_config
+from auth_proxy import AuthBackendError
+from body import RequestBody
+from config import init_config, ModelConfig, RateLimitConfig
+from metrics import REQUESTS_TOTAL, REQUEST_BODY_BYTES
+from ratelimit import MemoryBackend, RateLimiter
 
 
-async def test_auth_middleware():
+async def call_asgi(app, path="/v1/chat/completions", body=b"", headers=None, body_chunks=None):
+    """以ASGI方式调用app，返回 (状态码, 响应头dict, 响应体分片列表, scope)"""
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": path,
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        "client": ("127.0.0.1", 12345),
+    }
+    chunks = body_chunks if body_chunks is not None else [body]
+    messages = [{"type": "http.request", "body": c, "more_body": i < len(chunks) - 1}
+                for i, c in enumerate(chunks)]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    status = None
+    response_headers = {}
+    response_chunks = []
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            response_headers.update({k.decode().lower(): v.decode() for k, v in message["headers"]})
+        elif message["type"] == "http.response.body" and message.get("body"):
+            response_chunks.append(message["body"])
+
+    await app(scope, receive, send)
+    return status, response_headers, response_chunks, scope
+
+
+def json_app(content=None):
+    """返回固定JSON的下游app，同时记录收到的请求体"""
+    async def app(scope, receive, send):
+        received = []
+        while True:
+            message = await receive()
+            received.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        scope["received_body"] = b"".join(received)
+        await JSONResponse(content=content or {"status": "success"})(scope, receive, send)
+    return app
+
+
+def with_state(app, **state):
+    """在调用app前向请求状态写入数据"""
+    async def wrapper(scope, receive, send):
+        scope.setdefault("state", {}).update(state)
+        await app(scope, receive, send)
+    return wrapper
+
+
+class StubAuthProxy:
+    async def auth(self, request):
+        if request.headers.get("Authorization") == "Bearer outage":
+            raise AuthBackendError("认证服务返回 502")
+        if request.headers.get("Authorization") != "Bearer good":
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        return True
+
+
+def test_auth_middleware():
     """测试认证中间件"""
-    print("🔐 测试认证中间件...")
-    
-    # 创建模拟的认证中间件
-    auth_middleware = AuthMiddleware("http://auth-service:8080")
-    
-    # 模拟请求
-    mock_request = Mock()
-    mock_request.url.path = "/v1/chat/completions"
-    
-    # 模拟call_next函数
-    async def mock_call_next(request):
-        return JSONResponse(content={"status": "success"})
-    
-    try:
-        response = await auth_middleware(mock_request, mock_call_next)
-        print("✅ 认证中间件测试通过")
-    except Exception as e:
-        print(f"❌ 认证中间件测试失败: {e}")
-
-
-async def test_logging_middleware():
+    async def run():
+        auth_middleware = AuthMiddleware(json_app(), "http://auth-service:8080", auth_proxy=StubAuthProxy())
+        status, _, _, _ = await call_asgi(auth_middleware, headers={"Authorization": "Bearer good"})
+        assert status == 200
+        status, _, chunks, _ = await call_asgi(auth_middleware, headers={"Authorization": "Bearer bad"})
+        assert status == 401
+        assert json.loads(b"".join(chunks))["error"] == "Authentication failed"
+        # 认证服务不可用时返回可重试的503，而不是401
+        status, headers, _, _ = await call_asgi(auth_middleware, headers={"Authorization": "Bearer outage"})
+        assert status == 503 and int(headers["retry-after"]) > 0
+        # 健康检查跳过认证
+        status, _, _, _ = await call_asgi(auth_middleware, path="/health")
+        assert status == 200
+
+    asyncio.run(run())
+
+
+def test_logging_middleware():
     """测试日志中间件"""
-    print("\n📝 测试日志中间件...")
-    
-    logging_middleware = LoggingMiddleware()
-    
-    # 模拟请求
-    mock_request = Mock()
-    mock_request.method = "POST"
-    mock_request.url.path = "/v1/chat/completions"
-    
-    # 模拟call_next函数
-    async def mock_call_next(request):
-        return JSONResponse(content={"status": "success"})
-    
-    try:
-        response = await logging_middleware(mock_request, mock_call_next)
-        print("✅ 日志中间件测试通过")
-        print(f"   响应头包含处理时间: {response.headers.get('X-Process-Time')}")
-    except Exception as e:
-        print(f"❌ 日志中间件测试失败: {e}")
-
-
-async def test_model_validation_middleware():
+    async def run():
+        logging_middleware = LoggingMiddleware(json_app())
+        status, headers, _, _ = await call_asgi(logging_middleware)
+        assert status == 200
+        assert float(headers["x-process-time"]) >= 0
+        assert len(headers["x-request-id"]) == 32
+        # 沿用客户端传入的请求ID
+        _, headers, _, scope = await call_asgi(logging_middleware, headers={"X-Request-ID": "abc-123"})
+        assert headers["x-request-id"] == "abc-123" and scope["state"]["request_id"] == "abc-123"
+
+    asyncio.run(run())
+
+
+def test_model_validation_middleware():
     """测试模型验证中间件"""
-    print("\n🔍 测试模型验证中间件...")
-    
-    # 初始化配置
-    init_config("config.json")
-    
-    model_validation_middleware = ModelValidationMiddleware()
-    
-    # 测试有效请求
-    mock_request = Mock()
-    mock_request.url.path = "/v1/chat/completions"
-    mock_request.body = AsyncMock(return_value=json.dumps({
-        "model": "deepseek-chat",
-        "messages": [{"role": "user", "content": "Hello"}]
-    }).encode())
-    
-    async def mock_call_next(request):
-        return JSONResponse(content={"status": "success"})
-    
-    try:
-        response = await model_validation_middleware(mock_request, mock_call_next)
-        print("✅ 模型验证中间件测试通过")
-    except Exception as e:
-        print(f"❌ 模型验证中间件测试失败: {e}")
-    
-    # 测试无效模型
-    mock_request.body = AsyncMock(return_value=json.dumps({
-        "model": "invalid-model",
-        "messages": [{"role": "user", "content": "Hello"}]
-    }).encode())
-    
-    try:
-        response = await model_validation_middleware(mock_request, mock_call_next)
-        if response.status_code == 400:
-            print("✅ 无效模型验证测试通过")
-        else:
-            print("❌ 无效模型验证测试失败")
-    except Exception as e:
-        print(f"❌ 无效模型验证测试失败: {e}")
-
-
-async def test_rate_limiting_middleware():
+    async def run():
+        # 初始化配置
+        init_config("config.json")
+        model_validation_middleware = ModelValidationMiddleware(json_app())
+
+        # 有效请求：请求体分多个分片到达，下游仍能读到完整请求体
+        body = json.dumps({
+            "model": "deepseek-chat",
+            "messages": [{"role": "user", "content": "Hello"}],
+            "stream": True
+        }).encode()
+        status, _, _, scope = await call_asgi(model_validation_middleware, body_chunks=[body[:10], body[10:]])
+        assert status == 200
+        assert scope["received_body"] == body
+        assert scope["state"]["request_body"].raw == body
+        assert scope["state"]["request_body"].stream is True
+        assert scope["state"]["model_config"].model_name == "deepseek-chat"
+
+        # 无效模型
+        status, _, chunks, _ = await call_asgi(model_validation_middleware, body=json.dumps({
+            "model": "invalid-model",
+            "messages": [{"role": "user", "content": "Hello"}]
+        }).encode())
+        assert status == 400
+        assert json.loads(b"".join(chunks))["error"].startswith("Invalid model")
+
+        # 非法JSON
+        status, _, chunks, _ = await call_asgi(model_validation_middleware, body=b'{"model": "deepseek-chat"')
+        assert status == 400
+        assert json.loads(b"".join(chunks))["error"] == "Invalid JSON in request body"
+        # 键名中的非法转义同样返回400
+        status, _, _, _ = await call_asgi(model_validation_middleware, body=b'{"\\x": 1, "model": "deepseek-chat"}')
+        assert status == 400
+
+        # 非/v1/路径不校验
+        status, _, _, _ = await call_asgi(model_validation_middleware, path="/debug/json", body=b"not json")
+        assert status == 200
+
+    asyncio.run(run())
+
+
+def test_request_size_limits():
+    """请求体超过限制返回413（Content-Length超限时不读取请求体），估算token数超过上下文长度返回400"""
+    async def run():
+        with open("config.json", encoding="utf-8") as f:
+            data = json.load(f)
+        for model in data["model_config"]:
+            model.update(max_body_bytes=4096, max_context_tokens=100)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "config.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            init_config(path)
+        try:
+            middleware = ModelValidationMiddleware(json_app())
+
+            def chat(content, **fields):
+                return json.dumps({"model": "deepseek-chat",
+                                   "messages": [{"role": "user", "content": content}], **fields}).encode()
+
+            status, _, _, scope = await call_asgi(middleware, body=chat("Hello"))
+            assert status == 200
+            assert 0 < scope["state"]["prompt_tokens"] < 100
+
+            # Content-Length超限时直接拒绝，不等待请求体
+            status, _, chunks, _ = await call_asgi(middleware, headers={"Content-Length": "5000"}, body_chunks=[])
+            assert status == 413
+            assert json.loads(b"".join(chunks))["error"] == "Request body too large"
+            status, _, _, _ = await call_asgi(middleware, body_chunks=[b"x" * 4000, b"x" * 4000])
+            assert status == 413
+
+            status, _, chunks, _ = await call_asgi(middleware, body=chat("x" * 500))
+            assert status == 400
+            assert json.loads(b"".join(chunks))["error"] == "Context length exceeded"
+            # max_tokens计入上下文长度
+            status, _, _, _ = await call_asgi(middleware, body=chat("Hello", max_tokens=95))
+            assert status == 400
+        finally:
+            init_config("config.json")
+
+    asyncio.run(run())
+
+
+def test_rate_limiting_middleware():
     """测试速率限制中间件"""
-    print("\n⏱️  测试速率限制中间件...")
-    
-    rate_limiting_middleware = RateLimitingMiddleware()
-    
-    # 模拟请求
-    mock_request = Mock()
-    mock_request.client.host = "127.0.0.1"
-    
-    async def mock_call_next(request):
-        return JSONResponse(content={"status": "success"})
-    
-    try:
-        # 测试正常请求
-        response = await rate_limiting_middleware(mock_request, mock_call_next)
-        print("✅ 速率限制中间件测试通过")
-    except Exception as e:
-        print(f"❌ 速率限制中间件测试失败: {e}")
-
-
-async def test_cors_middleware():
+    async def run():
+        model_config = ModelConfig.from_model_name("limited-model")
+        model_config.rate_limit = RateLimitConfig(requests_per_minute=2)
+        rate_limiter = RateLimiter(MemoryBackend())
+        rate_limiting_middleware = RateLimitingMiddleware(json_app(), rate_limiter=rate_limiter)
+
+        async def call(token):
+            # 模拟模型验证中间件写入的状态
+            app = with_state(rate_limiting_middleware, model_config=model_config,
+                             request_body=RequestBody(b'{"model": "limited-model"}', "limited-model"))
+            return await call_asgi(app, headers={"Authorization": f"Bearer {token}"})
+
+        statuses = [(await call("token-a"))[0] for _ in range(3)]
+        assert statuses == [200, 200, 429]
+        _, headers, _, _ = await call("token-a")
+        assert int(headers["retry-after"]) >= 1
+        # 不同token独立限流
+        assert (await call("token-b"))[0] == 200
+
+    asyncio.run(run())
+
+
+def test_metrics_middleware():
+    """测试指标中间件：按模型和状态码计数，记录请求体大小"""
+    async def run():
+        model_config = ModelConfig.from_model_name("metrics-model")
+        app = with_state(MetricsMiddleware(json_app()), model_config=model_config,
+                         request_body=RequestBody(b'{"model": "metrics-model"}', "metrics-model"))
+        for _ in range(2):
+            status, _, _, _ = await call_asgi(app)
+            assert status == 200
+        assert REQUESTS_TOTAL.value("metrics-model", "200") == 2
+        assert REQUEST_BODY_BYTES.count("metrics-model") == 2
+        # 非API路径不统计
+        await call_asgi(MetricsMiddleware(json_app()), path="/health")
+        assert REQUESTS_TOTAL.value("unknown", "200") == 0
+
+    asyncio.run(run())
+
+
+def test_cors_middleware():
     """测试CORS中间件"""
-    print("\n🌐 测试CORS中间件...")
-    
-    cors_middleware = CORSMiddleware()
-    
-    # 模拟请求
-    mock_request = Mock()
-    
-    async def mock_call_next(request):
-        return JSONResponse(content={"status": "success"})
-    
-    try:
-        response = await cors_middleware(mock_request, mock_call_next)
+    async def run():
+        cors_middleware = CORSMiddleware(json_app())
+        _, headers, _, _ = await call_asgi(cors_middleware)
         cors_headers = [
-            "Access-Control-Allow-Origin",
-            "Access-Control-Allow-Methods", 
-            "Access-Control-Allow-Headers"
+            "access-control-allow-origin",
+            "access-control-allow-methods",
+            "access-control-allow-headers"
         ]
-        
-        if all(header in response.headers for header in cors_headers):
-            print("✅ CORS中间件测试通过")
-        else:
-            print("❌ CORS中间件测试失败")
-    except Exception as e:
-        print(f"❌ CORS中间件测试失败: {e}")
+        assert all(header in headers for header in cors_headers)
+
+    asyncio.run(run())
 
 
-async def test_error_handling_middleware():
+def test_error_handling_middleware():
     """测试错误处理中间件"""
-    print("\n🚨 测试错误处理中间件...")
-    
-    error_handling_middleware = ErrorHandlingMiddleware()
-    
-    # 模拟请求
-    mock_request = Mock()
-    
-    # 测试正常情况
-    async def mock_call_next_success(request):
-        return JSONResponse(content={"status": "success"})
-    
-    try:
-        response = await error_handling_middleware(mock_request, mock_call_next_success)
-        print("✅ 错误处理中间件正常情况测试通过")
-    except Exception as e:
-        print(f"❌ 错误处理中间件正常情况测试失败: {e}")
-    
-    # 测试异常情况
-    async def mock_call_next_error(request):
-        raise Exception("测试异常")
-    
-    try:
-        response = await error_handling_middleware(mock_request, mock_call_next_error)
-        if response.status_code == 500:
-            print("✅ 错误处理中间件异常情况测试通过")
-        else:
-            print("❌ 错误处理中间件异常情况测试失败")
-    except Exception as e:
-        print(f"❌ 错误处理中间件异常情况测试失败: {e}")
-
-
-async def main():
-    """运行所有测试"""
-    print("🚀 开始测试middleware功能...\n")
-    
-    await test_auth_middleware()
-    await test_logging_middleware()
-    await test_model_validation_middleware()
-    await test_rate_limiting_middleware()
-    await test_cors_middleware()
-    await test_error_handling_middleware()
-    
-    print("\n🎉 所有middleware测试完成!")
+    async def run():
+        # 测试正常情况
+        status, _, _, _ = await call_asgi(ErrorHandlingMiddleware(json_app()))
+        assert status == 200
+
+        # 测试异常情况
+        async def error_app(scope, receive, send):
+            raise Exception("测试异常")
+
+        status, _, chunks, _ = await call_asgi(ErrorHandlingMiddleware(error_app))
+        assert status == 500
+        assert json.loads(b"".join(chunks))["detail"] == "测试异常"
+
+    asyncio.run(run())
+
+
+def test_streaming_passthrough():
+    """整条中间件链不缓冲流式响应，每个分片单独到达客户端"""
+    async def run():
+        async def stream_app(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"text/event-stream")]})
+            for i in range(3):
+                await send({"type": "http.response.body", "body": b"data: %d\n\n" % i, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+        app = stream_app
+        for middleware in (RateLimitingMiddleware, CORSMiddleware, LoggingMiddleware, ErrorHandlingMiddleware):
+            app = middleware(app)
+        status, headers, chunks, _ = await call_asgi(app, path="/stream")
+        assert status == 200
+        assert chunks == [b"data: 0\n\n", b"data: 1\n\n", b"data: 2\n\n"]
+        assert "x-process-time" in headers and "access-control-allow-origin" in headers
+
+    asyncio.run(run())
 
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    print("🚀 开始测试middleware功能...\n")
+    for test in (test_auth_middleware, test_logging_middleware, test_model_validation_middleware,
+                 test_request_size_limits, test_rate_limiting_middleware, test_metrics_middleware,
+                 test_cors_middleware, test_error_handling_middleware, test_streaming_passthrough):
+        test()
+        print(f"✅ {test.__doc__}")
+    print("\n🎉 所有middleware测试完成!")
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+测试令牌桶限流
+"""
+
+import asyncio
+import fcntl
+import multiprocessing
+import os
+import tempfile
+import time
+
+from config import ModelConfig, RateLimitConfig
+from ratelimit import MemoryBackend, RateLimiter, SharedMemoryBackend, gcra
+
+
+def test_gcra_burst_and_refill():
+    """突发容量用完后按速率恢复，不存在窗口边界的双倍突发"""
+    interval, burst = 1.0, 3
+    tat, now = 0.0, 100.0
+    for _ in range(3):
+        tat, retry_after = gcra(tat, now, 1, interval, burst)
+        assert retry_after == 0.0
+    _, retry_after = gcra(tat, now, 1, interval, burst)
+    assert abs(retry_after - 1.0) < 1e-9
+    # 1秒后恢复一个令牌
+    tat, retry_after = gcra(tat, now + 1.0, 1, interval, burst)
+    assert retry_after == 0.0
+    _, retry_after = gcra(tat, now + 1.0, 1, interval, burst)
+    assert retry_after > 0
+
+
+def test_gcra_oversized_cost():
+    """单次消耗超过桶容量时，满桶放行一次，之后需要等待"""
+    tat, retry_after = gcra(0.0, 10.0, 5, 1.0, 2)
+    assert retry_after == 0.0
+    _, retry_after = gcra(tat, 10.0, 1, 1.0, 2)
+    assert retry_after > 0
+
+
+def test_memory_backend_bounded():
+    """key数量有上界，空闲key被清理"""
+    async def run():
+        backend = MemoryBackend(max_keys=100)
+        for i in range(1000):
+            assert await backend.acquire(f"key-{i}", 1, 0.000001, 1) == 0.0
+        assert len(backend) <= 100
+
+    asyncio.run(run())
+
+
+def test_rate_limiter_request_and_token_limits():
+    """请求速率和token速率分别生效，completion token补扣后需要等待"""
+    async def run():
+        model_config = ModelConfig.from_model_name("m")
+        model_config.rate_limit = RateLimitConfig(requests_per_minute=600, tokens_per_minute=1000)
+        limiter = RateLimiter(MemoryBackend())
+
+        assert await limiter.acquire("token-a", model_config, prompt_tokens=600) == 0.0
+        # token桶剩余400，再来600个prompt token需要等待
+        assert await limiter.acquire("token-a", model_config, prompt_tokens=600) > 0
+        assert await limiter.acquire("token-a", model_config, prompt_tokens=300) == 0.0
+        await limiter.charge_tokens("token-a", model_config, 500)
+        assert await limiter.acquire("token-a", model_config, prompt_tokens=10) > 0
+        # 其他token和其他模型不受影响
+        assert await limiter.acquire("token-b", model_config, prompt_tokens=600) == 0.0
+        other_model = ModelConfig.from_model_name("other")
+        other_model.rate_limit = model_config.rate_limit
+        assert await limiter.acquire("token-a", other_model, prompt_tokens=600) == 0.0
+
+    asyncio.run(run())
+
+
+def test_rejected_request_keeps_request_quota():
+    """被token限制拒绝的请求不占用请求速率的额度"""
+    async def run():
+        model_config = ModelConfig.from_model_name("m")
+        model_config.rate_limit = RateLimitConfig(requests_per_minute=60, request_burst=2, tokens_per_minute=1000)
+        with tempfile.TemporaryDirectory() as tmp:
+            for backend in (MemoryBackend(), SharedMemoryBackend(os.path.join(tmp, "ratelimit.shm"), slots=64)):
+                limiter = RateLimiter(backend)
+                assert await limiter.acquire("token-a", model_config, prompt_tokens=600) == 0.0
+                for _ in range(5):
+                    assert await limiter.acquire("token-a", model_config, prompt_tokens=600) > 0
+                # 突发容量为2，第二个请求仍可通过
+                assert await limiter.acquire("token-a", model_config, prompt_tokens=300) == 0.0
+                assert await limiter.acquire("token-a", model_config, prompt_tokens=10) > 0
+                await limiter.close()
+
+    asyncio.run(run())
+
+
+def _shm_worker(path: str, attempts: int, queue):
+    async def run():
+        backend = SharedMemoryBackend(path, slots=1024)
+        allowed = 0
+        for _ in range(attempts):
+            if await backend.acquire("shared-key", 1, 60.0, 10) == 0.0:
+                allowed += 1
+        await backend.close()
+        return allowed
+
+    queue.put(asyncio.run(run()))
+
+
+def test_shared_memory_backend_across_processes():
+    """多个进程共享同一个限额"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "ratelimit.shm")
+        ctx = multiprocessing.get_context("spawn")
+        queue = ctx.Queue()
+        workers = [ctx.Process(target=_shm_worker, args=(path, 20, queue)) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+        # 突发容量为10，三个进程合计只能通过10个请求
+        assert sum(queue.get(timeout=5) for _ in workers) == 10
+
+
+def test_shared_memory_backend_slot_reuse():
+    """槽位不足时复用空闲或最早到期的槽位，不会报错"""
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = SharedMemoryBackend(os.path.join(tmp, "ratelimit.shm"), slots=4)
+            for i in range(100):
+                assert await backend.acquire(f"key-{i}", 1, 0.001, 5) == 0.0
+            await backend.close()
+
+    asyncio.run(run())
+
+
+def test_shared_memory_backend_lock_does_not_block_loop():
+    """其他进程持有文件锁时，等待加锁不阻塞事件循环，锁释放后继续判定"""
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ratelimit.shm")
+            backend = SharedMemoryBackend(path, slots=64)
+            # 另一个打开的文件描述符模拟其他worker持有锁
+            other = os.open(path, os.O_RDWR)
+            fcntl.flock(other, fcntl.LOCK_EX)
+            acquire = asyncio.ensure_future(backend.acquire("key", 1, 60.0, 1))
+            ticks = 0
+            for _ in range(10):
+                await asyncio.sleep(0.001)
+                ticks += 1
+            assert ticks == 10 and not acquire.done()
+            fcntl.flock(other, fcntl.LOCK_UN)
+            os.close(other)
+            assert await asyncio.wait_for(acquire, 1) == 0.0
+            await backend.close()
+
+    asyncio.run(run())
+
+
+def test_shared_memory_backend_survives_reboot():
+    """共享内存文件中的TAT为墙上时间，重启后单调时钟重新计时也不会长时间限流"""
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ratelimit.shm")
+            backend = SharedMemoryBackend(path, slots=64)
+            assert await backend.acquire("key", 1, 60.0, 1) == 0.0
+            tats = [SharedMemoryBackend.SLOT.unpack_from(backend._mmap, offset)[1]
+                    for offset in range(0, 64 * SharedMemoryBackend.SLOT.size, SharedMemoryBackend.SLOT.size)]
+            assert abs(max(tats) - (time.time() + 60.0)) < 5
+            await backend.close()
+
+            # 重新打开同一文件（如进程重启）时限流状态仍然有效
+            backend = SharedMemoryBackend(path, slots=64)
+            assert 55 < await backend.acquire("key", 1, 60.0, 1) <= 60
+            await backend.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试令牌桶限流...\n")
+    for test in (test_gcra_burst_and_refill, test_gcra_oversized_cost, test_memory_backend_bounded,
+                 test_rate_limiter_request_and_token_limits, test_rejected_request_keeps_request_quota,
+                 test_shared_memory_backend_across_processes, test_shared_memory_backend_slot_reuse,
+                 test_shared_memory_backend_lock_does_not_block_loop, test_shared_memory_backend_survives_reboot):
+        test()
+        print(f"✅ {test.__doc__}")
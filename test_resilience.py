@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+测试上游重试、对冲请求与熔断
+"""
+
+import asyncio
+import time
+
+from config import ModelConfig, ResilienceConfig
+from resilience import CircuitBreaker, CircuitOpen, ModelResilience, backoff_delay, hedged
+
+
+def test_config_from_dict():
+    """未配置的字段使用默认值，默认不重试、不对冲、不熔断"""
+    model_config = ModelConfig.from_dict({
+        "model_name": "m", "svc_name": "m", "svc_port": 9002, "api_key": "k",
+        "resilience": {"max_retries": 2, "retry_statuses": [503], "hedge": True},
+    })
+    assert model_config.resilience.max_retries == 2
+    assert model_config.resilience.retry_statuses == (503,)
+    assert model_config.resilience.hedge and model_config.resilience.breaker_threshold == 0
+    assert ModelConfig.from_model_name("m").resilience == ResilienceConfig()
+
+
+def test_circuit_breaker():
+    """连续失败后熔断并拒绝请求，到期后放行一个试探请求，试探成功则恢复"""
+    config = ResilienceConfig(breaker_threshold=2, breaker_open_time=0.05)
+    breaker = CircuitBreaker("m")
+    breaker.allow(config)
+    breaker.record(False, config)
+    breaker.record(False, config)
+    assert breaker.state == "open"
+    try:
+        breaker.allow(config)
+        assert False, "熔断期间应拒绝请求"
+    except CircuitOpen as e:
+        assert e.retry_after >= 1
+
+    time.sleep(0.06)
+    breaker.allow(config)
+    assert breaker.state == "half_open"
+    # 试探请求返回前不放行其他请求
+    try:
+        breaker.allow(config)
+        assert False, "半开状态只放行一个试探请求"
+    except CircuitOpen:
+        pass
+    breaker.record(False, config)
+    assert breaker.state == "open"
+
+    time.sleep(0.06)
+    breaker.allow(config)
+    breaker.record(True, config)
+    assert breaker.state == "closed"
+    breaker.allow(config)
+
+
+def test_backoff_and_hedge_delay():
+    """退避时间在 [0, min(max, base * 2^n)] 内；延迟样本足够、有多个副本且未熔断时才对冲"""
+    config = ResilienceConfig(retry_backoff=0.1, retry_backoff_max=0.3, hedge=True, hedge_min_delay=0.05)
+    assert all(0 <= backoff_delay(config, 0) <= 0.1 for _ in range(100))
+    assert all(0 <= backoff_delay(config, 5) <= 0.3 for _ in range(100))
+
+    resilience = ModelResilience("m")
+    assert resilience.hedge_delay(config, replicas=2) is None
+    for i in range(100):
+        resilience.latency.observe(0.01 * (i + 1))
+    assert abs(resilience.hedge_delay(config, replicas=2) - 0.96) < 1e-9
+    assert resilience.hedge_delay(config, replicas=1) is None
+    assert resilience.hedge_delay(ResilienceConfig(), replicas=2) is None
+
+    # 熔断器半开时只发送一个试探请求，不对冲
+    resilience.breaker.state = "half_open"
+    assert resilience.hedge_delay(config, replicas=2) is None
+
+
+def test_hedged_request():
+    """原请求超过对冲延迟未返回时发送对冲请求，采用先返回的可用结果并取消另一个"""
+    async def run():
+        cancelled = []
+
+        async def call(name, delay, status=200):
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                cancelled.append(name)
+                raise
+            return status, name
+
+        def acceptable(result):
+            return result[0] < 500
+
+        result = await hedged("m", lambda: call("primary", 1.0), lambda: call("backup", 0.01), 0.02, acceptable)
+        assert result == (200, "backup")
+        await asyncio.sleep(0)
+        assert cancelled == ["primary"]
+
+        # 原请求在对冲延迟内返回，不发送对冲请求
+        result = await hedged("m", lambda: call("primary", 0.0), lambda: call("backup", 0.0), 0.5, acceptable)
+        assert result == (200, "primary")
+
+        # 对冲请求失败时继续等待原请求
+        result = await hedged("m", lambda: call("primary", 0.05), lambda: call("backup", 0.0, 503), 0.01, acceptable)
+        assert result == (200, "primary")
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试重试与熔断...\n")
+    for test in (test_config_from_dict, test_circuit_breaker, test_backoff_and_hedge_delay, test_hedged_request):
+        test()
+        print(f"✅ {test.__doc__}")
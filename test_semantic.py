@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+测试语义缓存
+"""
+
+import asyncio
+import json
+import math
+
+from body import parse_request_body
+from cache import CacheEntry
+from config import ModelConfig, SemanticCacheConfig
+from metrics import SEMANTIC_CACHE_REQUESTS
+from semantic import SemanticCache, VectorIndex, local_embedding, query_scope, query_text
+
+URI = "/v1/chat/completions"
+
+
+def model_config(**semantic_cache) -> ModelConfig:
+    config = ModelConfig.from_model_name("semantic-model")
+    config.semantic_cache = SemanticCacheConfig(enabled=True, **semantic_cache)
+    return config
+
+
+def chat(question: str, system: str = "You are a helpful assistant.", **fields):
+    return parse_request_body(json.dumps({
+        "model": "semantic-model",
+        "messages": [{"role": "system", "content": system}, {"role": "user", "content": question}],
+        "temperature": 0,
+        **fields,
+    }).encode())
+
+
+def cosine(a, b) -> float:
+    return sum(x * y for x, y in zip(a, b)) / math.sqrt(sum(x * x for x in a) * sum(y * y for y in b))
+
+
+def test_local_embedding_and_scope():
+    """字面相近的问题相似度高、无关问题相似度低；系统提示或参数不同的请求不在同一范围"""
+    base = local_embedding("How do I reset my password?", 256)
+    assert cosine(base, local_embedding("how do I reset my  password", 256)) > 0.9
+    assert cosine(base, local_embedding("What is the refund policy for annual plans?", 256)) < 0.5
+    assert cosine(local_embedding("如何重置密码？", 256), local_embedding("如何重置密码", 256)) > 0.8
+
+    data = chat("hi").data
+    assert query_text(data) == "hi"
+    assert query_scope(URI, data) == query_scope(URI, chat("hello").data)
+    assert query_scope(URI, data) != query_scope(URI, chat("hi", system="Be terse.").data)
+    assert query_scope(URI, data) != query_scope(URI, chat("hi", max_tokens=10).data)
+    assert query_text({"messages": [{"role": "assistant", "content": "hi"}]}) is None
+    assert query_text({"messages": [{"role": "user", "content": [{"type": "text", "text": "hi"}]}]}) == "hi"
+
+
+def test_vector_index_eviction():
+    """超过容量时淘汰最久未使用的条目，过期条目查到时删除，不同范围互不匹配"""
+    index = VectorIndex(dimensions=2, capacity=2)
+
+    def entry(body: bytes, ttl: float = 60.0) -> CacheEntry:
+        return CacheEntry(body, "application/json", "json", 0.0, ttl)
+
+    index.add([1.0, 0.0], "s", entry(b"a"))
+    index.add([0.0, 1.0], "s", entry(b"b"))
+    slot, similarity = index.search([1.0, 0.0], "s")
+    assert index.get(slot, now=1.0).body == b"a" and similarity == 1.0
+    assert index.search([1.0, 0.0], "other") is None
+
+    # b最久未使用，被淘汰
+    index.add([0.6, 0.8], "s", entry(b"c", ttl=5.0))
+    assert len(index) == 2
+    assert sorted(index.entries[slot][1].body for slot in index.entries) == [b"a", b"c"]
+    slot, _ = index.search([0.0, 1.0], "s")
+    assert index.get(slot, now=10.0) is None
+    assert len(index) == 1
+
+
+def test_semantic_hit_and_miss():
+    """相似度不低于阈值时命中，非流式响应写入缓存，流式响应和不确定性请求不使用缓存"""
+    async def run():
+        cache = SemanticCache()
+        config = model_config()
+        assert cache.eligible(config, URI, chat("How do I reset my password?"))
+        assert not cache.eligible(config, URI, chat("hi", temperature=0.7))
+        assert not cache.eligible(config, "/v1/completions", chat("hi"))
+        assert not cache.eligible(ModelConfig.from_model_name("m"), URI, chat("hi"))
+
+        hits_before = SEMANTIC_CACHE_REQUESTS.value("semantic-model", "hit")
+        query = await cache.query(URI, config, chat("How do I reset my password?"))
+        assert cache.lookup(config, query) is None
+        await cache.recorder(config, query)(b'{"answer": 1}', "application/json")
+        await cache.recorder(config, query)(b"data: [DONE]\n\n", "text/event-stream", stream=True)
+
+        similar = await cache.query(URI, config, chat("how do i reset my password"))
+        entry, similarity = cache.lookup(config, similar)
+        assert entry.body == b'{"answer": 1}' and similarity > 0.9
+        assert SEMANTIC_CACHE_REQUESTS.value("semantic-model", "hit") == hits_before + 1
+        assert cache.lookup(config, await cache.query(URI, config, chat("Where is my invoice?"))) is None
+        # 系统提示不同时不命中
+        assert cache.lookup(config, await cache.query(URI, config, chat("How do I reset my password?",
+                                                                          system="Be terse."))) is None
+        assert cache.stats() == {"semantic-model": {"entries": 1, "capacity": 4096}}
+
+    asyncio.run(run())
+
+
+def test_embedding_model():
+    """配置了embedding模型时调用注入的embed函数，调用失败时不使用语义缓存"""
+    async def run():
+        calls = []
+
+        async def embed(model_name, text):
+            calls.append((model_name, text))
+            if text == "fail":
+                raise ConnectionError("embedding model unavailable")
+            return [1.0, float(len(text))]
+
+        cache = SemanticCache(embed=embed)
+        config = model_config(embedding_model="embedding-model")
+        query = await cache.query(URI, config, chat("abc"))
+        assert calls == [("embedding-model", "abc")]
+        assert len(query.vector) == 2
+
+        errors_before = SEMANTIC_CACHE_REQUESTS.value("semantic-model", "error")
+        assert await cache.query(URI, config, chat("fail")) is None
+        assert SEMANTIC_CACHE_REQUESTS.value("semantic-model", "error") == errors_before + 1
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试语义缓存...\n")
+    for test in (test_local_embedding_and_scope, test_vector_index_eviction, test_semantic_hit_and_miss,
+                 test_embedding_model):
+        test()
+        print(f"✅ {test.__doc__}")
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+测试流式透传
+"""
+
+import asyncio
+import time
+from aiohttp import web
+
+from config import ModelConfig
+from metrics import STREAM_TTFT, STREAM_INTER_TOKEN
+from streaming import UpstreamStreamingResponse
+from upstream import UpstreamClientManager
+
+
+CHUNKS = [b'data: {"n": %d}\n\n' % i for i in range(5)]
+
+
+async def start_sse_server(state: dict):
+    """启动本地SSE上游桩服务，每个分片间隔10ms"""
+    async def handler(request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        try:
+            for chunk in CHUNKS:
+                await response.write(chunk)
+                await asyncio.sleep(0.01)
+            state["completed"] = True
+        except (asyncio.CancelledError, ConnectionResetError):
+            state["cancelled"] = True
+            raise
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", handler)
+    runner = web.AppRunner(app, handler_cancellation=True)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/v1/chat/completions"
+
+
+def asgi_scope():
+    return {"type": "http", "asgi": {"spec_version": "2.4"}, "method": "POST",
+            "path": "/v1/chat/completions", "headers": []}
+
+
+def test_stream_passthrough():
+    """上游分片原样转发，结束后连接归还连接池并记录TTFT"""
+    async def run():
+        state = {}
+        runner, url = await start_sse_server(state)
+        manager = UpstreamClientManager()
+        model_config = ModelConfig.from_model_name("stream-model")
+        ttft_before = STREAM_TTFT.count("stream-model")
+        try:
+            upstream = await manager.session(model_config).post(url, json={"stream": True})
+            response = UpstreamStreamingResponse(upstream, "stream-model", time.perf_counter())
+            assert response.media_type == "text/event-stream"
+
+            messages = []
+
+            async def receive():
+                await asyncio.sleep(10)
+
+            async def send(message):
+                messages.append(message)
+
+            await response(asgi_scope(), receive, send)
+
+            body = b"".join(m.get("body", b"") for m in messages if m["type"] == "http.response.body")
+            assert body == b"".join(CHUNKS)
+            assert state.get("completed")
+            assert STREAM_TTFT.count("stream-model") == ttft_before + 1
+            assert STREAM_INTER_TOKEN.count("stream-model") >= 1
+            assert manager.stats()["stream-model"]["idle"] == 1
+        finally:
+            await manager.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_client_disconnect_cancels_upstream():
+    """客户端断开后关闭上游连接，上游处理被取消"""
+    async def run():
+        state = {}
+        runner, url = await start_sse_server(state)
+        manager = UpstreamClientManager()
+        model_config = ModelConfig.from_model_name("stream-model")
+        try:
+            upstream = await manager.session(model_config).post(url, json={"stream": True})
+            response = UpstreamStreamingResponse(upstream, "stream-model", time.perf_counter())
+            sent_chunks = []
+
+            async def receive():
+                await asyncio.sleep(10)
+
+            async def send(message):
+                if message["type"] == "http.response.body" and message.get("body"):
+                    sent_chunks.append(message["body"])
+                    # 收到首个分片后模拟客户端断开
+                    raise OSError("client disconnected")
+
+            try:
+                await response(asgi_scope(), receive, send)
+            except Exception:
+                pass
+
+            assert len(sent_chunks) == 1
+            assert upstream.closed
+            for _ in range(50):
+                if state.get("cancelled"):
+                    break
+                await asyncio.sleep(0.01)
+            assert state.get("cancelled") and not state.get("completed")
+            assert manager.stats()["stream-model"]["idle"] == 0
+        finally:
+            await manager.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试流式透传...\n")
+    test_stream_passthrough()
+    print("✅ 流式透传测试通过")
+    test_client_disconnect_cancels_upstream()
+    print("✅ 客户端断开取消上游测试通过")
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+测试请求超时与客户端断开取消
+"""
+
+import asyncio
+import time
+
+from aiohttp import web
+from starlette.requests import Request
+
+from config import ModelConfig, TimeoutConfig
+from fake_upstream import FakeModel, create_fake_upstream
+from main import ClientDisconnected, cancel_on_disconnect
+from metrics import REQUESTS_ABORTED
+from streaming import UpstreamStreamingResponse
+from timeouts import StreamDeadlines, UpstreamTimeout, request_deadline, wait_until
+from upstream import UpstreamClientManager
+
+
+def test_config_and_request_deadline():
+    """total未配置时使用命令行默认值，X-Request-Timeout只能缩短截止时间"""
+    model_config = ModelConfig.from_dict({
+        "model_name": "m", "svc_name": "m", "svc_port": 9002, "api_key": "k",
+        "timeout": {"first_byte": 5, "total": 30},
+    })
+    assert model_config.timeout == TimeoutConfig(connect=10.0, first_byte=5.0, idle=60.0, total=30.0)
+    assert ModelConfig.from_model_name("m").timeout == TimeoutConfig()
+
+    config = model_config.timeout
+    assert request_deadline(config, None, 120, now=100.0) == 130.0
+    assert request_deadline(config, "5", 120, now=100.0) == 105.0
+    assert request_deadline(config, "60", 120, now=100.0) == 130.0
+    assert request_deadline(config, "abc", 120, now=100.0) == 130.0
+    assert request_deadline(TimeoutConfig(), None, 120, now=100.0) == 220.0
+    assert request_deadline(TimeoutConfig(), "5", 0, now=100.0) == 105.0
+    assert request_deadline(TimeoutConfig(), None, 0, now=100.0) is None
+
+
+def test_wait_until_phases():
+    """超时抛出带阶段的UpstreamTimeout；流式响应的首分片、分片间隔都不超过总截止时间"""
+    async def run():
+        loop = asyncio.get_running_loop()
+        assert await wait_until(asyncio.sleep(0, "ok"), loop.time() + 1, "first_byte") == "ok"
+        assert await wait_until(asyncio.sleep(0, "ok"), None, "first_byte") == "ok"
+        try:
+            await wait_until(asyncio.sleep(1), loop.time() + 0.01, "idle")
+            assert False, "应当超时"
+        except UpstreamTimeout as e:
+            assert e.phase == "idle"
+
+    asyncio.run(run())
+
+    deadlines = StreamDeadlines(TimeoutConfig(first_byte=5, idle=2), start=100.0, deadline=104.0)
+    assert deadlines.next_chunk(True, 100.0) == (104.0, "deadline")
+    assert deadlines.next_chunk(False, 101.0) == (103.0, "idle")
+    assert deadlines.next_chunk(False, 103.0) == (104.0, "deadline")
+    deadlines = StreamDeadlines(TimeoutConfig(first_byte=1, idle=0), start=100.0, deadline=None)
+    assert deadlines.next_chunk(True, 100.0) == (101.0, "first_byte")
+    assert deadlines.next_chunk(False, 150.0) == (None, "deadline")
+
+
+def test_stream_idle_timeout():
+    """流式响应分片间隔超时后发送error事件并关闭上游连接"""
+    async def run():
+        fake_model = FakeModel(latency=0.0, tokens_per_sec=5, completion_tokens=8)
+        runner = web.AppRunner(create_fake_upstream(fake_model))
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}/v1/chat/completions"
+        manager = UpstreamClientManager()
+        model_config = ModelConfig.from_model_name("timeout-model")
+        aborted_before = REQUESTS_ABORTED.value("timeout-model", "idle")
+        try:
+            loop = asyncio.get_running_loop()
+            upstream = await manager.session(model_config).post(url, json={"stream": True, "messages": []})
+            deadlines = StreamDeadlines(TimeoutConfig(idle=0.05), loop.time(), None)
+            response = UpstreamStreamingResponse(upstream, "timeout-model", time.perf_counter(), deadlines=deadlines)
+            messages = []
+
+            async def receive():
+                await asyncio.sleep(10)
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {"type": "http", "asgi": {"spec_version": "2.4"}, "method": "POST",
+                     "path": "/v1/chat/completions", "headers": []}
+            await response(scope, receive, send)
+
+            body = b"".join(m.get("body", b"") for m in messages if m["type"] == "http.response.body")
+            events = [event for event in body.decode().split("\n\n") if event]
+            assert len(events) == 2
+            assert '"code": 504' in events[-1] and "idle" in events[-1]
+            assert deadlines.timed_out == "idle"
+            assert upstream.closed
+            assert REQUESTS_ABORTED.value("timeout-model", "idle") == aborted_before + 1
+            for _ in range(50):
+                if fake_model.aborted:
+                    break
+                await asyncio.sleep(0.01)
+            assert fake_model.aborted == 1
+        finally:
+            await manager.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_cancel_on_disconnect():
+    """客户端在响应前断开时取消正在进行的上游请求"""
+    async def run():
+        messages = [{"type": "http.request", "body": b"{}", "more_body": False}]
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(0.02)
+            return {"type": "http.disconnect"}
+
+        request = Request({"type": "http", "method": "POST", "path": "/", "headers": []}, receive)
+        cancelled = []
+
+        async def forward():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        try:
+            await cancel_on_disconnect(request, forward())
+            assert False, "应当因客户端断开而取消"
+        except ClientDisconnected:
+            pass
+        await asyncio.sleep(0)
+        assert cancelled == [True]
+
+        # 客户端未断开时正常返回结果
+        messages.append({"type": "http.request", "body": b"{}", "more_body": False})
+        assert await cancel_on_disconnect(request, asyncio.sleep(0, "response")) == "response"
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试请求超时...\n")
+    for test in (test_config_and_request_deadline, test_wait_until_phases, test_stream_idle_timeout,
+                 test_cancel_on_disconnect):
+        test()
+        print(f"✅ {test.__doc__}")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+测试prompt token数估算
+"""
+
+import json
+
+from body import parse_request_body
+from tokens import estimate_bytes, estimate_prompt_tokens, prompt_texts, register_tokenizer
+
+
+def test_estimate_bytes():
+    """ASCII约4字节一个token，非ASCII约3字节一个token"""
+    assert estimate_bytes(b"") == 0
+    assert estimate_bytes(b"abcdefgh") == 2
+    assert estimate_bytes(b"abcdefghi") == 3
+    assert estimate_bytes("你好世界".encode("utf-8")) == 4
+    assert estimate_bytes("ab你好".encode("utf-8")) == 3
+
+
+def test_prompt_texts():
+    """提取messages中的文本（包括多模态消息的text部分）、prompt和input"""
+    data = {
+        "messages": [
+            {"role": "system", "content": "be brief"},
+            {"role": "user", "content": [{"type": "text", "text": "describe"},
+                                         {"type": "image_url", "image_url": {"url": "data:..."}}]},
+            "invalid",
+        ],
+        "prompt": ["a", 1, "b"],
+        "input": "c",
+    }
+    assert list(prompt_texts(data)) == ["be brief", "describe", "a", "b", "c"]
+
+
+def test_estimate_with_tokenizer():
+    """配置分词器时对文本分词并加上消息格式开销，分词器不可用时按字节估算"""
+    register_tokenizer("whitespace", lambda text: len(text.split()))
+    body = parse_request_body(b'{"model": "m", "max_tokens": 16, "messages": ['
+                              b'{"role": "system", "content": "be brief"},'
+                              b'{"role": "user", "content": "one two three"}]}')
+    assert body.max_tokens == 16
+    assert estimate_prompt_tokens(body, "whitespace") == 2 + 3 + 4 * 2 + 3
+    assert estimate_prompt_tokens(body) == estimate_bytes(body.raw)
+    assert estimate_prompt_tokens(body, "no-such-tokenizer") == estimate_bytes(body.raw)
+
+
+def test_estimate_text_only():
+    """未配置分词器时只按文本估算：转义的中文按解码后的文本计算，图片不计入"""
+    text = "你好" * 4000
+    escaped = parse_request_body(json.dumps({"model": "m", "messages": [{"role": "user", "content": text}]}).encode())
+    assert b"\\u4f60" in escaped.raw
+    assert estimate_prompt_tokens(escaped, parse=True) == 8000 + 4 + 3
+    # 不解析时按整个请求体估算，\uXXXX转义被多算
+    assert estimate_prompt_tokens(escaped) > 12000
+
+    image = "data:image/png;base64," + "A" * 200000
+    vision = parse_request_body(json.dumps({"model": "m", "messages": [{"role": "user", "content": [
+        {"type": "text", "text": "describe this"},
+        {"type": "image_url", "image_url": {"url": image}},
+    ]}]}).encode())
+    assert estimate_prompt_tokens(vision, parse=True) == 4 + 4 + 3
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试token数估算...\n")
+    for test in (test_estimate_bytes, test_prompt_texts, test_estimate_with_tokenizer, test_estimate_text_only):
+        test()
+        print(f"✅ {test.__doc__}")
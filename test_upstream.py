@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+测试上游连接池管理
+"""
+
+import asyncio
+from aiohttp import web
+
+from config import ModelConfig, PoolConfig
+from upstream import UpstreamClientManager
+
+
+async def start_stub_server():
+    """启动本地上游桩服务，返回(runner, base_url)"""
+    async def handler(request):
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def test_session_reused_per_model():
+    """同一模型复用同一个Session，不同模型使用独立连接池"""
+    async def run():
+        manager = UpstreamClientManager()
+        model_a = ModelConfig.from_model_name("model-a")
+        model_b = ModelConfig.from_model_name("model-b")
+        model_b.pool = PoolConfig(limit=7, limit_per_host=3)
+
+        session_a = manager.session(model_a)
+        assert manager.session(model_a) is session_a
+        session_b = manager.session(model_b)
+        assert session_b is not session_a
+        assert session_b.connector.limit == 7
+        assert session_b.connector.limit_per_host == 3
+
+        await manager.close()
+        assert session_a.closed and session_b.closed
+        assert manager.stats() == {}
+
+    asyncio.run(run())
+
+
+def test_pool_stats_keepalive():
+    """请求结束后连接回到空闲池，并被后续请求复用"""
+    async def run():
+        runner, base_url = await start_stub_server()
+        manager = UpstreamClientManager()
+        model_config = ModelConfig.from_model_name("model-a")
+        try:
+            for _ in range(3):
+                session = manager.session(model_config)
+                async with session.post(f"{base_url}/v1/chat/completions", json={}) as response:
+                    assert response.status == 200
+                    await response.read()
+
+            stats = manager.stats()["model-a"]
+            assert stats["in_use"] == 0
+            assert stats["idle"] == 1
+            assert stats["waiters"] == 0
+        finally:
+            await manager.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试上游连接池...\n")
+    test_session_reused_per_model()
+    print("✅ Session复用测试通过")
+    test_pool_stats_keepalive()
+    print("✅ 连接池状态测试通过")
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+测试用量记录
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+
+from starlette.responses import Response
+
+from config import ModelConfig, init_config
+from metrics import USAGE_EVENTS
+from middleware import UsageMiddleware
+from usage import (JsonlSink, SqliteSink, UsageEvent, UsagePipeline, UsageRollups, UsageSink, create_sink,
+                   init_usage_pipeline, key_id, query_rollups)
+
+T0 = 1_700_000_040.0  # 整分钟
+
+
+def event(offset: float = 0.0, key: str = "k1", model: str = "m", status: int = 200, prompt: int = 10,
+          completion: int = 5, latency: float = 100.0) -> UsageEvent:
+    return UsageEvent(T0 + offset, key, model, status, latency, prompt_tokens=prompt, completion_tokens=completion)
+
+
+class FlakySink(UsageSink):
+    """前failures次写入失败的sink"""
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.batches = []
+
+    async def write(self, events):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("collector unavailable")
+        self.batches.append([e.request_id for e in events])
+
+
+def test_rollups_and_query():
+    """按调用方、分钟、模型汇总，查询时按时间范围、模型和步长合并，超过保留时间的分钟被删除"""
+    rollups = UsageRollups(retention_minutes=10)
+    rollups.add(event(0))
+    rollups.add(event(30, status=500, latency=300.0))
+    rollups.add(event(60, model="other", prompt=1, completion=1))
+    rollups.add(event(120))
+    rollups.add(event(0, key="k2", prompt=1000))
+
+    result = query_rollups([rollups.dump()], "k1", T0, T0 + 180)
+    assert [(row["start"] - T0, row["model"], row["requests"]) for row in result["usage"]] == \
+        [(0, "m", 2), (60, "other", 1), (120, "m", 1)]
+    first = result["usage"][0]
+    assert first["errors"] == 1 and first["prompt_tokens"] == 20 and first["latency_ms"] == 200.0
+    assert result["totals"]["requests"] == 4 and result["totals"]["prompt_tokens"] == 31
+
+    hourly = query_rollups([rollups.dump()], "k1", T0, T0 + 180, model="m", step_minutes=60)
+    assert [(row["model"], row["requests"], row["completion_tokens"]) for row in hourly["usage"]] == [("m", 3, 15)]
+    assert query_rollups([rollups.dump()], "k1", T0 + 60, T0 + 120)["totals"]["requests"] == 1
+    # 两个worker的快照相加
+    assert query_rollups([rollups.dump(), rollups.dump()], "k2", T0, T0 + 60)["totals"]["prompt_tokens"] == 2000
+
+    rollups.add(event(11 * 60))
+    assert query_rollups([rollups.dump()], "k1", T0, T0 + 60)["totals"]["requests"] == 0
+    assert "k2" not in rollups.buckets
+
+
+def test_pipeline_batches_to_sinks():
+    """record()只写入内存缓冲区，后台任务按批写入JSONL和SQLite"""
+    async def run():
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "usage.jsonl")
+            pipeline = UsagePipeline(create_sink(f"jsonl:{path}"), batch_size=4, flush_interval=60)
+            pipeline.start()
+            for i in range(10):
+                pipeline.record(event(i))
+            assert not os.path.exists(path) and len(pipeline.buffer) == 10
+            # 积累batch_size条后唤醒后台任务
+            await asyncio.sleep(0.1)
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+            assert len(lines) == 10 and len(pipeline.buffer) == 0
+            assert lines[0]["key"] == "k1" and lines[0]["prompt_tokens"] == 10
+            await pipeline.close()
+
+            db = os.path.join(directory, "usage.db")
+            pipeline = UsagePipeline(create_sink(f"sqlite:{db}"), batch_size=2)
+            assert isinstance(pipeline.sink, SqliteSink)
+            for i in range(3):
+                pipeline.record(event(i, status=200 + i))
+            await pipeline.close()
+            with sqlite3.connect(db) as connection:
+                rows = connection.execute("SELECT status, prompt_tokens FROM usage ORDER BY status").fetchall()
+            assert rows == [(200, 10), (201, 10), (202, 10)]
+
+            # 旧版本创建的表补上coalesced列
+            old_db = os.path.join(directory, "old.db")
+            with sqlite3.connect(old_db) as connection:
+                connection.execute("CREATE TABLE usage (timestamp REAL, request_id TEXT, key TEXT, tenant TEXT, "
+                                   "model TEXT, path TEXT, status INTEGER, prompt_tokens INTEGER, "
+                                   "completion_tokens INTEGER, latency_ms REAL)")
+            connection.close()
+            sink = SqliteSink(old_db)
+            coalesced = event()
+            coalesced.coalesced = True
+            await sink.write([event(), coalesced])
+            await sink.close()
+            with sqlite3.connect(old_db) as connection:
+                rows = connection.execute("SELECT coalesced FROM usage").fetchall()
+            connection.close()
+            assert rows == [(0,), (1,)]
+
+        assert isinstance(create_sink("jsonl:/tmp/x"), JsonlSink) and create_sink(None) is None
+        try:
+            create_sink("kafka://broker")
+            assert False, "应当不支持该目标"
+        except ValueError:
+            pass
+
+    asyncio.run(run())
+
+
+def test_backpressure_and_retry():
+    """sink写入失败时记录保留在缓冲区稍后重试，缓冲区满时丢弃最旧的记录"""
+    async def run():
+        sink = FlakySink(failures=1)
+        pipeline = UsagePipeline(sink, capacity=5, batch_size=3)
+        dropped = USAGE_EVENTS.value("dropped")
+        for i in range(7):
+            e = event(i)
+            e.request_id = str(i)
+            pipeline.record(e)
+        assert USAGE_EVENTS.value("dropped") == dropped + 2
+        assert [e.request_id for e in pipeline.buffer] == ["2", "3", "4", "5", "6"]
+
+        assert not await pipeline.flush()
+        assert len(pipeline.buffer) == 5 and pipeline._retry_delay > 0
+        assert await pipeline.flush()
+        assert sink.batches == [["2", "3", "4"], ["5", "6"]]
+        assert pipeline._retry_delay == 0.0
+
+    asyncio.run(run())
+
+
+def test_middleware_records_usage():
+    """请求结束时记录调用方（token的哈希）、模型、上游用量和状态码，未通过模型验证的请求不记录"""
+    async def run():
+        init_config("config.json")
+        pipeline = init_usage_pipeline()
+
+        def app_with(usage, status=200):
+            async def app(scope, receive, send):
+                state = scope.setdefault("state", {})
+                state["model_config"] = ModelConfig.from_model_name("usage-model")
+                state["usage"] = usage
+                await Response(b"{}", status_code=status, media_type="application/json")(scope, receive, send)
+            return app
+
+        async def call(app, token="sk-secret"):
+            scope = {"type": "http", "method": "POST", "path": "/v1/chat/completions",
+                     "headers": [(b"authorization", f"Bearer {token}".encode())]}
+
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            async def send(message):
+                pass
+
+            await UsageMiddleware(app)(scope, receive, send)
+
+        await call(app_with({"prompt_tokens": 12, "completion_tokens": 34}))
+        await call(app_with(None, status=502))
+
+        async def unvalidated(scope, receive, send):
+            await Response(b"", status_code=401)(scope, receive, send)
+        await call(unvalidated, token="other")
+
+        assert "sk-secret" not in json.dumps(pipeline.rollups.dump())
+        result = await pipeline.query(key_id("sk-secret"), T0, 2 * T0)
+        assert result["totals"]["requests"] == 2 and result["totals"]["errors"] == 1
+        assert result["totals"]["prompt_tokens"] == 12 and result["totals"]["completion_tokens"] == 34
+        assert list(pipeline.rollups.buckets) == [key_id("sk-secret")]
+
+    asyncio.run(run())
+
+
+def test_worker_snapshots_merged():
+    """多worker时各worker的分钟汇总写入共享目录，查询时合并"""
+    async def run():
+        with tempfile.TemporaryDirectory() as directory:
+            first = UsagePipeline(snapshot_dir=directory)
+            second = UsagePipeline(snapshot_dir=directory)
+            second.pid = first.pid + 1
+            first.record(event(0))
+            second.record(event(0, prompt=100))
+            await second.close()
+            result = await first.query("k1", T0, T0 + 60)
+            assert result["totals"]["requests"] == 2 and result["totals"]["prompt_tokens"] == 110
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试用量记录...\n")
+    for test in (test_rollups_and_query, test_pipeline_batches_to_sinks, test_backpressure_and_retry,
+                 test_middleware_records_usage, test_worker_snapshots_merged):
+        test()
+        print(f"✅ {test.__doc__}")
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+测试多worker运行模式
+"""
+
+import os
+import tempfile
+
+from fastapi.testclient import TestClient
+
+from args import apply_worker_defaults, parse_args
+from metrics import clear_metrics_dir
+
+BASE_ARGS = ["--auth-url", "http://auth", "--base-url", "http://base"]
+
+
+def test_worker_defaults():
+    """多worker时限流改用共享内存、指标写入汇总目录、日志改由外部轮转，显式配置不受影响"""
+    single = apply_worker_defaults(parse_args(BASE_ARGS))
+    assert single.rate_limit_backend == "memory" and single.metrics_dir is None
+    assert single.log_max_bytes > 0
+
+    multi = apply_worker_defaults(parse_args(BASE_ARGS + ["--workers", "4", "--port", "9000"]))
+    assert multi.rate_limit_backend == "shm"
+    assert multi.metrics_dir.endswith("maas_gateway_metrics_9000")
+    assert multi.log_max_bytes == 0
+
+    explicit = apply_worker_defaults(parse_args(
+        BASE_ARGS + ["--workers", "4", "--rate-limit-backend", "redis", "--metrics-dir", "/data/metrics"]))
+    assert explicit.rate_limit_backend == "redis" and explicit.metrics_dir == "/data/metrics"
+
+
+def test_clear_metrics_dir():
+    """启动worker前删除上一次运行留下的指标快照"""
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("123.json", "456.json.tmp", "keep.txt"):
+            open(os.path.join(tmp, name), "w").close()
+        clear_metrics_dir(tmp)
+        assert os.listdir(tmp) == ["keep.txt"]
+
+
+def test_create_app_factory():
+    """应用工厂按传入的参数创建应用，导入main模块时不解析命令行参数"""
+    import config
+    import main
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = main.create_app(BASE_ARGS + ["--log-file", os.path.join(tmp, "gateway.log"),
+                                           "--config-reload-interval", "0"])
+        assert main.args.workers == 1
+        with TestClient(app) as client:
+            assert client.get("/health").json()["status"] == "healthy"
+            assert "maas_gateway_requests_total" in client.get("/metrics").text
+    config.server_config = None
+
+
+if __name__ == "__main__":
+    print("🚀 开始测试多worker运行模式...\n")
+    for test in (test_worker_defaults, test_clear_metrics_dir, test_create_app_factory):
+        test()
+        print(f"✅ {test.__doc__}")
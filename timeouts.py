@@ -0,0 +1,92 @@
+import asyncio
+from typing import Awaitable, Optional, Tuple, TypeVar
+
+import aiohttp
+
+from config import TimeoutConfig
+
+T = TypeVar("T")
+
+# 客户端指定本次请求最长处理时间（秒）的请求头，只能缩短模型配置的total
+REQUEST_TIMEOUT_HEADER = "x-request-timeout"
+
+
+class UpstreamTimeout(asyncio.TimeoutError):
+    """上游请求超时，phase为first_byte（首字节）、idle（分片间隔）或deadline（请求总时长）"""
+
+    def __init__(self, phase: str):
+        super().__init__(f"Upstream {phase} timeout")
+        self.phase = phase
+
+
+async def wait_until(awaitable: Awaitable[T], when: Optional[float], phase: str) -> T:
+    """
+    在loop时间when之前等待awaitable完成，超时抛出UpstreamTimeout(phase)
+
+    awaitable内部抛出的其他超时异常（如aiohttp的连接超时）原样抛出。
+    """
+    if when is None:
+        return await awaitable
+    timeout = asyncio.timeout_at(when)
+    try:
+        async with timeout:
+            return await awaitable
+    except TimeoutError:
+        if timeout.expired():
+            raise UpstreamTimeout(phase) from None
+        raise
+
+
+def request_deadline(config: TimeoutConfig, client_timeout: Optional[str], default_total: float,
+                     now: float) -> Optional[float]:
+    """
+    请求的截止时间（loop时间），None表示不限制
+
+    取模型配置的total（未配置时为命令行 --timeout）与客户端 X-Request-Timeout 中较小的一个。
+    """
+    total = config.total or default_total
+    if client_timeout:
+        try:
+            requested = float(client_timeout)
+        except ValueError:
+            requested = 0.0
+        if requested > 0:
+            total = min(total, requested) if total > 0 else requested
+    return now + total if total > 0 else None
+
+
+def client_timeout(config: TimeoutConfig) -> aiohttp.ClientTimeout:
+    """单次上游请求的aiohttp超时：只限制建立连接（包括等待连接池空闲连接）的时间"""
+    return aiohttp.ClientTimeout(total=None, connect=config.connect or None)
+
+
+def first_byte_deadline(config: TimeoutConfig, start: float, deadline: Optional[float]) -> Tuple[Optional[float], str]:
+    """从start（loop时间）开始等待首个响应字节的截止时间及对应的超时阶段"""
+    if config.first_byte > 0 and (deadline is None or start + config.first_byte < deadline):
+        return start + config.first_byte, "first_byte"
+    return deadline, "deadline"
+
+
+class StreamDeadlines:
+    """
+    流式响应的超时设置（loop时间）
+
+    首个分片在first_byte_at之前到达，之后相邻分片间隔不超过idle秒，整个流在deadline之前结束；
+    timed_out为实际触发的超时阶段，由relay_stream设置。
+    """
+
+    __slots__ = ("first_byte_at", "first_byte_phase", "idle", "deadline", "timed_out")
+
+    def __init__(self, config: TimeoutConfig, start: float, deadline: Optional[float]):
+        self.first_byte_at, self.first_byte_phase = first_byte_deadline(config, start, deadline)
+        self.idle = config.idle
+        self.deadline = deadline
+        self.timed_out: Optional[str] = None
+
+    def next_chunk(self, first: bool, now: float) -> Tuple[Optional[float], str]:
+        """下一个分片的截止时间及对应的超时阶段"""
+        if first:
+            return self.first_byte_at, self.first_byte_phase
+        if self.idle > 0 and (self.deadline is None or now + self.idle < self.deadline):
+            return now + self.idle, "idle"
+        return self.deadline, "deadline"
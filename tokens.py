@@ -0,0 +1,107 @@
+import functools
+from typing import Callable, Dict, Iterator, Optional
+
+from body import RequestBody
+from log import logger
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken为可选依赖，未安装时按字节估算
+    tiktoken = None
+
+# 按字节估算：ASCII（英文、代码、JSON结构）约4字节一个token，
+# 非ASCII（中文在UTF-8中每字3字节，约1个token）约3字节一个token
+ASCII_BYTES_PER_TOKEN = 4
+NON_ASCII_BYTES_PER_TOKEN = 3
+# 按分词器计数时每条消息的格式开销（角色、分隔符）及回复前缀
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+
+_ASCII = bytes(range(128))
+
+# 自定义分词器：名称 -> 文本token计数函数
+_TOKENIZERS: Dict[str, Callable[[str], int]] = {}
+
+
+def register_tokenizer(name: str, count: Callable[[str], int]):
+    """注册自定义分词器，模型配置 "tokenizer" 为该名称时使用"""
+    _TOKENIZERS[name] = count
+    _counter.cache_clear()
+
+
+def estimate_bytes(raw: bytes) -> int:
+    """按请求体字节数估算token数，不解析JSON"""
+    if raw.isascii():
+        return -(-len(raw) // ASCII_BYTES_PER_TOKEN)
+    non_ascii = len(raw.translate(None, _ASCII))
+    ascii_bytes = len(raw) - non_ascii
+    return -(-ascii_bytes // ASCII_BYTES_PER_TOKEN) + -(-non_ascii // NON_ASCII_BYTES_PER_TOKEN)
+
+
+def _estimate_text(text: str) -> int:
+    """按UTF-8字节数估算一段文本的token数"""
+    return estimate_bytes(text.encode("utf-8"))
+
+
+@functools.lru_cache(maxsize=None)
+def _counter(name: str) -> Optional[Callable[[str], int]]:
+    """分词器名称对应的计数函数，词表只在首次使用时加载；不可用时返回None"""
+    if name in _TOKENIZERS:
+        return _TOKENIZERS[name]
+    if tiktoken is None:
+        logger.warning(f"未安装tiktoken，分词器 '{name}' 不可用，按字节估算token数")
+        return None
+    try:
+        encoding = tiktoken.get_encoding(name)
+    except (KeyError, ValueError) as e:
+        logger.warning(f"分词器 '{name}' 加载失败，按字节估算token数: {e}")
+        return None
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def prompt_texts(data: dict) -> Iterator[str]:
+    """请求体中会进入模型的文本：messages的content、prompt和input"""
+    messages = data.get("messages")
+    if isinstance(messages, list):
+        for message in messages:
+            if not isinstance(message, dict):
+                continue
+            content = message.get("content")
+            if isinstance(content, str):
+                yield content
+            elif isinstance(content, list):
+                for part in content:
+                    if isinstance(part, dict) and isinstance(part.get("text"), str):
+                        yield part["text"]
+    for key in ("prompt", "input"):
+        value = data.get(key)
+        if isinstance(value, str):
+            yield value
+        elif isinstance(value, list):
+            yield from (item for item in value if isinstance(item, str))
+
+
+def estimate_prompt_tokens(request_body: RequestBody, tokenizer: str = "", parse: bool = False) -> int:
+    """
+    估算请求的prompt token数
+
+    配置分词器时完整解析请求体并对文本分词；未配置（或分词器不可用）且parse为True时，
+    只对prompt_texts的文本按字节估算，JSON结构、转义和图片等非文本部分不计入。
+    parse为False时直接按整个请求体的字节数估算，不解析JSON：结果包含JSON结构、\\uXXXX转义
+    和base64图片，可能远高于实际值，只用于指标统计等不影响请求的场合。
+    """
+    count = _counter(tokenizer) if tokenizer else None
+    if count is None and not parse:
+        return estimate_bytes(request_body.raw)
+    try:
+        data = request_body.data
+    except ValueError:
+        # 嵌套值内部不合法时留给上游校验
+        return estimate_bytes(request_body.raw)
+    if count is None:
+        count = _estimate_text
+    messages = data.get("messages")
+    tokens = sum(count(text) for text in prompt_texts(data))
+    if isinstance(messages, list):
+        tokens += MESSAGE_OVERHEAD_TOKENS * len(messages) + REPLY_OVERHEAD_TOKENS
+    return tokens
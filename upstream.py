@@ -0,0 +1,139 @@
+import asyncio
+import time
+from typing import Dict, Mapping, Optional, Set
+import aiohttp
+
+from config import ModelConfig, PoolConfig
+from log import logger
+
+
+class UpstreamClientManager:
+    """
+    上游HTTP客户端管理器
+
+    在应用生命周期内为每个模型维护一个长期存在的ClientSession，
+    每个Session拥有独立的TCPConnector连接池，避免每次请求重新建立TCP/TLS连接。
+    """
+
+    def __init__(self):
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._pool_configs: Dict[str, PoolConfig] = {}
+        # 配置更新后等待在途请求结束再关闭的旧连接池
+        self._retiring: Set[asyncio.Task] = set()
+
+    def session(self, model_config: ModelConfig) -> aiohttp.ClientSession:
+        """获取模型对应的ClientSession，不存在时按模型的连接池配置创建"""
+        model_name = model_config.model_name
+        session = self._sessions.get(model_name)
+        if session is None or session.closed:
+            session = self._create_session(model_config.pool)
+            self._sessions[model_name] = session
+            self._pool_configs[model_name] = model_config.pool
+            logger.info(f"创建上游连接池: {model_name} {model_config.pool}")
+        return session
+
+    @staticmethod
+    def _create_session(pool: PoolConfig) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=pool.limit,
+            limit_per_host=pool.limit_per_host,
+            keepalive_timeout=pool.keepalive_timeout,
+            ttl_dns_cache=pool.ttl_dns_cache,
+        )
+        # 超时由调用方按请求控制，这里不设置Session级别的总超时
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None),
+        )
+
+    def sync(self, model_configs: Mapping[str, ModelConfig], grace: float = 300.0):
+        """
+        按新配置调整连接池
+
+        连接池配置未变的模型保留原连接池（已有的长连接不受影响）；模型被删除或连接池配置变化时，
+        后续请求使用新连接池，旧连接池在没有使用中的连接（或超过grace秒）后关闭。
+        """
+        for model_name in list(self._sessions):
+            model_config = model_configs.get(model_name)
+            if model_config is not None and model_config.pool == self._pool_configs[model_name]:
+                continue
+            session = self._sessions.pop(model_name)
+            self._pool_configs.pop(model_name)
+            if model_config is not None:
+                # 立即按新配置创建连接池，使用旧配置快照的在途请求也不会再按旧配置重建
+                self.session(model_config)
+            task = asyncio.create_task(self._close_when_idle(model_name, session, grace))
+            self._retiring.add(task)
+            task.add_done_callback(self._retiring.discard)
+
+    @staticmethod
+    async def _close_when_idle(model_name: str, session: aiohttp.ClientSession, grace: float):
+        deadline = time.monotonic() + grace
+        try:
+            while (session.connector is not None and _connector_stats(session.connector)["in_use"] > 0
+                   and time.monotonic() < deadline):
+                await asyncio.sleep(1.0)
+        finally:
+            await session.close()
+            logger.info(f"关闭旧的上游连接池: {model_name}")
+
+    async def close(self):
+        """关闭所有连接池"""
+        for task in list(self._retiring):
+            task.cancel()
+        await asyncio.gather(*self._retiring, return_exceptions=True)
+        for model_name, session in self._sessions.items():
+            if not session.closed:
+                await session.close()
+                logger.info(f"关闭上游连接池: {model_name}")
+        self._sessions.clear()
+        self._pool_configs.clear()
+
+    def stats(self) -> Dict[str, dict]:
+        """返回每个模型连接池的使用情况：使用中、空闲、等待连接的请求数"""
+        result = {}
+        for model_name, session in self._sessions.items():
+            connector = session.connector
+            if connector is None or session.closed:
+                continue
+            result[model_name] = {
+                "limit": connector.limit,
+                "limit_per_host": connector.limit_per_host,
+                **_connector_stats(connector),
+            }
+        return result
+
+
+def _connector_stats(connector: aiohttp.BaseConnector) -> Dict[str, int]:
+    """读取TCPConnector内部状态，aiohttp未提供公开接口，字段缺失时按0处理"""
+    acquired = getattr(connector, "_acquired", ())
+    conns = getattr(connector, "_conns", {})
+    waiters = getattr(connector, "_waiters", {})
+    return {
+        "in_use": len(acquired),
+        "idle": sum(len(c) for c in conns.values()),
+        "waiters": sum(len(w) for w in waiters.values()),
+    }
+
+
+upstream_client: Optional[UpstreamClientManager] = None
+
+
+def init_upstream_client() -> UpstreamClientManager:
+    global upstream_client
+    upstream_client = UpstreamClientManager()
+    return upstream_client
+
+
+def get_upstream_client() -> UpstreamClientManager:
+    global upstream_client
+    if upstream_client is None:
+        raise RuntimeError("上游客户端未初始化")
+    return upstream_client
+
+
+async def close_upstream_client():
+    global upstream_client
+    if upstream_client is not None:
+        await upstream_client.close()
+        upstream_client = None
@@ -0,0 +1,398 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+import aiohttp
+
+from body import json_dumps
+from log import logger
+from metrics import USAGE_EVENTS, USAGE_FLUSH_DURATION
+
+# 每分钟汇总的字段：请求数、失败数（状态码>=400）、prompt token、completion token、总耗时（毫秒）
+ROLLUP_FIELDS = ("requests", "errors", "prompt_tokens", "completion_tokens", "latency_ms")
+# 写入失败后的重试间隔上限（秒）
+MAX_RETRY_DELAY = 30.0
+
+
+def key_id(token: Optional[str]) -> str:
+    """
+    计费用的调用方标识：API token的SHA-256前16位（不在日志、文件中保存token本身），没有token时为anonymous
+    """
+    if not token:
+        return "anonymous"
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+
+class UsageEvent:
+    """一次请求的用量记录"""
+
+    __slots__ = ("timestamp", "request_id", "key", "tenant", "model", "path", "status",
+                 "prompt_tokens", "completion_tokens", "latency_ms", "coalesced")
+
+    def __init__(self, timestamp: float, key: str, model: str, status: int, latency_ms: float,
+                 prompt_tokens: int = 0, completion_tokens: int = 0, path: str = "",
+                 request_id: Optional[str] = None, tenant: Optional[str] = None, coalesced: bool = False):
+        self.timestamp = timestamp
+        self.request_id = request_id
+        self.key = key
+        self.tenant = tenant
+        self.model = model
+        self.path = path
+        self.status = status
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.latency_ms = latency_ms
+        self.coalesced = coalesced  # 请求合并的跟随者，用量来自共享的上游调用
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class UsageSink(ABC):
+    """
+    用量记录的持久化目标
+
+    write() 一次写入一批记录，失败时抛出异常，由UsagePipeline保留这批记录稍后重试。
+    """
+
+    @abstractmethod
+    async def write(self, events: List[UsageEvent]):
+        """写入一批记录"""
+
+    async def close(self):
+        pass
+
+
+class JsonlSink(UsageSink):
+    """追加写入本地JSONL文件，每批记录一次write，多个worker可以写同一个文件"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    async def write(self, events: List[UsageEvent]):
+        data = b"".join(json_dumps(event.to_dict()) + b"\n" for event in events)
+        await asyncio.to_thread(self._append, data)
+
+    def _append(self, data: bytes):
+        # O_APPEND保证多个进程的整批写入不会互相覆盖
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+
+class SqliteSink(UsageSink):
+    """写入本地SQLite数据库的usage表，每批记录一个事务"""
+
+    COLUMNS = UsageEvent.__slots__
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+
+    async def write(self, events: List[UsageEvent]):
+        rows = [tuple(getattr(event, name) for name in self.COLUMNS) for event in events]
+        await asyncio.to_thread(self._insert, rows)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # 只在写入线程中使用；多个worker写同一数据库时等待锁释放
+            connection = sqlite3.connect(self.path, timeout=10.0, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS usage (timestamp REAL, request_id TEXT, key TEXT, tenant TEXT, "
+                "model TEXT, path TEXT, status INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, "
+                "latency_ms REAL, coalesced INTEGER DEFAULT 0)")
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(usage)")}
+            if "coalesced" not in columns:
+                # 旧版本创建的表没有coalesced列
+                connection.execute("ALTER TABLE usage ADD COLUMN coalesced INTEGER DEFAULT 0")
+            connection.execute("CREATE INDEX IF NOT EXISTS usage_key_time ON usage (key, timestamp)")
+            self._connection = connection
+        return self._connection
+
+    def _insert(self, rows: List[tuple]):
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                f"INSERT INTO usage ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})", rows)
+
+    async def close(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            await asyncio.to_thread(connection.close)
+
+
+class HttpSink(UsageSink):
+    """以 {"events": [...]} 的JSON格式把每批记录POST给用量收集服务，非2xx响应视为失败"""
+
+    def __init__(self, url: str, timeout: float = 10.0):
+        self.url = url
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def write(self, events: List[UsageEvent]):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        async with self._session.post(self.url, json={"events": [event.to_dict() for event in events]}) as response:
+            if response.status >= 300:
+                raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                                  message=await response.text())
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def create_sink(target: Optional[str]) -> Optional[UsageSink]:
+    """
+    按 --usage-sink 创建持久化目标：jsonl:/path/usage.jsonl、sqlite:/path/usage.db、
+    http(s)://collector/usage；为空时只在内存中汇总
+    """
+    if not target:
+        return None
+    if target.startswith(("http://", "https://")):
+        return HttpSink(target)
+    scheme, _, path = target.partition(":")
+    if scheme == "jsonl" and path:
+        return JsonlSink(path)
+    if scheme == "sqlite" and path:
+        return SqliteSink(path)
+    raise ValueError(f"不支持的用量记录目标: {target}，可选 jsonl:<path>、sqlite:<path>、http(s)://<url>")
+
+
+class UsageRollups:
+    """
+    按调用方、分钟、模型预先汇总的用量，保留最近retention_minutes分钟
+
+    结构为 key -> {(分钟, 模型): [ROLLUP_FIELDS对应的累计值]}，按调用方查询时不需要扫描其他调用方。
+    """
+
+    def __init__(self, retention_minutes: int = 1440):
+        self.retention_minutes = retention_minutes
+        self.buckets: Dict[str, Dict[Tuple[int, str], List[float]]] = {}
+        self._pruned_minute = 0
+
+    def add(self, event: UsageEvent):
+        minute = int(event.timestamp // 60)
+        if minute > self._pruned_minute:
+            self._prune(minute)
+        counts = self.buckets.setdefault(event.key, {}).get((minute, event.model))
+        if counts is None:
+            counts = self.buckets[event.key][(minute, event.model)] = [0, 0, 0, 0, 0.0]
+        counts[0] += 1
+        counts[1] += event.status >= 400
+        counts[2] += event.prompt_tokens
+        counts[3] += event.completion_tokens
+        counts[4] += event.latency_ms
+
+    def _prune(self, minute: int):
+        """每分钟最多一次，删除超过保留时间的分钟"""
+        self._pruned_minute = minute
+        oldest = minute - self.retention_minutes
+        for key in list(self.buckets):
+            buckets = self.buckets[key]
+            for bucket in [bucket for bucket in buckets if bucket[0] <= oldest]:
+                del buckets[bucket]
+            if not buckets:
+                del self.buckets[key]
+
+    def dump(self) -> Dict[str, list]:
+        """可JSON序列化的快照：key -> [[分钟, 模型, 各字段累计值...], ...]"""
+        return {key: [[minute, model, *counts] for (minute, model), counts in buckets.items()]
+                for key, buckets in self.buckets.items()}
+
+
+def query_rollups(snapshots: Iterable[Dict[str, list]], key: str, since: float, until: float,
+                  model: Optional[str] = None, step_minutes: int = 1) -> dict:
+    """
+    合并各worker的汇总快照，返回调用方在 [since, until) 内按step_minutes分钟、模型分组的用量和合计
+    """
+    first, last = int(since // 60), int(until // 60)
+    merged: Dict[Tuple[int, str], List[float]] = {}
+    for snapshot in snapshots:
+        for minute, bucket_model, *counts in snapshot.get(key, ()):
+            if not first <= minute < last or (model is not None and bucket_model != model):
+                continue
+            start = minute - (minute - first) % step_minutes
+            total = merged.setdefault((start, bucket_model), [0, 0, 0, 0, 0.0])
+            for i, value in enumerate(counts):
+                total[i] += value
+    rows = []
+    totals = dict.fromkeys(ROLLUP_FIELDS, 0)
+    for (start, bucket_model), counts in sorted(merged.items()):
+        row = {"start": start * 60, "model": bucket_model, **dict(zip(ROLLUP_FIELDS, counts))}
+        for name in ROLLUP_FIELDS:
+            totals[name] += row[name]
+        row["latency_ms"] = round(row["latency_ms"] / row["requests"], 1) if row["requests"] else 0.0
+        rows.append(row)
+    totals["latency_ms"] = round(totals["latency_ms"] / totals["requests"], 1) if totals["requests"] else 0.0
+    return {"key": key, "since": first * 60, "until": last * 60, "step": step_minutes * 60,
+            "usage": rows, "totals": totals}
+
+
+class UsagePipeline:
+    """
+    用量记录管道
+
+    请求结束时record()只在内存中更新分钟汇总并把记录放入环形缓冲区，不做任何I/O；
+    后台任务每flush_interval秒（或缓冲区积累batch_size条时）把记录分批写入sink，
+    一次只有一批在写入。sink变慢或不可用时记录留在缓冲区中按指数退避重试，
+    缓冲区满后丢弃最旧的记录（计入 maas_gateway_usage_events_total{result="dropped"}），内存占用有上限。
+
+    snapshot_dir不为空时（多worker），分钟汇总定期写入该目录，/usage 查询合并所有worker的汇总。
+    """
+
+    def __init__(self, sink: Optional[UsageSink] = None, capacity: int = 100000, batch_size: int = 1000,
+                 flush_interval: float = 1.0, retention_minutes: int = 1440, snapshot_dir: Optional[str] = None):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer: Deque[UsageEvent] = deque(maxlen=capacity)
+        self.rollups = UsageRollups(retention_minutes)
+        self.snapshot_dir = snapshot_dir
+        self.pid = os.getpid()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._dirty = False
+        self._retry_delay = 0.0
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+
+    def start(self):
+        if self._task is None and (self.sink is not None or self.snapshot_dir):
+            self._task = asyncio.create_task(self._run())
+
+    def record(self, event: UsageEvent):
+        self.rollups.add(event)
+        self._dirty = True
+        if self.sink is None:
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            USAGE_EVENTS.inc("dropped")
+        self.buffer.append(event)
+        USAGE_EVENTS.inc("recorded")
+        if len(self.buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval + self._retry_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if self._dirty and self.snapshot_dir:
+                self._dirty = False
+                try:
+                    await asyncio.to_thread(self._write_snapshot, self.rollups.dump())
+                except OSError as e:
+                    logger.warning(f"写入用量汇总快照失败: {e}")
+
+    async def flush(self) -> bool:
+        """把缓冲区中的记录分批写入sink，写入失败时记录放回缓冲区并返回False"""
+        while self.buffer and self.sink is not None:
+            batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+            start = time.perf_counter()
+            try:
+                await self.sink.write(batch)
+            except Exception as e:
+                # 放回缓冲区头部（期间新增的记录排在后面），缓冲区已满时丢弃最旧的
+                room = self.buffer.maxlen - len(self.buffer)
+                if room < len(batch):
+                    USAGE_EVENTS.inc("dropped", amount=len(batch) - room)
+                self.buffer.extendleft(reversed(batch[len(batch) - room:] if room < len(batch) else batch))
+                USAGE_EVENTS.inc("failed", amount=len(batch))
+                self._retry_delay = min(MAX_RETRY_DELAY, max(self.flush_interval, self._retry_delay * 2))
+                logger.warning(f"写入用量记录失败，{self._retry_delay:.0f}秒后重试（缓冲{len(self.buffer)}条）: {e}")
+                return False
+            USAGE_FLUSH_DURATION.observe(time.perf_counter() - start)
+            USAGE_EVENTS.inc("written", amount=len(batch))
+            self._retry_delay = 0.0
+        return True
+
+    def _snapshot_path(self, pid: int) -> str:
+        return os.path.join(self.snapshot_dir, f"usage-{pid}.json")
+
+    def _write_snapshot(self, snapshot: Dict[str, list]):
+        path = self._snapshot_path(self.pid)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(tmp, path)
+
+    def _read_others(self) -> List[Dict[str, list]]:
+        # 已退出worker的汇总仍然有效（不同于gauge），全部合并
+        snapshots = []
+        for name in os.listdir(self.snapshot_dir):
+            if not (name.startswith("usage-") and name.endswith(".json")) or name == f"usage-{self.pid}.json":
+                continue
+            try:
+                with open(os.path.join(self.snapshot_dir, name), encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    async def query(self, key: str, since: float, until: float, model: Optional[str] = None,
+                    step_minutes: int = 1) -> dict:
+        snapshots = [self.rollups.dump()]
+        if self.snapshot_dir:
+            snapshots += await asyncio.to_thread(self._read_others)
+        return query_rollups(snapshots, key, since, until, model, step_minutes)
+
+    def stats(self) -> Dict[str, int]:
+        return {"buffered": len(self.buffer), "capacity": self.buffer.maxlen,
+                "keys": len(self.rollups.buckets)}
+
+    async def close(self, timeout: float = 5.0):
+        """停止后台任务，把缓冲区中剩余的记录写入sink（最多等待timeout秒）"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            async with asyncio.timeout(timeout):
+                await self.flush()
+        except asyncio.TimeoutError:
+            logger.warning(f"退出时写入用量记录超时，丢弃{len(self.buffer)}条")
+        if self.snapshot_dir:
+            try:
+                self._write_snapshot(self.rollups.dump())
+            except OSError:
+                pass
+        if self.sink is not None:
+            await self.sink.close()
+
+
+usage_pipeline: Optional[UsagePipeline] = None
+
+
+def init_usage_pipeline(**kwargs) -> UsagePipeline:
+    global usage_pipeline
+    usage_pipeline = UsagePipeline(**kwargs)
+    usage_pipeline.start()
+    return usage_pipeline
+
+
+def get_usage_pipeline() -> Optional[UsagePipeline]:
+    return usage_pipeline
+
+
+async def close_usage_pipeline():
+    global usage_pipeline
+    if usage_pipeline is not None:
+        await usage_pipeline.close()
+        usage_pipeline = None